@@ -1,180 +1,512 @@
-import os, sys, json
+import os, sys, json, time
 SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
 HOME_PATH = os.path.expanduser('~')
 INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
 BIOCONTAINERS_REGISTRY = 'public.ecr.aws/biocontainers'
 
+## Subsystems (boto3, pandas, yaml, requests) are imported inside the command handlers that need them,
+## so that e.g. "bioshed --help" or "bioshed search" does not pay for every subsystem at startup.
 sys.path.append(os.path.join(SCRIPT_DIR))
 import bioshed_core_utils
-import bioshed_init
-import bioshed_deploy_core
 sys.path.append(os.path.join(SCRIPT_DIR, 'bioshed_utils/'))
-import docker_utils
-import aws_batch_utils
-import quick_utils
 sys.path.append(os.path.join(SCRIPT_DIR, 'bioshed_atlas/'))
-import atlas_encode_utils
-import atlas_tcga_utils
 
 AWS_CONFIG_FILE = os.path.join(INIT_PATH,'aws_config_constants.json')
 GCP_CONFIG_FILE = ''
 PROVIDER_FILE = os.path.join(INIT_PATH, 'hs_providers.tf')
 MAIN_FILE = os.path.join(INIT_PATH, 'main.tf')
-SYSTEM_TYPE = bioshed_core_utils.detect_os()
-VALID_COMMANDS = ['init', 'setup', 'connect', 'build', 'run', 'runlocal', 'deploy', 'search', 'download', 'teardown', 'keygen']
+VALID_COMMANDS = ['init', 'setup', 'connect', 'build', 'run', 'runlocal', 'deploy', 'search', 'download', 'teardown', 'keygen', 'serve', 'jobs', 'wait', 'pipeline', 'images', 'cache', 'upload', 'index']
 VALID_PROVIDERS = ['aws', 'amazon', 'gcp', 'google']
 
 def bioshed_cli_entrypoint():
-    bioshed_cli_main( sys.argv )
-    return
+    # forward to a running "bioshed serve" process if there is one, otherwise run in-process
+    import bioshed_daemon
+    status = bioshed_daemon.forward_command( dict(argv=sys.argv))
+    if status is None:
+        status = exit_status( bioshed_cli_main( sys.argv ))
+    sys.exit(1 if status not in (None, 0) else 0)
+
+def exit_status( result ):
+    """ Exit status for a command handler's result - a non-zero status code (e.g., -1 on error) exits 1.
+    """
+    return 1 if type(result) == int and result != 0 else 0
 
 def bioshed_cli_main( args ):
     """ Main function for parsing command line arguments and running stuff.
+    Looks up the subcommand in the command registry (COMMANDS) and dispatches to its handler.
     args: list of command-line args
 
     [TODO] figure out local search
     [DONE] add docker installation to "pip install bioshed"
     """
-    ogargs = quick_utils.format_type(args, 'space-str')       # original arguments
-
-    if SYSTEM_TYPE == 'unsupported' or SYSTEM_TYPE == 'windows': # until I can support windows
+    system_type = bioshed_core_utils.detect_os_cached( dict(initpath=INIT_PATH))
+    if system_type == 'unsupported' or system_type == 'windows': # until I can support windows
         print('Unsupported system OS. Linux (Ubuntu, Debian, RedHat, AmazonLinux) or Mac OS X currently supported.\n')
-    elif len(args) > 1:
+    elif len(args) > 1 and args[1].strip() in COMMANDS:
         cmd = args[1].strip()
-        if cmd in ['run', 'runlocal'] and bioshed_init.userExists( dict(quick_utils.loadJSON(AWS_CONFIG_FILE)).get("login", "") ):
-            parseRunCommand( cmd, args )
-
-        elif cmd == 'build' and bioshed_init.userExists( dict(quick_utils.loadJSON(AWS_CONFIG_FILE)).get("login", "") ):
-            if len(args) < 3:
-                print('You must specify a module to build: bioshed build <MODULE> <ARGS>')
-                print('For help: "bioshed build --help"')
-                return
-            module = args[2].strip()
-            build_args = getCommandOptions(args[3:])
-            # parsed_args = bioshed_core_utils.parse_build_args( args[3:] )
-            if 'help' in build_args or 'install' not in build_args:
-                print_help_menu('build')
-            elif 'install' in build_args:
-                print('Building container for {}.'.format(str(module)))
-                if 'codebase' not in build_args:
-                    build_args['codebase'] = 'python'
-                docker_utils.build_container( dict(name=module, requirements=build_args['install'], codebase=build_args['codebase'] ))
-
-        elif cmd == 'connect' and bioshed_init.userExists( dict(quick_utils.loadJSON(AWS_CONFIG_FILE)).get("login", "") ):
-            if len(args) > 2:
-                cloud_provider = args[2].lower()
-                cmd_options = getCommandOptions( args[3:] )
-                if 'help' in cmd_options or 'h' in cmd_options:
-                    print_help_menu('connect')
-                    return
-                if cloud_provider in ['aws', 'amazon']:
-                    bioshed_connect_args = dict( cloud=cloud_provider, initpath=INIT_PATH, configfile=AWS_CONFIG_FILE, providerfile=PROVIDER_FILE, mainfile=MAIN_FILE)
-                    if 'keyfile' in cmd_options:
-                        bioshed_connect_args['apikeyfile'] = cmd_options['keyfile']
-                    bioshed_init.bioshed_connect(bioshed_connect_args)
-                else:
-                    print('Provider {} currently not supported.'.format(cloud_provider))
-            else:
-                print('Must specify a cloud provider - e.g., bioshed connect aws')
-
-        elif cmd == 'init':
-            optional_args = getCommandOptions(args[2:])
-            if 'help' in optional_args:
-                print_help_menu('init')
-                return
-            initialize_bioshed()
-
-        elif cmd == 'deploy' and bioshed_init.userExists( dict(quick_utils.loadJSON(AWS_CONFIG_FILE)).get("login", "") ):
-            if len(args) < 4 or '--help' in args:
-                print_help_menu('deploy')
-                return
-            # resource to deploy - e.g., core
-            deploy_resource = args[2]
-            provider = args[3]
-            deploy_option = quick_utils.format_type(args[4:], 'space-str') if len(args) > 4 else ''
-            bioshed_deploy_core.bioshed_deploy_core(dict(cloud_provider=provider, initpath=INIT_PATH, configfile=AWS_CONFIG_FILE, deployoption=deploy_option))
-
-        elif cmd == 'teardown' and bioshed_init.userExists( dict(quick_utils.loadJSON(AWS_CONFIG_FILE)).get("login", "") ):
-            if len(args) < 3:
-                print("Must specify a resource provider to teardown - e.g., bioshed teardown aws")
-                return
-            r = input('You are going to tear down your entire bioshed infrastructure. Are you sure? y/n: ') or "N"
-            # [TODO] have another credential-based check - ask for AWS credentials or some password
-            if r.upper() == "Y":
-                provider = args[2]
-                teardown_options = quick_utils.format_type(args[3:], 'space-str') if len(args) > 3 else ''
-                bioshed_init.bioshed_teardown( dict(initpath=INIT_PATH, cloud=provider, options=teardown_options))
-
-        elif cmd == 'search' and bioshed_init.userExists( dict(quick_utils.loadJSON(AWS_CONFIG_FILE)).get("login", "") ):
-            if len(args) < 3:
-                print_help_menu('search')
-                return
-            optional_args = getCommandOptions(args[3:])
-            if 'help' in optional_args:
-                print_help_menu('search')
-                return
-            elif str(args[2]).lower() == 'encode':
-                search_terms = str(' '.join(args[3:])).strip()
-                print('Searching ENCODE for: {}'.format(search_terms))
-                atlas_encode_utils.search_encode( dict(searchterms=search_terms))
-            elif str(args[2]).lower() in ['tcga', 'gdc']:
-                search_terms = str(' '.join(args[3:])).strip()
-                print('Searching Genomic Data Commons for: {}'.format(search_terms))
-                atlas_tcga_utils.search_gdc( dict(searchterms=search_terms))
-            elif str(args[2]).lower() == 'ncbi':
-                print('NCBI search coming soon!')
-            elif str(args[2]).lower() == 'local':
-                print('Local search coming soon!')
-            else:
-                print('Currently supported searches: encode, tcga, gdc. Coming soon: nbci, local')
-                
-        elif cmd == 'download' and bioshed_init.userExists( dict(quick_utils.loadJSON(AWS_CONFIG_FILE)).get("login", "") ):
-            if len(args) < 3:
-                print_help_menu('download')
-                return
-            optional_args = getCommandOptions(args[3:])
-            if 'help' in optional_args:
-                print_help_menu('search')
-                return
-            elif str(args[2]).lower() == 'encode':
-                atlas_encode_utils.download_encode( dict(downloadstr=str(' '.join(args[3:])).strip()))
-            elif str(args[2]).lower() in ['tcga', 'gdc']:
-                atlas_tcga_utils.download_gdc( dict(downloadstr=str(' '.join(args[3:])).strip()))
-            elif str(args[2]).lower() == 'ncbi':
-                print('NCBI download coming soon!')
-            elif str(args[2]).lower() == 'local':
-                print('Local download coming soon!')
-            else:
-                print('Currently supported downloads: encode, nbci, local')
-
-        elif cmd == 'keygen' and bioshed_init.userExists( dict(quick_utils.loadJSON(AWS_CONFIG_FILE)).get("login", "") ):
-            if len(args) < 3 or (len(args) >=3 and str(args[2]).lower() not in VALID_PROVIDERS):
-                print('Specify a valid cloud provider to generate an API key for.')
-                print('\tbioshed keygen aws')
-                print('\tbioshed keygen gcp')
-                return
-            if str(args[2]).lower() in ['aws', 'amazon']:
-                key_file = bioshed_init.generate_api_key( dict(cloud='aws', configfile=AWS_CONFIG_FILE))
-                print_key = bioshed_init.get_public_key( dict(configfile=AWS_CONFIG_FILE))
-                print(print_key)
-            elif str(args[2]).lower() in ['gcp', 'google']:
-                key_file = bioshed_init.generate_api_key( dict(cloud='gcp', configfile=GCP_CONFIG_FILE))
-                print_key = bioshed_init.get_public_key( dict(configfile=AWS_CONFIG_FILE))
-                print(print_key)
-
-        elif cmd in VALID_COMMANDS and not bioshed_init.userExists( dict(quick_utils.loadJSON(AWS_CONFIG_FILE)).get("login", "") ):
+        command = COMMANDS[cmd]
+        if command['login'] and not user_logged_in():
             print('Not logged on. Please type "bioshed init" and login first.')
-        else:
-            print_help_menu()
+            return
+        return command['handler']( cmd, args )
     else:
         print_help_menu()
     return
 
 
+def user_logged_in():
+    """ Checks (once per invocation) whether the user in the config file has a valid login session.
+    """
+    import bioshed_config
+    import bioshed_session
+    return bioshed_session.session_valid( dict(user=bioshed_config.get_config( dict(configfile=AWS_CONFIG_FILE, key='login'))))
+
+
+def parseBuildCommand( cmd, args ):
+    """ $ bioshed build <MODULE> --install <REQUIREMENTS> --codebase <CODEBASE>
+    """
+    import docker_utils
+    if len(args) < 3:
+        print('You must specify a module to build: bioshed build <MODULE> <ARGS>')
+        print('For help: "bioshed build --help"')
+        return
+    module = args[2].strip()
+    build_args = getCommandOptions(args[3:])
+    # parsed_args = bioshed_core_utils.parse_build_args( args[3:] )
+    if 'help' in build_args or 'install' not in build_args:
+        print_help_menu('build')
+    elif 'install' in build_args:
+        print('Building container for {}.'.format(str(module)))
+        if 'codebase' not in build_args:
+            build_args['codebase'] = 'python'
+        docker_utils.build_container( dict(name=module, requirements=build_args['install'], codebase=build_args['codebase'] ))
+    return
+
+
+def parseConnectCommand( cmd, args ):
+    """ $ bioshed connect <PROVIDER> --keyfile <KEYFILE>
+    """
+    import bioshed_init
+    if len(args) > 2:
+        cloud_provider = args[2].lower()
+        cmd_options = getCommandOptions( args[3:] )
+        if 'help' in cmd_options or 'h' in cmd_options:
+            print_help_menu('connect')
+            return
+        if cloud_provider in ['aws', 'amazon']:
+            bioshed_connect_args = dict( cloud=cloud_provider, initpath=INIT_PATH, configfile=AWS_CONFIG_FILE, providerfile=PROVIDER_FILE, mainfile=MAIN_FILE)
+            if 'keyfile' in cmd_options:
+                bioshed_connect_args['apikeyfile'] = cmd_options['keyfile']
+            bioshed_init.bioshed_connect(bioshed_connect_args)
+        else:
+            print('Provider {} currently not supported.'.format(cloud_provider))
+    else:
+        print('Must specify a cloud provider - e.g., bioshed connect aws')
+    return
+
+
+def parseInitCommand( cmd, args ):
+    """ $ bioshed init
+    """
+    optional_args = getCommandOptions(args[2:])
+    if 'help' in optional_args:
+        print_help_menu('init')
+        return
+    initialize_bioshed()
+    return
+
+
+def parseDeployCommand( cmd, args ):
+    """ $ bioshed deploy <RESOURCE> <PROVIDER> <OPTIONS>
+    """
+    import quick_utils
+    import bioshed_deploy_core
+    if len(args) < 4 or '--help' in args:
+        print_help_menu('deploy')
+        return
+    # resource to deploy - e.g., core
+    deploy_resource = args[2]
+    provider = args[3]
+    deploy_option = quick_utils.format_type(args[4:], 'space-str') if len(args) > 4 else ''
+    bioshed_deploy_core.bioshed_deploy_core(dict(cloud_provider=provider, initpath=INIT_PATH, configfile=AWS_CONFIG_FILE, deployoption=deploy_option))
+    return
+
+
+def parseTeardownCommand( cmd, args ):
+    """ $ bioshed teardown <PROVIDER> <OPTIONS>
+    """
+    import quick_utils
+    import bioshed_init
+    if len(args) < 3:
+        print("Must specify a resource provider to teardown - e.g., bioshed teardown aws")
+        return
+    r = input('You are going to tear down your entire bioshed infrastructure. Are you sure? y/n: ') or "N"
+    # [TODO] have another credential-based check - ask for AWS credentials or some password
+    if r.upper() == "Y":
+        provider = args[2]
+        teardown_options = quick_utils.format_type(args[3:], 'space-str') if len(args) > 3 else ''
+        bioshed_init.bioshed_teardown( dict(initpath=INIT_PATH, cloud=provider, options=teardown_options))
+    return
+
+
+def parseSearchCommand( cmd, args ):
+    """ $ bioshed search <SYSTEM> <SEARCH_TERMS> [--refresh]
+        Search responses are cached on disk (bioshed_httpcache) - --refresh skips cached responses.
+    """
+    if len(args) < 3:
+        print_help_menu('search')
+        return
+    optional_args = getCommandOptions(args[3:])
+    if 'help' in optional_args:
+        print_help_menu('search')
+        return
+    elif str(args[2]).lower() == 'encode':
+        import atlas_encode_utils
+        import bioshed_httpcache
+        import bioshed_vocab
+        bioshed_httpcache.install( dict(refresh='refresh' in optional_args))
+        bioshed_vocab.install({})       # --category terms resolved from the compiled vocabulary index
+        search_terms = str(' '.join(a for a in args[3:] if a != '--refresh')).strip()
+        print('Searching ENCODE for: {}'.format(search_terms))
+        results = atlas_encode_utils.search_encode( dict(searchterms=search_terms))
+        if hasattr(results, 'to_dict'):
+            # indexed results file used by "bioshed download encode" - search_encode.txt stays as the TSV export
+            import bioshed_encode
+            print('Indexed search results in {}.'.format(bioshed_encode.save_results( dict(results=results))))
+        bioshed_httpcache.print_report()
+    elif str(args[2]).lower() in ['tcga', 'gdc']:
+        import atlas_tcga_utils
+        import bioshed_httpcache
+        bioshed_httpcache.install( dict(refresh='refresh' in optional_args))
+        search_terms = str(' '.join(a for a in args[3:] if a != '--refresh')).strip()
+        print('Searching Genomic Data Commons for: {}'.format(search_terms))
+        atlas_tcga_utils.search_gdc( dict(searchterms=search_terms))
+        bioshed_httpcache.print_report()
+    elif str(args[2]).lower() == 'ncbi':
+        print('NCBI search coming soon!')
+    elif str(args[2]).lower() == 'local':
+        # answered from the dataset catalog built by "bioshed index" - no bucket listing
+        import bioshed_catalog
+        search_terms = ' '.join(a for a in args[3:] if not a.startswith('--') and a not in optional_args.values())
+        results = bioshed_catalog.search_catalog( dict(terms=search_terms, assay=optional_args.get('assay', ''), filetype=optional_args.get('filetype', ''),
+                                                       sample=optional_args.get('sample', ''), root=optional_args.get('location', ''),
+                                                       limit=optional_args.get('limit', '')))
+        bioshed_catalog.print_results( dict(results=results, limit=optional_args.get('limit', '')))
+    else:
+        print('Currently supported searches: encode, tcga, gdc, local. Coming soon: nbci')
+    return
+
+
+def parseDownloadCommand( cmd, args ):
+    """ $ bioshed download <SYSTEM> <OPTIONS>
+    """
+    if len(args) < 3:
+        print_help_menu('download')
+        return
+    optional_args = getCommandOptions(args[3:])
+    if 'help' in optional_args:
+        print_help_menu('search')
+        return
+    elif str(args[2]).lower() == 'encode':
+        # experiments are resolved concurrently and checkpointed (resumable)
+        import bioshed_encode
+        bioshed_encode.download_encode( dict(downloadstr=str(' '.join(args[3:])).strip()))
+    elif str(args[2]).lower() in ['tcga', 'gdc'] and 'manifest' in optional_args:
+        # parallel, resumable download of the files in a GDC manifest (or search output), md5-verified
+        import bioshed_gdc
+        token = ''
+        if optional_args.get('token-file', '') != '':
+            with open(optional_args['token-file'], 'r') as f:
+                token = f.read().strip()
+        try:
+            result = bioshed_gdc.download_manifest( dict(manifest=optional_args['manifest'], outdir=optional_args.get('output', ''), token=token,
+                                                         concurrency=optional_args.get('concurrency', ''), part_size=optional_args.get('part-size', '')))
+        except (OSError, ValueError) as e:
+            print('ERROR: {}'.format(str(e)))
+            return -1
+        return -1 if result['failed'] != [] else 0
+    elif str(args[2]).lower() in ['tcga', 'gdc']:
+        import atlas_tcga_utils
+        atlas_tcga_utils.download_gdc( dict(downloadstr=str(' '.join(args[3:])).strip()))
+    elif str(args[2]).lower() == 's3':
+        # parallel multipart download of an S3 object or prefix
+        import bioshed_transfer
+        positional = [a for a in args[3:] if not a.startswith('--') and a not in optional_args.values()]
+        if positional == []:
+            print('Specify an S3 object or folder - ex: bioshed download s3 s3://mybucket/fastqs/ ./fastqs/')
+            return
+        result = bioshed_transfer.download_s3( dict(src=positional[0], dest=positional[1] if len(positional) > 1 else '.',
+                                                    concurrency=optional_args.get('concurrency', ''), part_size=optional_args.get('part-size', '')))
+        return -1 if result['failed'] != [] else 0
+    elif str(args[2]).lower() == 'ncbi':
+        print('NCBI download coming soon!')
+    elif str(args[2]).lower() == 'local':
+        # copies the files matching a catalog search ("bioshed search local")
+        import bioshed_catalog
+        search_terms = ' '.join(a for a in args[3:] if not a.startswith('--') and a not in optional_args.values())
+        if 'output' not in optional_args or optional_args['output'] == '':
+            print('Specify where to copy the files - ex: bioshed download local rnaseq fastq --output ./fastqs/')
+            return
+        results = bioshed_catalog.search_catalog( dict(terms=search_terms, assay=optional_args.get('assay', ''), filetype=optional_args.get('filetype', ''),
+                                                       sample=optional_args.get('sample', ''), root=optional_args.get('location', ''),
+                                                       limit=optional_args.get('limit', '')))
+        print('Copying {} file(s) to {}'.format(len(results), optional_args['output']))
+        result = bioshed_catalog.download_results( dict(results=results, outdir=optional_args['output']))
+        return -1 if result['failed'] != [] else 0
+    else:
+        print('Currently supported downloads: encode, tcga, gdc, s3, local. Coming soon: ncbi')
+    return
+
+
+def parseUploadCommand( cmd, args ):
+    """ $ bioshed upload s3 <LOCAL_PATH> <S3_URI> [--concurrency <N>] [--part-size <MB>]
+    """
+    import bioshed_transfer
+    optional_args = getCommandOptions(args[3:])
+    positional = [a for a in args[3:] if not a.startswith('--') and a not in optional_args.values()]
+    if len(args) < 3 or 'help' in optional_args or str(args[2]).lower() != 's3' or len(positional) < 2:
+        print_help_menu('download')
+        return
+    result = bioshed_transfer.upload_s3( dict(src=positional[0], dest=positional[1],
+                                              concurrency=optional_args.get('concurrency', ''), part_size=optional_args.get('part-size', '')))
+    return -1 if result['failed'] != [] else 0
+
+
+def parseIndexCommand( cmd, args ):
+    """ $ bioshed index <LOCAL_DIR|S3_PREFIX> ... [--all-files] [--no-checksum]
+        $ bioshed index --refresh
+        $ bioshed index --list
+        $ bioshed index --remove <LOCAL_DIR|S3_PREFIX>
+    """
+    import bioshed_catalog
+    optional_args = getCommandOptions(args[2:])
+    locations = [a for a in args[2:] if not a.startswith('--') and a not in optional_args.values()]
+    if 'help' in optional_args or (locations == [] and not any(o in optional_args for o in ['refresh', 'list', 'remove'])):
+        print_help_menu('index')
+        return
+    if 'remove' in optional_args:
+        bioshed_catalog.remove_root( dict(root=optional_args['remove']))
+        print('Removed {} from the catalog.'.format(optional_args['remove']))
+        return
+    if 'list' in optional_args:
+        for root in bioshed_catalog.list_roots({}):
+            print('{}\t{} files\t{:.2f} GB\tindexed {}'.format(root['root'], root['files'], root['bytes'] / 1024**3,
+                  time.strftime('%Y-%m-%d %H:%M', time.localtime(root['indexed']))))
+        return
+    if 'refresh' in optional_args:
+        locations += [root['root'] for root in bioshed_catalog.list_roots({})]
+    failed = 0
+    for location in list(dict.fromkeys(locations)):
+        try:
+            bioshed_catalog.index_location( dict(location=location, checksum='no-checksum' not in optional_args, all_files='all-files' in optional_args))
+        except Exception as e:
+            print('ERROR: could not index {}: {}'.format(location, str(e)))
+            failed += 1
+    return -1 if failed > 0 else 0
+
+
+def parseKeygenCommand( cmd, args ):
+    """ $ bioshed keygen <PROVIDER>
+    """
+    import bioshed_init
+    if len(args) < 3 or (len(args) >=3 and str(args[2]).lower() not in VALID_PROVIDERS):
+        print('Specify a valid cloud provider to generate an API key for.')
+        print('\tbioshed keygen aws')
+        print('\tbioshed keygen gcp')
+        return
+    if str(args[2]).lower() in ['aws', 'amazon']:
+        key_file = bioshed_init.generate_api_key( dict(cloud='aws', configfile=AWS_CONFIG_FILE))
+        print_key = bioshed_init.get_public_key( dict(configfile=AWS_CONFIG_FILE))
+        print(print_key)
+    elif str(args[2]).lower() in ['gcp', 'google']:
+        key_file = bioshed_init.generate_api_key( dict(cloud='gcp', configfile=GCP_CONFIG_FILE))
+        print_key = bioshed_init.get_public_key( dict(configfile=AWS_CONFIG_FILE))
+        print(print_key)
+    return
+
+
+def parseServeCommand( cmd, args ):
+    """ $ bioshed serve          (run a persistent bioshed server in the foreground)
+        $ bioshed serve --stop   (stop a running server)
+    """
+    import bioshed_daemon
+    optional_args = getCommandOptions(args[2:])
+    if 'help' in optional_args:
+        print_help_menu('serve')
+    elif 'stop' in optional_args:
+        bioshed_daemon.stop_server({})
+    else:
+        bioshed_daemon.bioshed_serve({})
+    return
+
+
+def parseJobsCommand( cmd, args ):
+    """ $ bioshed jobs [--status <STATUS>] [--module <MODULE>] [--limit <N>] [--refresh]
+        Lists submitted jobs from the local job ledger. --refresh updates active jobs first (batched DescribeJobs).
+    """
+    import bioshed_jobs
+    optional_args = getCommandOptions(args[2:])
+    if 'help' in optional_args:
+        print_help_menu('jobs')
+        return
+    if 'refresh' in optional_args:
+        result = bioshed_jobs.refresh_jobs({})
+        print('Refreshed job status ({} API call(s)).'.format(result['api_calls']))
+    jobs = bioshed_jobs.list_jobs( dict(status=optional_args.get('status', ''), module=optional_args.get('module', ''),
+                                        limit=optional_args.get('limit', '50')))
+    bioshed_jobs.print_jobs( jobs )
+    return
+
+
+def parseWaitCommand( cmd, args ):
+    """ $ bioshed wait <JOBID> [<JOBID> ...]
+        $ bioshed wait --manifest <MANIFEST>   (jobs submitted with bioshed run --samplesheet)
+        $ bioshed wait --all                   (all active jobs in the job ledger)
+    """
+    import bioshed_jobs
+    optional_args = getCommandOptions(args[2:])
+    if 'help' in optional_args or len(args) < 3:
+        print_help_menu('jobs')
+        return
+    if 'manifest' in optional_args:
+        with open(optional_args['manifest'], 'r') as f:
+            jobids = [job['jobid'] for job in json.load(f)['jobs'] if job['jobid'] != '']
+    elif 'all' in optional_args:
+        jobids = [job['jobid'] for job in bioshed_jobs.list_jobs( dict(active=True))]
+    else:
+        jobids = [arg for arg in args[2:] if not arg.startswith('--')]
+    if jobids == []:
+        print('No jobs to wait on.')
+        return
+    summary = bioshed_jobs.wait_jobs( dict(jobids=jobids))
+    return -1 if summary.get('FAILED', 0) + summary.get('EXPIRED', 0) + summary.get('UNKNOWN', 0) > 0 else 0
+
+
+def parseImagesCommand( cmd, args ):
+    """ $ bioshed images prefetch [--tag <TAG>] [--registry <REGISTRY>]
+        $ bioshed images list
+        $ bioshed images clear
+    """
+    import bioshed_images
+    optional_args = getCommandOptions(args[3:])
+    if len(args) < 3 or 'help' in optional_args or args[2] not in ['prefetch', 'list', 'clear']:
+        print_help_menu('images')
+    elif args[2] == 'prefetch':
+        bioshed_images.prefetch_images( dict(tag=optional_args.get('tag', ''), registry=optional_args.get('registry', '')))
+    elif args[2] == 'list':
+        bioshed_images.print_image_cache({})
+    elif args[2] == 'clear':
+        bioshed_images.clear_image_cache({})
+    return
+
+
+def parseCacheCommand( cmd, args ):
+    """ $ bioshed cache stats
+        $ bioshed cache clear [--s3] [--runs] [--http] [--terraform]
+        $ bioshed cache evict [--max-gb <GB>]
+        $ bioshed cache terraform [--platform <PLATFORM> ...]
+    """
+    import bioshed_s3cache
+    import bioshed_runcache
+    import bioshed_httpcache
+    import bioshed_terraform
+    optional_args = getCommandOptions(args[3:])
+    if len(args) < 3 or 'help' in optional_args or args[2] not in ['stats', 'clear', 'evict', 'terraform']:
+        print_help_menu('cache')
+    elif args[2] == 'stats':
+        s3 = bioshed_s3cache.cache_stats({})
+        requests = s3['hits'] + s3['misses']
+        print('S3 object cache: {} objects, {:.2f} GB | {} hits, {} misses ({:.0f}% hit rate) | {:.2f} GB downloaded, {:.2f} GB served | {} evictions'.format(
+              s3['objects'], s3['bytes'] / 1024**3, s3['hits'], s3['misses'], 100.0 * s3['hits'] / requests if requests > 0 else 0,
+              s3['bytes_downloaded'] / 1024**3, s3['bytes_served'] / 1024**3, s3['evictions']))
+        runs = bioshed_runcache.cache_stats({})
+        print('Run cache: {} runs, {:.2f} GB of local outputs'.format(runs['runs'], runs['bytes'] / 1024**3))
+        http = bioshed_httpcache.cache_stats({})
+        print('HTTP response cache: {} responses, {:.1f} MB | {} fresh hits, {} revalidated, {} misses | {:.1f} MB served'.format(
+              http['responses'], http['bytes'] / 1024**2, http['fresh'], http['revalidated'], http['misses'], http['bytes_served'] / 1024**2))
+        tf = bioshed_terraform.cache_stats({})
+        print('Terraform providers ({}): plugin cache {:.1f} MB | offline mirror {} | provider lock file {}'.format(
+              tf['shared'], tf['plugins_bytes'] / 1024**2, '{:.1f} MB'.format(tf['mirror_bytes'] / 1024**2) if tf['mirror'] else 'not present',
+              'pinned' if tf['lockfile'] else 'not yet written'))
+    elif args[2] == 'clear':
+        which = [c for c in ['s3', 'runs', 'http', 'terraform'] if c in optional_args] or ['s3', 'runs', 'http']
+        if 's3' in which:
+            bioshed_s3cache.clear_cache({})
+            print('Cleared S3 object cache.')
+        if 'runs' in which:
+            bioshed_runcache.clear_cache({})
+            print('Cleared run cache.')
+        if 'http' in which:
+            bioshed_httpcache.clear_cache({})
+            print('Cleared HTTP response cache.')
+        if 'terraform' in which:
+            bioshed_terraform.clear_cache({})
+            print('Cleared terraform provider cache and mirror.')
+    elif args[2] == 'evict':
+        max_bytes = int(float(optional_args['max-gb']) * 1024**3) if 'max-gb' in optional_args else bioshed_s3cache.S3_CACHE_MAX_BYTES
+        print('Evicted {} S3 object(s).'.format(bioshed_s3cache.evict_objects( dict(max_bytes=max_bytes))))
+    elif args[2] == 'terraform':
+        # local provider mirror, so that terraform init runs offline (e.g., bake it into CI runner images)
+        platforms = [a.split('=', 1)[-1] for a in args[3:] if not a.startswith('--')]
+        if bioshed_terraform.mirror_providers( dict(initpath=INIT_PATH, platforms=platforms)) != 0:
+            print('ERROR: could not mirror terraform providers - run "bioshed connect aws" first.')
+            return -1
+        print('Mirrored terraform providers to {}.'.format(bioshed_terraform.shared_paths()['mirror']))
+    return
+
+
+def parsePipelineCommand( cmd, args ):
+    """ $ bioshed pipeline run <PIPELINE_YAML> [--local] [--wait] [--cpus <N>] [--mem <MB>] [--s3-cache] [--stream-inputs]
+        Runs a DAG of bioshed modules. In AWS, all steps are submitted at once with Batch job dependencies.
+    """
+    import bioshed_pipeline
+    optional_args = getCommandOptions(args[3:])
+    if len(args) < 4 or args[2] != 'run' or 'help' in optional_args:
+        print_help_menu('pipeline')
+        return 1
+    try:
+        pipeline = bioshed_pipeline.load_pipeline( dict(pipelinefile=args[3]))
+    except (OSError, ValueError) as e:
+        print('ERROR: invalid pipeline - {}'.format(str(e)))
+        return -1
+    print('Pipeline {}: {}'.format(pipeline['name'], ' -> '.join(pipeline['order'])))
+    if 'local' in optional_args or not cloud_ready():
+        import bioshed_s3cache
+        import bioshed_stream
+        run_args = dict(pipeline=pipeline, cpus=optional_args.get('cpus', ''), mem=optional_args.get('mem', ''),
+                        s3_cache=bioshed_s3cache.cache_enabled( dict(cache=True if 's3-cache' in optional_args else None)),
+                        stream_inputs=bioshed_stream.stream_enabled( dict(stream=True if 'stream-inputs' in optional_args else None)))
+        results = bioshed_pipeline.run_pipeline_local( run_args )
+        bioshed_pipeline.print_timing_report( dict(pipeline=pipeline, timings=results))
+        return -1 if any(r['status'] != 'SUCCEEDED' for r in results.values()) else 0
+    run = bioshed_pipeline.submit_pipeline_awsbatch( dict(pipeline=pipeline, runfile=os.path.splitext(args[3])[0] + '.run.json'))
+    if 'wait' not in optional_args:
+        print('Check status with: bioshed wait {}'.format(' '.join(run['jobs'].values())))
+        return 0
+    import bioshed_jobs
+    summary = bioshed_jobs.wait_jobs( dict(jobids=list(run['jobs'].values())))
+    ledger = dict((job['jobid'], job) for job in bioshed_jobs.list_jobs( dict(jobids=list(run['jobs'].values()))))
+    timings = dict((step, dict(start=ledger[jobid]['started_at'], end=ledger[jobid]['stopped_at'])) for step, jobid in run['jobs'].items() if jobid in ledger)
+    bioshed_pipeline.print_timing_report( dict(pipeline=pipeline, timings=timings))
+    return -1 if summary.get('SUCCEEDED', 0) < len(run['jobs']) else 0
+
+
+def cloud_ready( no_probe = False ):
+    """ Whether a cloud provider is connected and core infrastructure is deployed (otherwise run locally).
+    no_probe skips the (cached) cloud credential check - also set by BIOSHED_NO_PROBE.
+    """
+    import bioshed_init
+    no_probe = no_probe or os.environ.get('BIOSHED_NO_PROBE', '') != ''
+    return (no_probe or bioshed_init.cloud_configured( dict(initpath=INIT_PATH))) and bioshed_init.cloud_core_setup( dict(configfile=AWS_CONFIG_FILE))
+
+
 def initialize_bioshed():
     """ $ bioshed init
         Initialize Bioshed by creating a unique bioshed init directory and creating necessary config files and API keys.
     """
+    import bioshed_config
+    import bioshed_init
+    import bioshed_session
     ## Bioshed creates an init directory (.bioshedinit) under a user's HOME directory to store config files, TF files, and API keys.
     if not os.path.exists(INIT_PATH):
         os.mkdir(INIT_PATH)
@@ -185,8 +517,9 @@ def initialize_bioshed():
     ## A user must login before initializing Bioshed.
     login_success = bioshed_init.bioshed_login()
     if login_success["login"]:
-        quick_utils.add_to_json(AWS_CONFIG_FILE, {"login": login_success["user"]})
-        which_os = bioshed_init.bioshed_init(dict(system=SYSTEM_TYPE, initpath=INIT_PATH))
+        bioshed_config.update_config( dict(configfile=AWS_CONFIG_FILE, values={"login": login_success["user"]}))
+        bioshed_session.write_session( dict(user=login_success["user"]))
+        which_os = bioshed_init.bioshed_init(dict(system=bioshed_core_utils.detect_os_cached( dict(initpath=INIT_PATH)), initpath=INIT_PATH))
         print("""
         BioShed initial install complete. Follow-up options are:
 
@@ -217,6 +550,9 @@ def parseRunCommand( cmd, args ):
     [NOTE] bioshed now has basic support for running biocontainers - "bioshed run biocontainers <CMD>"
     [TODO] write simple test cases for different run commands
     """
+    import quick_utils
+    import bioshed_init
+    import docker_utils
     ogargs = quick_utils.format_type(args, 'space-str')       # original arguments
 
     if len(args) < 3:
@@ -246,7 +582,8 @@ def parseRunCommand( cmd, args ):
         return 1
 
     # special case: if no cloud provider is fully setup, then run locally
-    if not (bioshed_init.cloud_configured({}) and bioshed_init.cloud_core_setup( dict(configfile=AWS_CONFIG_FILE))):
+    # --no-probe skips the (cached) cloud credential check - for batch drivers calling bioshed many times
+    if not cloud_ready( '--no-probe' in args ):
         args = args[0:2] + ['--local'] + args[2:]
 
     args = args[2:] # don't need to parse "bioshed run/runlocal" -> parse everything after from the command line
@@ -254,6 +591,12 @@ def parseRunCommand( cmd, args ):
     registry = ''
     ctag = ''
     need_user = ''
+    samplesheet = ''
+    use_cache = None
+    s3_cache = None
+    stream_inputs = None
+    shards = 0
+    local_rows = False
 
     # optional argument is specified (--OPTIONAL_ARG)
     while args[0].startswith('--') or args[0]=='-u':
@@ -268,7 +611,11 @@ def parseRunCommand( cmd, args ):
             current_dir = str(os.getcwd()).replace(' ','\ ')
             #if '--inputdir' not in ogargs:
             #    dockerargs += '-v {}:/input/ '.format(current_dir)
-            if 'biocontainers' not in ogargs:
+            if 'biocontainers' not in ogargs and '--samplesheet' in args:
+                # samplesheet runs are prepared per row, once {column} templates are filled in (bioshed_local.local_run_args)
+                local_rows = True
+                args = args[1:]
+            elif 'biocontainers' not in ogargs:
                 args = docker_utils.specify_output_dir( dict(program_args=args[1:], default_dir=current_dir))
                 # if no cloud bucket is specified, then output to local.
                 if 's3://' not in quick_utils.format_type(args, 'space-str') and 'gcp://' not in quick_utils.format_type(args, 'space-str'):
@@ -292,6 +639,34 @@ def parseRunCommand( cmd, args ):
             else:
                 # special case: biocontainers
                 dockerargs += '-v {}:/data/ '.format(args[1])
+        elif args[0]=='--no-probe':
+            args = args[1:]
+        elif args[0]=='--s3-cache':
+            # stage s3:// inputs of local runs through the host-wide S3 object cache
+            s3_cache = True
+            args = args[1:]
+        elif args[0]=='--stream-inputs':
+            # local runs: feed sequentially-read s3:// inputs to the container through named pipes
+            stream_inputs = True
+            args = args[1:]
+        elif args[0]=='--shard':
+            # split FASTQ inputs into N shards, run one batch job per shard and merge the outputs
+            if len(args) < 3 or not args[1].isdigit():
+                print('You need to specify a number of shards and a module - ex: bioshed run --shard 8 bwa mem -o aligned.sam ...')
+                return 1
+            shards = int(args[1])
+            args = args[2:]
+        elif args[0] in ['--cache', '--no-cache']:
+            # reuse the outputs of an identical earlier run (same image digest, arguments and inputs)
+            use_cache = args[0] == '--cache'
+            args = args[1:]
+        elif args[0]=='--samplesheet':
+            # one run per samplesheet row - {column} templates in program args are filled from each row
+            if len(args) < 3:
+                print('You need to specify a samplesheet and a module - ex: bioshed run --samplesheet samples.tsv fastqc {fastq}')
+                return 1
+            samplesheet = args[1]
+            args = args[2:]
         elif args[0]=='--help':
             bioshed_init.bioshed_run_help()
             return
@@ -317,22 +692,147 @@ def parseRunCommand( cmd, args ):
     elif ogargs.endswith('--example'):
         args = ['cat', '/example.txt']
     # special case: e.g., fastqc - need to explicitly specify output directory
-    elif module.lower() in ['fastqc']:
+    elif module.lower() in ['fastqc'] and not local_rows:
         args = [args[0]] + ['-o', '/output/'] + args[1:]
     # run module
-    if cmd == 'run':
+    if cmd == 'runlocal':
+        import bioshed_s3cache
+        import bioshed_stream
+        s3_cache = bioshed_s3cache.cache_enabled( dict(cache=s3_cache))
+        stream_inputs = bioshed_stream.stream_enabled( dict(stream=stream_inputs))
+    if shards > 1 and (cmd != 'run' or samplesheet != ''):
+        print('--shard only applies to single runs in the cloud - running without shards.')
+    if cmd == 'run' and shards > 1 and samplesheet == '':
+        # scatter-gather: one batch job per FASTQ shard, then a merge job that depends on all of them
+        import bioshed_jobs
+        import bioshed_shard
+        try:
+            run = bioshed_shard.submit_shards( dict(module=module, tag=ctag, program_args=args, shards=shards))
+        except ValueError as e:
+            print('ERROR: {}'.format(str(e)))
+            return 1
+        bioshed_jobs.record_jobs( dict(jobs=run['jobs'] + [run['merge']]))
+        print('SUBMITTED {} SHARD JOBS: {}'.format(len(run['jobs']), ' '.join(j['jobid'] for j in run['jobs'])))
+        print('MERGE JOB: {}'.format(str(run['merge'])))
+        print('Check status with: bioshed jobs --refresh  OR  bioshed wait {}'.format(run['merge']['jobid']))
+    elif cmd == 'run' and samplesheet != '':
+        # submit one batch job per samplesheet row and write a manifest of job IDs
+        import bioshed_batch
+        bioshed_batch.submit_samplesheet( dict(name=module, program_args=args, samplesheet=samplesheet))
+    elif cmd == 'run':
         # run module as a batch job in AWS
         # [TODO] expand support for running batch jobs in other cloud providers
-        jobinfo = aws_batch_utils.submit_job_awsbatch( dict(name=module, program_args=args))
+        import bioshed_jobs
+        import bioshed_runcache
+        cached_run = dict(key='')
+        if bioshed_runcache.cache_enabled( dict(cache=use_cache)) and any(a.startswith('out::s3://') for a in args):
+            cached_run = bioshed_runcache.check_run( dict(module=module, program_args=args, tag=ctag))
+            if cached_run['hit']:
+                return 0
+            snapshot = bioshed_runcache.snapshot_s3_outputs( dict(outdest=cached_run['outdest'])) if cached_run['key'] != '' else {}
+        # routed to the job queue for the module's size (size-tiered queues from "bioshed deploy core aws")
+        import bioshed_batch
+        jobinfo = bioshed_batch.submit_job( dict(name=module, tag=ctag, program_args=args))
+        bioshed_jobs.record_jobs( dict(jobs=[jobinfo]))
+        if cached_run['key'] != '':
+            bioshed_runcache.record_batch_run( dict(cached_run, module=module, program_args=args, jobid=jobinfo['jobid'], created=cached_run['started'],
+                                                    snapshot=snapshot))
         print('SUBMITTED JOB INFO: '+str(jobinfo))
+        print('Check status with: bioshed jobs --refresh  OR  bioshed wait {}'.format(jobinfo['jobid']))
+    elif cmd == 'runlocal' and samplesheet != '' and need_user == '':
+        # run samples concurrently, packed by the module's CPU/memory needs against this machine
+        import bioshed_batch
+        import bioshed_local
+        tasks = []
+        for i, row in enumerate(bioshed_batch.read_samplesheet( dict(samplesheet=samplesheet))):
+            row_args = dict(program_args=bioshed_batch.expand_program_args( dict(program_args=args, row=row)), dockerargs='')
+            if local_rows:
+                row_args = bioshed_local.local_run_args( dict(program_args=row_args['program_args'], envfile='--aws-env-file' not in ogargs))
+            tasks.append(dict(name='{}_{}'.format(i, list(row.values())[0].split('/')[-1]), module=module, tag=ctag if ctag != '' else 'latest',
+                              args=row_args['program_args'], dockerargs=row_args['dockerargs']))
+        results = bioshed_local.run_local_tasks( dict(tasks=tasks, registry=registry, dockerargs=dockerargs, s3_cache=s3_cache,
+                                                      stream_inputs=stream_inputs))
+        return -1 if any(r['status'] != 'SUCCEEDED' for r in results.values()) else 0
+    elif cmd == 'runlocal' and samplesheet != '':
+        import bioshed_batch
+        import bioshed_local
+        for row in bioshed_batch.read_samplesheet( dict(samplesheet=samplesheet)):
+            row_args = dict(program_args=bioshed_batch.expand_program_args( dict(program_args=args, row=row)), dockerargs='')
+            if local_rows:
+                row_args = bioshed_local.local_run_args( dict(program_args=row_args['program_args'], envfile='--aws-env-file' not in ogargs))
+            print('TOTAL COMMAND: {} | {}'.format(str(row_args['dockerargs']+dockerargs), str(row_args['program_args'])))
+            docker_utils.run_container_local( dict(name=module, args=row_args['program_args'], dockerargs=row_args['dockerargs']+dockerargs,
+                                                   registry=registry, tag=ctag, need_user=need_user))
     elif cmd == 'runlocal':
         # run module as a local container
         print('TOTAL COMMAND: {} | {}'.format(str(dockerargs), str(args)))
         print('NOTE: If you get an AWS credentials error, you may need to specify an AWS ENV file: --aws-env-file <.ENV>')
-        docker_utils.run_container_local( dict(name=module, args=args, dockerargs=dockerargs, registry=registry, tag=ctag, need_user=need_user))
+        if need_user == '':
+            # skip "docker pull" while the image's cached digest is fresh
+            import bioshed_images
+            import bioshed_runcache
+            cached_run = dict(key='')
+            outdir = bioshed_runcache.local_output_dir( dockerargs )
+            if bioshed_runcache.cache_enabled( dict(cache=use_cache)) and (outdir != '' or any(a.startswith('out::s3://') for a in args)):
+                cached_run = bioshed_runcache.check_run( dict(module=module, program_args=args, registry=registry, tag=ctag, outdir=outdir))
+                if cached_run['hit']:
+                    return 0
+                if cached_run['outdest'].startswith('s3://'):
+                    snapshot = bioshed_runcache.snapshot_s3_outputs( dict(outdest=cached_run['outdest']))
+                else:
+                    snapshot = bioshed_runcache.snapshot_outputs( dict(outdir=outdir)) if outdir != '' else {}
+            staged = dict(program_args=args, dockerargs='', stagedir='')
+            if stream_inputs and any(a.startswith('s3://') for a in args):
+                # sequentially-read s3:// inputs are streamed through named pipes, the rest downloaded first
+                staged = bioshed_stream.stage_streams( dict(module=module, program_args=args, s3_cache=s3_cache))
+            elif s3_cache and any(a.startswith('s3://') for a in args):
+                # s3:// inputs come from the host-wide object cache, bind-mounted into the container
+                import bioshed_s3cache
+                staged = bioshed_s3cache.stage_inputs( dict(program_args=args))
+            stream_errors = []
+            try:
+                status = bioshed_images.run_container_cached( dict(module=module, args=staged['program_args'], dockerargs=staged['dockerargs']+dockerargs,
+                                                                   registry=registry, tag=ctag))
+            finally:
+                if 'streams' in staged:
+                    stream_errors = bioshed_stream.finish_streams( staged )
+                elif staged['stagedir'] != '':
+                    bioshed_s3cache.unstage_inputs( staged )
+            if stream_errors != []:
+                return -1
+            if status == 0 and cached_run['key'] != '':
+                bioshed_runcache.record_local_run( dict(cached_run, module=module, program_args=args, outdir=outdir, snapshot=snapshot,
+                                                        created=cached_run['started']))
+        else:
+            docker_utils.run_container_local( dict(name=module, args=args, dockerargs=dockerargs, registry=registry, tag=ctag, need_user=need_user))
     return 0
 
 
+## Command registry: subcommand -> handler, and whether a login session is required.
+## Each handler imports only the subsystem modules it needs.
+COMMANDS = {
+    'init': dict(handler=parseInitCommand, login=False),
+    'setup': dict(handler=lambda cmd, args: print_help_menu(), login=True),
+    'connect': dict(handler=parseConnectCommand, login=True),
+    'build': dict(handler=parseBuildCommand, login=True),
+    'run': dict(handler=parseRunCommand, login=True),
+    'runlocal': dict(handler=parseRunCommand, login=True),
+    'deploy': dict(handler=parseDeployCommand, login=True),
+    'search': dict(handler=parseSearchCommand, login=True),
+    'download': dict(handler=parseDownloadCommand, login=True),
+    'upload': dict(handler=parseUploadCommand, login=True),
+    'index': dict(handler=parseIndexCommand, login=True),
+    'teardown': dict(handler=parseTeardownCommand, login=True),
+    'keygen': dict(handler=parseKeygenCommand, login=True),
+    'serve': dict(handler=parseServeCommand, login=True),
+    'jobs': dict(handler=parseJobsCommand, login=True),
+    'wait': dict(handler=parseWaitCommand, login=True),
+    'pipeline': dict(handler=parsePipelineCommand, login=True),
+    'images': dict(handler=parseImagesCommand, login=True),
+    'cache': dict(handler=parseCacheCommand, login=True)
+}
+
+
 def getCommandOptions( _args ):
     """ Given a list of optional arguments, parses into a dictionary.
 
@@ -380,6 +880,21 @@ def print_help_menu( which_menu = 'base' ):
         $ bioshed download encode
         $ bioshed download tcga
         $ bioshed download gdc
+        $ bioshed download s3
+        $ bioshed upload s3
+
+        $ bioshed index
+        $ bioshed search local
+        $ bioshed download local
+
+        $ bioshed pipeline run
+        $ bioshed jobs
+        $ bioshed wait
+
+        $ bioshed images prefetch
+        $ bioshed cache stats
+
+        $ bioshed serve
         
         You can add --help option to each subcommand for specific help.
         
@@ -393,6 +908,22 @@ def print_help_menu( which_menu = 'base' ):
     elif which_menu == 'deploy':
         print("""
         Must specify a resource to deploy - e.g., bioshed deploy aws core
+
+        Redeploying only plans and applies the resources that changed since the last deploy (nothing is run if
+        nothing changed). Add "full" to plan every resource and refresh state from AWS, or "dryrun" to only plan.
+
+        AWS Batch gets one compute environment and job queue per sizing tier (default: small, medium, large, highmem),
+        and "bioshed run" sends each module to the queue of the tier that fits its vcpu/mem best. Deploy prints the
+        expected packing efficiency. To change the tiers (instance types, max vCPUs, Spot with On-Demand fallback),
+        write a sizing profile to ~/.bioshedinit/batch_sizing.json (or BIOSHED_BATCH_SIZING) - e.g.,
+            {"spot": true, "spot_bid_percentage": 60,
+             "tiers": [{"name": "small", "instance_types": ["c5.large", "c5.xlarge"], "max_vcpus": 64, "max_job_vcpus": 2, "max_job_mem": 3800},
+                       {"name": "medium", "default": true, "spot": false, "instance_types": ["m5.xlarge", "m5.2xlarge"], "max_vcpus": 256,
+                        "max_job_vcpus": 8, "max_job_mem": 30000}]}
+
+        With "reference_cache_gb" set in the sizing profile (default 0 - none), Batch instances get a reference cache
+        volume of that size. Jobs on an instance share it: S3 inputs (reference genomes, indexes) are downloaded once per instance and reused
+        by later jobs until the object changes in S3 or is evicted to make room.
         """)
     elif which_menu == 'connect':
         print("""
@@ -407,6 +938,110 @@ def print_help_menu( which_menu = 'base' ):
 
         EXAMPLE: bioshed build bowtie --install bowtie.requirements.txt --codebase python
         """)
+    elif which_menu == 'serve':
+        print("""
+        Run a persistent bioshed server that keeps libraries, cloud clients and config loaded.
+        While it is running, most bioshed commands (run, search, download, upload, jobs, ...) are forwarded to it,
+        which removes most of the startup cost of each command. Without a server, commands run as usual.
+
+            $ bioshed serve             (runs in the foreground - e.g., in a separate terminal or under nohup)
+            $ bioshed serve --stop
+
+        Set BIOSHED_NO_DAEMON=1 to bypass a running server.
+        """)
+    elif which_menu == 'pipeline':
+        print("""
+        Run a pipeline (DAG) of bioshed modules defined in a YAML file. Example pipeline.yaml:
+
+            name: rnaseq
+            steps:
+              fastqc:
+                module: fastqc
+                args: s3://mybucket/sample_R1.fastq.gz out::s3://mybucket/qc/
+              star:
+                module: star
+                args: --genomeDir s3://mybucket/ref/ --readFilesIn s3://mybucket/sample_R1.fastq.gz out::s3://mybucket/align/
+              featurecounts:
+                module: featurecounts
+                args: -a s3://mybucket/ref/genes.gtf -o counts.txt s3://mybucket/align/Aligned.out.bam out::s3://mybucket/counts/
+                depends_on: [star]
+
+        In AWS, all steps are submitted at once - each job starts when the jobs it depends on succeed.
+        With --local, independent steps run concurrently on this machine, packed by each module's CPU/memory
+        needs against the machine's capacity (--cpus/--mem to use less). Run times and the critical path
+        (the longest chain of dependent steps) are reported at the end.
+
+            $ bioshed pipeline run pipeline.yaml
+            $ bioshed pipeline run pipeline.yaml --wait
+            $ bioshed pipeline run pipeline.yaml --local --cpus 32 --mem 128000
+            $ bioshed pipeline run pipeline.yaml --local --stream-inputs    (--s3-cache / --stream-inputs: see "bioshed run --help")
+        """)
+    elif which_menu == 'images':
+        print("""
+        Local runs remember which image digest each module resolved to, and skip "docker pull" until the
+        cache entry is older than BIOSHED_IMAGE_CACHE_TTL seconds (default 6 hours). Runs use the image
+        pinned to that digest, so back-to-back runs use the same image.
+
+            $ bioshed images prefetch                   (pull all bioshed modules in parallel, e.g. on a new machine)
+            $ bioshed images prefetch --tag latest --registry public.ecr.aws/w7q0j5w1
+            $ bioshed images list                       (cached digests and their age)
+            $ bioshed images clear                      (next run of each module pulls again)
+        """)
+    elif which_menu == 'cache':
+        print("""
+        Local caches used by "bioshed run --local":
+
+        - S3 object cache (--s3-cache or BIOSHED_S3_CACHE=1): s3:// inputs are downloaded once per object version
+          (bucket/key/ETag) into ~/.bioshedinit/s3cache/ and bind-mounted into containers read-only.
+          Limited to BIOSHED_S3_CACHE_MAX_GB (default 200), least recently used objects are evicted first.
+        - Run cache (--cache or BIOSHED_RUN_CACHE=1): outputs of earlier identical runs.
+
+        and by "bioshed search" / "bioshed download encode":
+
+        - HTTP response cache: search responses are reused for BIOSHED_HTTP_CACHE_TTL seconds (default 1 day),
+          then revalidated with the server (ETag / Last-Modified). Limited to BIOSHED_HTTP_CACHE_MAX_MB (default 512).
+          "bioshed search ... --refresh" skips it for one search.
+
+        and by "bioshed connect" / "bioshed deploy" / "bioshed teardown":
+
+        - Terraform providers: downloaded once per host into a shared plugin cache (/var/cache/bioshed/terraform, or
+          BIOSHED_TF_SHARED_DIR), with provider versions and hashes pinned by a shared lock file.
+          "bioshed cache terraform" fills a local provider mirror - terraform init then runs offline.
+
+            $ bioshed cache stats
+            $ bioshed cache clear              (all caches; --s3, --runs or --http for one, --terraform for providers)
+            $ bioshed cache evict --max-gb 50
+            $ bioshed cache terraform linux_amd64 darwin_arm64   (platforms to mirror - default this one)
+        """)
+    elif which_menu == 'index':
+        print("""
+        Catalog your own datasets - local folders and S3 prefixes - so they can be searched in milliseconds.
+        Each file's path, size, checksum (md5, or the S3 ETag), sample / assay / read tags parsed from its name
+        and S3 object tags are stored in ~/.bioshedinit/catalog.db. Indexing again is incremental: only new or
+        changed files are hashed and tagged, and removed files are dropped from the catalog.
+
+            $ bioshed index ./sequencing/ s3://mybucket/fastqs/
+            $ bioshed index --refresh                      (re-crawl every indexed location)
+            $ bioshed index --list
+            $ bioshed index --remove s3://mybucket/fastqs/
+            (--all-files to index every file, not only sequencing/genomics files; --no-checksum to skip md5 of local files)
+
+            $ bioshed search local mouse liver R1 --assay rna-seq --filetype fastq
+            $ bioshed download local mouse liver --filetype fastq --output ./fastqs/
+            (--sample <NAME> --location <LOCAL_DIR|S3_PREFIX> --limit <N>)
+        """)
+    elif which_menu == 'jobs':
+        print("""
+        Track jobs submitted with "bioshed run". Every submitted job is recorded in a local job ledger,
+        so listing jobs does not call AWS. Status updates query AWS Batch for up to 100 jobs per call,
+        and finished jobs (SUCCEEDED/FAILED) are never queried again.
+
+            $ bioshed jobs                                  (most recent 50 jobs)
+            $ bioshed jobs --refresh --status RUNNING --module fastqc --limit 200
+            $ bioshed wait <JOBID> <JOBID> ...
+            $ bioshed wait --manifest samples.manifest.json
+            $ bioshed wait --all
+        """)
     elif which_menu in ['search', 'download']:
         print("""
         Search and download datasets from public sequencing repositories.
@@ -416,5 +1051,19 @@ def print_help_menu( which_menu = 'base' ):
             bioshed search gdc <SEARCH_TERMS>
             bioshed search tcga <SEARCH_TERMS>
             bioshed search ncbi <SEARCH_TERMS>
+            bioshed search local <SEARCH_TERMS>      (your datasets - see "bioshed index --help")
+        Search responses are cached for a day (see "bioshed cache --help") - add --refresh to query the repository again.
+        ENCODE results are written to search_encode.db (indexed; used by "bioshed download encode") and search_encode.txt.
+            bioshed download encode --list --assay rna-seq --filetype fastq --export files.tsv
+
+        Download the files in a GDC manifest (from the GDC portal, or GDC search output) - many files in parallel,
+        md5-verified. Run it again to resume - only missing, incomplete or corrupt files are downloaded:
+            bioshed download gdc --manifest gdc_manifest.txt --output ./tcga/
+            (--concurrency <FILES_IN_PARALLEL> --part-size <MB> --token-file <GDC_TOKEN> for controlled-access data)
+
+        Copy files between S3 and this machine - many files in parallel, large files in parallel parts:
+            bioshed download s3 s3://mybucket/fastqs/ ./fastqs/
+            bioshed upload s3 ./results/ s3://mybucket/results/
+            (--concurrency <FILES_IN_PARALLEL> --part-size <MB>; BIOSHED_S3_ENDPOINT_URL for another S3 endpoint)
         """)
     return
@@ -0,0 +1,266 @@
+import os, sys, csv, json, uuid, time, threading, functools, concurrent.futures
+from datetime import datetime
+##
+## AWS Batch submission helpers for bulk runs.
+## $ bioshed run --samplesheet samples.tsv <MODULE> <PROGRAM-ARGS with {column} templates>
+## Jobs go to the job queue of the sizing tier that fits the module's specs.json vcpu/mem (see bioshed_sizing).
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+SPECS_FILE = os.path.join(SCRIPT_DIR, 'bioshed_utils', 'specs.json')
+SUBMIT_CONCURRENCY = int(os.environ.get('BIOSHED_SUBMIT_CONCURRENCY', 16))
+SUBMIT_RATE = float(os.environ.get('BIOSHED_SUBMIT_RATE', 20))     # max SubmitJob calls per second
+DEFAULT_REGISTRY = 'public.ecr.aws/w7q0j5w1'
+BATCH_ENDPOINT_URL = os.environ.get('BIOSHED_BATCH_ENDPOINT_URL', '')   # e.g., a local Batch stand-in
+SUBMIT_ATTEMPTS = 5
+SUBMIT_BACKOFF_SECONDS = 1.0    # doubled after every retry, up to 30s
+THROTTLING_ERRORS = ['Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException', 'RequestLimitExceeded']
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_config
+import bioshed_sizing
+import bioshed_refcache
+
+@functools.lru_cache(maxsize=None)
+def get_batch_client( region ):
+    """ One boto3 Batch client per region per process (boto3 clients are thread-safe).
+    """
+    import boto3
+    if BATCH_ENDPOINT_URL != '':
+        return boto3.client('batch', region_name=region, endpoint_url=BATCH_ENDPOINT_URL)
+    return boto3.client('batch', region_name=region)
+
+
+def get_job_properties( args ):
+    """ Container properties for a module's job definition - sized from specs.json. With the reference cache deployed
+    (bioshed deploy core aws), jobs mount the host-level S3 object cache (see bioshed_refcache) - the cache's PYTHONPATH
+    entry goes in front of the image's own PYTHONPATH (read from the image config).
+
+    name: module name
+    tag: (optional) image tag - default latest
+    configfile: (optional) bioshed AWS config file
+    ---
+    job_properties: containerProperties for RegisterJobDefinition
+    """
+    cname = args['name']
+    ctag = args['tag'] if 'tag' in args else 'latest'
+    configfile = args['configfile'] if 'configfile' in args else bioshed_config.AWS_CONFIG_FILE
+    specs = load_specs()
+    job_properties = {}
+    job_properties['image'] = '{}/{}:{}'.format(bioshed_config.get_config( dict(configfile=configfile, key='ecr_registry', default=DEFAULT_REGISTRY)), cname, ctag)
+    job_properties['vcpus'] = int(specs[cname]['vcpu']) if (cname in specs and 'vcpu' in specs[cname]) else 1
+    job_properties['memory'] = int(specs[cname]['mem']) if (cname in specs and 'mem' in specs[cname]) else 1000
+    job_properties['jobRoleArn'] = bioshed_config.get_config( dict(configfile=configfile, key='aws_ecs_job_role'))
+    if bioshed_config.get_config( dict(configfile=configfile, key='reference_cache')) == True:
+        import bioshed_images
+        pythonpath = bioshed_images.image_env( dict(image=job_properties['image'])).get('PYTHONPATH', '')
+        job_properties.update(bioshed_refcache.job_mounts( dict(pythonpath=pythonpath)))
+    return job_properties
+
+
+@functools.lru_cache(maxsize=1)
+def load_specs():
+    """ Per-module vcpu/mem specs (bioshed_utils/specs.json), loaded once per process.
+    """
+    try:
+        with open(SPECS_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def route_job_queue( args ):
+    """ Job queue for a module - the queue of the sizing tier that packs its specs.json vcpu/mem best, or the tier named by
+    "tier" in its specs. Without size-tiered queues deployed (no jobqueues in config), the single configured job queue.
+
+    name: module name
+    configfile: (optional) bioshed AWS config file
+    ---
+    jobqueue: job queue name
+    """
+    configfile = args['configfile'] if 'configfile' in args else bioshed_config.AWS_CONFIG_FILE
+    jobqueue = bioshed_config.get_config( dict(configfile=configfile, key='jobqueue'))
+    jobqueues = bioshed_config.get_config( dict(configfile=configfile, key='jobqueues'))
+    if type(jobqueues) != dict or jobqueues == {}:
+        return jobqueue
+    specs = load_specs()
+    tier = specs.get(args['name'], {}).get('tier', '')
+    if tier == '':
+        try:
+            profile = bioshed_sizing.load_profile({})
+        except (OSError, ValueError):
+            return jobqueue
+        tier = bioshed_sizing.route_tier( dict(bioshed_sizing.module_size( dict(module=args['name'], specs=specs)), profile=profile))['tier']['name']
+    return jobqueues.get(tier, jobqueue)
+
+
+def submit_job( args ):
+    """ Submits one module run as a Batch job, to the job queue for the module's size (route_job_queue).
+    Same job definition and job info as aws_batch_utils.submit_job_awsbatch.
+
+    name: module name
+    tag: (optional) image tag - default latest
+    program_args: program arguments (list or string)
+    dependent_job_ids: (optional) list of IDs of jobs this job depends on
+    jobqueue: (optional) job queue - default routed by module size
+    client: (optional) Batch client
+    configfile: (optional) bioshed AWS config file
+    ---
+    jobinfo: dict(module, jobid, jobqueue, joboverrides, program_args)
+    """
+    cname = args['name']
+    ctag = args['tag'] if args.get('tag', '') != '' else 'latest'
+    pargs = args['program_args'] if 'program_args' in args else ''
+    pargs = ' '.join(pargs) if type(pargs) == list else str(pargs)
+    configfile = args['configfile'] if 'configfile' in args else bioshed_config.AWS_CONFIG_FILE
+    client = args['client'] if 'client' in args else get_batch_client( bioshed_config.get_config( dict(configfile=configfile, key='aws_region')))
+    jobqueue = args['jobqueue'] if 'jobqueue' in args else route_job_queue( dict(name=cname, configfile=configfile))
+    uid = str(uuid.uuid4())
+    job_def_name = 'jdef_{}_{}'.format(cname, uid)
+    client.register_job_definition( jobDefinitionName=job_def_name, type='container', retryStrategy={'attempts': 3},
+                                    containerProperties=get_job_properties( dict(name=cname, tag=ctag, configfile=configfile)))
+    print('Registering Job Definition: {}'.format(job_def_name))
+    job_overrides = {'command': [pargs] if pargs != '' else ['-test']}
+    response = client.submit_job( jobName='job_{}_{}'.format(cname, uid), jobQueue=jobqueue, jobDefinition=job_def_name,
+                                  containerOverrides=job_overrides, dependsOn=[{'jobId': j} for j in args.get('dependent_job_ids', []) if j != ''])
+    return dict(module=cname, jobid=str(response['jobId']), jobqueue=jobqueue, joboverrides=job_overrides, program_args=pargs)
+
+
+def read_samplesheet( args ):
+    """ Reads a samplesheet - tab-delimited (or comma-delimited if .csv) with a header row.
+
+    samplesheet: samplesheet file
+    ---
+    rows: list of dicts, one per sample (column name -> value)
+    """
+    samplesheet = args['samplesheet']
+    delim = ',' if samplesheet.lower().endswith('.csv') else '\t'
+    with open(samplesheet, 'r', newline='') as f:
+        rows = [dict((str(k).strip(), str(v).strip()) for k, v in row.items() if k != None)
+                for row in csv.DictReader(f, delimiter=delim)]
+    return list(filter(lambda row: any(v != '' for v in row.values()), rows))
+
+
+def expand_program_args( args ):
+    """ Fills {column} templates in program arguments from one samplesheet row.
+
+    program_args: program arguments (list) - e.g., ['fastqc', '{fastq}', 'out::s3://results/{sample}/']
+    row: samplesheet row (dict)
+    ---
+    program_args: expanded program arguments (list)
+
+    >>> expand_program_args( dict(program_args=['fastqc', '{fastq}'], row={'fastq': 's3://a/b.fastq.gz'}))
+    ['fastqc', 's3://a/b.fastq.gz']
+    """
+    row = args['row']
+    expanded = []
+    for parg in args['program_args']:
+        for column, value in row.items():
+            parg = parg.replace('{'+column+'}', value)
+        expanded.append(parg)
+    return expanded
+
+
+def submit_samplesheet( args ):
+    """ Submits one Batch job per samplesheet row, and writes a single manifest of job IDs.
+
+    One job definition is registered for the module, then SubmitJob calls are made concurrently
+    (bounded thread pool) and rate-limited. Batch array jobs are not used: all children of an array job
+    share one command, and the module entrypoint (run_main.py) does not select per-row arguments by
+    AWS_BATCH_JOB_ARRAY_INDEX.
+
+    name: module name
+    program_args: templated program arguments (list)
+    samplesheet: samplesheet file
+    tag: (optional) image tag
+    manifest: (optional) manifest file to write - default <samplesheet>.manifest.json
+    concurrency: (optional) max concurrent SubmitJob calls
+    rate: (optional) max SubmitJob calls per second
+    client: (optional) Batch client (e.g., a local stand-in)
+    configfile: (optional) bioshed AWS config file
+    jobqueue: (optional) job queue - default routed by module size (route_job_queue)
+    ---
+    manifest: dict(module, samplesheet, jobqueue, jobdefinition, submitted, jobs=[{row, program_args, jobid, error}])
+    """
+    cname = args['name']
+    ctag = args['tag'] if 'tag' in args else 'latest'
+    samplesheet = args['samplesheet']
+    manifest_file = args['manifest'] if 'manifest' in args else os.path.splitext(samplesheet)[0] + '.manifest.json'
+    concurrency = int(args['concurrency']) if 'concurrency' in args else SUBMIT_CONCURRENCY
+    rate = float(args['rate']) if 'rate' in args else SUBMIT_RATE
+    configfile = args['configfile'] if 'configfile' in args else bioshed_config.AWS_CONFIG_FILE
+    client = args['client'] if 'client' in args else get_batch_client( bioshed_config.get_config( dict(configfile=configfile, key='aws_region')))
+    jobqueue = args['jobqueue'] if 'jobqueue' in args else route_job_queue( dict(name=cname, configfile=configfile))
+
+    rows = read_samplesheet( dict(samplesheet=samplesheet))
+    if rows == []:
+        print('No samples found in {}.'.format(samplesheet))
+        return {}
+    uid = str(uuid.uuid4())
+    job_def_name = 'jdef_{}_{}'.format(cname, uid)
+    print('Registering Job Definition: {}'.format(job_def_name))
+    client.register_job_definition( jobDefinitionName=job_def_name, type='container', retryStrategy={'attempts': 3},
+                                    containerProperties=get_job_properties( dict(name=cname, tag=ctag, configfile=configfile)))
+
+    throttle = rate_limiter( rate )
+    def submit_row( indexed_row ):
+        i, row = indexed_row
+        pargs = ' '.join(expand_program_args( dict(program_args=args['program_args'], row=row)))
+        job = dict(row=i, sample=list(row.values())[0], program_args=pargs, jobid='', error='')
+        for attempt in range(SUBMIT_ATTEMPTS):
+            throttle()
+            try:
+                response = client.submit_job( jobName='job_{}_{}_{}'.format(cname, uid, i), jobQueue=jobqueue, jobDefinition=job_def_name,
+                                              containerOverrides={'command': [pargs]})
+                job['jobid'] = str(response['jobId'])
+                job['error'] = ''
+                break
+            except Exception as e:
+                job['error'] = str(e)
+                if not retryable_error( e ) or attempt == SUBMIT_ATTEMPTS - 1:
+                    break
+                # throttling or server-side error - back off and retry
+                time.sleep(min(SUBMIT_BACKOFF_SECONDS * 2 ** attempt, 30))
+        return job
+
+    print('Submitting {} jobs for {} to {}...'.format(len(rows), cname, jobqueue))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        jobs = list(executor.map(submit_row, enumerate(rows)))
+
+    manifest = dict(module=cname, samplesheet=samplesheet, jobqueue=jobqueue, jobdefinition=job_def_name,
+                    submitted=str(datetime.now()), jobs=jobs)
+    bioshed_config.write_json_atomic( manifest, manifest_file )
+    import bioshed_jobs
+    bioshed_jobs.record_jobs( dict(jobs=[dict(job, module=cname, jobqueue=jobqueue) for job in jobs]))
+    failed = [job for job in jobs if job['jobid'] == '']
+    print('Submitted {} of {} jobs. Manifest written to {}'.format(len(jobs) - len(failed), len(jobs), manifest_file))
+    for job in failed:
+        print('ERROR: row {} ({}) was not submitted: {}'.format(job['row'], job['sample'], job['error']))
+    return manifest
+
+
+def retryable_error( e ):
+    """ Whether a failed AWS API call is worth retrying - throttling or a server-side (5xx) error.
+    Other errors (e.g., an invalid job queue or parameters) fail the same way every time.
+    """
+    response = getattr(e, 'response', None)
+    if type(response) != dict:
+        return False
+    code = str(response.get('Error', {}).get('Code', ''))
+    status = int(response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) or 0)
+    return code in THROTTLING_ERRORS or status == 429 or status >= 500
+
+
+def rate_limiter( rate ):
+    """ Returns a thread-safe function that blocks so that calls happen at most <rate> times per second.
+    """
+    lock = threading.Lock()
+    interval = 1.0 / rate if rate > 0 else 0
+    next_slot = [time.monotonic()]
+    def throttle():
+        with lock:
+            now = time.monotonic()
+            wait = next_slot[0] - now
+            next_slot[0] = max(now, next_slot[0]) + interval
+        if wait > 0:
+            time.sleep(wait)
+    return throttle
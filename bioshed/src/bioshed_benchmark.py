@@ -0,0 +1,102 @@
+import os, sys, json, subprocess, tempfile
+##
+## Startup benchmark for the bioshed CLI.
+## Measures import + dispatch time of each subcommand in a fresh interpreter and checks it against a budget.
+##
+## $ python bioshed_benchmark.py                 (exits non-zero if any subcommand is over budget)
+## $ BIOSHED_STARTUP_BUDGET=0.5 python bioshed_benchmark.py
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+STARTUP_BUDGET = float(os.environ.get('BIOSHED_STARTUP_BUDGET', 1.0))   # seconds, per subcommand
+BENCHMARK_USER = 'benchmark@bioshed.io'
+BENCHMARK_OS = 'ubuntu'      # pinned, so the CLI dispatches on any host (it stops early on unsupported systems)
+BENCHMARK_COMMANDS = [['--help'], ['init', '--help'], ['build', '--help'], ['connect', 'aws', '--help'], ['deploy', '--help'],
+                      ['search', 'encode', '--help'], ['download', 'encode', '--help'], ['keygen'], ['run', '--help']]
+
+## child process: time "import bioshed" and the dispatch of one subcommand
+TIMER_CODE = """
+import sys, time, json
+t0 = time.perf_counter()
+sys.path.insert(0, {scriptdir!r})
+import bioshed
+t1 = time.perf_counter()
+bioshed.bioshed_cli_main(['bioshed'] + {cmd!r})
+t2 = time.perf_counter()
+with open({outfile!r}, 'w') as fout:
+    json.dump(dict(import_time=t1 - t0, dispatch_time=t2 - t1, modules=len(sys.modules)), fout)
+"""
+
+def startup_benchmark( args ):
+    """ Runs each benchmark subcommand in a fresh python process, with a temporary HOME holding a valid login session
+    (so no login API call is made), and reports import + dispatch time.
+
+    commands: (optional) list of subcommand argument lists - default BENCHMARK_COMMANDS
+    budget: (optional) time budget in seconds per subcommand - default STARTUP_BUDGET
+    ---
+    results: list of {"command", "import_time", "dispatch_time", "total_time", "modules", "over_budget", "returncode", "error"}
+             - a command that fails (error: last line of its stderr) is over budget
+    """
+    commands = args['commands'] if 'commands' in args else BENCHMARK_COMMANDS
+    budget = float(args['budget']) if 'budget' in args else STARTUP_BUDGET
+    results = []
+    with tempfile.TemporaryDirectory() as homedir:
+        setup_benchmark_home( dict(homedir=homedir))
+        env = dict(os.environ, HOME=homedir)
+        for cmd in commands:
+            outfile = os.path.join(homedir, 'timing.json')
+            code = TIMER_CODE.format(scriptdir=SCRIPT_DIR, cmd=list(cmd), outfile=outfile)
+            child = subprocess.run([sys.executable, '-c', code], env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            timing = dict(import_time=float('inf'), dispatch_time=float('inf'), modules=0)
+            if os.path.exists(outfile):
+                with open(outfile, 'r') as f:
+                    timing = json.load(f)
+                os.remove(outfile)
+            timing.update(returncode=child.returncode, error='')
+            if child.returncode != 0 or timing['modules'] == 0:
+                # crashed, or exited before dispatch finished
+                stderr = child.stderr.decode(errors='replace').strip()
+                timing.update(import_time=float('inf'), dispatch_time=float('inf'),
+                              error=stderr.split('\n')[-1] if stderr != '' else 'exited with status {}'.format(child.returncode))
+            timing['command'] = ' '.join(cmd)
+            timing['total_time'] = timing['import_time'] + timing['dispatch_time']
+            timing['over_budget'] = timing['total_time'] > budget
+            results.append(timing)
+    return results
+
+
+def setup_benchmark_home( args ):
+    """ Creates a bioshed init directory with a logged-in config, a fresh session record and the detected OS
+    (BENCHMARK_OS, in the format bioshed_core_utils.detect_os_cached reads).
+
+    homedir: temporary HOME directory
+    """
+    sys.path.append(SCRIPT_DIR)
+    import bioshed_session
+    initpath = os.path.join(args['homedir'], '.bioshedinit/')
+    os.mkdir(initpath)
+    with open(os.path.join(initpath, 'aws_config_constants.json'), 'w') as fout:
+        json.dump({"login": BENCHMARK_USER}, fout)
+    bioshed_session.write_session( dict(user=BENCHMARK_USER, sessionfile=os.path.join(initpath, 'session.json')))
+    uname = os.uname()
+    with open(os.path.join(initpath, '.detected_os'), 'w') as fout:
+        fout.write('{} {}\t{}\n'.format(uname.sysname, uname.release, BENCHMARK_OS))
+    return
+
+
+def print_benchmark( results, budget = STARTUP_BUDGET ):
+    """ Prints benchmark results as a table.
+    """
+    print('COMMAND\tIMPORT(s)\tDISPATCH(s)\tTOTAL(s)\tMODULES\tBUDGET({}s)'.format(budget))
+    for r in results:
+        print('bioshed {}\t{:.3f}\t{:.3f}\t{:.3f}\t{}\t{}'.format(r['command'], r['import_time'], r['dispatch_time'],
+                                                              r['total_time'], r['modules'], 'OVER' if r['over_budget'] else 'ok'))
+    for r in results:
+        if r['error'] != '':
+            print('ERROR: bioshed {}: {}'.format(r['command'], r['error']))
+    return
+
+
+if __name__ == '__main__':
+    benchmark_results = startup_benchmark( dict(budget=STARTUP_BUDGET))
+    print_benchmark( benchmark_results, STARTUP_BUDGET )
+    sys.exit(1 if any(r['over_budget'] for r in benchmark_results) else 0)
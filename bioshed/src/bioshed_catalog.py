@@ -0,0 +1,340 @@
+import os, re, sys, time, json, sqlite3, hashlib, concurrent.futures
+##
+## Local dataset catalog (bioshed index ..., bioshed search local ..., bioshed download local ...).
+##
+## "bioshed index <DIR|s3://PREFIX>" crawls local directories and S3 prefixes into ~/.bioshedinit/catalog.db:
+## path, size, checksum (md5 for local files, ETag for S3), sample/assay/read/lane tags parsed from file and folder
+## names, and S3 object tags (the TagSet read and written by aws_s3_utils get_metadata / set_metadata).
+## Crawls are incremental - unchanged files (same size and mtime, or same ETag) are not hashed or tagged again,
+## and files that are gone are dropped. Searches run against an SQLite FTS5 index, without listing any bucket.
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+CATALOG_DB = os.path.join(INIT_PATH, 'catalog.db')
+DATA_EXTENSIONS = ['.fastq', '.fq', '.fastq.gz', '.fq.gz', '.fastq.bz2', '.bam', '.bai', '.cram', '.crai', '.sam', '.vcf', '.vcf.gz',
+                   '.bcf', '.bed', '.bed.gz', '.bigwig', '.bw', '.bigbed', '.bb', '.gtf', '.gtf.gz', '.gff', '.gff3', '.fa', '.fasta',
+                   '.fa.gz', '.fasta.gz', '.h5', '.h5ad', '.loom', '.mtx', '.mtx.gz', '.tsv', '.tsv.gz', '.csv', '.txt', '.txt.gz']
+ASSAY_KEYWORDS = [('scrnaseq', 'scRNA-seq'), ('singlecell', 'scRNA-seq'), ('10x', 'scRNA-seq'), ('rnaseq', 'RNA-seq'), ('mrna', 'RNA-seq'),
+                  ('chipseq', 'ChIP-seq'), ('cutandrun', 'CUT&RUN'), ('cuttag', 'CUT&Tag'), ('atacseq', 'ATAC-seq'), ('dnaseseq', 'DNase-seq'),
+                  ('wgbs', 'WGBS'), ('bisulfite', 'WGBS'), ('rrbs', 'RRBS'), ('methyl', 'methylation'), ('hic', 'Hi-C'), ('exome', 'WES'),
+                  ('wes', 'WES'), ('wgs', 'WGS'), ('amplicon', 'amplicon'), ('16s', '16S')]
+HASH_CONCURRENCY = 8
+TAG_CONCURRENCY = 16
+BATCH_SIZE = 5000
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_transfer
+
+def open_catalog( args ):
+    """ Opens (and creates if needed) the dataset catalog.
+    """
+    catalogdb = args['catalogdb'] if 'catalogdb' in args else CATALOG_DB
+    os.makedirs(os.path.dirname(catalogdb), exist_ok=True)
+    conn = sqlite3.connect(catalogdb, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS roots (root TEXT PRIMARY KEY, files INTEGER, bytes INTEGER, indexed REAL, seconds REAL);
+        CREATE TABLE IF NOT EXISTS datasets (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE,
+            root TEXT,
+            size INTEGER,
+            mtime REAL,
+            etag TEXT,
+            checksum TEXT,
+            filetype TEXT,
+            sample TEXT,
+            assay TEXT,
+            read TEXT,
+            lane TEXT,
+            tags TEXT,
+            crawl REAL);
+        CREATE INDEX IF NOT EXISTS datasets_root ON datasets (root, crawl);
+        CREATE VIRTUAL TABLE IF NOT EXISTS datasets_fts USING fts5(path, sample, assay, filetype, tags, tokenize="unicode61 tokenchars '-'");""")
+    return conn
+
+
+def parse_name( path ):
+    """ Tags parsed from a file path - e.g., .../rnaseq/mouse_liver_S3_L001_R1_001.fastq.gz ->
+    dict(filetype='fastq.gz', sample='mouse_liver', assay='RNA-seq', read='R1', lane='L001')
+    """
+    name = path.rstrip('/').split('/')[-1]
+    lower = name.lower()
+    filetype = ''
+    for ext in sorted(DATA_EXTENSIONS, key=len, reverse=True):
+        if lower.endswith(ext):
+            filetype = ext.lstrip('.')
+            break
+    stem = name[:len(name) - len(filetype) - 1] if filetype != '' else os.path.splitext(name)[0]
+    read = re.search(r'(?:^|[_.-])(R?[12])(?:_0*\d+)?$', stem)
+    lane = re.search(r'(?:^|[_.-])(L\d{3})(?:[_.-]|$)', stem)
+    sample = re.sub(r'([_.-]S\d+)?([_.-]L\d{3})?([_.-]R?[12])?([_.-]\d{3})?$', '', stem) or stem
+    words = re.sub(r'[^a-z0-9]', '', path.lower())
+    assay = next((label for keyword, label in ASSAY_KEYWORDS if keyword in words), '')
+    return dict(filetype=filetype, sample=sample, assay=assay, read=('R' + read.group(1).lstrip('Rr')) if read else '',
+                lane=lane.group(1) if lane else '')
+
+
+def is_data_file( path, all_files = False ):
+    return all_files or any(path.lower().endswith(ext) for ext in DATA_EXTENSIONS)
+
+
+def index_location( args ):
+    """ Crawls a local directory or S3 prefix into the catalog. Only new or changed files are hashed/tagged;
+    files no longer there are removed from the catalog. Locations may nest (e.g., a directory and one of its subdirectories):
+    a file belongs to the location it was last crawled from.
+
+    location: local directory or s3://bucket/prefix/
+    checksum: (optional) compute md5 of new/changed local files - default True
+    all_files: (optional) index every file, not only sequencing/genomics data files
+    ---
+    result: dict(root, files, new, changed, removed, bytes, seconds)
+    """
+    location = args['location']
+    root = location_root( location )
+    start = time.time()
+    conn = open_catalog( args )
+    # files under this location may already be in the catalog under another (enclosing or nested) location
+    prefix = root if root.endswith('/') else root + '/'
+    known = dict((row['path'], row) for row in conn.execute("""SELECT id, path, root, size, mtime, etag, checksum FROM datasets
+                                                               WHERE root = ? OR substr(path, 1, ?) = ?""", (root, len(prefix), prefix)))
+    print('Indexing {} ({} files already in the catalog)...'.format(root, len(known)))
+    if root.startswith('s3://'):
+        found = crawl_s3( dict(args, root=root))
+    else:
+        found = crawl_local( dict(args, root=root))
+
+    changed = []    # new or changed: need checksum / tags
+    unchanged = []
+    for f in found:
+        old = known.get(f['path'], None)
+        if old != None and old['size'] == f['size'] and (old['etag'] == f['etag'] if f['etag'] != '' else old['mtime'] == f['mtime']):
+            unchanged.append(old['id'])
+        else:
+            changed.append(f)
+    print('\t{} files found: {} new, {} changed, {} unchanged.'.format(len(found), len([f for f in changed if f['path'] not in known]),
+          len([f for f in changed if f['path'] in known]), len(unchanged)))
+    if root.startswith('s3://'):
+        add_s3_tags( dict(files=changed))
+    elif args.get('checksum', True):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=HASH_CONCURRENCY) as executor:
+            for f, checksum in zip(changed, executor.map(lambda f: file_md5( f['path'] ), changed)):
+                f['checksum'] = checksum
+
+    crawl = time.time()
+    for i in range(0, len(unchanged), BATCH_SIZE):
+        with conn:
+            conn.executemany('UPDATE datasets SET root = ?, crawl = ? WHERE id = ?', [(root, crawl, rowid) for rowid in unchanged[i:i+BATCH_SIZE]])
+    for i in range(0, len(changed), BATCH_SIZE):
+        with conn:
+            for f in changed[i:i+BATCH_SIZE]:
+                save_dataset( conn, dict(f, root=root, crawl=crawl, old=known.get(f['path'], None)))
+    removed = [row['id'] for row in conn.execute('SELECT id FROM datasets WHERE root = ? AND crawl < ?', (root, crawl))]
+    with conn:
+        conn.executemany('DELETE FROM datasets WHERE id = ?', [(rowid,) for rowid in removed])
+        conn.executemany('DELETE FROM datasets_fts WHERE rowid = ?', [(rowid,) for rowid in removed])
+        total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM datasets WHERE root = ?', (root,)).fetchone()
+        conn.execute('INSERT OR REPLACE INTO roots VALUES (?, ?, ?, ?, ?)', (root, total[0], total[1], crawl, time.time() - start))
+        for other in set(row['root'] for row in known.values() if row['root'] != root):
+            # locations that files were moved from - or the same location indexed under its old name (s3://b/p)
+            if location_root( other ) == root:
+                conn.execute('DELETE FROM roots WHERE root = ?', (other,))
+            else:
+                conn.execute("""UPDATE roots SET (files, bytes) = (SELECT COUNT(*), COALESCE(SUM(size), 0) FROM datasets WHERE root = ?)
+                                WHERE root = ?""", (other, other))
+    conn.close()
+    result = dict(root=root, files=total[0], new=len([f for f in changed if f['path'] not in known]), changed=len([f for f in changed if f['path'] in known]),
+                  removed=len(removed), bytes=total[1], seconds=time.time() - start)
+    print('Indexed {}: {} files ({:.2f} GB), {} new, {} changed, {} removed in {:.1f}s.'.format(root, result['files'], result['bytes'] / 1024**3,
+          result['new'], result['changed'], result['removed'], result['seconds']))
+    return result
+
+
+def location_root( location ):
+    """ Catalog root of a location - an absolute local path, or an S3 prefix ending with '/' (s3://b/p and s3://b/p/ are the same root).
+    """
+    if location.startswith('s3://'):
+        bucket, prefix = bioshed_transfer.split_s3_uri( location )
+        return 's3://{}/{}'.format(bucket, prefix.rstrip('/') + '/' if prefix.rstrip('/') != '' else '')
+    return os.path.abspath(os.path.expanduser(location))
+
+
+def save_dataset( conn, f ):
+    """ Inserts or updates one catalog entry and its full-text row.
+    """
+    tags = parse_name( f['path'] )
+    object_tags = f.get('tags', {})
+    tag_text = ' '.join('{}={}'.format(k, v) for k, v in sorted(object_tags.items()))
+    values = (f['path'], f['root'], f['size'], f['mtime'], f['etag'], f.get('checksum', f['etag']), tags['filetype'], tags['sample'],
+              object_tags.get('assay', tags['assay']), tags['read'], tags['lane'], json.dumps(object_tags), f['crawl'])
+    if f['old'] != None:
+        conn.execute("""UPDATE datasets SET path = ?, root = ?, size = ?, mtime = ?, etag = ?, checksum = ?, filetype = ?, sample = ?,
+                        assay = ?, read = ?, lane = ?, tags = ?, crawl = ? WHERE id = ?""", values + (f['old']['id'],))
+        rowid = f['old']['id']
+        conn.execute('DELETE FROM datasets_fts WHERE rowid = ?', (rowid,))
+    else:
+        rowid = conn.execute("""INSERT INTO datasets (path, root, size, mtime, etag, checksum, filetype, sample, assay, read, lane, tags, crawl)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", values).lastrowid
+    conn.execute('INSERT INTO datasets_fts (rowid, path, sample, assay, filetype, tags) VALUES (?, ?, ?, ?, ?, ?)',
+                 (rowid, f['path'], tags['sample'], values[8], tags['filetype'], tag_text))
+    return
+
+
+def crawl_local( args ):
+    """ Data files under a local directory.
+    ---
+    files: list of dict(path, size, mtime, etag='')
+    """
+    files = []
+    stack = [args['root']]
+    while stack != []:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith('.'):
+                    stack.append(entry.path)
+            elif entry.is_file() and is_data_file( entry.name, args.get('all_files', False) ):
+                st = entry.stat()
+                files.append(dict(path=entry.path, size=st.st_size, mtime=st.st_mtime, etag=''))
+    return files
+
+
+def crawl_s3( args ):
+    """ Data objects under an S3 prefix (one listing, no per-object calls).
+    ---
+    files: list of dict(path, size, mtime, etag)
+    """
+    bucket, prefix = bioshed_transfer.split_s3_uri( args['root'] )
+    files = []
+    for page in bioshed_transfer.get_s3_client().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for o in page.get('Contents', []):
+            if not o['Key'].endswith('/') and is_data_file( o['Key'], args.get('all_files', False) ):
+                files.append(dict(path='s3://{}/{}'.format(bucket, o['Key']), size=o['Size'], mtime=o['LastModified'].timestamp(),
+                                  etag=str(o['ETag']).strip('"')))
+    return files
+
+
+def add_s3_tags( args ):
+    """ Adds the S3 object tags (TagSet) of new/changed objects, concurrently.
+    """
+    client = bioshed_transfer.get_s3_client()
+    def get_tags( f ):
+        bucket, key = bioshed_transfer.split_s3_uri( f['path'] )
+        try:
+            return dict((t['Key'], t['Value']) for t in client.get_object_tagging(Bucket=bucket, Key=key).get('TagSet', []))
+        except Exception:
+            return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=TAG_CONCURRENCY) as executor:
+        for f, tags in zip(args['files'], executor.map(get_tags, args['files'])):
+            f['tags'] = tags
+    return
+
+
+def search_catalog( args ):
+    """ Searches the catalog - every term must match (as a word prefix) the path, sample, assay, file type or tags.
+
+    terms: search terms (string)
+    assay, filetype, sample, root: (optional) filters
+    limit: (optional) maximum results - default 100
+    ---
+    results: list of dataset rows (dict)
+    """
+    conn = open_catalog( args )
+    words = re.findall(r'[\w-]+', str(args.get('terms', '')).lower())
+    where, params = [], []
+    if words != []:
+        where.append('d.id IN (SELECT rowid FROM datasets_fts WHERE datasets_fts MATCH ?)')
+        params.append(' AND '.join('"{}"*'.format(word.replace('"', '')) for word in words))
+    for column in ['assay', 'filetype', 'sample']:
+        if args.get(column, '') != '':
+            where.append('d.{} LIKE ?'.format(column))
+            params.append('%{}%'.format(args[column]))
+    if args.get('root', '') != '':
+        where.append('d.path LIKE ?')
+        params.append('{}%'.format(args['root']))
+    limit = int(args['limit']) if args.get('limit', '') != '' else 100
+    rows = conn.execute('SELECT d.* FROM datasets d{} ORDER BY d.sample, d.path LIMIT ?'.format(' WHERE ' + ' AND '.join(where) if where != [] else ''),
+                        params + [limit]).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def print_results( args ):
+    """ Prints search results as a table.
+    """
+    results = args['results']
+    print('PATH\tSIZE\tSAMPLE\tASSAY\tTYPE\tREAD\tCHECKSUM')
+    for r in results:
+        print('{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(r['path'], human_size( r['size'] ), r['sample'], r['assay'], r['filetype'], r['read'], r['checksum']))
+    print('{} file(s){}.'.format(len(results), ' (limit reached - use --limit for more)' if len(results) == int(args.get('limit', 100) or 100) else ''))
+    return
+
+
+def download_results( args ):
+    """ Copies catalog search results to an output directory or S3 prefix (S3 through the parallel transfer engine).
+
+    results: search results
+    outdir: local directory or s3:// prefix
+    ---
+    result: dict(files, failed, ...) from bioshed_transfer.transfer_files
+    """
+    import shutil
+    outdir = args['outdir']
+    transfers = []
+    for r in args['results']:
+        name = r['path'].split('/')[-1]
+        dest = outdir.rstrip('/') + '/' + name if outdir.startswith('s3://') else os.path.join(outdir, name)
+        if r['path'].startswith('s3://') or outdir.startswith('s3://'):
+            transfers.append(dict(src=r['path'], dest=dest, size=r['size']))
+        else:
+            os.makedirs(outdir, exist_ok=True)
+            shutil.copy2(r['path'], dest)
+    if transfers == []:
+        return dict(files=len(args['results']), failed=[])
+    return bioshed_transfer.transfer_files( dict(transfers=transfers))
+
+
+def list_roots( args ):
+    """ Indexed locations.
+    """
+    conn = open_catalog( args )
+    roots = [dict(row) for row in conn.execute('SELECT * FROM roots ORDER BY root')]
+    conn.close()
+    return roots
+
+
+def remove_root( args ):
+    """ Removes an indexed location and its files from the catalog.
+    """
+    root = location_root( args['root'] )
+    conn = open_catalog( args )
+    with conn:
+        conn.execute('DELETE FROM datasets_fts WHERE rowid IN (SELECT id FROM datasets WHERE root = ?)', (root,))
+        conn.execute('DELETE FROM datasets WHERE root = ?', (root,))
+        conn.execute('DELETE FROM roots WHERE root = ?', (root,))
+    conn.close()
+    return
+
+
+def file_md5( path ):
+    md5 = hashlib.md5()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(8*1024*1024), b''):
+                md5.update(chunk)
+    except OSError:
+        return ''
+    return md5.hexdigest()
+
+
+def human_size( nbytes ):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024:
+            return '{:.0f}{}'.format(nbytes, unit) if unit == 'B' else '{:.1f}{}'.format(nbytes, unit)
+        nbytes /= 1024.0
+    return '{:.1f}TB'.format(nbytes)
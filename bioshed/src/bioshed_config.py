@@ -0,0 +1,134 @@
+import os, json, fcntl
+##
+## Config store for bioshed config files (e.g., ~/.bioshedinit/aws_config_constants.json).
+## - loaded once per process and re-read only when the file's mtime/size changes
+## - updates are read-modify-write under an advisory file lock, written atomically (temp file + rename)
+## - typed schema: flags like core_setup are parsed once into booleans instead of string-checked on every access
+##
+## Values are stored on disk as before ('True'/'False' strings for flags), so other readers of the file keep working.
+
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+AWS_CONFIG_FILE = os.path.join(INIT_PATH, 'aws_config_constants.json')
+# can be pointed at a local stand-in of the serverless core for testing
+BIOSHED_SERVERLESS_API = os.environ.get("BIOSHED_SERVERLESS_API", "https://hu9ug76w32.execute-api.us-west-2.amazonaws.com/prod")
+
+CONFIG_SCHEMA = {'login': 'str',
+                 'setup': 'bool',
+                 'core_setup': 'bool',
+                 'aws_region': 'str',
+                 'ecr_registry': 'str',
+                 'jobqueue': 'str',
+                 'jobqueues': 'dict',
+                 'reference_cache': 'bool',
+                 'aws_ecr_role': 'str',
+                 'aws_ecs_job_role': 'str',
+                 'working_dir': 'str',
+                 'apikeyfile': 'str'}
+CONFIG_DEFAULTS = {'str': '', 'bool': False, 'int': 0, 'dict': {}}
+
+_CONFIG_CACHE = {}   # configfile -> dict(stamp=(mtime_ns, size), raw=..., typed=...)
+
+def load_config( args ):
+    """ Loads a config file (cached until the file changes).
+
+    configfile: (optional) config file - default AWS config file
+    ---
+    config: config as stored on disk (dict copy). Empty dict if file is missing or unreadable.
+    """
+    configfile = args['configfile'] if 'configfile' in args else AWS_CONFIG_FILE
+    return dict(_cached_config( configfile )['raw'])
+
+
+def get_config( args ):
+    """ Gets a typed config value.
+
+    configfile: (optional) config file - default AWS config file
+    key: config key (see CONFIG_SCHEMA for types)
+    default: (optional) value to return if key is not set
+    ---
+    value: typed value (e.g., core_setup -> True/False)
+    """
+    configfile = args['configfile'] if 'configfile' in args else AWS_CONFIG_FILE
+    key = args['key']
+    typed = _cached_config( configfile )['typed']
+    if key in typed:
+        return typed[key]
+    return args['default'] if 'default' in args else CONFIG_DEFAULTS.get(CONFIG_SCHEMA.get(key, 'str'), '')
+
+
+def update_config( args ):
+    """ Adds/updates keys in a config file, safely with respect to other bioshed processes.
+    Takes an advisory lock, re-reads the latest file contents, merges and writes atomically.
+
+    configfile: (optional) config file - default AWS config file
+    values: dict of keys and values to set (booleans are stored as 'True'/'False')
+    ---
+    configfile: config file written
+    """
+    configfile = args['configfile'] if 'configfile' in args else AWS_CONFIG_FILE
+    values = args['values']
+    with open(configfile + '.lock', 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            config = _read_config( configfile )
+            for k, v in values.items():
+                config[k] = str(v) if type(v) == bool else v
+            write_json_atomic( config, configfile )
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+    _CONFIG_CACHE.pop(configfile, None)
+    return configfile
+
+
+def write_json_atomic( myjson, fout_name ):
+    """ Writes a JSON file atomically: write to a temp file in the same directory, fsync, then rename over the target.
+    Readers see either the old or the new file, never a partial one.
+    """
+    tmpfile = '{}.{}.tmp'.format(fout_name, os.getpid())
+    with open(tmpfile, 'w') as fout:
+        json.dump(myjson, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmpfile, fout_name)
+    return fout_name
+
+
+def parse_config_value( key, value ):
+    """ Converts a stored config value to its schema type.
+    Flags were historically stored as strings, so 'True'/'T'/'Yes'/'Y' (any case) all mean True.
+    """
+    vtype = CONFIG_SCHEMA.get(key, '')
+    if vtype == 'bool':
+        return str(value).strip().upper()[0:1] in ['T', 'Y'] if type(value) != bool else value
+    elif vtype == 'int':
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return 0
+    elif vtype == 'str':
+        return str(value)
+    return value
+
+
+def _cached_config( configfile ):
+    try:
+        st = os.stat(configfile)
+        stamp = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        stamp = None
+    cached = _CONFIG_CACHE.get(configfile)
+    if cached is None or cached['stamp'] != stamp:
+        raw = _read_config( configfile ) if stamp != None else {}
+        cached = dict(stamp=stamp, raw=raw, typed={k: parse_config_value(k, v) for k, v in raw.items()})
+        _CONFIG_CACHE[configfile] = cached
+    return cached
+
+
+def _read_config( configfile ):
+    try:
+        with open(configfile, 'r') as f:
+            config = json.load(f)
+        return config if type(config) == dict else {}
+    except (OSError, ValueError):
+        return {}
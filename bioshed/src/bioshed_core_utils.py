@@ -1,6 +1,8 @@
-import sys, os, subprocess, platform
+import sys, os, re, json, subprocess, platform
 from argparse import ArgumentParser
 
+_DETECTED_OS = ''
+
 def detect_os():
     """ Detect system OS, if not provided.
     https://stackoverflow.com/questions/394230/how-to-detect-the-os-from-a-bash-script
@@ -39,6 +41,34 @@ def detect_os():
     print('Detected system OS: {}'.format(which_os))
     return which_os
 
+def detect_os_cached( args ):
+    """ Detect system OS, reusing the result from earlier invocations.
+    The result is kept in memory for this process and in the init directory (keyed by kernel name and release),
+    so detect_os() only runs again after an OS upgrade.
+
+    initpath: bioshed init directory (optional - if missing, only the in-memory cache is used)
+    ---
+    which_os: detected OS (see detect_os)
+    """
+    global _DETECTED_OS
+    initpath = args['initpath'] if 'initpath' in args else ''
+    uname = os.uname() if hasattr(os, 'uname') else None
+    os_key = '{} {}'.format(uname.sysname, uname.release) if uname != None else ''
+    cachefile = os.path.join(initpath, '.detected_os') if initpath != '' else ''
+    if _DETECTED_OS != '':
+        return _DETECTED_OS
+    if os_key != '' and cachefile != '' and os.path.exists(cachefile):
+        with open(cachefile,'r') as f:
+            cached = f.read().strip().split('\t')
+        if len(cached) == 2 and cached[0] == os_key:
+            _DETECTED_OS = cached[1]
+            return _DETECTED_OS
+    _DETECTED_OS = detect_os()
+    if os_key != '' and cachefile != '' and os.path.exists(initpath):
+        with open(cachefile,'w') as fout:
+            fout.write('{}\t{}\n'.format(os_key, _DETECTED_OS))
+    return _DETECTED_OS
+
 def parse_build_args( args ):
     """ Parse arguments to bioshed build.
     """
@@ -65,6 +95,10 @@ def write_resource_block( args ):
     type: resource type
     name: resource name
     block: internal of block, as dict/JSON
+    kind: (optional) resource (default), data or variable
+    comment: (optional) comment line written above the block
+    ---
+    text: block as written (see render_resource_block)
 
     NOTE: functions within a block are a special case and are defined as:
     {"policy": {"jsonencode()": {"Version": "2012-10-17", Statement: [{"Action":...}]}}}}
@@ -79,23 +113,74 @@ def write_resource_block( args ):
         ]
       }
     )
+    Nested blocks have keys ending with {} - {"route{}": {"cidr_block": ...}} is route { cidr_block = ... },
+    and a list of dicts is a repeated block. References and other expressions are written as interpolation-only
+    strings - "${aws_vpc.vpc.id}" is written as aws_vpc.vpc.id, "${var.name_prefix}-vpc" stays a quoted string.
+    """
+    text = render_resource_block( args )
+    with open(args['file'],'a') as f:
+        f.write(text)
+    return text
+
+def render_resource_block( args ):
+    """ Renders a resource block (see write_resource_block) as HCL. The same block always renders to the same text,
+    so rendered blocks can be hashed and compared with what was last deployed.
     """
+    kind = args['kind'] if 'kind' in args else 'resource'
+    if kind == 'variable':
+        header = 'variable "{}" {{\n'.format(args['name'])
+    else:
+        header = '{} "{}" "{}" {{\n'.format(kind, args['type'], args['name'])
+    comment = '# {}\n'.format(args['comment']) if args.get('comment', '') != '' else ''
+    return comment + header + render_block_body( args['block'], 2 ) + '}\n\n'
+
+def render_block_body( block, indent ):
+    lines = ''
+    for key, value in block.items():
+        if key.endswith('{}'):
+            # nested block, or repeated nested blocks
+            for nested in (value if type(value) == type([]) else [value]):
+                lines += indent*' ' + '{} {{\n'.format(key[:-2]) + render_block_body( nested, indent+2 ) + indent*' ' + '}\n'
+        else:
+            lines += indent*' ' + '{} = {}\n'.format(key, render_hcl_value( value, indent ))
+    return lines
+
+def render_hcl_value( value, indent = 0 ):
+    """ HCL expression for a value - e.g., ["m5.large", "m5.xlarge"], true, var.vpc_cidr_block, jsonencode({...})
     """
-    rtype = args['type']
-    rname = args['name']
-    rblock = args['block']
-    rid = args['type']+'.'+args['name']
-    indent = 0
+    if type(value) == bool:
+        return 'true' if value else 'false'
+    elif value == None:
+        return 'null'
+    elif type(value) in [int, float]:
+        return str(value)
+    elif type(value) == str:
+        if value.startswith('${') and value.endswith('}') and value.count('${') == 1 and value.index('}') == len(value)-1:
+            return value[2:-1]
+        return json.dumps(value)
+    elif type(value) == type([]):
+        if all(type(v) not in [type({}), type([])] for v in value):
+            return '[' + ', '.join(render_hcl_value( v, indent ) for v in value) + ']'
+        return '[\n' + ''.join((indent+2)*' ' + render_hcl_value( v, indent+2 ) + ',\n' for v in value) + indent*' ' + ']'
+    elif type(value) == type({}) and len(value) == 1 and list(value.keys())[0].endswith('()'):
+        function = list(value.keys())[0]
+        return '{}({})'.format(function[:-2], render_hcl_value( value[function], indent ))
+    elif type(value) == type({}):
+        if value == {}:
+            return '{}'
+        items = ''
+        for k, v in value.items():
+            key = k if re.fullmatch(r'[A-Za-z_][A-Za-z0-9_-]*', str(k)) else json.dumps(str(k))
+            items += (indent+2)*' ' + '{} = {}\n'.format(key, render_hcl_value( v, indent+2 ))
+        return '{\n' + items + indent*' ' + '}'
+    return json.dumps(str(value))
 
-    with open(args['file'],'a') as f:
-        f.write("resource {} {} {\n".format(rtype, rname))
-        # iterate through resource arguments inside block
-        indent += 2
-        for rarg in rblock:
-            rvalue = rblock[rarg]
-            if type(value) == type({}):
-                f.write(indent*" "+"{} = {\n".format(str(rarg)))
-                indent += 2
-                f.write(indent*" "+"{}")
+def resource_address( args ):
+    """ Terraform address of a resource block - e.g., aws_vpc.vpc, data.aws_key_pair.deployer, var.aws_region
     """
-    return
+    kind = args['kind'] if 'kind' in args else 'resource'
+    if kind == 'variable':
+        return 'var.{}'.format(args['name'])
+    elif kind == 'data':
+        return 'data.{}.{}'.format(args['type'], args['name'])
+    return '{}.{}'.format(args['type'], args['name'])
@@ -0,0 +1,272 @@
+import os, sys, json, socket, signal, struct, functools, importlib
+##
+## $ bioshed serve
+## Optional long-lived bioshed process. Keeps subsystem imports (boto3, pandas, yaml, requests), boto3 clients
+## (per AWS credential environment) and the detected OS warm. The bioshed entry point forwards its argv to this
+## process over a Unix socket and falls back to running in-process if no server is listening.
+##
+## Each forwarded command runs in a forked child of the server, with the client's stdin/stdout/stderr
+## passed over the socket - so prompts and container/CLI output go straight to the user's terminal,
+## and the command runs in the client's working directory and environment.
+## Settings that modules read from the environment when imported (BIOSHED_S3_ENDPOINT_URL, BIOSHED_BATCH_ENDPOINT_URL,
+## BIOSHED_SERVERLESS_API, ...) are frozen in the server - if a client's differ, its child re-imports the bioshed modules.
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+SOCKET_FILE = os.path.join(INIT_PATH, 'bioshed.sock')
+FORWARD_COMMANDS = ['run', 'runlocal', 'search', 'download', 'build', 'keygen', 'jobs', 'wait', 'pipeline', 'images', 'cache', 'upload', 'index']
+MAX_REQUEST_BYTES = 4*1024*1024
+## environment that decides which AWS identity/endpoint a boto3 client uses - cached clients are keyed on it
+CREDENTIAL_ENV = ['AWS_PROFILE', 'AWS_DEFAULT_PROFILE', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN',
+                  'AWS_CONFIG_FILE', 'AWS_SHARED_CREDENTIALS_FILE', 'AWS_ROLE_ARN', 'AWS_WEB_IDENTITY_TOKEN_FILE',
+                  'AWS_DEFAULT_REGION', 'AWS_REGION', 'AWS_ENDPOINT_URL']
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+sys.path.append(os.path.join(SCRIPT_DIR, 'bioshed_utils/'))
+sys.path.append(os.path.join(SCRIPT_DIR, 'bioshed_atlas/'))
+
+def bioshed_serve( args ):
+    """ Runs the bioshed server in the foreground until stopped (Ctrl-C or "bioshed serve --stop").
+
+    socketfile: (optional) Unix socket path - default ~/.bioshedinit/bioshed.sock
+    ---
+    """
+    socketfile = args['socketfile'] if 'socketfile' in args else SOCKET_FILE
+    if server_running( dict(socketfile=socketfile)):
+        print('A bioshed server is already listening on {}.'.format(socketfile))
+        return
+    if os.path.exists(socketfile):
+        os.remove(socketfile)   # stale socket from a server that did not shut down cleanly
+
+    warm_state({})
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)     # socket is only accessible by this user
+    server.bind(socketfile)
+    os.umask(old_umask)
+    server.listen(64)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)    # children report their own status - let the kernel reap them
+    print('bioshed server listening on {} (pid {}).'.format(socketfile, os.getpid()))
+    try:
+        while True:
+            conn, _ = server.accept()
+            if not same_user( conn ):
+                conn.close()
+                continue
+            request, fds = receive_request( conn )
+            if request.get('stop'):
+                conn.sendall(b'{"status": 0}\n')
+                conn.close()
+                break
+            if os.fork() == 0:
+                server.close()
+                run_forwarded_command( conn, request, fds )     # does not return
+            conn.close()
+            for fd in fds:
+                os.close(fd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(socketfile):
+            os.remove(socketfile)
+        print('bioshed server stopped.')
+    return
+
+
+def forward_command( args ):
+    """ Client side: forwards a command to a running bioshed server.
+
+    argv: full command-line args (including "bioshed")
+    socketfile: (optional) Unix socket path
+    ---
+    status: exit status of the command, or None if no server could be reached (caller runs in-process)
+    """
+    argv = args['argv']
+    socketfile = args['socketfile'] if 'socketfile' in args else SOCKET_FILE
+    if os.environ.get('BIOSHED_NO_DAEMON', '') != '' or len(argv) < 2 or argv[1] not in FORWARD_COMMANDS or not os.path.exists(socketfile):
+        return None
+    request = json.dumps(dict(argv=argv, cwd=os.getcwd(), env=dict(os.environ))).encode() + b'\n'
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(socketfile)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        socket.send_fds(conn, [request], [0, 1, 2])
+    except OSError:
+        return None
+    response = b''
+    try:
+        while not response.endswith(b'\n'):
+            chunk = conn.recv(4096)
+            if chunk == b'':
+                break
+            response += chunk
+    except KeyboardInterrupt:
+        pass
+    conn.close()
+    try:
+        return int(json.loads(response)['status'])
+    except (ValueError, KeyError):
+        # the command has already been sent to the server, so it must not be re-run in-process
+        return 1
+
+
+def stop_server( args ):
+    """ Asks a running bioshed server to shut down.
+
+    socketfile: (optional) Unix socket path
+    """
+    socketfile = args['socketfile'] if 'socketfile' in args else SOCKET_FILE
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(socketfile)
+        conn.sendall(b'{"stop": true}\n')
+        conn.recv(64)
+        conn.close()
+        print('Stopped bioshed server.')
+    except OSError:
+        print('No bioshed server running.')
+    return
+
+
+def server_running( args ):
+    """ Checks if a server is accepting connections on the socket.
+    """
+    socketfile = args['socketfile'] if 'socketfile' in args else SOCKET_FILE
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(socketfile)
+        conn.close()
+        return True
+    except OSError:
+        return False
+
+
+def warm_state( args ):
+    """ Pre-imports subsystems and pre-builds state that every forked command would otherwise rebuild.
+    - subsystem modules (docker_utils, aws_batch_utils, quick_utils, atlas modules) and the detected OS
+    - boto3 clients are cached per (service, region, AWS credential environment), so submit_job_awsbatch reuses one
+      Batch client, and a forwarded command with other AWS credentials (AWS_PROFILE, keys) gets its own client
+    - the config file is held by bioshed_config (re-read only when it changes)
+    """
+    import bioshed
+    import bioshed_core_utils
+    import bioshed_init
+    import bioshed_session
+    import bioshed_config
+    import bioshed_jobs
+    import docker_utils
+    import aws_batch_utils
+    import boto3
+    bioshed_core_utils.detect_os_cached( dict(initpath=INIT_PATH))
+    for optional_module in ['atlas_encode_utils', 'atlas_tcga_utils']:
+        try:
+            __import__(optional_module)
+        except ImportError:
+            pass
+
+    boto3_client = boto3.client
+    @functools.lru_cache(maxsize=None)
+    def cached_client( service_name, region_name, credential_env ):
+        # a new session resolves credentials from the current environment (not the server's default session)
+        return boto3.session.Session().client(service_name, region_name=region_name)
+    def client( service_name, region_name=None, **kwargs ):
+        if kwargs != {}:
+            return boto3_client(service_name, region_name=region_name, **kwargs)
+        return cached_client(service_name, region_name, tuple(os.environ.get(k, '') for k in CREDENTIAL_ENV))
+    boto3.client = client
+    region = bioshed_config.get_config( dict(key='aws_region'))
+    if region != '':
+        boto3.client('batch', region_name=region)
+    return
+
+
+def run_forwarded_command( conn, request, fds ):
+    """ Forked child: adopt the client's stdio, working directory and environment, run the command, report status.
+    """
+    status = 0
+    try:
+        for target, fd in zip([0, 1, 2], fds):
+            os.dup2(fd, target)
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', closefd=False)
+        sys.stderr = open(2, 'w', closefd=False)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        settings_changed = settings_env( os.environ ) != settings_env( request.get('env', {}))
+        os.environ.clear()
+        os.environ.update(request.get('env', {}))
+        os.chdir(request['cwd'])
+        if settings_changed:
+            reload_settings({})
+        if 'boto3' in sys.modules:
+            # credentials of the default session were resolved from the server's environment
+            sys.modules['boto3'].DEFAULT_SESSION = None
+        import bioshed
+        status = bioshed.exit_status( bioshed.bioshed_cli_main( request['argv'] ))
+    except SystemExit as e:
+        status = e.code if type(e.code) == int else 1
+    except BaseException as e:
+        print('ERROR: {}'.format(str(e)), file=sys.stderr)
+        status = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.sendall(json.dumps(dict(status=status)).encode() + b'\n')
+    finally:
+        os._exit(0)
+
+
+def settings_env( env ):
+    """ The part of an environment that bioshed modules read into settings when they are imported.
+    """
+    return dict((k, v) for k, v in env.items() if k.startswith('BIOSHED_') or k == 'HOME')
+
+
+def reload_settings( args ):
+    """ Forked child: re-imports the bioshed modules loaded in the server, so their import-time settings (and the
+    clients cached from them, e.g., bioshed_transfer.get_s3_client) come from the adopted environment.
+    Modules are re-imported after the bioshed modules they import - e.g., bioshed_init copies a bioshed_config setting.
+    ---
+    reloaded: names of the re-imported modules, in order
+    """
+    modules = dict((name, module) for name, module in list(sys.modules.items()) if name not in ['__main__', __name__]
+                   and os.path.dirname(os.path.realpath(str(getattr(module, '__file__', None)))) == SCRIPT_DIR)
+    visited, reloaded = set(), []
+    def reload_module( name ):
+        if name in visited:
+            return
+        visited.add(name)     # also ends import cycles
+        for dependency in [v.__name__ for v in vars(modules[name]).values() if type(v) == type(sys) and v.__name__ in modules]:
+            reload_module( dependency )
+        importlib.reload(modules[name])
+        reloaded.append(name)
+    for name in modules:
+        reload_module( name )
+    return reloaded
+
+
+def receive_request( conn ):
+    """ Reads a newline-terminated JSON request and any passed file descriptors.
+    """
+    data, fds, _, _ = socket.recv_fds(conn, 65536, 3)
+    while not data.endswith(b'\n') and len(data) < MAX_REQUEST_BYTES:
+        chunk = conn.recv(65536)
+        if chunk == b'':
+            break
+        data += chunk
+    try:
+        return json.loads(data), fds
+    except ValueError:
+        return {}, fds
+
+
+def same_user( conn ):
+    """ Only serve clients running as the same user as the server.
+    Where peer credentials are unavailable (e.g., Mac OS X), the owner-only socket permissions apply.
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid == os.getuid()
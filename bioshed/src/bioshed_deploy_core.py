@@ -1,8 +1,14 @@
-import os, sys, subprocess
+import os, sys, re, json, time, base64, hashlib
 SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+DEPLOY_STATE_FILE = '.bioshed_deploy_state.json'     # block hashes as of the last successful apply
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_config
+import bioshed_core_utils
+import bioshed_terraform
+import bioshed_sizing
+import bioshed_batch
+import bioshed_refcache
 sys.path.append(os.path.join(SCRIPT_DIR, 'bioshed_utils/'))
-import quick_utils
-import aws_s3_utils
 
 def bioshed_deploy_core( args ):
     """
@@ -36,7 +42,6 @@ def bioshed_deploy_core_aws_test( args ):
     deployoption: option for deployment - ex: dryrun
     ---
     """
-    cwd = os.getcwd()
     INIT_PATH = args['initpath'] # os.path.join(os.getcwd(), 'hsinit')
     deployoption = args['deployoption'] if 'deployoption' in args else ''
     with open(os.path.join(INIT_PATH,'main.tf'),'w') as f:
@@ -84,10 +89,9 @@ def bioshed_deploy_core_aws_test( args ):
       }
       """
       )
-    os.chdir(INIT_PATH)
-    subprocess.call('terraform plan -out hs_deploy_core.plan', shell=True)
-    subprocess.call('terraform apply hs_deploy_core.plan', shell=True)
-    os.chdir(cwd)
+    bioshed_terraform.terraform_init( dict(initpath=INIT_PATH))
+    bioshed_terraform.run_terraform( dict(initpath=INIT_PATH, command=['plan', '-out', 'hs_deploy_core.plan']))
+    bioshed_terraform.run_terraform( dict(initpath=INIT_PATH, command=['apply', 'hs_deploy_core.plan']))
     return
 
 def bioshed_deploy_core_aws_public( args ):
@@ -97,374 +101,322 @@ def bioshed_deploy_core_aws_public( args ):
     configfile = args['configfile']
     region: region to deploy files
     deployoption = args['deployoption'] if 'deployoption' in args else ''
+    sizingfile: (optional) Batch sizing profile (see bioshed_sizing)
     ---
 
-    [TODO] add to existing TF files instead of overwriting.
+    Resources are defined as a resource model (core_aws_public_variables, core_aws_public_resources) and rendered
+    to variables.tf / main.tf - see deploy_resources for how only changed resources are planned and applied.
+
     [TODO] check if VPC CIDR block is already taken before assigning
     [TODO] use generated key - set this up
     [TODO] make EC2 Batch AMI public
     [TODO] add ability to specify multiple subnets
     """
-    cwd = os.getcwd()
     CIDR_BLOCKS = ['10.35.0.0']  # [TODO] make a list of CIDR blocks to check for availability
     INIT_PATH = args['initpath'] # os.path.join(os.getcwd(), 'hsinit')
     configfile = args['configfile']
     deployoption = args['deployoption'] if 'deployoption' in args else ''
     region = args['region'] if 'region' in args else 'us-west-2'
+    profile = bioshed_sizing.load_profile( dict(sizingfile=args.get('sizingfile', '')))
+    bioshed_sizing.print_packing_report( dict(profile=profile, specs=bioshed_batch.load_specs()))
+    deployed = deploy_resources( dict(initpath=INIT_PATH, deployoption=deployoption,
+                                      files={'variables.tf': core_aws_public_variables( dict(region=region, cidr_blocks=CIDR_BLOCKS)),
+                                             'main.tf': core_aws_public_resources( dict(region=region, profile=profile))}))
+    if deployed == -1:
+        return
+    # job queue of each tier, used to route jobs (bioshed_batch.route_job_queue)
+    jobqueues = dict((tier['name'], bioshed_sizing.queue_name( dict(tier=tier))) for tier in profile['tiers'])
+    reference_cache = profile['reference_cache_gb'] > 0
+    if deployed == 'unchanged' and bioshed_config.get_config( dict(configfile=configfile, key='core_setup')) == True:
+        bioshed_config.update_config( dict(configfile=configfile, values=dict(jobqueues=jobqueues, reference_cache=reference_cache)))
+        return
+    # add roles and other config to aws config file
+    import aws_s3_utils
     aws_id = aws_s3_utils.get_aws_id()
-    with open(os.path.join(INIT_PATH,'variables.tf'),'w') as f:
-        f.write(
-        """
-        variable "name_prefix" {
-          type        = string
-          description = "Naming prefix for resources"
-          default     = "bioshed-managed"
-        }
-
-        variable "aws_region" {
-          type        = string
-          description = "Region for AWS Resources"
-        """
-        )
-        f.write('  default = "{}"\n'.format(region))
-        f.write('}\n\n')
-        f.write(
-        """
-        variable "aws_azs" {
-          type        = list(string)
-          description = "AWS Available Zones to use"
-        """
-        )
-        f.write('  default     = ["{}a", "{}b", "{}c"]\n'.format(region, region, region))
-        f.write('}\n\n')
-        f.write(
-        """
-        # assume that CIDR block is not taken
-        variable "vpc_cidr_block" {
-          type        = string
-          description = "Base CIDR Block for VPC"
-        """)
-        f.write('  default     = "{}/16"\n'.format(CIDR_BLOCKS[0]))
-        f.write(
-        """
-        }
-
-        variable "vpc_cidr_range_public_subnets" {
-          type        = list(string)
-          description = "CIDR ranges for public subnets"
-        """
-        )
-        # might need to expand the list if more than one subnet is defined
-        f.write('  default     = ["{}/17"]'.format(CIDR_BLOCKS[0]))
-        f.write(
-        """
-        }
-
-        variable "enable_dns_hostnames" {
-          type        = bool
-          description = "Enable DNS hostnames in VPC"
-          default     = true
-        }
-
-        variable "vpc_subnet_count" {
-          type        = number
-          description = "Number of private or public subnets to create in VPC"
-        """)
-        f.write('  default     = {}'.format(str(len(CIDR_BLOCKS))))
-        f.write(
-        """
-        }
+    bioshed_config.update_config( dict(configfile=configfile, values=dict(aws_ecr_role='arn:aws:iam::{}:instance-profile/bioshed_ecs_instance_role'.format(aws_id), \
+                                                                          aws_ecs_job_role='arn:aws:iam::{}:role/bioshed_ecs_batch_service_role'.format(aws_id), \
+                                                                          jobqueue='bioshed-managed_batch_job_queue_public', \
+                                                                          jobqueues=jobqueues, \
+                                                                          reference_cache=reference_cache, \
+                                                                          working_dir='/home',
+                                                                          core_setup='True')))
 
-        variable "public_ecs_batch_service_role_policy_arns" {
-          type        = list(string)
-          description = "IAM Role Policies for Batch to be able to start instances"
-          default     = ["arn:aws:iam::aws:policy/AmazonEC2ContainerRegistryFullAccess", "arn:aws:iam::aws:policy/AmazonElasticContainerRegistryPublicReadOnly", "arn:aws:iam::aws:policy/AmazonS3FullAccess", "arn:aws:iam::aws:policy/CloudWatchFullAccess", "arn:aws:iam::aws:policy/AmazonECS_FullAccess", "arn:aws:iam::aws:policy/service-role/AmazonEC2ContainerServiceRole", "arn:aws:iam::aws:policy/service-role/AWSBatchServiceRole"]
-        }
-
-        variable "bioshed_ecs_instance_role_policy_arn" {
-          type        = list(string)
-          description = "IAM Role Policiy to attach to instances run within Batch"
-          default     = ["arn:aws:iam::aws:policy/service-role/AmazonEC2ContainerServiceforEC2Role", "arn:aws:iam::aws:policy/AmazonS3FullAccess", "arn:aws:iam::aws:policy/AmazonEC2ContainerRegistryFullAccess", "arn:aws:iam::aws:policy/AmazonElasticContainerRegistryPublicReadOnly"]
-        }
-
-        # use public ID later (or make this AMI public)
-        variable "batch_ami_id_tiny" {
-          type        = string
-          description = "AMI for Batch EC2 instances with 100GB storage"
-          default     = "ami-08576a4860f85fa6d"
-        }
+    return
 
-        # default used to be "npi_aws_batch" for testing
-        variable "batch_ec2_key" {
-          type        = string
-          description = "EC2 key pair for Batch instances"
-          default     = data.aws_key_pair.deployer
-        }
+def core_aws_public_variables( args ):
+    """ Variables of the core AWS infrastructure (variables.tf).
 
-        """
-        )
-    with open(os.path.join(INIT_PATH,'main.tf'),'w') as f:
-        f.write(
-        """
+    region: AWS region
+    cidr_blocks: VPC CIDR blocks
+    ---
+    blocks: list of resource blocks (see bioshed_core_utils.write_resource_block)
+    """
+    region = args['region']
+    CIDR_BLOCKS = args['cidr_blocks']
+    def variable( name, vtype, description, default, comment = '' ):
+        return dict(kind='variable', name=name, comment=comment, block=dict(type='${'+vtype+'}', description=description, default=default))
+    return [variable('name_prefix', 'string', 'Naming prefix for resources', 'bioshed-managed'),
+            variable('aws_region', 'string', 'Region for AWS Resources', region),
+            variable('aws_azs', 'list(string)', 'AWS Available Zones to use', ['{}a'.format(region), '{}b'.format(region), '{}c'.format(region)]),
+            variable('vpc_cidr_block', 'string', 'Base CIDR Block for VPC', '{}/16'.format(CIDR_BLOCKS[0]), comment='assume that CIDR block is not taken'),
+            # might need to expand the list if more than one subnet is defined
+            variable('vpc_cidr_range_public_subnets', 'list(string)', 'CIDR ranges for public subnets', ['{}/17'.format(CIDR_BLOCKS[0])]),
+            variable('enable_dns_hostnames', 'bool', 'Enable DNS hostnames in VPC', True),
+            variable('vpc_subnet_count', 'number', 'Number of private or public subnets to create in VPC', len(CIDR_BLOCKS)),
+            variable('public_ecs_batch_service_role_policy_arns', 'list(string)', 'IAM Role Policies for Batch to be able to start instances',
+                     ["arn:aws:iam::aws:policy/AmazonEC2ContainerRegistryFullAccess", "arn:aws:iam::aws:policy/AmazonElasticContainerRegistryPublicReadOnly",
+                      "arn:aws:iam::aws:policy/AmazonS3FullAccess", "arn:aws:iam::aws:policy/CloudWatchFullAccess", "arn:aws:iam::aws:policy/AmazonECS_FullAccess",
+                      "arn:aws:iam::aws:policy/service-role/AmazonEC2ContainerServiceRole", "arn:aws:iam::aws:policy/service-role/AWSBatchServiceRole"]),
+            variable('bioshed_ecs_instance_role_policy_arn', 'list(string)', 'IAM Role Policiy to attach to instances run within Batch',
+                     ["arn:aws:iam::aws:policy/service-role/AmazonEC2ContainerServiceforEC2Role", "arn:aws:iam::aws:policy/AmazonS3FullAccess",
+                      "arn:aws:iam::aws:policy/AmazonEC2ContainerRegistryFullAccess", "arn:aws:iam::aws:policy/AmazonElasticContainerRegistryPublicReadOnly"]),
+            variable('batch_ami_id_tiny', 'string', 'AMI for Batch EC2 instances with 100GB storage', 'ami-08576a4860f85fa6d',
+                     comment='use public ID later (or make this AMI public)'),
+            variable('batch_ec2_key', 'string', 'EC2 key pair for Batch instances', '${data.aws_key_pair.deployer}',
+                     comment='default used to be "npi_aws_batch" for testing')]
+
+def core_aws_public_resources( args ):
+    """ Resources of the core AWS infrastructure (main.tf): VPC, subnets and routes, security groups, IAM roles, Batch launch template,
+    compute environments and job queues.
+
+    region: AWS region
+    profile: sizing profile - Batch compute environments and queues (see bioshed_sizing)
+    ---
+    blocks: list of resource blocks (see bioshed_core_utils.write_resource_block)
+    """
+    region = args['region']
+    def assume_role_policy( services ):
+        return {'jsonencode()': {'Version': '2012-10-17', 'Statement': [{'Action': 'sts:AssumeRole', 'Effect': 'Allow', 'Principal': {'Service': services}}]}}
+    def all_traffic( cidr_block ):
+        return {'from_port': 0, 'to_port': 0, 'protocol': '-1', 'cidr_blocks': [cidr_block]}
+    return [
         # Setup VPC and subnets and route tables
-        resource "aws_vpc" "vpc" {
-          cidr_block           = var.vpc_cidr_block
-          enable_dns_hostnames = var.enable_dns_hostnames
-          tags = { Name = "${var.name_prefix}-vpc" }
-        }
-
-        resource "aws_internet_gateway" "igw" {
-          vpc_id = aws_vpc.vpc.id
-          tags = { Name = "${var.name_prefix}-igw" }
-        }
-
-        resource "aws_subnet" "public_subnets" {
-          count                   = var.vpc_subnet_count
-          cidr_block              = var.vpc_cidr_range_public_subnets[count.index]
-          vpc_id                  = aws_vpc.vpc.id
-          map_public_ip_on_launch = true
-          availability_zone       = var.aws_azs[count.index]
-          tags = { Name = "${var.name_prefix}-public-subnet-${count.index}" }
-        }
-
-        # public route table - mapping of VPC CIDR block to local is added automatically
-        resource "aws_route_table" "public_route_table" {
-          vpc_id = aws_vpc.vpc.id
-          route {
-            cidr_block = "0.0.0.0/0"
-            gateway_id = aws_internet_gateway.igw.id
-          }
-          tags = { Name = "${var.name_prefix}-public-route-table" }
-        }
-
-        # set main route table
-        resource "aws_main_route_table_association" "rta-main-public" {
-          vpc_id         = aws_vpc.vpc.id
-          route_table_id = aws_route_table.public_route_table.id
-        }
-
-        # route table associations
-        resource "aws_route_table_association" "rta-public-subnets" {
-          count          = var.vpc_subnet_count
-          subnet_id      = aws_subnet.public_subnets[count.index].id
-          route_table_id = aws_route_table.public_route_table.id
-        }
-
-        # s3 endpoint inside VPC - routes any S3-bound traffic to this endpoint instead of through NAT->IGW
-        resource "aws_vpc_endpoint_route_table_association" "rta-s3-public" {
-          route_table_id = aws_route_table.public_route_table.id
-          vpc_endpoint_id = aws_vpc_endpoint.s3.id
-        }
-
-        resource "aws_vpc_endpoint" "s3" {
-          vpc_id = aws_vpc.vpc.id
-        """
-        )
-        f.write('service_name = "com.amazonaws.{}.s3"\n'.format(region))
-        f.write('}\n\n')
-        f.write(
-        """
-        # reachable-from-vpc allows full access to a resource if within the VPC.
-        resource "aws_security_group" "reachable_from_vpc" {
-          name   = "${var.name_prefix}-reachable-from-vpc"
-          vpc_id = aws_vpc.vpc.id
-
-          # inbound - full access from inside VPC
-          ingress {
-            from_port   = 0
-            to_port     = 0
-            protocol    = "-1"
-            cidr_blocks = [var.vpc_cidr_block]
-          }
-
-          # outbound - internet access
-          egress {
-            from_port   = 0
-            to_port     = 0
-            protocol    = "-1"
-            cidr_blocks = ["0.0.0.0/0"]
-          }
-          tags = { Name = "${var.name_prefix}-reachable-from-vpc" }
-        }
-
-        # reachable-with-ssh allows external SSH access for a resource in a public subnet.
-        resource "aws_security_group" "reachable_with_ssh" {
-          name   = "${var.name_prefix}-reachable-with-ssh"
-          vpc_id = aws_vpc.vpc.id
-
-          # inbound - full access from inside VPC
-          ingress {
-            from_port   = 22
-            to_port     = 22
-            protocol    = "tcp"
-            cidr_blocks = ["0.0.0.0/0"]
-          }
-
-          # outbound - internet access
-          egress {
-            from_port   = 0
-            to_port     = 0
-            protocol    = "-1"
-            cidr_blocks = ["0.0.0.0/0"]
-          }
-
-          tags = { Name = "${var.name_prefix}-reachable-with-ssh" }
-        }
-
-        """
-        )
-        f.write(
-        """
-        # Batch role and policy
-        resource "aws_iam_role" "bioshed_aws_batch_service_role" {
-          name = "bioshed_aws_batch_service_role"
-          assume_role_policy = <<EOF
-{
-  "Version": "2012-10-17",
-  "Statement": [
-    {
-      "Action": "sts:AssumeRole",
-      "Effect": "Allow",
-      "Principal": {
-        "Service": "batch.amazonaws.com"
-      }
-    }
-  ]
-}
-EOF
-        }
-
-        resource "aws_iam_role_policy_attachment" "bioshed_aws_batch_service_role" {
-          role       = aws_iam_role.bioshed_aws_batch_service_role.name
-          policy_arn = "arn:aws:iam::aws:policy/service-role/AWSBatchServiceRole"
-        }
-
-        """
-        )
-        f.write(
-        """
-        # gives EC2 instances deployed by Batch permissions to access container regsitry, container agent, and S3.
-        resource "aws_iam_role" "bioshed_ecs_instance_role" {
-          name = "bioshed_ecs_instance_role"
-
-          assume_role_policy = <<EOF
-{
-  "Version": "2012-10-17",
-    "Statement": [
-      {
-        "Action": "sts:AssumeRole",
-        "Effect": "Allow",
-        "Principal": {
-          "Service": ["ec2.amazonaws.com"]
-        }
-      }
-    ]
-}
-EOF
-        }
-
-        resource "aws_iam_role_policy_attachment" "bioshed_ecs_instance_role" {
-          role       = aws_iam_role.bioshed_ecs_instance_role.name
-          count      = length(var.bioshed_ecs_instance_role_policy_arn)
-          policy_arn = var.bioshed_ecs_instance_role_policy_arn[count.index]
-        }
-
-        resource "aws_iam_instance_profile" "bioshed_ecs_instance_role" {
-          name = "bioshed_ecs_instance_role"
-          role = aws_iam_role.bioshed_ecs_instance_role.name
-        }
-
-        """
-        )
-        f.write(
-        """
-        # Deploys the batch environment within the VPC setup
-        resource "aws_batch_compute_environment" "batch_compute_public" {
-          compute_environment_name = "${var.name_prefix}_batch_compute_public"
-
-          compute_resources {
-            # compute instances within Batch environment will have resource access governed by ECS instance role
-            instance_role = aws_iam_instance_profile.bioshed_ecs_instance_role.arn
-            instance_type = ["m5.large", "m5.xlarge", "m5.2xlarge", "m5.4xlarge"]
-
-            max_vcpus = 256
-            min_vcpus = 0
-
-            security_group_ids = [
-              aws_security_group.reachable_from_vpc.id,
-              aws_security_group.reachable_with_ssh.id
-            ]
-
-            # ec2_key_pair = var.batch_ec2_key
-            ec2_key_pair = aws_key_pair.deployer.id
-
-            subnets = [for s in aws_subnet.public_subnets : s.id]
-
-            type = "EC2"
-
-            image_id = var.batch_ami_id_tiny
-            # ec2_configuration {
-            #  image_id_override = var.batch_ami_id_tiny
-            #  image_type = "ECS_AL2"
-            # }
-          }
-
-          service_role = aws_iam_role.bioshed_aws_batch_service_role.arn
-          type         = "MANAGED"
-          depends_on   = [aws_iam_role_policy_attachment.bioshed_aws_batch_service_role, aws_iam_instance_profile.bioshed_ecs_instance_role, aws_internet_gateway.igw, aws_security_group.reachable_from_vpc, aws_security_group.reachable_with_ssh]
-        }
-
-        resource "aws_batch_job_queue" "batch_job_queue_public" {
-          name     = "${var.name_prefix}_batch_job_queue_public"
-          state    = "ENABLED"
-          priority = 1
-          compute_environments = [
-            aws_batch_compute_environment.batch_compute_public.arn
-          ]
-          depends_on  = [aws_batch_compute_environment.batch_compute_public]
-        }
-
-        """
-        )
-        f.write(
-        """
-        # ECS batch service role and policy - allows Batch access to containers and container agent.
-        resource "aws_iam_role" "bioshed_ecs_batch_service_role" {
-          name = "bioshed_ecs_batch_service_role"
-
-          assume_role_policy = <<EOF
-{
-  "Version": "2012-10-17",
-  "Statement": [
-    {
-      "Action": "sts:AssumeRole",
-      "Effect": "Allow",
-      "Principal": {
-        "Service": ["ec2.amazonaws.com", "ecs.amazonaws.com", "ecs-tasks.amazonaws.com"]
-      }
-    }
-  ]
-}
-EOF
-        }
-
-        resource "aws_iam_role_policy_attachment" "bioshed_ecs_batch_service_role" {
-          role       = aws_iam_role.bioshed_ecs_batch_service_role.name
-          count      = length(var.public_ecs_batch_service_role_policy_arns)
-          policy_arn = var.public_ecs_batch_service_role_policy_arns[count.index]
-        }
-        """
-        )
-    os.chdir(INIT_PATH)
-    subprocess.call('terraform plan -out hs_deploy_core.plan', shell=True)
-    if 'dryrun' not in str(deployoption).lower():
-        subprocess.call('terraform apply hs_deploy_core.plan', shell=True)
-    os.chdir(cwd)
-    # add roles and other config to aws config file
-    quick_utils.add_to_json( configfile, dict(aws_ecr_role='arn:aws:iam::{}:instance-profile/bioshed_ecs_instance_role'.format(aws_id), \
-                                              aws_ecs_job_role='arn:aws:iam::{}:role/bioshed_ecs_batch_service_role'.format(aws_id), \
-                                              jobqueue='bioshed-managed_batch_job_queue_public', \
-                                              working_dir='/home',
-                                              core_setup='True'))
+        dict(type='aws_vpc', name='vpc', comment='Setup VPC and subnets and route tables',
+             block={'cidr_block': '${var.vpc_cidr_block}', 'enable_dns_hostnames': '${var.enable_dns_hostnames}', 'tags': {'Name': '${var.name_prefix}-vpc'}}),
+        dict(type='aws_internet_gateway', name='igw', block={'vpc_id': '${aws_vpc.vpc.id}', 'tags': {'Name': '${var.name_prefix}-igw'}}),
+        dict(type='aws_subnet', name='public_subnets',
+             block={'count': '${var.vpc_subnet_count}', 'cidr_block': '${var.vpc_cidr_range_public_subnets[count.index]}', 'vpc_id': '${aws_vpc.vpc.id}',
+                    'map_public_ip_on_launch': True, 'availability_zone': '${var.aws_azs[count.index]}',
+                    'tags': {'Name': '${var.name_prefix}-public-subnet-${count.index}'}}),
+        dict(type='aws_route_table', name='public_route_table', comment='public route table - mapping of VPC CIDR block to local is added automatically',
+             block={'vpc_id': '${aws_vpc.vpc.id}', 'route{}': {'cidr_block': '0.0.0.0/0', 'gateway_id': '${aws_internet_gateway.igw.id}'},
+                    'tags': {'Name': '${var.name_prefix}-public-route-table'}}),
+        dict(type='aws_main_route_table_association', name='rta-main-public', comment='set main route table',
+             block={'vpc_id': '${aws_vpc.vpc.id}', 'route_table_id': '${aws_route_table.public_route_table.id}'}),
+        dict(type='aws_route_table_association', name='rta-public-subnets', comment='route table associations',
+             block={'count': '${var.vpc_subnet_count}', 'subnet_id': '${aws_subnet.public_subnets[count.index].id}',
+                    'route_table_id': '${aws_route_table.public_route_table.id}'}),
+        dict(type='aws_vpc_endpoint_route_table_association', name='rta-s3-public',
+             comment='s3 endpoint inside VPC - routes any S3-bound traffic to this endpoint instead of through NAT->IGW',
+             block={'route_table_id': '${aws_route_table.public_route_table.id}', 'vpc_endpoint_id': '${aws_vpc_endpoint.s3.id}'}),
+        dict(type='aws_vpc_endpoint', name='s3', block={'vpc_id': '${aws_vpc.vpc.id}', 'service_name': 'com.amazonaws.{}.s3'.format(region)}),
+        dict(type='aws_security_group', name='reachable_from_vpc', comment='reachable-from-vpc allows full access to a resource if within the VPC.',
+             block={'name': '${var.name_prefix}-reachable-from-vpc', 'vpc_id': '${aws_vpc.vpc.id}',
+                    'ingress{}': all_traffic('${var.vpc_cidr_block}'), 'egress{}': all_traffic('0.0.0.0/0'),
+                    'tags': {'Name': '${var.name_prefix}-reachable-from-vpc'}}),
+        dict(type='aws_security_group', name='reachable_with_ssh', comment='reachable-with-ssh allows external SSH access for a resource in a public subnet.',
+             block={'name': '${var.name_prefix}-reachable-with-ssh', 'vpc_id': '${aws_vpc.vpc.id}',
+                    'ingress{}': {'from_port': 22, 'to_port': 22, 'protocol': 'tcp', 'cidr_blocks': ['0.0.0.0/0']}, 'egress{}': all_traffic('0.0.0.0/0'),
+                    'tags': {'Name': '${var.name_prefix}-reachable-with-ssh'}}),
+        dict(type='aws_iam_role', name='bioshed_aws_batch_service_role', comment='Batch role and policy',
+             block={'name': 'bioshed_aws_batch_service_role', 'assume_role_policy': assume_role_policy('batch.amazonaws.com')}),
+        dict(type='aws_iam_role_policy_attachment', name='bioshed_aws_batch_service_role',
+             block={'role': '${aws_iam_role.bioshed_aws_batch_service_role.name}', 'policy_arn': 'arn:aws:iam::aws:policy/service-role/AWSBatchServiceRole'}),
+        dict(type='aws_iam_role', name='bioshed_ecs_instance_role',
+             comment='gives EC2 instances deployed by Batch permissions to access container regsitry, container agent, and S3.',
+             block={'name': 'bioshed_ecs_instance_role', 'assume_role_policy': assume_role_policy(['ec2.amazonaws.com'])}),
+        dict(type='aws_iam_role_policy_attachment', name='bioshed_ecs_instance_role',
+             block={'role': '${aws_iam_role.bioshed_ecs_instance_role.name}', 'count': '${length(var.bioshed_ecs_instance_role_policy_arn)}',
+                    'policy_arn': '${var.bioshed_ecs_instance_role_policy_arn[count.index]}'}),
+        dict(type='aws_iam_instance_profile', name='bioshed_ecs_instance_role',
+             block={'name': 'bioshed_ecs_instance_role', 'role': '${aws_iam_role.bioshed_ecs_instance_role.name}'}),
+        dict(type='aws_iam_role', name='bioshed_ecs_batch_service_role',
+             comment='ECS batch service role and policy - allows Batch access to containers and container agent.',
+             block={'name': 'bioshed_ecs_batch_service_role',
+                    'assume_role_policy': assume_role_policy(['ec2.amazonaws.com', 'ecs.amazonaws.com', 'ecs-tasks.amazonaws.com'])}),
+        dict(type='aws_iam_role_policy_attachment', name='bioshed_ecs_batch_service_role',
+             block={'role': '${aws_iam_role.bioshed_ecs_batch_service_role.name}', 'count': '${length(var.public_ecs_batch_service_role_policy_arns)}',
+                    'policy_arn': '${var.public_ecs_batch_service_role_policy_arns[count.index]}'})] \
+        + batch_launch_template( dict(profile=args['profile'])) + batch_tier_resources( dict(profile=args['profile']))
+
+def batch_launch_template( args ):
+    """ Launch template of Batch instances - adds a host-level S3 object cache volume (profile reference_cache_gb),
+    mounted and set up for job containers at boot (see bioshed_refcache). No launch template if reference_cache_gb is 0.
+
+    profile: sizing profile
+    ---
+    blocks: list of resource blocks
+    """
+    if args['profile']['reference_cache_gb'] <= 0:
+        return []
+    device_name = '/dev/xvdb'
+    # Batch requires MIME multi-part user data; a boothook runs before the ECS agent starts jobs
+    user_data = '\n'.join(['MIME-Version: 1.0', 'Content-Type: multipart/mixed; boundary="==BIOSHED=="', '', '--==BIOSHED==',
+                            'Content-Type: text/cloud-boothook; charset="us-ascii"', '',
+                            bioshed_refcache.host_setup_script( dict(device_name=device_name)), '--==BIOSHED==--', ''])
+    return [dict(type='aws_launch_template', name='batch_launch_template', comment='Batch instances with a host-level reference cache volume',
+                 block={'name': '${var.name_prefix}-batch-launch-template',
+                        'block_device_mappings{}': {'device_name': device_name,
+                                                    'ebs{}': {'volume_size': args['profile']['reference_cache_gb'], 'volume_type': 'gp3',
+                                                              'delete_on_termination': True}},
+                        'user_data': base64.b64encode(user_data.encode()).decode()})]
+
+def batch_tier_resources( args ):
+    """ Batch compute environments and job queues for the tiers of a sizing profile (see bioshed_sizing) -
+    one queue per tier; a Spot tier's queue has a Spot environment first and an On-Demand environment as fallback.
+
+    profile: sizing profile
+    ---
+    blocks: list of resource blocks
+    """
+    blocks = []
+    for tier in args['profile']['tiers']:
+        suffix = bioshed_sizing.tier_resource_name( tier )
+        environments = []
+        for spot in ([True, False] if tier['spot'] else [False]):
+            name = 'batch_compute_{}{}'.format(suffix, '_spot' if spot else '')
+            compute_resources = {'instance_role': '${aws_iam_instance_profile.bioshed_ecs_instance_role.arn}',
+                                 'instance_type': tier['instance_types'],
+                                 'max_vcpus': tier['max_vcpus'], 'min_vcpus': tier['min_vcpus'],
+                                 'security_group_ids': ['${aws_security_group.reachable_from_vpc.id}', '${aws_security_group.reachable_with_ssh.id}'],
+                                 'ec2_key_pair': '${aws_key_pair.deployer.id}',
+                                 'subnets': '${[for s in aws_subnet.public_subnets : s.id]}',
+                                 'type': 'SPOT' if spot else 'EC2',
+                                 'image_id': tier['image_id'] if tier['image_id'] != '' else '${var.batch_ami_id_tiny}'}
+            if args['profile'].get('reference_cache_gb', 0) > 0:
+                compute_resources['launch_template{}'] = {'launch_template_id': '${aws_launch_template.batch_launch_template.id}',
+                                                          'version': '${aws_launch_template.batch_launch_template.latest_version}'}
+            if spot:
+                compute_resources.update({'allocation_strategy': 'SPOT_CAPACITY_OPTIMIZED', 'bid_percentage': args['profile'].get('spot_bid_percentage', 100)})
+            blocks.append(dict(type='aws_batch_compute_environment', name=name,
+                               comment='Batch environment for {} jobs ({}){}'.format(tier['name'], ', '.join(tier['instance_types']), ' - Spot' if spot else ''),
+                               block={'compute_environment_name': '${var.name_prefix}_' + name,
+                                      # compute instances within Batch environment will have resource access governed by ECS instance role
+                                      'compute_resources{}': compute_resources,
+                                      'service_role': '${aws_iam_role.bioshed_aws_batch_service_role.arn}',
+                                      'type': 'MANAGED',
+                                      'depends_on': ['${aws_iam_role_policy_attachment.bioshed_aws_batch_service_role}',
+                                                     '${aws_iam_instance_profile.bioshed_ecs_instance_role}', '${aws_internet_gateway.igw}',
+                                                     '${aws_security_group.reachable_from_vpc}', '${aws_security_group.reachable_with_ssh}']}))
+            environments.append('aws_batch_compute_environment.' + name)
+        blocks.append(dict(type='aws_batch_job_queue', name='batch_job_queue_{}'.format(suffix),
+                           block={'name': '${var.name_prefix}_batch_job_queue_' + suffix, 'state': 'ENABLED', 'priority': 1,
+                                  # environments are tried in order - Spot first, then On-Demand
+                                  'compute_environments': ['${' + e + '.arn}' for e in environments],
+                                  'depends_on': ['${' + e + '}' for e in environments]}))
+    return blocks
+
+def deploy_resources( args ):
+    """ Writes resource models to TF files and deploys only what changed since the last deploy.
+
+    Each rendered block is hashed and compared with the hashes saved after the last successful apply (DEPLOY_STATE_FILE).
+    - nothing changed (and no deployoption 'full'): terraform is not run at all.
+    - some blocks changed: plan/apply with -target for the changed resources, resources using changed variables, and
+      resources that reference those (terraform adds what targets depend on, but not what depends on them).
+      -refresh=false is used when terraform state is unchanged since the last bioshed deploy (nothing else applied).
+    - first deploy, removed resources, changes to other TF files in initpath (e.g., provider), or deployoption 'full':
+      full plan/apply.
 
-    return
+    initpath: path to init files
+    files: dict of TF file name -> list of resource blocks
+    deployoption: (optional) dryrun (plan only), full (full plan with refresh)
+    ---
+    result: 'unchanged', 'applied', 'planned' (dryrun), or -1 if terraform failed
+    """
+    INIT_PATH = args['initpath']
+    deployoption = str(args['deployoption']).lower() if 'deployoption' in args else ''
+    statefile = os.path.join(INIT_PATH, DEPLOY_STATE_FILE)
+    last = {}
+    if os.path.exists(statefile):
+        with open(statefile, 'r') as f:
+            last = json.load(f)
+    hashes = {}
+    texts = {}
+    for filename, blocks in args['files'].items():
+        for block in blocks:
+            address = bioshed_core_utils.resource_address( block )
+            texts[address] = bioshed_core_utils.render_resource_block( block )
+            hashes[address] = hashlib.sha256(texts[address].encode()).hexdigest()
+        write_if_changed( os.path.join(INIT_PATH, filename), ''.join(bioshed_core_utils.render_resource_block( block ) for block in blocks))
+    other_files = other_tf_hashes( dict(initpath=INIT_PATH, exclude=list(args['files'].keys())))
+
+    changed = [a for a in hashes if last.get('resources', {}).get(a, '') != hashes[a]]
+    removed = [a for a in last.get('resources', {}) if a not in hashes]
+    if changed == [] and removed == [] and other_files == last.get('files', {}) and 'full' not in deployoption:
+        print('Core infrastructure is up to date - no resources changed since the last deploy.')
+        return 'unchanged'
+
+    plan_args = ['-out', 'hs_deploy_core.plan']
+    if last == {} or removed != [] or other_files != last.get('files', {}) or 'full' in deployoption:
+        print('Planning all resources.')
+    else:
+        targets = dependent_resources( dict(changed=changed, texts=texts))
+        print('Planning {} changed resource(s): {}'.format(len(targets), ', '.join(targets)))
+        plan_args += ['-target={}'.format(t) for t in targets]
+        if last.get('tfstate_serial', None) == tfstate_serial( dict(initpath=INIT_PATH)):
+            plan_args.append('-refresh=false')
+    if bioshed_terraform.terraform_init( dict(initpath=INIT_PATH)) != 0:
+        print('ERROR: terraform init failed.')
+        return -1
+    if bioshed_terraform.run_terraform( dict(initpath=INIT_PATH, command=['plan'] + plan_args)) != 0:
+        print('ERROR: terraform plan failed.')
+        return -1
+    if 'dryrun' in deployoption:
+        return 'planned'
+    if bioshed_terraform.run_terraform( dict(initpath=INIT_PATH, command=['apply', 'hs_deploy_core.plan'])) != 0:
+        print('ERROR: terraform apply failed.')
+        return -1
+    bioshed_config.write_json_atomic( dict(resources=hashes, files=other_files, tfstate_serial=tfstate_serial( dict(initpath=INIT_PATH)), deployed=time.time()), statefile )
+    return 'applied'
+
+def dependent_resources( args ):
+    """ Resources to target for a set of changed blocks: changed resources, resources that use changed variables,
+    and (transitively) resources that reference any of those.
+
+    changed: changed addresses (resources and var.*)
+    texts: dict of address -> rendered block
+    ---
+    targets: sorted list of resource addresses
+    """
+    texts = args['texts']
+    targets = set(args['changed'])
+    added = True
+    while added:
+        added = False
+        for address, text in texts.items():
+            if address not in targets and any(re.search(r'(?<![\w.])' + re.escape(t) + r'(?![\w-])', text) for t in targets):
+                targets.add(address)
+                added = True
+    return sorted(t for t in targets if not t.startswith('var.'))
+
+def write_if_changed( fname, text ):
+    """ Writes a file (atomically) only if its content changed.
+    """
+    if os.path.exists(fname):
+        with open(fname, 'r') as f:
+            if f.read() == text:
+                return False
+    tmpfile = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmpfile, 'w') as f:
+        f.write(text)
+    os.replace(tmpfile, fname)
+    return True
+
+def other_tf_hashes( args ):
+    """ Hashes of the other TF files in initpath (providers, keys), which are not part of a resource model.
+    """
+    hashes = {}
+    for fname in sorted(os.listdir(args['initpath'])):
+        if fname.endswith('.tf') and fname not in args['exclude']:
+            with open(os.path.join(args['initpath'], fname), 'rb') as f:
+                hashes[fname] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+def tfstate_serial( args ):
+    """ Serial of the local terraform state (incremented by terraform on every state change), or None.
+    """
+    try:
+        with open(os.path.join(args['initpath'], 'terraform.tfstate'), 'r') as f:
+            return json.load(f).get('serial', None)
+    except (OSError, ValueError):
+        return None
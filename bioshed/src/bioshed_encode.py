@@ -0,0 +1,289 @@
+import os, sys, ast, json, sqlite3, threading, functools, concurrent.futures
+##
+## ENCODE search results and downloads (bioshed search encode ..., bioshed download encode ...).
+##
+## Search results are stored in an SQLite results file (search_encode.db) next to the search_encode.txt export:
+## one row per experiment, and one row per file (the stringified file lists of the TSV, exploded), indexed by
+## experiment. Download filters (--assay/--species/--celltype/--experiment/--filetype) run as SQL queries on it, so
+## large result sets are never loaded whole. A TSV passed with --input is converted on first use.
+##
+## Experiments are resolved to their downloadable files with a bounded pool of concurrent requests over one
+## keep-alive session. Resolved files are written to the same results file as they come in, so an interrupted
+## resolution - or a download after "--list" - picks up where it left off. BIOSHED_ENCODE_URL points at another
+## ENCODE server (e.g., a local stand-in for testing). Responses go through the HTTP response cache (bioshed_httpcache).
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+ENCODE_URL = os.environ.get('BIOSHED_ENCODE_URL', 'https://www.encodeproject.org').rstrip('/')
+ENCODE_CONCURRENCY = int(os.environ.get('BIOSHED_ENCODE_CONCURRENCY', 16))
+DEFAULT_SEARCH_FILE = 'search_encode.txt'
+INFO_COLUMNS = ['experiment', 'assay', 'celltype', 'species']
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_transfer
+import bioshed_httpcache
+
+@functools.lru_cache(maxsize=None)
+def get_session():
+    """ One requests session per process - keep-alive connections shared by all resolver threads,
+    with retries on rate limiting (429) and server errors.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    session = requests.Session()
+    retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, ENCODE_CONCURRENCY), max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'accept': 'application/json'})
+    return session
+
+
+def get_json( args ):
+    """ GET an ENCODE URL as JSON (through the response cache).
+
+    url: URL suffix (e.g., /experiments/ENCSR000AHE/) or full URL
+    ---
+    results: JSON
+    """
+    url = args['url'] if str(args['url']).startswith('http') else '{}/{}'.format(ENCODE_URL, str(args['url']).lstrip('/'))
+    response = bioshed_httpcache.cached_request( dict(url=url, session=get_session(), headers={'accept': 'application/json'}))
+    response.raise_for_status()
+    return response.json()
+
+
+def results_file( infile ):
+    """ SQLite results file for a search results TSV - search_encode.txt -> search_encode.db
+    """
+    return os.path.splitext(infile)[0] + '.db'
+
+
+def open_results( args ):
+    """ Opens (and creates if needed) a search results file.
+
+    resultsdb: results file
+    """
+    conn = sqlite3.connect(args['resultsdb'], timeout=30, check_same_thread=False)     # resolver threads write under a lock
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS experiments (experiment TEXT PRIMARY KEY, assay TEXT, celltype TEXT, species TEXT, accession TEXT);
+        CREATE TABLE IF NOT EXISTS experiment_files (experiment TEXT, file TEXT);
+        CREATE INDEX IF NOT EXISTS experiment_files_experiment ON experiment_files (experiment);
+        CREATE TABLE IF NOT EXISTS resolved (experiment TEXT PRIMARY KEY, resolved REAL);
+        CREATE TABLE IF NOT EXISTS files (experiment TEXT, file TEXT, file_format TEXT, file_size INTEGER);
+        CREATE INDEX IF NOT EXISTS files_experiment ON files (experiment);
+        CREATE INDEX IF NOT EXISTS files_format ON files (file_format);""")
+    return conn
+
+
+def save_results( args ):
+    """ Writes search results (the data frame returned by atlas_encode_utils.search_encode) to a results file,
+    replacing earlier results.
+
+    results: data frame - experiment, assay, celltype, species, accession (list), file (list of /files/... IDs)
+    resultsdb: (optional) results file - default search_encode.db
+    ---
+    resultsdb: results file
+    """
+    df = args['results']
+    resultsdb = args['resultsdb'] if args.get('resultsdb', '') != '' else results_file( DEFAULT_SEARCH_FILE )
+    for path in [resultsdb, resultsdb + '-wal', resultsdb + '-shm']:
+        if os.path.exists(path):
+            os.remove(path)
+    conn = open_results( dict(resultsdb=resultsdb))
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO experiments VALUES (?, ?, ?, ?, ?)',
+                         [(str(r['experiment']), str(r['assay']), str(r['celltype']), str(r['species']), json.dumps(as_list( r['accession'] )))
+                          for r in df.to_dict('records')])
+        conn.executemany('INSERT INTO experiment_files VALUES (?, ?)',
+                         [(str(r['experiment']), str(f)) for r in df.to_dict('records') for f in as_list( r['file'] )])
+    conn.close()
+    return resultsdb
+
+
+def load_results( args ):
+    """ Opens the results file for a search results TSV, converting the TSV if there is no up-to-date results file.
+
+    infile: search results TSV
+    ---
+    conn: results file connection
+    """
+    import pandas as pd
+    resultsdb = results_file( args['infile'] )
+    if not os.path.exists(resultsdb) or os.path.getmtime(resultsdb) < os.path.getmtime(args['infile']) - 1:
+        save_results( dict(results=pd.read_csv(args['infile'], sep='\t'), resultsdb=resultsdb))
+    return open_results( dict(resultsdb=resultsdb))
+
+
+def export_results( args ):
+    """ Writes a results file back out as a bioshed search results TSV (index, experiment, assay, celltype, species, accession, file).
+
+    resultsdb: results file
+    outfile: TSV to write
+    """
+    import pandas as pd
+    conn = open_results( args )
+    files = {}
+    for row in conn.execute('SELECT experiment, file FROM experiment_files'):
+        files.setdefault(row['experiment'], []).append(row['file'])
+    df = pd.read_sql_query('SELECT experiment, assay, celltype, species, accession FROM experiments', conn)
+    conn.close()
+    df['accession'] = df['accession'].apply(json.loads)
+    df['file'] = df['experiment'].apply(lambda e: files.get(e, []))
+    df.index.name = 'index'
+    df.to_csv(args['outfile'], sep='\t')
+    return args['outfile']
+
+
+def as_list( value ):
+    """ A list column value - a list, or its string form as written to the TSV ("['/files/ENCFF804ONU/', ...]").
+    """
+    if isinstance(value, list):
+        return value
+    try:
+        parsed = ast.literal_eval(str(value))
+        return list(parsed) if isinstance(parsed, (list, tuple)) else []
+    except (ValueError, SyntaxError):
+        return []
+
+
+def select_experiments( args ):
+    """ Experiments matching the download filters (case-insensitive substring match, as in the search TSV).
+
+    conn: results file connection
+    filters: dict of column (assay, species, experiment, celltype) -> value
+    ---
+    experiments: list of experiment URL suffixes
+    """
+    where = ['{} LIKE ?'.format(column) for column in INFO_COLUMNS if args['filters'].get(column, '') != '']
+    params = ['%{}%'.format(args['filters'][column]) for column in INFO_COLUMNS if args['filters'].get(column, '') != '']
+    query = 'SELECT experiment FROM experiments' + (' WHERE ' + ' AND '.join(where) if where != [] else '')
+    return [row['experiment'] for row in args['conn'].execute(query, params)]
+
+
+def select_files( args ):
+    """ Resolved files of the selected experiments, with experiment info - optionally only files matching any of
+    the given file types (file format or part of the file name).
+
+    conn: results file connection
+    experiments: list of experiment URL suffixes
+    filetypes: (optional) list of file types
+    ---
+    files: list of dict(file, file_size, info)
+    """
+    conn = args['conn']
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS selected (experiment TEXT PRIMARY KEY)')
+    conn.execute('DELETE FROM selected')
+    conn.executemany('INSERT OR IGNORE INTO selected VALUES (?)', [(e,) for e in args['experiments']])
+    filetypes = [ftype for ftype in args.get('filetypes', []) if ftype != '']
+    where = ' AND (' + ' OR '.join(['f.file_format = ? COLLATE NOCASE OR f.file LIKE ?'] * len(filetypes)) + ')' if filetypes != [] else ''
+    params = [p for ftype in filetypes for p in (ftype, '%{}%'.format(ftype))]
+    rows = conn.execute("""SELECT f.file, MAX(f.file_size) AS file_size, e.experiment, e.assay, e.celltype, e.species
+                           FROM selected s JOIN files f ON f.experiment = s.experiment JOIN experiments e ON e.experiment = s.experiment
+                           WHERE 1 = 1{} GROUP BY f.file ORDER BY e.experiment, f.file""".format(where), params).fetchall()
+    return [dict(file=row['file'], file_size=row['file_size'], info='; '.join(str(row[c]) for c in INFO_COLUMNS)) for row in rows]
+
+
+def resolve_experiments( args ):
+    """ Resolves experiments to their files, concurrently, writing them to the results file as they come in.
+    Experiments already resolved in the results file are not requested again.
+
+    conn: results file connection
+    experiments: list of experiment URL suffixes (/experiments/ENCSR.../)
+    concurrency: (optional) requests in flight - default BIOSHED_ENCODE_CONCURRENCY
+    ---
+    failed: list of experiments that could not be resolved
+    """
+    import time
+    conn = args['conn']
+    experiments = list(dict.fromkeys(args['experiments']))
+    concurrency = int(args['concurrency']) if args.get('concurrency', '') != '' else ENCODE_CONCURRENCY
+    done = set(row['experiment'] for row in conn.execute('SELECT experiment FROM resolved'))
+    todo = [e for e in experiments if e not in done]
+    if len(experiments) > len(todo):
+        print('Resuming: {} of {} experiments already resolved.'.format(len(experiments) - len(todo), len(experiments)))
+    lock = threading.Lock()
+    failed = []
+    progress = [0]
+    def resolve_one( e_url ):
+        try:
+            results = get_json( dict(url=e_url))
+        except Exception as e:
+            print('ERROR: could not resolve {}: {}'.format(e_url, str(e)))
+            return e_url
+        files = [(e_url, f['s3_uri'], f.get('file_format', ''), int(f.get('file_size', 0))) for f in results.get('files', []) if 's3_uri' in f]
+        with lock:
+            with conn:
+                conn.execute('DELETE FROM files WHERE experiment = ?', (e_url,))
+                conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?)', files)
+                conn.execute('INSERT OR REPLACE INTO resolved VALUES (?, ?)', (e_url, time.time()))
+            progress[0] += 1
+            if progress[0] % 50 == 0:
+                print('\tresolved {} of {} experiments'.format(progress[0], len(todo)))
+        return None
+
+    if todo != []:
+        print('Resolving files for {} experiments ({} at a time)...'.format(len(todo), concurrency))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(todo)))) as executor:
+            failed = [e for e in executor.map(resolve_one, todo) if e != None]
+    if failed != []:
+        print('WARNING: {} experiment(s) could not be resolved - run again to retry them.'.format(len(failed)))
+    return failed
+
+
+def download_encode( args ):
+    """ Entrypoint for an ENCODE download, from the results of "bioshed search encode".
+
+    downloadstr: download string passed in, which can include the following:
+
+    --list : list files, but do not download (like a dryrun)
+    --input <file name> : search results - default search_encode.txt (its search_encode.db results file is used)
+    --output <output directory or s3:// folder>
+    --filetype <refine by file type(s) - space delimited, any of>
+    --assay <refine by assay>
+    --species <refine by species>
+    --experiment <refine by experiment ID>
+    --celltype <refine by cell type>
+    --concurrency <experiments resolved at a time>
+    --export <file name> : write the (filtered) file list as a TSV
+    ---
+    downloaded_files: list of downloaded files
+    """
+    import atlas_utils
+    dd = atlas_utils.parse_search_terms( args['downloadstr'] ) if args.get('downloadstr', '') != '' else {}
+    infile = dd['input'] if dd.get('input', '') != '' else DEFAULT_SEARCH_FILE
+    outdir = dd['output'] if dd.get('output', '') != '' else str(os.getcwd())
+    if not os.path.exists(infile) and not os.path.exists(results_file( infile )):
+        print('File {} does not exist. Please first run "bioshed search encode"'.format(infile))
+        return []
+
+    conn = load_results( dict(infile=infile)) if os.path.exists(infile) else open_results( dict(resultsdb=results_file( infile )))
+    experiments = select_experiments( dict(conn=conn, filters=dd))
+    resolve_experiments( dict(conn=conn, experiments=experiments, concurrency=dd.get('concurrency', '')))
+    files = select_files( dict(conn=conn, experiments=experiments, filetypes=dd.get('filetype', '').split(' ')))
+    conn.close()
+
+    if dd.get('export', '') != '':
+        with open(dd['export'], 'w') as f:
+            f.write('file\tfile_size\tinfo\n')
+            f.writelines('{}\t{}\t{}\n'.format(row['file'], row['file_size'], row['info']) for row in files)
+        print('File list written to {}.'.format(dd['export']))
+    if 'list' in dd:
+        # list files, but do not download
+        print('FILE\tINFO (EXPT; ASSAY; CELLTYPE; SPECIES)')
+        for row in files:
+            print('{}\t{}'.format(row['file'].split('/')[-1], row['info']))
+        return []
+    if dd.get('export', '') != '' and 'output' not in dd:
+        return []
+    if outdir.startswith('s3://'):
+        transfers = [dict(src=row['file'], dest=outdir.rstrip('/') + '/' + row['file'].split('/')[-1], size=row['file_size']) for row in files]
+    else:
+        transfers = [dict(src=row['file'], dest=os.path.join(outdir, row['file'].split('/')[-1]), size=row['file_size']) for row in files]
+    if transfers == []:
+        print('No files to download.')
+        return []
+    result = bioshed_transfer.transfer_files( dict(transfers=transfers))
+    failed = set(f['src'] for f in result['failed'])
+    return [t['dest'] for t in transfers if t['src'] not in failed]
@@ -0,0 +1,248 @@
+import os, time, sqlite3, hashlib, threading, functools, concurrent.futures
+##
+## GDC/TCGA bulk downloads from a manifest (bioshed download gdc --manifest <MANIFEST> ...).
+##
+## The manifest is a GDC portal manifest (id, filename, md5, size) or any tab-delimited file with a file ID column
+## (id / file_id), e.g. GDC search output. Files download concurrently; large files are split into ranged requests
+## that are written in place and also run concurrently. Every file is checked against the manifest md5 (and size).
+## Progress is recorded in <output dir>/.bioshed_gdc.db - finished files and finished parts of unfinished files - so a
+## rerun only fetches files that are missing, incomplete or corrupt. BIOSHED_GDC_URL points at another GDC API
+## (e.g., a local stand-in for testing); controlled-access files need a GDC token (--token-file or BIOSHED_GDC_TOKEN).
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+GDC_URL = os.environ.get('BIOSHED_GDC_URL', 'https://api.gdc.cancer.gov').rstrip('/')
+GDC_CONCURRENCY = int(os.environ.get('BIOSHED_GDC_CONCURRENCY', 8))          # files in parallel
+GDC_PART_CONCURRENCY = int(os.environ.get('BIOSHED_GDC_PART_CONCURRENCY', 4))  # ranged requests in parallel per file
+GDC_PART_MB = int(os.environ.get('BIOSHED_GDC_PART_MB', 64))
+GDC_RETRIES = 3
+GDC_TIMEOUT = 300
+STATE_FILE = '.bioshed_gdc.db'
+PROGRESS_SECONDS = 5
+
+@functools.lru_cache(maxsize=None)
+def get_session( token = '' ):
+    """ One requests session per process, with a connection pool large enough for all download threads.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max(10, GDC_CONCURRENCY * GDC_PART_CONCURRENCY))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if token != '':
+        session.headers.update({'X-Auth-Token': token})
+    return session
+
+
+def read_manifest( args ):
+    """ Reads a GDC manifest (or search output with a file ID column).
+
+    manifest: tab-delimited file - id/file_id, and optionally filename/file_name, md5/md5sum, size/file_size
+    ---
+    files: list of dict(id, filename, md5, size) - size 0 if unknown
+    """
+    import csv
+    files = []
+    with open(args['manifest'], 'r', newline='') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            row = dict((str(k).strip().lower(), str(v or '').strip()) for k, v in row.items() if k != None)
+            file_id = row.get('id', row.get('file_id', ''))
+            if file_id == '':
+                continue
+            size = row.get('size', row.get('file_size', ''))
+            files.append(dict(id=file_id, filename=row.get('filename', row.get('file_name', '')) or file_id,
+                              md5=row.get('md5', row.get('md5sum', '')).lower(), size=int(float(size)) if size != '' else 0))
+    if files == []:
+        raise ValueError('no file IDs found in {} (expected an "id" or "file_id" column)'.format(args['manifest']))
+    return files
+
+
+def open_state( args ):
+    """ Opens (and creates if needed) the download state of an output directory.
+    """
+    conn = sqlite3.connect(os.path.join(args['outdir'], STATE_FILE), timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS files (id TEXT PRIMARY KEY, path TEXT, md5 TEXT, size INTEGER, mtime REAL, completed REAL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS parts (id TEXT, start INTEGER, size INTEGER, PRIMARY KEY (id, start))')
+    return conn
+
+
+def download_manifest( args ):
+    """ Downloads every file in a manifest, skipping files already downloaded and verified.
+
+    manifest: manifest file (see read_manifest)
+    outdir: (optional) output directory - default current directory
+    concurrency: (optional) files in parallel
+    part_size: (optional) ranged request size in MB
+    token: (optional) GDC authentication token - default BIOSHED_GDC_TOKEN
+    ---
+    result: dict(files, downloaded, skipped, failed=[dict(id, filename, error)], bytes, seconds, mbps)
+    """
+    files = read_manifest( args )
+    outdir = args['outdir'] if args.get('outdir', '') != '' else str(os.getcwd())
+    concurrency = int(args['concurrency']) if args.get('concurrency', '') != '' else GDC_CONCURRENCY
+    part_bytes = int(float(args['part_size']) * 1024**2) if args.get('part_size', '') != '' else GDC_PART_MB * 1024**2
+    token = args['token'] if args.get('token', '') != '' else os.environ.get('BIOSHED_GDC_TOKEN', '')
+    os.makedirs(outdir, exist_ok=True)
+    conn = open_state( dict(outdir=outdir))
+    lock = threading.Lock()
+    progress = dict(bytes=0, done=0)
+    context = dict(conn=conn, lock=lock, progress=progress, outdir=outdir, part_bytes=part_bytes, session=get_session( token ))
+
+    todo = []
+    skipped = 0
+    for f in files:
+        if file_complete( dict(context, file=f)):
+            skipped += 1
+        else:
+            todo.append(f)
+    total_bytes = sum(f['size'] for f in todo)
+    print('{} of {} files already downloaded and verified. Downloading {} files ({:.2f} GB, {} at a time)...'.format(
+          skipped, len(files), len(todo), total_bytes / 1024**3, concurrency))
+    start = time.time()
+    stop = threading.Event()
+    def report():
+        while not stop.wait(PROGRESS_SECONDS):
+            print('\t{}/{} files | {:.2f} / {:.2f} GB | {:.1f} MB/s'.format(progress['done'], len(todo), progress['bytes'] / 1024**3,
+                  total_bytes / 1024**3, progress['bytes'] / 1024**2 / (time.time() - start)), flush=True)
+    threading.Thread(target=report, daemon=True).start()
+    def download_one( f ):
+        error = download_file( dict(context, file=f))
+        with lock:
+            progress['done'] += 1
+        return None if error == '' else dict(id=f['id'], filename=f['filename'], error=error)
+    failed = []
+    if todo != []:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(todo)))) as executor:
+            failed = [f for f in executor.map(download_one, todo) if f != None]
+    stop.set()
+    conn.close()
+    seconds = max(time.time() - start, 1e-9)
+    result = dict(files=len(files), downloaded=len(todo) - len(failed), skipped=skipped, failed=failed,
+                  bytes=progress['bytes'], seconds=seconds, mbps=progress['bytes'] / 1024**2 / seconds)
+    print('Downloaded {} file(s), {:.2f} GB in {:.1f}s ({:.1f} MB/s). Skipped {} already complete. Failed: {}.'.format(
+          result['downloaded'], result['bytes'] / 1024**3, seconds, result['mbps'], skipped, len(failed)))
+    for f in failed:
+        print('ERROR: {} ({}): {}'.format(f['filename'], f['id'], f['error']))
+    if failed != []:
+        print('Run the same command again to retry - completed files and parts are not downloaded again.')
+    return result
+
+
+def file_complete( args ):
+    """ Whether a manifest file is already downloaded and verified. Files recorded as complete are trusted if their size
+    and mtime are unchanged; an unrecorded file of the right size (e.g., from another tool) is checked against its md5.
+    """
+    f = args['file']
+    path = os.path.join(args['outdir'], f['filename'])
+    if not os.path.exists(path):
+        return False
+    row = args['conn'].execute('SELECT * FROM files WHERE id = ?', (f['id'],)).fetchone()
+    if row != None and row['completed'] != None and row['path'] == path and row['size'] == os.path.getsize(path) and row['mtime'] == os.path.getmtime(path):
+        return True
+    if f['md5'] == '' or (f['size'] != 0 and os.path.getsize(path) != f['size']) or file_md5( path ) != f['md5']:
+        return False
+    mark_complete( dict(args, path=path))
+    return True
+
+
+def mark_complete( args ):
+    with args['lock']:
+        with args['conn']:
+            args['conn'].execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', (args['file']['id'], args['path'], args['file']['md5'],
+                                 os.path.getsize(args['path']), os.path.getmtime(args['path']), time.time()))
+            args['conn'].execute('DELETE FROM parts WHERE id = ?', (args['file']['id'],))
+    return
+
+
+def download_file( args ):
+    """ Downloads one file - ranged parts in parallel into <file>.part (parts already done in an earlier run are kept),
+    then verifies size and md5 and moves it into place.
+    ---
+    error: '' if the file was downloaded and verified
+    """
+    f = args['file']
+    conn, lock = args['conn'], args['lock']
+    path = os.path.join(args['outdir'], f['filename'])
+    partfile = path + '.part'
+    url = '{}/data/{}'.format(GDC_URL, f['id'])
+    session = args['session']
+    try:
+        size = f['size'] if f['size'] != 0 else remote_size( dict(session=session, url=url))
+        if size == 0 or size <= args['part_bytes']:
+            parts = [(0, size)]
+            done = set()
+            if os.path.exists(partfile):
+                os.remove(partfile)
+        else:
+            parts = [(start, min(args['part_bytes'], size - start)) for start in range(0, size, args['part_bytes'])]
+            with lock:
+                done = set(row['start'] for row in conn.execute('SELECT start FROM parts WHERE id = ? AND size = ?', (f['id'], args['part_bytes'])))
+            if not os.path.exists(partfile):
+                done = set()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(partfile, 'r+b' if os.path.exists(partfile) else 'w+b') as out:
+            if size > 0:
+                out.truncate(size)
+            def fetch_part( part ):
+                start, length = part
+                for attempt in range(GDC_RETRIES + 1):
+                    written = 0
+                    try:
+                        headers = {'Range': 'bytes={}-{}'.format(start, start + length - 1)} if len(parts) > 1 else {}
+                        with session.get(url, headers=headers, stream=True, timeout=GDC_TIMEOUT) as response:
+                            response.raise_for_status()
+                            if len(parts) > 1 and response.status_code != 206:
+                                raise IOError('server does not support ranged requests')
+                            for chunk in response.iter_content(chunk_size=1024*1024):
+                                os.pwrite(out.fileno(), chunk, start + written)
+                                written += len(chunk)
+                                with lock:
+                                    args['progress']['bytes'] += len(chunk)
+                        if len(parts) > 1 and written != length:
+                            raise IOError('short read: {} of {} bytes'.format(written, length))
+                        if len(parts) > 1:
+                            with lock:
+                                with conn:
+                                    conn.execute('INSERT OR REPLACE INTO parts VALUES (?, ?, ?)', (f['id'], start, args['part_bytes']))
+                        return
+                    except Exception:
+                        with lock:
+                            args['progress']['bytes'] -= written
+                        if attempt == GDC_RETRIES:
+                            raise
+                        time.sleep(min(2 ** attempt, 30))
+            todo = [part for part in parts if part[0] not in done]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(GDC_PART_CONCURRENCY, len(todo)))) as executor:
+                list(executor.map(fetch_part, todo))
+        if f['size'] != 0 and os.path.getsize(partfile) != f['size']:
+            raise IOError('size {} does not match manifest size {}'.format(os.path.getsize(partfile), f['size']))
+        if f['md5'] != '' and file_md5( partfile ) != f['md5']:
+            os.remove(partfile)
+            with lock:
+                with conn:
+                    conn.execute('DELETE FROM parts WHERE id = ?', (f['id'],))
+            raise IOError('md5 does not match manifest - removed, will be downloaded again')
+        os.replace(partfile, path)
+        mark_complete( dict(args, path=path))
+        return ''
+    except Exception as e:
+        return str(e)
+
+
+def remote_size( args ):
+    """ Size of a remote file from a one-byte ranged request (Content-Range), or 0 if unknown.
+    """
+    with args['session'].get(args['url'], headers={'Range': 'bytes=0-0'}, stream=True, timeout=GDC_TIMEOUT) as response:
+        response.raise_for_status()
+        content_range = response.headers.get('Content-Range', '')
+        return int(content_range.split('/')[-1]) if '/' in content_range and content_range.split('/')[-1].isdigit() else 0
+
+
+def file_md5( path ):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(8*1024*1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
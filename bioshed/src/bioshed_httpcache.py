@@ -0,0 +1,266 @@
+import os, time, json, shutil, sqlite3, hashlib, threading, urllib.parse
+##
+## On-disk HTTP response cache for dataset searches (bioshed search encode/gdc ..., ENCODE experiment resolution).
+##
+## Responses are stored under ~/.bioshedinit/httpcache/, keyed by the normalized request (method, URL with sorted
+## query parameters, body). Within BIOSHED_HTTP_CACHE_TTL seconds a cached response is returned with no network call.
+## After that it is revalidated with If-None-Match / If-Modified-Since, and a 304 reuses the stored body.
+## The cache is limited to BIOSHED_HTTP_CACHE_MAX_MB; least recently used responses are evicted first.
+## --refresh (or BIOSHED_HTTP_CACHE=0) skips cached responses for one command.
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+HTTP_CACHE_DIR = os.path.join(INIT_PATH, 'httpcache')
+HTTP_CACHE_DB = os.path.join(INIT_PATH, 'httpcache.db')
+HTTP_CACHE_TTL = int(os.environ.get('BIOSHED_HTTP_CACHE_TTL', 24*60*60))
+HTTP_CACHE_MAX_BYTES = int(float(os.environ.get('BIOSHED_HTTP_CACHE_MAX_MB', 512)) * 1024**2)
+HTTP_TIMEOUT = 120
+
+_session_stats = dict(fresh=0, revalidated=0, misses=0, bytes_served=0)     # this command's counters, for the report
+_options = dict(refresh=False, installed=False)
+_lock = threading.Lock()
+
+def cache_enabled( args ):
+    """ Whether cached responses are used (they are always stored).
+
+    refresh: True (--refresh) - ignore cached responses
+    """
+    return not args.get('refresh', _options['refresh']) and os.environ.get('BIOSHED_HTTP_CACHE', '') != '0'
+
+
+def open_cache( args ):
+    """ Opens (and creates if needed) the response cache index.
+    """
+    cachedb = args['cachedb'] if 'cachedb' in args else HTTP_CACHE_DB
+    os.makedirs(os.path.dirname(cachedb), exist_ok=True)
+    conn = sqlite3.connect(cachedb, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        url TEXT,
+                        status INTEGER,
+                        headers TEXT,
+                        etag TEXT,
+                        last_modified TEXT,
+                        bytes INTEGER,
+                        stored REAL,
+                        last_used REAL)""")
+    conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+    conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+    return conn
+
+
+def normalize_url( url ):
+    """ Normalized URL for cache keys - lower-case scheme/host, sorted query parameters, no fragment.
+    Parameter order does not change the result: ?type=Experiment&searchTerm=x == ?searchTerm=x&type=Experiment
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+    return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', query, ''))
+
+
+def request_key( args ):
+    """ Cache key for a request.
+
+    url: URL
+    method: (optional) GET (default) or POST
+    body: (optional) JSON body of a POST
+    accept: (optional) Accept header
+    """
+    body = json.dumps(args['body'], sort_keys=True) if args.get('body', None) not in [None, {}] else ''
+    key = '\t'.join([args.get('method', 'GET').upper(), normalize_url( args['url'] ), body, args.get('accept', '')])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def cached_request( args ):
+    """ HTTP request through the response cache.
+
+    url: URL
+    method: (optional) GET (default) or POST (search APIs that take a JSON body, e.g., GDC)
+    body: (optional) JSON body of a POST
+    headers: (optional) request headers
+    session: (optional) requests session - default a plain request
+    refresh: (optional) ignore a cached response (the new response is still stored)
+    ttl: (optional) seconds a response is used without revalidation - default BIOSHED_HTTP_CACHE_TTL
+    ---
+    response: requests.Response - response.from_cache is 'fresh', 'revalidated' or ''
+    """
+    import requests
+    method = args.get('method', 'GET').upper()
+    headers = dict(args.get('headers', None) or {})
+    ttl = int(args['ttl']) if 'ttl' in args else HTTP_CACHE_TTL
+    http = args['session'] if args.get('session', None) != None else requests
+    key = request_key( dict(args, method=method, accept=headers.get('accept', headers.get('Accept', ''))))
+    bodyfile = os.path.join(HTTP_CACHE_DIR, key[:2], key)
+    use_cached = cache_enabled( args )
+
+    conn = open_cache( args )
+    row = conn.execute('SELECT * FROM responses WHERE key = ?', (key,)).fetchone()
+    if row != None and not os.path.exists(bodyfile):
+        row = None
+    if row != None and use_cached and time.time() - row['stored'] < ttl:
+        with conn:
+            conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+            add_stats( conn, dict(fresh=1, bytes_served=row['bytes']))
+        conn.close()
+        return cached_response( dict(row=row, bodyfile=bodyfile, from_cache='fresh'))
+    if row != None and use_cached:
+        if row['etag'] != '':
+            headers['If-None-Match'] = row['etag']
+        if row['last_modified'] != '':
+            headers['If-Modified-Since'] = row['last_modified']
+
+    if method == 'POST':
+        response = http.post(args['url'], json=args.get('body', {}), headers=headers, timeout=HTTP_TIMEOUT)
+    else:
+        response = http.get(args['url'], headers=headers, timeout=HTTP_TIMEOUT)
+    if response.status_code == 304 and row != None:
+        with conn:
+            conn.execute('UPDATE responses SET stored = ?, last_used = ? WHERE key = ?', (time.time(), time.time(), key))
+            add_stats( conn, dict(revalidated=1, bytes_served=row['bytes']))
+        conn.close()
+        return cached_response( dict(row=row, bodyfile=bodyfile, from_cache='revalidated'))
+    response.from_cache = ''
+    if response.status_code == 200:
+        save_response( dict(conn=conn, key=key, url=args['url'], response=response, bodyfile=bodyfile))
+    with conn:
+        add_stats( conn, dict(misses=1))
+    conn.close()
+    evict_responses({})
+    return response
+
+
+def cached_response( args ):
+    """ Rebuilds a requests.Response from a cache entry.
+    """
+    import requests
+    row = args['row']
+    response = requests.Response()
+    response.status_code = row['status']
+    response.headers.update(json.loads(row['headers']))
+    response.url = row['url']
+    response.encoding = 'utf-8'
+    with open(args['bodyfile'], 'rb') as f:
+        response._content = f.read()
+    response.from_cache = args['from_cache']
+    return response
+
+
+def save_response( args ):
+    """ Stores a response body (written atomically) and its validators.
+    """
+    response = args['response']
+    os.makedirs(os.path.dirname(args['bodyfile']), exist_ok=True)
+    tmpfile = '{}.{}.{}.tmp'.format(args['bodyfile'], os.getpid(), threading.get_ident())
+    with open(tmpfile, 'wb') as f:
+        f.write(response.content)
+    os.replace(tmpfile, args['bodyfile'])
+    keep_headers = dict((k, v) for k, v in response.headers.items() if k.lower() in ['content-type', 'etag', 'last-modified'])
+    now = time.time()
+    with args['conn']:
+        args['conn'].execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (args['key'], args['url'], response.status_code, json.dumps(keep_headers), response.headers.get('ETag', ''),
+                              response.headers.get('Last-Modified', ''), len(response.content), now, now))
+    return
+
+
+def evict_responses( args ):
+    """ Evicts least-recently-used responses until the cache fits in the size limit.
+
+    max_bytes: (optional) size limit - default BIOSHED_HTTP_CACHE_MAX_MB
+    ---
+    evicted: number of responses evicted
+    """
+    max_bytes = int(args['max_bytes']) if 'max_bytes' in args else HTTP_CACHE_MAX_BYTES
+    conn = open_cache( args )
+    total = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM responses').fetchone()[0]
+    evicted = []
+    if total > max_bytes:
+        for row in conn.execute('SELECT key, bytes FROM responses ORDER BY last_used ASC').fetchall():
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(os.path.join(HTTP_CACHE_DIR, row['key'][:2], row['key']))
+            except OSError:
+                pass
+            total -= row['bytes']
+            evicted.append(row['key'])
+        with conn:
+            conn.executemany('DELETE FROM responses WHERE key = ?', [(key,) for key in evicted])
+    conn.close()
+    return len(evicted)
+
+
+def add_stats( conn, counters ):
+    conn.executemany('INSERT INTO stats VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                     list(counters.items()))
+    with _lock:
+        for name, value in counters.items():
+            _session_stats[name] = _session_stats.get(name, 0) + value
+    return
+
+
+def cache_stats( args ):
+    """ Response cache size and hit/miss counters.
+    ---
+    stats: dict(responses, bytes, fresh, revalidated, misses, bytes_served)
+    """
+    conn = open_cache( args )
+    row = conn.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM responses').fetchone()
+    stats = dict(responses=row[0], bytes=row[1], fresh=0, revalidated=0, misses=0, bytes_served=0)
+    stats.update(dict((r['name'], r['value']) for r in conn.execute('SELECT name, value FROM stats')))
+    conn.close()
+    return stats
+
+
+def clear_cache( args ):
+    """ Removes all cached responses and resets stats.
+    """
+    shutil.rmtree(HTTP_CACHE_DIR, ignore_errors=True)
+    if os.path.exists(HTTP_CACHE_DB):
+        conn = open_cache( args )
+        with conn:
+            conn.execute('DELETE FROM responses')
+            conn.execute('DELETE FROM stats')
+        conn.close()
+    return
+
+
+def print_report():
+    """ Prints this command's cache use - e.g., "HTTP cache: 2 hit(s) (1 fresh, 1 revalidated), 1 miss(es), 3.1 MB from cache".
+    """
+    with _lock:
+        stats = dict(_session_stats)
+    if stats['fresh'] + stats['revalidated'] + stats['misses'] > 0:
+        print('HTTP cache: {} hit(s) ({} fresh, {} revalidated), {} miss(es), {:.1f} MB from cache.'.format(
+              stats['fresh'] + stats['revalidated'], stats['fresh'], stats['revalidated'], stats['misses'], stats['bytes_served'] / 1024**2))
+    return
+
+
+def install( args ):
+    """ Routes quick_utils.get_request / post_request (used by the bioshed_atlas search modules) through the cache
+    for the rest of this command, and starts a new cache-use report. Safe to call once per command in a long-running
+    process (bioshed serve).
+
+    refresh: (optional) ignore cached responses
+    """
+    import quick_utils
+    with _lock:
+        _options['refresh'] = args.get('refresh', False)
+        _session_stats.update(dict(fresh=0, revalidated=0, misses=0, bytes_served=0))
+        if _options['installed']:
+            return
+        _options['installed'] = True
+    def get_request( args ):
+        apptype = args['type'] if 'type' in args else '*/*'
+        response = cached_request( dict(url=args['url'], headers={'accept': apptype}, refresh=_options['refresh']))
+        return response.json() if apptype == 'application/json' else response
+    def post_request( args ):
+        response = cached_request( dict(url=args['url'], method='POST', body=args.get('body', {}), headers=args.get('headers', {}),
+                                        refresh=_options['refresh']))
+        return json.loads(response.content)
+    quick_utils.get_request = get_request
+    quick_utils.post_request = post_request
+    return
@@ -0,0 +1,252 @@
+import os, re, sys, time, json, functools, subprocess, concurrent.futures
+##
+## Local image resolution cache.
+## $ bioshed images prefetch [--tag <TAG>] [--registry <REGISTRY>]
+## $ bioshed images list
+## $ bioshed images clear
+##
+## The digest that <registry>/<module>:<tag> resolved to is recorded in ~/.bioshedinit/image_cache.json.
+## Within the TTL, local runs skip "docker pull" and run the image pinned to that digest
+## (<registry>/<module>@sha256:...), as long as it is still present in the local Docker image store.
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+IMAGE_CACHE_FILE = os.path.join(INIT_PATH, 'image_cache.json')
+IMAGE_CACHE_TTL = int(os.environ.get('BIOSHED_IMAGE_CACHE_TTL', 6*60*60))   # seconds before re-checking the registry
+PREFETCH_CONCURRENCY = 8
+MANIFEST_TYPES = ['application/vnd.docker.distribution.manifest.v2+json', 'application/vnd.docker.distribution.manifest.list.v2+json',
+                  'application/vnd.oci.image.manifest.v1+json', 'application/vnd.oci.image.index.v1+json']
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+sys.path.append(os.path.join(SCRIPT_DIR, 'bioshed_utils/'))
+import bioshed_config
+
+def image_name( args ):
+    """ Full image name for a module.
+
+    module: module name
+    registry: (optional) container registry - default ecr_registry from config
+    tag: (optional) image tag - default latest
+    ---
+    image: <registry>/<module>:<tag>
+    """
+    import bioshed_batch
+    registry = str(args['registry']).rstrip('/') if args.get('registry', '') != '' else \
+               bioshed_config.get_config( dict(key='ecr_registry', default=bioshed_batch.DEFAULT_REGISTRY))
+    tag = args['tag'] if args.get('tag', '') != '' else 'latest'
+    return '{}/{}:{}'.format(registry, args['module'], tag)
+
+
+def resolve_image( args ):
+    """ Resolves an image to a digest-pinned reference, pulling only when needed.
+
+    Within the TTL, a cached digest that is still present locally is used with no registry call.
+    Otherwise the image is pulled and its digest recorded. If the registry cannot be reached but the
+    image exists locally, the local image is used.
+
+    image: <registry>/<module>:<tag>
+    ttl: (optional) cache TTL in seconds
+    refresh: (optional) always pull and re-resolve
+    cachefile: (optional) image cache file
+    ---
+    ref: image reference to run - <registry>/<module>@sha256:... if known, else the image name
+    """
+    image = args['image']
+    ttl = int(args['ttl']) if 'ttl' in args else IMAGE_CACHE_TTL
+    cachefile = args['cachefile'] if 'cachefile' in args else IMAGE_CACHE_FILE
+    if not args.get('refresh', False):
+        entry = bioshed_config.load_config( dict(configfile=cachefile)).get(image, {})
+        if entry != {} and time.time() - float(entry.get('resolved', 0)) < ttl and local_image_present( entry['ref'] ):
+            return entry['ref']
+    pulled = subprocess.call(['docker', 'pull', '-q', image], stdout=subprocess.DEVNULL) == 0
+    digest = image_digest( image )
+    if not pulled or digest == '':
+        if not pulled:
+            print('WARNING: could not pull {} - using the local image if there is one.'.format(image))
+        return image
+    ref = '{}@{}'.format(image_repository( image ), digest)
+    bioshed_config.update_config( dict(configfile=cachefile, values={image: dict(digest=digest, ref=ref, resolved=time.time())}))
+    return ref
+
+
+def image_digest( image ):
+    """ Registry digest of a locally present image (from docker image inspect RepoDigests), or '' if unknown.
+    """
+    try:
+        out = subprocess.check_output(['docker', 'image', 'inspect', '--format', '{{json .RepoDigests}}', image], stderr=subprocess.DEVNULL)
+        repo_digests = json.loads(out.decode().strip() or '[]') or []
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return ''
+    repository = image_repository( image )
+    for repo_digest in repo_digests:
+        if repo_digest.split('@')[0] == repository:
+            return repo_digest.split('@')[1]
+    return ''
+
+
+def image_repository( image ):
+    """ Image name without its tag - e.g., public.ecr.aws/abc/fastqc:latest -> public.ecr.aws/abc/fastqc
+    """
+    name = image.split('@')[0]
+    return name[:name.rfind(':')] if name.rfind(':') > name.rfind('/') else name
+
+
+@functools.lru_cache(maxsize=None)
+def _image_env( image ):
+    try:
+        out = subprocess.check_output(['docker', 'image', 'inspect', '--format', '{{json .Config.Env}}', image], stderr=subprocess.DEVNULL)
+        env = json.loads(out.decode().strip() or '[]') or []
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        env = registry_image_config( dict(image=image)).get('config', {}).get('Env', []) or []
+    return dict(e.split('=', 1) for e in env if '=' in e)
+
+
+def image_env( args ):
+    """ Environment (ENV) an image was built with - from the local Docker image store, else from the registry.
+
+    image: <registry>/<module>:<tag>
+    ---
+    env: dict of variable -> value ({} if unknown)
+    """
+    return dict(_image_env( args['image'] ))
+
+
+def registry_image_config( args ):
+    """ Image config of an image in a registry (Docker registry HTTP API v2), without pulling it.
+    Anonymous token auth (e.g., public.ecr.aws) or, for private ECR registries, an ECR authorization token.
+
+    image: <registry>/<repository>:<tag> or <registry>/<repository>@sha256:...
+    ---
+    config: image config (dict with 'config': {'Env': ...}), or {} if it cannot be read
+    """
+    import urllib.request, urllib.error
+    image = args['image']
+    host, repo = image_repository( image ).split('/', 1)
+    ref = image.split('@')[1] if '@' in image else (image[len(image_repository( image ))+1:] or 'latest')
+    baseurl = '{}://{}/v2/{}/'.format('http' if host.split(':')[0] in ['localhost', '127.0.0.1'] else 'https', host, repo)
+    auth = {}
+    def get( path ):
+        request = urllib.request.Request(baseurl + path, headers={'Accept': ', '.join(MANIFEST_TYPES)})
+        if 'header' in auth:
+            request.add_unredirected_header('Authorization', auth['header'])    # not sent to blob storage redirects
+        with urllib.request.urlopen(request, timeout=30) as r:
+            return json.loads(r.read().decode())
+    try:
+        try:
+            manifest = get( 'manifests/' + ref )
+        except urllib.error.HTTPError as e:
+            if e.code != 401:
+                raise
+            auth['header'] = registry_auth( dict(host=host, repo=repo, challenge=e.headers.get('WWW-Authenticate', '')))
+            manifest = get( 'manifests/' + ref )
+        if 'manifests' in manifest:     # multi-platform image
+            platform = next((m for m in manifest['manifests'] if m.get('platform', {}).get('architecture', '') == 'amd64'), manifest['manifests'][0])
+            manifest = get( 'manifests/' + platform['digest'] )
+        return get( 'blobs/' + manifest['config']['digest'] )
+    except Exception:
+        return {}
+
+
+def registry_auth( args ):
+    """ Authorization header for a registry that answered 401.
+
+    host: registry host
+    repo: repository
+    challenge: WWW-Authenticate header of the 401 response
+    ---
+    header: Authorization header value
+    """
+    import urllib.request, urllib.parse
+    challenge = args['challenge']
+    if challenge.lower().startswith('bearer'):
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        query = dict(service=params.get('service', args['host']), scope=params.get('scope', 'repository:{}:pull'.format(args['repo'])))
+        with urllib.request.urlopen(params['realm'] + '?' + urllib.parse.urlencode(query), timeout=30) as r:
+            token = json.loads(r.read().decode())
+        return 'Bearer ' + token.get('token', token.get('access_token', ''))
+    import boto3    # private ECR registry: <account>.dkr.ecr.<region>.amazonaws.com
+    region = args['host'].split('.')[3] if '.dkr.ecr.' in args['host'] else None
+    return 'Basic ' + boto3.client('ecr', region_name=region).get_authorization_token()['authorizationData'][0]['authorizationToken']
+
+
+def local_image_present( ref ):
+    """ Whether an image reference exists in the local Docker image store (no registry call).
+    """
+    return subprocess.call(['docker', 'image', 'inspect', ref], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def resolve_images( args ):
+    """ Resolves several images in parallel.
+
+    images: list of images
+    refresh: (optional) always pull and re-resolve
+    ---
+    refs: dict of image -> reference to run
+    """
+    images = sorted(set(args['images']))
+    if images == []:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(PREFETCH_CONCURRENCY, len(images))) as executor:
+        refs = list(executor.map(lambda image: resolve_image( dict(args, image=image)), images))
+    return dict(zip(images, refs))
+
+
+def prefetch_images( args ):
+    """ Pulls and records digests for all public bioshed modules (docker_utils.list_containers), in parallel.
+
+    registry: (optional) container registry
+    tag: (optional) image tag
+    ---
+    refs: dict of image -> pinned reference
+    """
+    import docker_utils
+    modules = [module for module in sorted(docker_utils.list_containers()) if module not in ['test']]
+    images = [image_name( dict(args, module=module)) for module in modules]
+    print('Prefetching {} images...'.format(len(images)))
+    start = time.time()
+    refs = resolve_images( dict(images=images, refresh=True))
+    pinned = [image for image, ref in refs.items() if '@' in ref]
+    print('Prefetched {} of {} images in {:.1f}s.'.format(len(pinned), len(images), time.time() - start))
+    for image in images:
+        if image not in pinned:
+            print('\tnot available: {}'.format(image))
+    return refs
+
+
+def run_container_cached( args ):
+    """ Runs a local container (docker run) pinned to the cached digest - pulls only if the cache is stale or missing.
+
+    module: module name
+    args: program arguments (list)
+    registry: (optional) container registry
+    tag: (optional) image tag
+    dockerargs: (optional) arguments to docker run
+    ---
+    status: docker run exit status
+    """
+    ref = resolve_image( dict(image=image_name( args )))
+    dockerargs = str(args['dockerargs']).strip()+' ' if args.get('dockerargs', '') != '' else ''
+    cmd = 'docker run {}{} {}'.format(dockerargs, ref, ' '.join(args.get('args', [])))
+    return subprocess.call(cmd, shell=True)
+
+
+def print_image_cache( args ):
+    """ Prints cached image digests and their age.
+    """
+    cachefile = args['cachefile'] if 'cachefile' in args else IMAGE_CACHE_FILE
+    cache = bioshed_config.load_config( dict(configfile=cachefile))
+    print('IMAGE\tDIGEST\tAGE')
+    for image, entry in sorted(cache.items()):
+        age = time.time() - float(entry.get('resolved', 0))
+        print('{}\t{}\t{:.0f}m{}'.format(image, entry.get('digest', ''), age / 60, ' (stale)' if age >= IMAGE_CACHE_TTL else ''))
+    return
+
+
+def clear_image_cache( args ):
+    """ Forgets all cached digests (the next run of each image pulls again).
+    """
+    cachefile = args['cachefile'] if 'cachefile' in args else IMAGE_CACHE_FILE
+    if os.path.exists(cachefile):
+        os.remove(cachefile)
+    return
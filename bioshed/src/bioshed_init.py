@@ -1,4 +1,4 @@
-import os, sys, subprocess, json, uuid
+import os, sys, subprocess, json, uuid, time, concurrent.futures
 ##
 ## $ bioshed init
 ## 1) checks 
@@ -16,10 +16,23 @@ VALID_REGION_NUMBERS = {'1': 'us-west-1', '2': 'us-west-2', '3': 'us-east-1', '4
                         '12': 'eu-west-3', '13': 'eu-central-1'}
 
 ECR_PUBLIC_REGISTRY = "public.ecr.aws/w7q0j5w1"
-BIOSHED_SERVERLESS_API = "https://hu9ug76w32.execute-api.us-west-2.amazonaws.com/prod"
-
+CLOUD_PROBE_FILE = 'cloud_probe.json'
+CLOUD_PROBE_TTL = int(os.environ.get('BIOSHED_CLOUD_PROBE_TTL', 24*60*60))
+CLOUD_PROBE_NEGATIVE_TTL = 5*60     # failed probes may be transient (network), so re-check them sooner
+CLOUD_PROBE_TIMEOUT = 20
+CLOUD_PROBES = {'aws': dict(command=['aws', 'sts', 'get-caller-identity', '--output', 'text'],
+                            credfiles=[os.path.join(HOME_PATH, '.aws/credentials'), os.path.join(HOME_PATH, '.aws/config')],
+                            env=['AWS_PROFILE', 'AWS_ACCESS_KEY_ID', 'AWS_DEFAULT_REGION']),
+                'gcp': dict(command=['gcloud', 'config', 'get-value', 'account'],
+                            credfiles=[os.path.join(HOME_PATH, '.config/gcloud/credentials.db'), os.path.join(HOME_PATH, '.config/gcloud/active_config')],
+                            env=['CLOUDSDK_CORE_ACCOUNT', 'GOOGLE_APPLICATION_CREDENTIALS'])}
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_config
+import bioshed_terraform
 sys.path.append(os.path.join(SCRIPT_DIR, 'bioshed_utils/'))
 import quick_utils
+BIOSHED_SERVERLESS_API = bioshed_config.BIOSHED_SERVERLESS_API     # can be pointed at a local stand-in (BIOSHED_SERVERLESS_API)
 
 def userExists( user ):
     """ Check if username exists in the user database.
@@ -239,7 +252,6 @@ def bioshed_connect_aws( args ):
 
     """
     ## init, config and API file paths
-    cwd = os.getcwd()
     INIT_PATH = args['initpath']
     if not os.path.exists(INIT_PATH):
         os.mkdir(INIT_PATH)
@@ -296,10 +308,9 @@ def bioshed_connect_aws( args ):
     # indicate that AWS has been setup
     AWS_CONSTANTS_JSON['setup'] = 'True'
     # write config file and finish initialization
-    quick_utils.add_to_json( AWS_CONFIG_FILE, AWS_CONSTANTS_JSON)
-    os.chdir(INIT_PATH)
-    subprocess.call('terraform init', shell=True)
-    os.chdir(cwd)
+    bioshed_config.update_config( dict(configfile=AWS_CONFIG_FILE, values=AWS_CONSTANTS_JSON))
+    # providers come from the host-wide plugin cache / local mirror, pinned by the shared lock file
+    bioshed_terraform.terraform_init( dict(initpath=INIT_PATH))
     return PROVIDER_FILE
 
 
@@ -312,19 +323,17 @@ def bioshed_teardown( args ):
     options: teardown options. 
              Currently supported: 'dryrun' - show plan but do not destroy
     """
-    cwd = os.getcwd()
     INIT_PATH = args['initpath']
     provider = args['cloud'] if 'cloud' in args else 'aws' # default provider is aws
     options = args['options'] if 'options' in args else ''
 
-    os.chdir(INIT_PATH)
     if provider in ['aws', 'amazon']:
-        subprocess.call('terraform plan -destroy', shell=True)
+        bioshed_terraform.terraform_init( dict(initpath=INIT_PATH))
+        bioshed_terraform.run_terraform( dict(initpath=INIT_PATH, command=['plan', '-destroy']))
         if 'dryrun' not in options:
-            subprocess.call('terraform apply -destroy', shell=True)
+            bioshed_terraform.run_terraform( dict(initpath=INIT_PATH, command=['apply', '-destroy']))
     else:
         print('Only AWS currently supported.')
-    os.chdir(cwd)
     return
 
 
@@ -401,31 +410,76 @@ def cloud_setup( args ):
     cloud = args['cloud'] if 'cloud'in args else 'aws'
     configfile = args['configfile'] if 'configfile' in args else ''
     if os.path.exists(configfile):
-        config_json = quick_utils.loadJSON(configfile)
-        is_cloud_setup = config_json['setup'] if 'setup' in config_json else 'False'
-        if is_cloud_setup.upper()[0] in ['T','Y']:
-            isSetup = True
+        isSetup = bioshed_config.get_config( dict(configfile=configfile, key='setup'))
     return isSetup
 
 
 def cloud_configured( args ):
-    """ Checks if a cloud provider is configured properly
+    """ Checks if a cloud provider is configured properly.
+    Providers are probed concurrently with a cheap credential check (no bucket listing):
+        aws: aws sts get-caller-identity
+        gcp: gcloud config get-value account
+    Results are cached in the init directory, keyed on the mtimes of each provider's credential files
+    (and credential env variables), so the probe only re-runs when credentials change or the cache expires.
 
     cloud: which cloud provider to check. If empty, then check all.
+    initpath: (optional) init path where the probe cache is kept
     ---
     boolean: True/False if cloud is configured or not
     """
     cloud = args['cloud'] if 'cloud' in args else 'all'
-    pnum = 127
-    if cloud in ['aws','amazon','all']:
-        pnum = min(int(subprocess.call('aws s3 ls', shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)), pnum)
-    if cloud in ['gcp','all']:
-        pnum = min(int(subprocess.call('gcp --help', shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)), pnum)
+    initpath = args['initpath'] if 'initpath' in args else INIT_PATH
+    cachefile = os.path.join(initpath, CLOUD_PROBE_FILE)
+    if cloud in ['aws', 'amazon']:
+        providers = ['aws']
+    elif cloud in ['gcp', 'google']:
+        providers = ['gcp']
+    else:
+        providers = list(CLOUD_PROBES.keys())
+
+    probe_cache = quick_utils.loadJSON(cachefile) if os.path.exists(cachefile) else {}
+    results = {}
+    to_probe = []
+    for provider in providers:
+        cached = probe_cache.get(provider, {})
+        ttl = CLOUD_PROBE_TTL if cached.get('configured') else CLOUD_PROBE_NEGATIVE_TTL
+        if cached.get('key') == cloud_probe_key(provider) and time.time() - float(cached.get('time', 0)) < ttl:
+            results[provider] = bool(cached.get('configured'))
+        else:
+            to_probe.append(provider)
 
-    if pnum > 3:
+    if to_probe != []:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(to_probe)) as executor:
+            for provider, configured in zip(to_probe, executor.map(probe_cloud, to_probe)):
+                results[provider] = configured
+                probe_cache[provider] = dict(key=cloud_probe_key(provider), time=time.time(), configured=configured)
+        if os.path.exists(initpath):
+            bioshed_config.write_json_atomic(probe_cache, cachefile)
+    return any(results.values())
+
+
+def probe_cloud( provider ):
+    """ Runs the credential check for one cloud provider.
+    ---
+    boolean: True if the check succeeded
+    """
+    try:
+        probe = subprocess.run(CLOUD_PROBES[provider]['command'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               stdin=subprocess.DEVNULL, timeout=CLOUD_PROBE_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired):
         return False
-    else:
-        return True
+    return probe.returncode == 0 and probe.stdout.strip() != b''
+
+
+def cloud_probe_key( provider ):
+    """ Cache key for a cloud probe: mtimes of the provider's credential files plus its credential env variables.
+    """
+    key = []
+    for credfile in CLOUD_PROBES[provider]['credfiles']:
+        key.append(os.path.getmtime(credfile) if os.path.exists(credfile) else None)
+    for envvar in CLOUD_PROBES[provider]['env']:
+        key.append(os.environ.get(envvar, ''))
+    return key
 
 
 def cloud_core_setup( args ):
@@ -438,10 +492,7 @@ def cloud_core_setup( args ):
     isCoreSetup = False
     configfile = args['configfile'] if 'configfile' in args else ''
     if configfile!='' and os.path.exists(configfile):
-        config_json = quick_utils.loadJSON(configfile)
-        is_core_setup = config_json['core_setup'] if 'core_setup' in config_json else 'N'
-    if is_core_setup.upper()[0] in ['Y','T']:
-        isCoreSetup = True
+        isCoreSetup = bioshed_config.get_config( dict(configfile=configfile, key='core_setup'))
     return isCoreSetup
 
 
@@ -473,7 +524,7 @@ def generate_api_key( args ):
             if int(rcode) == 0:
                 print('Public/private key generated at {}'.format(keyfile))
             # reference key file name within config file
-            quick_utils.add_to_json( configfile, CONFIG_JSON)
+            bioshed_config.update_config( dict(configfile=configfile, values=CONFIG_JSON))
         else:
             print('ERROR: No key generated. Must specify a cloud config file.')
     else:
@@ -494,8 +545,7 @@ def get_public_key( args ):
     pubkey = ''
 
     if os.path.exists(configfile):
-        configjson = quick_utils.loadJSON(configfile)
-        keyfile = configjson['apikeyfile']
+        keyfile = bioshed_config.get_config( dict(configfile=configfile, key='apikeyfile'))
     if keyfile != '' and os.path.exists(keyfile+'.pub'):
         with open(keyfile+'.pub','r') as f:
             # takes last line as key
@@ -527,6 +577,31 @@ def bioshed_run_help():
                                   AWS_SECRET_ACCESS_KEY=[KEY]
                                   AWS_DEFAULT_REGION=[region]
         --inputdir <DIR>        Full path of local input directory. By default, the current directory is used.
+        --samplesheet <FILE>    Run once per row of a tab-delimited samplesheet (with header). {column} in the program
+                                arguments is replaced by that row's value. In the cloud, all rows are submitted as
+                                concurrent Batch jobs and job IDs are written to <FILE>.manifest.json
+                                Locally, rows run concurrently, packed by the app's CPU/memory needs against this
+                                machine (BIOSHED_LOCAL_CPUS / BIOSHED_LOCAL_MEM_MB to use less). Each run's output
+                                is written to bioshed_logs/<row>_<sample>.log
+        --s3-cache              Local runs: stage s3:// inputs through a host-wide cache of S3 objects, so each object
+                                version is downloaded once and shared by all runs. Same as BIOSHED_S3_CACHE=1.
+                                See "bioshed cache --help".
+        --stream-inputs         Local runs: pass s3:// FASTQ, SAM and text inputs to the app as named pipes under
+                                /input/s3/, fed by parallel ranged reads, so the app starts on the first megabyte and
+                                no local copy is made. Inputs that need seekable access (BAM, references, indexes, or
+                                apps like samtools/gatk) are fully downloaded first. Linux only (Docker Desktop falls
+                                back to downloads). Same as BIOSHED_STREAM_INPUTS=1.
+        --shard <N>             Cloud runs of bwa, STAR and fastqc: split the FASTQ inputs into N shards (2-20, paired
+                                R1/R2 split in lockstep), run one job per shard and merge the outputs into out::
+                                (samtools merge for bwa/STAR, a MultiQC report for fastqc). Needs out::s3://...;
+                                shards are kept under shards_input/ and shards/ there. bwa needs -o <FILE>.
+                                Splitting streams the inputs through this machine - run it close to the data.
+        --cache                 Reuse the outputs of an identical earlier run - same app image (digest), arguments and
+                                input files (content hash, or ETag for S3) - instead of running. Outputs are restored to
+                                the current output directory / out:: location. Same as setting BIOSHED_RUN_CACHE=1.
+        --no-cache              Always run, even if BIOSHED_RUN_CACHE=1.
+        --no-probe              Skip the cloud credential check and trust the BioShed config (for batch drivers).
+                                Same as setting BIOSHED_NO_PROBE=1.
 
 
     <APP>
@@ -562,6 +637,7 @@ def bioshed_run_help():
             $ bioshed run fastqc s3://folder1/seq.fastq.gz
             $ bioshed run bwa mem s3://genomes/bwa_index s3://folder1/seq.fastq.gz out://s3://alignments/
             $ bioshed run STAR --genomeDir s3://genomes/hg38_STAR_index/ --readFilesIn s3://fastqs/my.fastq.gz out::s3://alignments/
+            $ bioshed run --samplesheet samples.tsv fastqc {fastq} out::s3://qc/{sample}/
 
         Using local storage:
             $ bioshed run --local zcat my.fastq.gz
@@ -0,0 +1,261 @@
+import os, sys, time, sqlite3, concurrent.futures
+##
+## Local job ledger for bioshed batch jobs.
+## $ bioshed jobs [--status <STATUS>] [--module <MODULE>] [--refresh] [--limit <N>]
+## $ bioshed wait <JOBID> ... | --manifest <MANIFEST> | --all
+##
+## Every submitted job is recorded in a SQLite ledger (~/.bioshedinit/jobs.db). Listing reads only the ledger.
+## Status refreshes call DescribeJobs in batches of 100 job IDs, and only for jobs not yet in a terminal state.
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+LEDGER_FILE = os.path.join(INIT_PATH, 'jobs.db')
+TERMINAL_STATES = ['SUCCEEDED', 'FAILED', 'EXPIRED']    # EXPIRED: no longer returned by DescribeJobs (Batch keeps finished jobs ~7 days)
+EXPIRE_AFTER_SECONDS = 7*24*3600    # a job missing from DescribeJobs is EXPIRED once it is older than Batch's retention window
+EXPIRE_AFTER_MISSES = 5             # ...or once it has been missing from this many consecutive refreshes
+DESCRIBE_BATCH_SIZE = 100       # DescribeJobs accepts at most 100 job IDs per call
+DESCRIBE_CONCURRENCY = 8
+POLL_MIN_SECONDS = 10
+POLL_MAX_SECONDS = 300
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_config
+
+def open_ledger( args ):
+    """ Opens (and creates if needed) the job ledger.
+
+    ledger: (optional) ledger file - default ~/.bioshedinit/jobs.db
+    ---
+    conn: sqlite3 connection
+    """
+    ledger = args['ledger'] if 'ledger' in args else LEDGER_FILE
+    conn = sqlite3.connect(ledger, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                        jobid TEXT PRIMARY KEY,
+                        module TEXT,
+                        jobqueue TEXT,
+                        program_args TEXT,
+                        status TEXT,
+                        reason TEXT,
+                        submitted_at REAL,
+                        started_at REAL,
+                        stopped_at REAL,
+                        updated_at REAL,
+                        missed INTEGER DEFAULT 0)""")
+    if 'missed' not in [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]:
+        conn.execute('ALTER TABLE jobs ADD COLUMN missed INTEGER DEFAULT 0')     # ledgers from earlier versions
+    conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+    conn.execute('CREATE INDEX IF NOT EXISTS jobs_submitted ON jobs (submitted_at)')
+    return conn
+
+
+def record_jobs( args ):
+    """ Records submitted jobs in the ledger.
+
+    jobs: list of job info dicts with at least 'jobid' (as returned by submit_job_awsbatch) - also 'module', 'jobqueue', 'program_args'
+    ledger: (optional) ledger file
+    ---
+    num_recorded: number of jobs recorded
+    """
+    now = time.time()
+    rows = [(str(job['jobid']), job.get('module', ''), job.get('jobqueue', ''), str(job.get('program_args', '')), 'SUBMITTED', '', now, now)
+            for job in args['jobs'] if job.get('jobid', '') != '']
+    with open_ledger( args ) as conn:
+        conn.executemany("""INSERT OR IGNORE INTO jobs (jobid, module, jobqueue, program_args, status, reason, submitted_at, updated_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+    conn.close()
+    return len(rows)
+
+
+def list_jobs( args ):
+    """ Lists jobs from the ledger only (no API calls).
+
+    status: (optional) filter by status (e.g., RUNNING, FAILED)
+    active: (optional) only jobs not yet in a terminal state
+    module: (optional) filter by module
+    jobids: (optional) restrict to these job IDs
+    limit: (optional) max number of jobs (most recent first)
+    ledger: (optional) ledger file
+    ---
+    jobs: list of job dicts
+    """
+    query = 'SELECT * FROM jobs WHERE 1=1'
+    params = []
+    if args.get('status', '') != '':
+        query += ' AND status = ?'
+        params.append(str(args['status']).upper())
+    if args.get('active', False):
+        query += ' AND status NOT IN ({})'.format(','.join('?' * len(TERMINAL_STATES)))
+        params += TERMINAL_STATES
+    if args.get('module', '') != '':
+        query += ' AND module = ?'
+        params.append(args['module'])
+    jobids = args.get('jobids', [])
+    query += ' ORDER BY submitted_at DESC'
+    if args.get('limit', '') != '':
+        query += ' LIMIT {}'.format(int(args['limit']))
+    conn = open_ledger( args )
+    jobs = [dict(row) for row in conn.execute(query, params)]
+    conn.close()
+    if jobids != []:
+        jobids = set(jobids)
+        jobs = [job for job in jobs if job['jobid'] in jobids]
+    return jobs
+
+
+def refresh_jobs( args ):
+    """ Refreshes the status of non-terminal jobs with batched DescribeJobs calls (100 IDs per call).
+    Jobs already in a terminal state (SUCCEEDED/FAILED/EXPIRED) are never polled again.
+    A job DescribeJobs does not return (e.g., just submitted) stays active until it is older than Batch's retention
+    window or has been missing from EXPIRE_AFTER_MISSES consecutive refreshes - then it is EXPIRED.
+
+    jobids: (optional) job IDs to refresh - default all non-terminal jobs in the ledger
+    client: (optional) Batch client (e.g., a local stand-in)
+    ledger: (optional) ledger file
+    ---
+    result: dict(api_calls, changed, active) - active is the number of refreshed jobs still not in a terminal state
+    """
+    jobs = list_jobs( dict(args, active=True))
+    active_ids = [job['jobid'] for job in jobs]
+    previous = dict((job['jobid'], job['status']) for job in jobs)
+    jobinfo = dict((job['jobid'], job) for job in jobs)
+    if active_ids == []:
+        return dict(api_calls=0, changed=0, active=0)
+    described, api_calls = describe_jobs( dict(args, jobids=active_ids))
+
+    now = time.time()
+    updates = []
+    for job in described:
+        updates.append((job['status'], job.get('statusReason', ''), _seconds(job.get('startedAt')), _seconds(job.get('stoppedAt')), now, 0, job['jobId']))
+    found = set(job['jobId'] for job in described)
+    for jobid in active_ids:
+        if jobid not in found:
+            job = jobinfo[jobid]
+            missed = int(job.get('missed') or 0) + 1
+            if now - float(job['submitted_at'] or now) > EXPIRE_AFTER_SECONDS or missed >= EXPIRE_AFTER_MISSES:
+                updates.append(('EXPIRED', 'Job not found by DescribeJobs', job['started_at'], job['stopped_at'], now, missed, jobid))
+            else:
+                updates.append((job['status'], job['reason'], job['started_at'], job['stopped_at'], now, missed, jobid))
+    conn = open_ledger( args )
+    with conn:
+        conn.executemany('UPDATE jobs SET status = ?, reason = ?, started_at = ?, stopped_at = ?, updated_at = ?, missed = ? WHERE jobid = ?', updates)
+    conn.close()
+    changed = len([u for u in updates if previous.get(u[-1]) != u[0]])
+    import bioshed_runcache
+    bioshed_runcache.finalize_batch_runs( dict(succeeded=[u[-1] for u in updates if u[0] == 'SUCCEEDED'],
+                                              failed=[u[-1] for u in updates if u[0] in ['FAILED', 'EXPIRED']],
+                                              stopped=dict((u[-1], u[3]) for u in updates if u[3] != None)))
+    active = len([u for u in updates if u[0] not in TERMINAL_STATES])
+    return dict(api_calls=api_calls, changed=changed, active=active)
+
+
+def describe_jobs( args ):
+    """ DescribeJobs for job IDs, in concurrent batches of DESCRIBE_BATCH_SIZE.
+
+    jobids: job IDs
+    client: (optional) Batch client
+    ---
+    described: list of job descriptions returned by Batch (jobs it does not know are left out)
+    api_calls: number of DescribeJobs calls
+    """
+    if 'client' in args:
+        client = args['client']
+    else:
+        import bioshed_batch
+        client = bioshed_batch.get_batch_client( bioshed_config.get_config( dict(key='aws_region')))
+    jobids = args['jobids']
+    batches = [jobids[i:i+DESCRIBE_BATCH_SIZE] for i in range(0, len(jobids), DESCRIBE_BATCH_SIZE)]
+    described = []
+    if batches != []:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(DESCRIBE_CONCURRENCY, len(batches))) as executor:
+            for response in executor.map(lambda batch: client.describe_jobs(jobs=batch), batches):
+                described += response.get('jobs', [])
+    return described, len(batches)
+
+
+def add_jobs( args ):
+    """ Adds jobs that are not in the ledger (e.g., submitted from another machine or by an earlier version) from
+    DescribeJobs, so they can be waited on and listed.
+
+    jobids: job IDs
+    client: (optional) Batch client
+    ledger: (optional) ledger file
+    ---
+    unknown: job IDs that are neither in the ledger nor known to Batch
+    """
+    known = set(job['jobid'] for job in list_jobs( dict(args, jobids=args['jobids'])))
+    missing = [jobid for jobid in dict.fromkeys(args['jobids']) if jobid not in known]
+    if missing == []:
+        return []
+    described, api_calls = describe_jobs( dict(args, jobids=missing))
+    record_jobs( dict(args, jobs=[dict(jobid=job['jobId'], module=job.get('jobName', '').split('_')[1] if job.get('jobName', '').startswith('job_') else '',
+                                       jobqueue=job.get('jobQueue', ''), program_args=' '.join(job.get('container', {}).get('command', [])))
+                                  for job in described]))
+    conn = open_ledger( args )
+    with conn:
+        conn.executemany('UPDATE jobs SET submitted_at = ? WHERE jobid = ?',
+                         [(_seconds(job['createdAt']), job['jobId']) for job in described if job.get('createdAt') not in [None, '', 0]])
+    conn.close()
+    found = set(job['jobId'] for job in described)
+    return [jobid for jobid in missing if jobid not in found]
+
+
+def wait_jobs( args ):
+    """ Waits until all given jobs reach a terminal state.
+    Polls with adaptive backoff: the interval grows while nothing changes and resets when a job changes state.
+    Jobs not in the ledger are added from DescribeJobs first; job IDs Batch does not know either are counted as UNKNOWN.
+
+    jobids: job IDs to wait on (default: all non-terminal jobs in the ledger)
+    min_interval: (optional) seconds between polls when jobs are changing
+    max_interval: (optional) max seconds between polls
+    client: (optional) Batch client
+    ledger: (optional) ledger file
+    ---
+    summary: dict of status -> number of jobs
+    """
+    jobids = args['jobids'] if 'jobids' in args else []
+    min_interval = float(args['min_interval']) if 'min_interval' in args else POLL_MIN_SECONDS
+    max_interval = float(args['max_interval']) if 'max_interval' in args else POLL_MAX_SECONDS
+    interval = min_interval
+    unknown = add_jobs( dict(args, jobids=jobids)) if jobids != [] else []
+    for jobid in unknown:
+        print('ERROR: job {} is not in the job ledger and was not found by DescribeJobs.'.format(jobid))
+    while True:
+        result = refresh_jobs( args )
+        summary = job_summary( dict(args, jobids=jobids))
+        if unknown != []:
+            summary['UNKNOWN'] = len(unknown)
+        print('{} | {} API call(s) | {}'.format(time.strftime('%H:%M:%S'), result['api_calls'],
+                                               ', '.join('{}: {}'.format(k, v) for k, v in sorted(summary.items()))))
+        if result['active'] == 0:
+            break
+        interval = min_interval if result['changed'] > 0 else min(interval * 1.5, max_interval)
+        time.sleep(interval)
+    return summary
+
+
+def job_summary( args ):
+    """ Counts jobs by status (from the ledger).
+    """
+    summary = {}
+    for job in list_jobs( args ):
+        summary[job['status']] = summary.get(job['status'], 0) + 1
+    return summary
+
+
+def print_jobs( jobs ):
+    """ Prints jobs as a table.
+    """
+    print('JOBID\tMODULE\tSTATUS\tSUBMITTED\tDURATION\tARGS')
+    for job in jobs:
+        duration = '{:.0f}s'.format(job['stopped_at'] - job['started_at']) if job['started_at'] and job['stopped_at'] else ''
+        print('{}\t{}\t{}\t{}\t{}\t{}'.format(job['jobid'], job['module'], job['status'],
+                                            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['submitted_at'])), duration, job['program_args']))
+    return
+
+
+def _seconds( epoch_ms ):
+    return float(epoch_ms) / 1000.0 if epoch_ms not in [None, ''] else None
@@ -0,0 +1,238 @@
+import os, sys, time, subprocess, platform
+##
+## Local executor for many container runs on one machine (bioshed run --local with a samplesheet or pipeline).
+## Containers are packed against the host's CPUs and memory, using each module's vcpu/mem from specs.json
+## (the same sizing used for AWS Batch), and run concurrently with docker --cpus/--memory limits.
+## Each container's output goes to its own log file. Program and docker arguments of each run are prepared the same way
+## as "bioshed run --local" (local_run_args).
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+LOCAL_CPUS = os.environ.get('BIOSHED_LOCAL_CPUS', '')       # override detected host capacity
+LOCAL_MEM_MB = os.environ.get('BIOSHED_LOCAL_MEM_MB', '')
+LOG_DIR = 'bioshed_logs'
+POLL_SECONDS = 0.2
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_batch
+import bioshed_images
+
+def host_capacity( args ):
+    """ CPUs and memory available for containers on this machine.
+
+    cpus: (optional) override number of CPUs
+    mem: (optional) override memory in MB
+    ---
+    capacity: dict(cpus, mem) - mem in MB
+    """
+    cpus = args['cpus'] if args.get('cpus', '') != '' else LOCAL_CPUS
+    mem = args['mem'] if args.get('mem', '') != '' else LOCAL_MEM_MB
+    cpus = float(cpus) if cpus != '' else float(os.cpu_count() or 1)
+    mem = int(mem) if mem != '' else host_memory_mb()
+    return dict(cpus=cpus, mem=mem)
+
+
+def host_memory_mb():
+    """ Total physical memory in MB (Linux /proc/meminfo, Mac OS X sysctl).
+    """
+    try:
+        if platform.system() == 'Darwin':
+            return int(subprocess.check_output(['sysctl', '-n', 'hw.memsize']).decode().strip()) // (1024*1024)
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        pass
+    return 4000
+
+
+def local_run_args( args ):
+    """ Program and docker run arguments for one local module run - the same preparation as "bioshed run --local":
+    output directory (docker_utils.specify_output_dir; the local directory is mounted at /output/ unless outputs go to
+    s3:// or gcp://), the bioshed AWS env file when there are s3:// paths, and module-specific arguments (module_args).
+
+    program_args: program arguments, starting with the module - as in "bioshed run <MODULE> <ARGS>" (list)
+    outdir: (optional) local output directory - default current directory
+    envfile: (optional) add the bioshed AWS env file for s3:// paths - default True (False if an env file was given)
+    ---
+    prepared: dict(program_args, dockerargs)
+    """
+    import docker_utils
+    import bioshed_init
+    outdir = args['outdir'] if args.get('outdir', '') != '' else str(os.getcwd()).replace(' ','\\ ')
+    program_args = docker_utils.specify_output_dir( dict(program_args=args['program_args'], default_dir=outdir))
+    argstr = ' '.join(program_args)
+    dockerargs = ''
+    if 's3://' not in argstr and 'gcp://' not in argstr:
+        # if no cloud bucket is specified, then output to local
+        dockerargs += '-v {}:/output/:Z '.format(outdir)
+    if args.get('envfile', True) and 's3://' in argstr:
+        dockerargs += '--env-file {} '.format(bioshed_init.get_env_file( dict(cloud='aws', initpath=bioshed_init.INIT_PATH)))
+    return dict(program_args=module_args( program_args ), dockerargs=dockerargs)
+
+
+def module_args( program_args ):
+    """ Module-specific program arguments - e.g., fastqc needs its output directory explicitly (-o /output/).
+
+    >>> module_args( ['fastqc', 'a.fastq.gz'] )
+    ['fastqc', '-o', '/output/', 'a.fastq.gz']
+    """
+    if len(program_args) > 0 and str(program_args[0]).strip().lower() in ['fastqc']:
+        return [program_args[0]] + ['-o', '/output/'] + program_args[1:]
+    return program_args
+
+
+def task_resources( args ):
+    """ vcpu and memory (MB) for a module, from specs.json - defaults match AWS Batch job sizing (1 vcpu, 1000 MB).
+
+    module: module name
+    ---
+    resources: dict(cpus, mem)
+    """
+    specs = bioshed_batch.load_specs().get(args['module'], {})
+    return dict(cpus=float(specs.get('vcpu', 1)), mem=int(specs.get('mem', 1000)))
+
+
+def run_local_tasks( args ):
+    """ Runs container tasks concurrently, packing them by CPU/memory against host capacity.
+
+    Ready tasks are started in order; when the next task does not fit, smaller tasks behind it may start
+    (first fit). A task larger than the host is capped to the host's capacity and runs on its own.
+    Tasks with depends_on start only after those tasks succeed, and are skipped if any of them fails.
+
+    tasks: list of dict(name, module, args (list), tag, depends_on, dockerargs) - names must be unique
+    registry: (optional) container registry - default ecr_registry from config
+    dockerargs: (optional) extra docker run arguments for every task
+    cpus: (optional) CPUs available - default all host CPUs
+    mem: (optional) memory (MB) available - default all host memory
+    logdir: (optional) directory for per-task log files - default ./bioshed_logs
+    s3_cache: (optional) stage s3:// inputs through the host-wide S3 object cache (bioshed_s3cache)
+    stream_inputs: (optional) stream sequentially-read s3:// inputs through named pipes (bioshed_stream)
+    ---
+    results: dict of task name -> dict(status, returncode, start, end, log) - status is SUCCEEDED, FAILED or SKIPPED
+    """
+    tasks = args['tasks']
+    capacity = host_capacity( args )
+    dockerargs = str(args['dockerargs']).strip()+' ' if args.get('dockerargs', '') != '' else ''
+    logdir = args['logdir'] if 'logdir' in args else os.path.join(os.getcwd(), LOG_DIR)
+    os.makedirs(logdir, exist_ok=True)
+    names = set(task['name'] for task in tasks)
+    for task in tasks:
+        for dep in task.get('depends_on', []):
+            if dep not in names:
+                raise ValueError('Task {} depends on unknown task {}.'.format(task['name'], dep))
+
+    for task in tasks:
+        needed = task_resources( dict(module=task['module']))
+        task['cpus'] = min(needed['cpus'], capacity['cpus'])
+        task['mem'] = min(needed['mem'], capacity['mem'])
+        task['image'] = bioshed_images.image_name( dict(module=task['module'], tag=task.get('tag', 'latest'), registry=args.get('registry', '')))
+    # resolve each distinct image once (digest cache - pulls only if stale), so concurrent tasks never pull
+    refs = bioshed_images.resolve_images( dict(images=[task['image'] for task in tasks]))
+    for task in tasks:
+        task['image'] = refs[task['image']]
+
+    if args.get('stream_inputs', False):
+        # pipes are created up front - each is only read (and fed) once its task's container starts
+        import bioshed_stream
+        for task in tasks:
+            if any(a.startswith('s3://') for a in task.get('args', [])):
+                task['staged'] = bioshed_stream.stage_streams( dict(module=task['module'], program_args=task['args'], s3_cache=args.get('s3_cache', False)))
+    elif args.get('s3_cache', False):
+        # stage every task's s3:// inputs from the host-wide object cache up front (shared objects download once)
+        import bioshed_s3cache
+        for task in tasks:
+            if any(a.startswith('s3://') for a in task.get('args', [])):
+                task['staged'] = bioshed_s3cache.stage_inputs( dict(program_args=task['args']))
+
+    print('Running {} task(s) on {:g} CPUs / {} MB - logs in {}'.format(len(tasks), capacity['cpus'], capacity['mem'], logdir))
+    results = {}
+    running = {}    # name -> (task, Popen, logfile, start time)
+    used = dict(cpus=0.0, mem=0)
+    usage = dict(cpu_seconds=0.0, mem_seconds=0.0, peak_tasks=0)
+    start_time = last_tick = time.time()
+    while len(results) < len(tasks):
+        # start every ready task that fits - with nothing running, the next ready task always fits (sizes are capped to the host)
+        skipped = 0
+        for task in tasks:
+            if task['name'] in results or task['name'] in running:
+                continue
+            dep_status = [results[dep]['status'] if dep in results else '' for dep in task.get('depends_on', [])]
+            if any(s in ['FAILED', 'SKIPPED'] for s in dep_status):
+                results[task['name']] = dict(status='SKIPPED', returncode=None, start=None, end=None, log='')
+                print('Skipping {}: an upstream task did not succeed.'.format(task['name']))
+                skipped += 1
+            elif all(s == 'SUCCEEDED' for s in dep_status) and (running == {} or (used['cpus'] + task['cpus'] <= capacity['cpus'] and
+                                                                                 used['mem'] + task['mem'] <= capacity['mem'])):
+                running[task['name']] = start_task( dict(task=task, dockerargs=dockerargs, logdir=logdir))
+                used['cpus'] += task['cpus']
+                used['mem'] += task['mem']
+                usage['peak_tasks'] = max(usage['peak_tasks'], len(running))
+                print('Started {} ({:g} CPU, {} MB).'.format(task['name'], task['cpus'], task['mem']))
+        if running == {}:
+            if skipped == 0 and len(results) < len(tasks):
+                # nothing running, started or skipped: the remaining tasks can never become ready
+                raise ValueError('Tasks {} cannot be scheduled.'.format(', '.join(t['name'] for t in tasks if t['name'] not in results)))
+            continue    # skips can make more tasks skippable - another pass, no waiting on containers
+        time.sleep(POLL_SECONDS)
+        now = time.time()
+        usage['cpu_seconds'] += used['cpus'] * (now - last_tick)
+        usage['mem_seconds'] += used['mem'] * (now - last_tick)
+        last_tick = now
+        for name, (task, proc, logfile, started) in list(running.items()):
+            if proc.poll() is None:
+                continue
+            logfile.close()
+            running.pop(name)
+            used['cpus'] -= task['cpus']
+            used['mem'] -= task['mem']
+            if running == {}:
+                used = dict(cpus=0.0, mem=0)     # no float drift from fractional CPUs
+            stream_errors = bioshed_stream.finish_streams( task.pop('staged') ) if 'streams' in task.get('staged', {}) else []
+            results[name] = dict(status='SUCCEEDED' if proc.returncode == 0 and stream_errors == [] else 'FAILED', returncode=proc.returncode,
+                                 start=started, end=now, log=logfile.name)
+            print('{} {} ({:.1f}s) - log: {}'.format(name, results[name]['status'], now - started, logfile.name))
+
+    for task in tasks:
+        if 'streams' in task.get('staged', {}):
+            bioshed_stream.finish_streams( task['staged'] )     # skipped tasks - pipes never read
+        elif 'staged' in task:
+            bioshed_s3cache.unstage_inputs( task['staged'] )
+
+    wall = max(time.time() - start_time, 1e-9)
+    print_utilisation( dict(results=results, capacity=capacity, usage=usage, wall=wall))
+    return results
+
+
+def start_task( args ):
+    """ Starts one container with CPU/memory limits, writing its output to a log file.
+    ---
+    running: (task, Popen, logfile, start time)
+    """
+    task = args['task']
+    staged = task.get('staged', dict(program_args=task.get('args', []), dockerargs=''))
+    dockerargs = staged['dockerargs'] + (str(task['dockerargs']).strip()+' ' if task.get('dockerargs', '') != '' else '') + args['dockerargs']
+    cmd = 'docker run --rm --cpus {:g} --memory {}m {}{} {}'.format(task['cpus'], task['mem'], dockerargs, task['image'], ' '.join(staged['program_args']))
+    logname = ''.join(c if (c.isalnum() or c in '._-') else '_' for c in task['name'])
+    logfile = open(os.path.join(args['logdir'], '{}.log'.format(logname)), 'w')
+    logfile.write('$ {}\n'.format(cmd))
+    logfile.flush()
+    proc = subprocess.Popen(cmd, shell=True, stdout=logfile, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    return (task, proc, logfile, time.time())
+
+
+def print_utilisation( args ):
+    """ Prints task outcomes and how much of the host's CPU/memory was allocated to containers over the run.
+    """
+    results = args['results']
+    capacity = args['capacity']
+    usage = args['usage']
+    wall = args['wall']
+    counts = {}
+    for result in results.values():
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    print('\nLocal run summary: {} in {:.1f}s'.format(', '.join('{} {}'.format(v, k) for k, v in sorted(counts.items())), wall))
+    print('Allocated CPU: {:.0f}% of {:g} CPUs | Allocated memory: {:.0f}% of {} MB | Peak concurrent tasks: {}'.format(
+          100.0 * usage['cpu_seconds'] / (capacity['cpus'] * wall), capacity['cpus'],
+          100.0 * usage['mem_seconds'] / (capacity['mem'] * wall), capacity['mem'], usage['peak_tasks']))
+    return
@@ -0,0 +1,193 @@
+import os, sys
+from datetime import datetime
+##
+## Pipelines (DAGs) of bioshed modules.
+## $ bioshed pipeline run pipeline.yaml [--local] [--wait]
+##
+## Example pipeline.yaml:
+##   name: rnaseq
+##   steps:
+##     fastqc:
+##       module: fastqc
+##       args: s3://mybucket/sample_R1.fastq.gz out::s3://mybucket/qc/
+##     star:
+##       module: star
+##       args: --genomeDir s3://mybucket/ref/ --readFilesIn s3://mybucket/sample_R1.fastq.gz out::s3://mybucket/align/
+##     featurecounts:
+##       module: featurecounts
+##       args: -a s3://mybucket/ref/genes.gtf -o counts.txt s3://mybucket/align/Aligned.out.bam out::s3://mybucket/counts/
+##       depends_on: [star]
+##
+## A step's args are what follows the module in "bioshed run <MODULE> <ARGS>", and are prepared the same way.
+## In AWS, every step is submitted at once, with Batch job dependencies (dependsOn) wired from depends_on.
+## With --local, independent steps run concurrently as local containers once their dependencies succeed,
+## packed by CPU/memory against the host (bioshed_local).
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+sys.path.append(os.path.join(SCRIPT_DIR, 'bioshed_utils/'))
+
+def load_pipeline( args ):
+    """ Loads and validates a pipeline YAML file.
+
+    pipelinefile: pipeline YAML file
+    ---
+    pipeline: dict(name, steps={step: dict(module, args, tag, depends_on)}, order=[step, ...] in topological order)
+    """
+    import yaml
+    pipelinefile = args['pipelinefile']
+    with open(pipelinefile, 'r') as f:
+        pipeline_yaml = yaml.safe_load(f) or {}
+    if type(pipeline_yaml.get('steps', None)) != dict or pipeline_yaml['steps'] == {}:
+        raise ValueError('{} has no steps.'.format(pipelinefile))
+    steps = {}
+    for step, spec in pipeline_yaml['steps'].items():
+        spec = spec or {}
+        if 'module' not in spec:
+            raise ValueError('Step {} has no module.'.format(step))
+        depends_on = spec.get('depends_on', [])
+        step_args = spec.get('args', '')
+        steps[str(step)] = dict(module=str(spec['module']).strip().lower(),
+                                args=str(step_args).split() if type(step_args) != list else [str(a) for a in step_args],
+                                tag=str(spec.get('tag', 'latest')),
+                                depends_on=[str(d) for d in ([depends_on] if type(depends_on) == str else depends_on)])
+    name = str(pipeline_yaml.get('name', os.path.splitext(os.path.basename(pipelinefile))[0]))
+    return dict(name=name, steps=steps, order=topological_order( dict(steps=steps)))
+
+
+def topological_order( args ):
+    """ Orders pipeline steps so that every step comes after the steps it depends on (Kahn's algorithm).
+    Raises ValueError on unknown dependencies or cycles.
+
+    steps: dict of step -> dict(depends_on=[...])
+    ---
+    order: list of steps
+
+    >>> topological_order( dict(steps={'b': dict(depends_on=['a']), 'a': dict(depends_on=[])}))
+    ['a', 'b']
+    """
+    steps = args['steps']
+    for step, spec in steps.items():
+        for dep in spec['depends_on']:
+            if dep not in steps:
+                raise ValueError('Step {} depends on unknown step {}.'.format(step, dep))
+    remaining = dict((step, set(spec['depends_on'])) for step, spec in steps.items())
+    order = []
+    while remaining != {}:
+        ready = sorted(step for step, deps in remaining.items() if deps == set())
+        if ready == []:
+            raise ValueError('Pipeline has a dependency cycle between steps: {}'.format(', '.join(sorted(remaining))))
+        for step in ready:
+            order.append(step)
+            remaining.pop(step)
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return order
+
+
+def submit_pipeline_awsbatch( args ):
+    """ Submits all pipeline steps as AWS Batch jobs, with job dependencies wired from depends_on.
+    Steps are submitted in topological order, so every dependency already has a job ID.
+
+    pipeline: pipeline dict (from load_pipeline)
+    runfile: (optional) file to write the run record to
+    ---
+    run: dict(pipeline, submitted, jobs={step: jobid})
+    """
+    import bioshed_batch
+    import bioshed_jobs
+    pipeline = args['pipeline']
+    jobs = {}
+    jobinfos = []
+    for step in pipeline['order']:
+        spec = pipeline['steps'][step]
+        jobinfo = bioshed_batch.submit_job( dict(name=spec['module'], tag=spec['tag'], program_args=step_args( spec ),
+                                                 dependent_job_ids=[jobs[dep] for dep in spec['depends_on']]))
+        jobs[step] = jobinfo['jobid']
+        jobinfos.append(jobinfo)
+        print('Submitted step {} ({}): {}{}'.format(step, spec['module'], jobinfo['jobid'],
+                                                   ' - after {}'.format(', '.join(spec['depends_on'])) if spec['depends_on'] != [] else ''))
+    bioshed_jobs.record_jobs( dict(jobs=jobinfos))
+    run = dict(pipeline=pipeline['name'], submitted=str(datetime.now()), jobs=jobs)
+    if 'runfile' in args:
+        import bioshed_config
+        bioshed_config.write_json_atomic( run, args['runfile'] )
+    return run
+
+
+def run_pipeline_local( args ):
+    """ Runs a pipeline with local containers (see bioshed_local.run_local_tasks). A step starts as soon as
+    its dependencies have succeeded and there is CPU/memory for it, so independent branches run concurrently.
+    Steps downstream of a failed step are skipped. Each step's arguments are prepared as for "bioshed run --local"
+    (output directory, AWS env file for s3:// paths, module-specific arguments).
+
+    pipeline: pipeline dict (from load_pipeline)
+    registry: (optional) container registry
+    dockerargs: (optional) extra docker run arguments
+    outdir: (optional) local output directory - default current directory
+    cpus: (optional) CPUs available - default all host CPUs
+    mem: (optional) memory (MB) available - default all host memory
+    ---
+    results: dict of step -> dict(status, start, end, ...) - status is SUCCEEDED, FAILED or SKIPPED
+    """
+    import bioshed_local
+    pipeline = args['pipeline']
+    tasks = []
+    for step in pipeline['order']:
+        spec = pipeline['steps'][step]
+        prepared = bioshed_local.local_run_args( dict(program_args=[spec['module']] + spec['args'], outdir=args.get('outdir', '')))
+        tasks.append(dict(spec, name=step, args=prepared['program_args'], dockerargs=prepared['dockerargs']))
+    return bioshed_local.run_local_tasks( dict(args, tasks=tasks))
+
+
+def step_args( spec ):
+    """ Program arguments of a step's Batch job - the module followed by its args, as for "bioshed run <MODULE> <ARGS>".
+    """
+    import bioshed_local
+    return bioshed_local.module_args( [spec['module']] + spec['args'] )
+
+
+def critical_path( args ):
+    """ Finds the critical path - the chain of dependent steps with the longest total run time.
+
+    pipeline: pipeline dict (from load_pipeline)
+    durations: dict of step -> run time in seconds (missing steps count as 0)
+    ---
+    path: dict(steps=[step, ...], seconds=total run time of the path)
+    """
+    pipeline = args['pipeline']
+    durations = args['durations']
+    best = {}   # step -> (seconds of longest path ending at step, previous step)
+    for step in pipeline['order']:
+        deps = pipeline['steps'][step]['depends_on']
+        prev = max(deps, key=lambda dep: best[dep][0]) if deps != [] else None
+        best[step] = ((best[prev][0] if prev != None else 0) + max(0, durations.get(step, 0) or 0), prev)
+    step = max(best, key=lambda s: best[s][0])
+    total = best[step][0]
+    path = []
+    while step != None:
+        path.insert(0, step)
+        step = best[step][1]
+    return dict(steps=path, seconds=total)
+
+
+def print_timing_report( args ):
+    """ Prints per-step run times, the critical path and the wall time.
+
+    pipeline: pipeline dict
+    timings: dict of step -> dict(start, end) (epoch seconds; None if the step did not run)
+    """
+    pipeline = args['pipeline']
+    timings = args['timings']
+    durations = dict((step, t['end'] - t['start']) for step, t in timings.items() if t.get('start') and t.get('end'))
+    starts = [t['start'] for t in timings.values() if t.get('start')]
+    ends = [t['end'] for t in timings.values() if t.get('end')]
+    print('\nPipeline {} timing:'.format(pipeline['name']))
+    for step in pipeline['order']:
+        print('\t{}\t{}'.format(step, '{:.1f}s'.format(durations[step]) if step in durations else '-'))
+    path = critical_path( dict(pipeline=pipeline, durations=durations))
+    print('Critical path: {} ({:.1f}s)'.format(' -> '.join(path['steps']), path['seconds']))
+    if starts != [] and ends != []:
+        print('Wall time: {:.1f}s'.format(max(ends) - min(starts)))
+    return path
@@ -0,0 +1,271 @@
+import os, shutil, fcntl, hashlib
+##
+## Host-level S3 object cache for AWS Batch jobs (reference genomes, aligner indexes, ...).
+##
+## Batch hosts launched from the bioshed launch template (bioshed deploy core aws) have a cache volume mounted at
+## HOST_CACHE_DIR, which job definitions bind-mount into job containers at CONTAINER_CACHE_DIR (BIOSHED_REF_CACHE).
+## This module is installed on the host next to a sitecustomize.py, which job containers get on their PYTHONPATH
+## (in front of the image's own PYTHONPATH): in the run_main.py process of a bioshed module container it replaces
+## program_utils.download_files, so s3:// inputs are fetched through the cache and symlinked into the job's input directory.
+## Other Python processes in the container are left alone.
+##
+## Objects are keyed by bucket/key/ETag - a changed object is a new entry. Concurrent jobs on a host share one
+## download (an exclusive lock on the object's .download file, held only while checking and filling the cache); jobs
+## hold a shared lock on the object's .lock file (the pin) while they use it, until they exit, so objects in use are
+## never evicted. Eviction takes the pin exclusively without waiting, so pins never block each other. Least recently used objects are evicted when the volume is BIOSHED_REF_CACHE_FULL
+## (default 90%) full. Self-contained (boto3 only), since it runs inside module containers.
+
+HOST_CACHE_DIR = '/var/lib/bioshed/refcache'
+HOST_PYTHON_DIR = '/var/lib/bioshed/python'
+CONTAINER_CACHE_DIR = '/bioshed-cache'
+CONTAINER_PYTHON_DIR = '/bioshed-python'
+REF_CACHE_DIR = os.environ.get('BIOSHED_REF_CACHE', '')
+REF_CACHE_FULL = float(os.environ.get('BIOSHED_REF_CACHE_FULL', 0.9))
+SITECUSTOMIZE = """import os, sys
+# bioshed: fetch s3:// inputs of bioshed module containers through the host cache (see bioshed_refcache) - only in the
+# module's run_main.py process, not in other Python programs the job runs
+def _bioshed_argv():
+    if getattr(sys, 'argv', None):
+        return sys.argv
+    try:
+        with open('/proc/self/cmdline', 'rb') as f:
+            return f.read().decode(errors='replace').split('\\0')[1:]
+    except OSError:
+        return []
+if os.environ.get('BIOSHED_REF_CACHE', '') != '' and [a for a in _bioshed_argv() if a != ''][:1] == ['/run_main.py']:
+    try:
+        if '/' not in sys.path:
+            sys.path.append('/')
+        import bioshed_refcache
+        bioshed_refcache.install({})
+    except Exception as e:
+        sys.stderr.write('bioshed reference cache not used: {}\\n'.format(str(e)))
+"""
+
+_held_locks = []     # shared locks on objects used by this job - released when the job exits
+_download_files = None     # program_utils.download_files of the image, for paths the cache cannot stage
+
+def get_s3_client():
+    import boto3
+    return boto3.client('s3')
+
+
+def fetch_object( args ):
+    """ Local path of an S3 object in the host cache, downloading it if this bucket/key/ETag is not cached yet.
+
+    bucket: S3 bucket
+    key: S3 key
+    cachedir: (optional) cache directory - default BIOSHED_REF_CACHE
+    client: (optional) boto3 S3 client
+    ---
+    object: dict(path, bytes, hit)
+    """
+    cachedir = args['cachedir'] if args.get('cachedir', '') != '' else REF_CACHE_DIR
+    client = args['client'] if 'client' in args else get_s3_client()
+    bucket, key = args['bucket'], args['key']
+    head = client.head_object(Bucket=bucket, Key=key)
+    etag, size = str(head['ETag']).strip('"'), int(head['ContentLength'])
+    objid = hashlib.sha256('{}/{}/{}'.format(bucket, key, etag).encode()).hexdigest()
+    objdir = os.path.join(cachedir, 'objects', objid[:2], objid)
+    path = os.path.join(objdir, os.path.basename(key) or 'object')
+    pinfile = pin_object( objdir )
+    tmpfile = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(os.path.join(objdir, '.download'), 'a') as downloadlock:
+            fcntl.flock(downloadlock, fcntl.LOCK_EX)     # one download per object on this host
+            hit = os.path.exists(path)
+            if not hit:
+                evict_objects( dict(cachedir=cachedir, needed=size))
+                print('Reference cache miss - downloading s3://{}/{} ({:.2f} GB)'.format(bucket, key, size / 1024**3))
+                client.download_file(bucket, key, tmpfile)
+                os.replace(tmpfile, path)
+            else:
+                print('Reference cache hit - s3://{}/{}'.format(bucket, key))
+        os.utime(os.path.join(objdir, '.lock'))      # last used, for eviction
+    except Exception:
+        pinfile.close()
+        raise
+    finally:
+        if os.path.exists(tmpfile):     # failed download
+            os.remove(tmpfile)
+    _held_locks.append(pinfile)     # keep the object while this job runs
+    return dict(path=path, bytes=size, hit=hit)
+
+
+def pin_object( objdir ):
+    """ Takes a shared lock on an object's .lock file, creating the object directory if needed. If the object was
+    evicted while waiting for the lock, the directory is created again.
+    ---
+    pinfile: open .lock file - the object cannot be evicted until it is closed
+    """
+    while True:
+        os.makedirs(objdir, exist_ok=True)
+        pinfile = open(os.path.join(objdir, '.lock'), 'a')
+        fcntl.flock(pinfile, fcntl.LOCK_SH)
+        try:
+            if os.path.samestat(os.fstat(pinfile.fileno()), os.stat(pinfile.name)):
+                return pinfile
+        except OSError:
+            pass
+        pinfile.close()
+
+
+def evict_objects( args ):
+    """ Evicts least recently used objects until the cache volume has room for a new object.
+    Objects that are in use (locked by a running job) are skipped.
+
+    cachedir: cache directory
+    needed: (optional) bytes about to be added
+    ---
+    evicted: number of objects evicted
+    """
+    cachedir = args['cachedir']
+    usage = shutil.disk_usage(cachedir)
+    limit = usage.total * REF_CACHE_FULL
+    used = usage.used + int(args.get('needed', 0))
+    if used <= limit:
+        return 0
+    objdirs = []
+    for prefix in os.listdir(os.path.join(cachedir, 'objects')):
+        for objid in os.listdir(os.path.join(cachedir, 'objects', prefix)):
+            objdir = os.path.join(cachedir, 'objects', prefix, objid)
+            try:
+                objdirs.append((os.path.getmtime(os.path.join(objdir, '.lock')), objdir))
+            except OSError:
+                pass
+    evicted = 0
+    for last_used, objdir in sorted(objdirs):
+        if used <= limit:
+            break
+        try:
+            with open(os.path.join(objdir, '.lock'), 'a') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                nbytes = sum(os.path.getsize(os.path.join(objdir, f)) for f in os.listdir(objdir))
+                shutil.rmtree(objdir, ignore_errors=True)
+        except (BlockingIOError, OSError):
+            continue
+        used -= nbytes
+        evicted += 1
+    return evicted
+
+
+def list_prefix( client, bucket, prefix ):
+    keys = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        keys += [o['Key'] for o in page.get('Contents', []) if not o['Key'].endswith('/')]
+    return keys
+
+
+def stage_path( args ):
+    """ Stages an s3:// file or folder from the cache into a local directory (symlinks), like
+    aws_s3_utils.download_file_s3 / download_folder_s3 - a folder's contents are staged into the local directory.
+
+    path: s3:// path
+    localdir: local directory
+    ---
+    localpath: local file path or local directory, or '' if the path does not exist in S3
+    """
+    client = args['client'] if 'client' in args else get_s3_client()
+    bucket, _, key = args['path'][len('s3://'):].partition('/')
+    localdir = args['localdir']
+    if '.' in args['path'].split('/')[-1] and not args['path'].endswith('/'):
+        keys, prefix, localpath = [key], key[:len(key) - len(key.split('/')[-1])], os.path.join(localdir, key.split('/')[-1])
+    else:
+        prefix = key.rstrip('/') + '/' if key.rstrip('/') != '' else ''
+        keys, localpath = list_prefix( client, bucket, prefix ), localdir
+    if keys == []:
+        return ''
+    for k in keys:
+        obj = fetch_object( dict(bucket=bucket, key=k, client=client, cachedir=args.get('cachedir', '')))
+        target = os.path.join(localdir, k[len(prefix):])
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        if os.path.lexists(target):
+            os.remove(target)
+        os.symlink(obj['path'], target)
+    return localpath
+
+
+def download_files( args ):
+    """ Given program arguments, stages any s3:// files from the host cache - same as program_utils.download_files.
+    Other arguments, and paths that cannot be staged from the cache, go to the image's own download_files.
+
+    program_args: program arguments (list of space-separated strings of args)
+    localdir: directory to stage to
+    ---
+    program_args_out: formatted program arguments
+    """
+    client = get_s3_client()
+    program_args_out_all = []
+    for pargs_command in args['program_args']:
+        program_args_out = []
+        for p in str(pargs_command).split(' '):
+            localpath = ''
+            if p.startswith('s3://'):
+                try:
+                    localpath = stage_path( dict(path=p, localdir=args['localdir'], client=client))
+                except Exception as e:
+                    print('Could not stage {} from the reference cache: {}'.format(p, str(e)))
+            if localpath == '' and p != '' and _download_files != None:
+                localpath = ' '.join(_download_files( dict(program_args=[p], localdir=args['localdir'])))
+            if localpath != '' or p != '':
+                program_args_out.append(localpath if localpath != '' else p)
+        if program_args_out != []:
+            program_args_out_all.append(' '.join(program_args_out))
+    return program_args_out_all
+
+
+def install( args ):
+    """ Routes program_utils.download_files through the host cache (called from sitecustomize in job containers).
+    """
+    global _download_files
+    import program_utils
+    if program_utils.download_files != download_files:
+        _download_files = program_utils.download_files
+        program_utils.download_files = download_files
+    return
+
+
+def host_setup_script( args ):
+    """ Shell script (launch template user data) that mounts the cache volume on a Batch host and installs this module
+    with its sitecustomize.py for job containers.
+
+    device_name: block device name of the cache volume in the launch template (e.g., /dev/xvdb)
+    ---
+    script: shell script
+    """
+    import base64, gzip
+    with open(os.path.realpath(__file__), 'rb') as f:
+        module_b64 = base64.b64encode(gzip.compress(f.read(), mtime=0)).decode()
+    return '\n'.join([
+        '#!/bin/bash',
+        '# bioshed reference cache: mount the cache volume (NVMe instances expose it as another nvme device)',
+        'DEV={}'.format(args['device_name']),
+        'for d in /dev/nvme1n1 {}; do [ -b "$d" ] && DEV="$d" && break; done'.format(args['device_name']),
+        'mkdir -p {} {}'.format(HOST_CACHE_DIR, HOST_PYTHON_DIR),
+        'if [ -b "$DEV" ] && ! mountpoint -q {}; then'.format(HOST_CACHE_DIR),
+        '  blkid "$DEV" || mkfs -t xfs "$DEV"',
+        '  mount "$DEV" {}'.format(HOST_CACHE_DIR),
+        'fi',
+        'mkdir -p {}/objects && chmod 1777 {} {}/objects'.format(HOST_CACHE_DIR, HOST_CACHE_DIR, HOST_CACHE_DIR),
+        'echo {} | base64 -d | gunzip > {}/bioshed_refcache.py'.format(module_b64, HOST_PYTHON_DIR),
+        "cat > {}/sitecustomize.py <<'EOF'".format(HOST_PYTHON_DIR),
+        SITECUSTOMIZE.rstrip('\n'),
+        'EOF',
+        ''])
+
+
+def job_mounts( args ):
+    """ Job definition volumes, mount points and environment that give a job container the host cache.
+    Job definition environment values are not expanded, so the image's own PYTHONPATH is passed in and kept.
+
+    pythonpath: (optional) PYTHONPATH of the job's image
+    ---
+    properties: dict(volumes, mountPoints, environment) for containerProperties
+    """
+    pythonpath = ':'.join([CONTAINER_PYTHON_DIR] + [p for p in str(args.get('pythonpath', '')).split(':') if p != ''])
+    return dict(volumes=[{'name': 'bioshed_refcache', 'host': {'sourcePath': HOST_CACHE_DIR}},
+                         {'name': 'bioshed_python', 'host': {'sourcePath': HOST_PYTHON_DIR}}],
+                mountPoints=[{'sourceVolume': 'bioshed_refcache', 'containerPath': CONTAINER_CACHE_DIR, 'readOnly': False},
+                             {'sourceVolume': 'bioshed_python', 'containerPath': CONTAINER_PYTHON_DIR, 'readOnly': True}],
+                environment=[{'name': 'BIOSHED_REF_CACHE', 'value': CONTAINER_CACHE_DIR},
+                             {'name': 'PYTHONPATH', 'value': pythonpath}])
@@ -0,0 +1,477 @@
+import os, sys, time, json, shutil, sqlite3, hashlib
+##
+## Content-addressed run cache (opt-in: bioshed run --cache, or BIOSHED_RUN_CACHE=1; --no-cache always runs).
+##
+## A run is identified by the module's image digest, its normalized program arguments (output destination removed)
+## and a fingerprint of every input it references: content hashes for local files, ETags for S3 objects.
+## Output locations (out::..., the local output directory, values of output options such as -o) are not inputs.
+## - local runs: output files are hard-linked (or copied) into ~/.bioshedinit/runcache/<key>/ and restored on a hit
+## - outputs at out::s3://...: the objects the run wrote (new or changed since a listing taken before the run, and
+##   written while it ran) are recorded, and server-side copied to the new destination on a hit
+## - AWS Batch runs are recorded when the job is seen to succeed (bioshed jobs --refresh / bioshed wait)
+## Local cached files are evicted least-recently-used first once the cache exceeds BIOSHED_RUN_CACHE_MAX_GB.
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+RUN_CACHE_DIR = os.path.join(INIT_PATH, 'runcache')
+RUN_CACHE_DB = os.path.join(INIT_PATH, 'runcache.db')
+RUN_CACHE_MAX_BYTES = int(float(os.environ.get('BIOSHED_RUN_CACHE_MAX_GB', 50)) * 1024**3)
+HASH_CHUNK = 8*1024*1024
+OUTPUT_OPTIONS = ['-o', '-O', '--out', '--output', '--outdir', '--output-dir', '--outFileNamePrefix']    # value is an output location
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_transfer
+
+def cache_enabled( args ):
+    """ Whether the run cache applies to this run.
+
+    cache: True (--cache), False (--no-cache) or None (not specified - use BIOSHED_RUN_CACHE)
+    ---
+    enabled: True/False
+    """
+    if args.get('cache', None) != None:
+        return args['cache']
+    return os.environ.get('BIOSHED_RUN_CACHE', '') not in ['', '0']
+
+
+def check_run( args ):
+    """ Looks up a run in the cache, restoring its outputs on a hit.
+
+    module: module name
+    program_args: program arguments (list)
+    registry: (optional) container registry
+    tag: (optional) image tag
+    outdir: (optional) local output directory (local runs)
+    ---
+    run: dict(hit, key, outdest, image, started) - key is '' if this run cannot be cached
+    """
+    import bioshed_images
+    image = bioshed_images.resolve_image( dict(image=bioshed_images.image_name( args )))
+    run = dict(hit=False, key='', outdest='', image=image, started=time.time())
+    if '@' not in image:
+        print('Run cache: could not resolve an image digest for {} - running without the cache.'.format(args['module']))
+        return run
+    run.update(run_key( dict(image=image, program_args=args['program_args'], outdir=args.get('outdir', ''))))
+    if run['key'] == '':
+        print('Run cache: could not fingerprint all inputs - running without the cache.')
+        return run
+    run['hit'] = lookup_run( dict(key=run['key'], outdest=run['outdest'], outdir=args.get('outdir', '')))
+    return run
+
+
+def local_output_dir( dockerargs ):
+    """ Host directory mounted as the container's /output/ (from docker run arguments), or '' if none.
+
+    >>> local_output_dir( '-v /home/me/run:/output/:Z ' )
+    '/home/me/run'
+    """
+    import re
+    match = re.search(r'-v\s+((?:\\ |\S)+):/output/?', dockerargs)
+    return match.group(1).replace('\\ ', ' ') if match else ''
+
+
+def open_cache( args ):
+    """ Opens (and creates if needed) the run cache index.
+    """
+    cachedb = args['cachedb'] if 'cachedb' in args else RUN_CACHE_DB
+    conn = sqlite3.connect(cachedb, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute("""CREATE TABLE IF NOT EXISTS runs (
+                        key TEXT PRIMARY KEY,
+                        module TEXT,
+                        image TEXT,
+                        program_args TEXT,
+                        status TEXT,
+                        jobid TEXT,
+                        outdest TEXT,
+                        outputs TEXT,
+                        bytes INTEGER,
+                        created REAL,
+                        last_used REAL)""")
+    conn.execute('CREATE INDEX IF NOT EXISTS runs_jobid ON runs (jobid)')
+    conn.execute("""CREATE TABLE IF NOT EXISTS file_hashes (
+                        path TEXT PRIMARY KEY,
+                        size INTEGER,
+                        mtime_ns INTEGER,
+                        sha256 TEXT)""")
+    return conn
+
+
+def run_key( args ):
+    """ Computes the cache key for a run.
+
+    image: digest-pinned image reference (<repo>@sha256:...)
+    program_args: program arguments (list)
+    outdir: (optional) local output directory - not an input
+    ---
+    key: dict(key, outdest, inputs) - key is '' if the run cannot be cached (e.g., an input could not be fingerprinted)
+    """
+    program_args = args['program_args']
+    outdest = ''
+    normalized = []
+    for parg in program_args:
+        if parg.startswith('out::'):
+            # only the kind of destination (S3 or local) is part of the key - a hit is restored to the new destination
+            outdest = parg[len('out::'):]
+            normalized.append('out::s3' if outdest.startswith('s3://') else 'out::local')
+        else:
+            normalized.append(parg.strip())
+    inputs = {}
+    for path in input_paths( dict(program_args=normalized, outdir=args.get('outdir', ''))):
+        fingerprint = s3_fingerprint( path ) if path.startswith('s3://') else file_fingerprint( dict(path=path))
+        if fingerprint == '':
+            return dict(key='', outdest=outdest, inputs={})
+        inputs[path] = fingerprint
+    record = json.dumps(dict(image=args['image'], program_args=normalized, inputs=inputs), sort_keys=True)
+    return dict(key=hashlib.sha256(record.encode()).hexdigest(), outdest=outdest, inputs=inputs)
+
+
+def input_paths( args ):
+    """ Input paths referenced by program arguments - S3 URIs and existing local files/directories
+    (including the value part of --opt=value arguments). Output locations are skipped: out:: destinations, values of
+    output options (-o, --outdir, ...), and the local output directory itself.
+
+    program_args: program arguments (list)
+    outdir: (optional) local output directory
+    ---
+    paths: sorted list of input paths
+
+    >>> input_paths( dict(program_args=['fastqc', 's3://a/b.fastq.gz', 'out::', '-o', 's3://a/qc/']))
+    ['s3://a/b.fastq.gz']
+    """
+    outdir = os.path.realpath(args['outdir']) if args.get('outdir', '') != '' else ''
+    paths = []
+    after_output_option = False
+    for parg in args['program_args']:
+        is_output = after_output_option or parg.startswith('out::') or parg.split('=', 1)[0] in OUTPUT_OPTIONS
+        after_output_option = parg in OUTPUT_OPTIONS
+        if is_output:
+            continue
+        for candidate in set([parg, parg.split('=', 1)[-1]]):
+            if candidate.startswith('s3://'):
+                paths.append(candidate)
+            elif candidate not in ['', '.', '/'] and os.path.exists(candidate) and os.path.realpath(candidate) != outdir:
+                paths.append(candidate)
+    return sorted(set(paths))
+
+
+def file_fingerprint( args ):
+    """ SHA-256 of a local file's content (or of a directory's files). Hashes are remembered by (path, size, mtime),
+    so unchanged files are not re-read on every run.
+    """
+    path = os.path.abspath(args['path'])
+    if os.path.isdir(path):
+        digests = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fname in sorted(files):
+                fpath = os.path.join(root, fname)
+                digests.append('{}:{}'.format(os.path.relpath(fpath, path), file_fingerprint( dict(args, path=fpath))))
+        return hashlib.sha256('\n'.join(digests).encode()).hexdigest()
+    st = os.stat(path)
+    conn = open_cache( args )
+    row = conn.execute('SELECT sha256 FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?', (path, st.st_size, st.st_mtime_ns)).fetchone()
+    if row != None:
+        conn.close()
+        return row['sha256']
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            sha.update(chunk)
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)', (path, st.st_size, st.st_mtime_ns, sha.hexdigest()))
+    conn.close()
+    return sha.hexdigest()
+
+
+def s3_fingerprint( uri ):
+    """ ETag(s) of an S3 object, or of every object under a prefix (URI ending in /). '' if not found.
+    """
+    bucket, key = bioshed_transfer.split_s3_uri( uri )
+    objects = list_s3_objects( dict(bucket=bucket, prefix=key)) if key.endswith('/') or key == '' else []
+    if objects == []:
+        try:
+            return str(bioshed_transfer.get_s3_client().head_object(Bucket=bucket, Key=key)['ETag']).strip('"')
+        except Exception:
+            return ''
+    return hashlib.sha256('\n'.join('{}:{}'.format(o['key'], o['etag']) for o in objects).encode()).hexdigest()
+
+
+def lookup_run( args ):
+    """ Finds a cached result and restores its outputs.
+
+    key: run key (from run_key)
+    outdest: output destination of this run (S3 URI) - '' for local runs
+    outdir: local output directory (local runs)
+    ---
+    hit: True if the outputs were restored (the run can be skipped)
+    """
+    conn = open_cache( args )
+    row = conn.execute("SELECT * FROM runs WHERE key = ? AND status = 'ready'", (args['key'],)).fetchone()
+    conn.close()
+    if row == None:
+        return False
+    entry = dict(row)
+    outputs = json.loads(entry['outputs'])
+    try:
+        if entry['outdest'].startswith('s3://'):
+            restored = restore_s3_outputs( dict(outputs=outputs, outdest=args['outdest']))
+        else:
+            restored = restore_local_outputs( dict(key=args['key'], outputs=outputs, outdir=args['outdir']))
+    except Exception as e:
+        restored = False
+        print('Run cache entry {} could not be restored ({}).'.format(args['key'][:12], str(e)))
+    conn = open_cache( args )
+    with conn:
+        if restored:
+            conn.execute('UPDATE runs SET last_used = ? WHERE key = ?', (time.time(), args['key']))
+        else:
+            conn.execute('DELETE FROM runs WHERE key = ?', (args['key'],))
+    conn.close()
+    if restored:
+        print('Run cache hit: restored {} output(s) of an identical {} run from {} (use --no-cache to re-run).'.format(
+              len(outputs), entry['module'], time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['created']))))
+    else:
+        shutil.rmtree(os.path.join(RUN_CACHE_DIR, args['key']), ignore_errors=True)
+    return restored
+
+
+def snapshot_outputs( args ):
+    """ Sizes and mtimes of files under a local output directory (taken before a run, to find what it wrote).
+    """
+    snapshot = {}
+    for root, dirs, files in os.walk(args['outdir']):
+        dirs[:] = [d for d in dirs if d not in ['bioshed_logs']]
+        for fname in files:
+            fpath = os.path.join(root, fname)
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                continue
+            snapshot[os.path.relpath(fpath, args['outdir'])] = (st.st_size, st.st_mtime_ns)
+    return snapshot
+
+
+def record_local_run( args ):
+    """ Records the outputs of a successful local run - files in outdir that are new or changed since the snapshot.
+
+    key: run key
+    module, image, program_args: run description
+    outdir: local output directory
+    snapshot: output directory snapshot taken before the run (snapshot_outputs, or snapshot_s3_outputs for S3 outputs)
+    outdest: (optional) S3 output destination - the objects the run wrote there are recorded instead of local files
+    started: (optional) run start time (for S3 outputs)
+    """
+    key = args['key']
+    if args.get('outdest', '').startswith('s3://'):
+        outputs = s3_outputs_written( dict(outdest=args['outdest'], snapshot=args['snapshot'], started=args['started'], ended=time.time()))
+        nbytes = 0
+    else:
+        before = args['snapshot']
+        after = snapshot_outputs( dict(outdir=args['outdir']))
+        changed = sorted(p for p, stat in after.items() if before.get(p) != stat)
+        cachedir = os.path.join(RUN_CACHE_DIR, key)
+        os.makedirs(cachedir, exist_ok=True)
+        outputs = []
+        nbytes = 0
+        for relpath in changed:
+            target = os.path.join(cachedir, relpath)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            link_or_copy( os.path.join(args['outdir'], relpath), target )
+            st = os.stat(target)
+            outputs.append(dict(path=relpath, size=st.st_size, mtime_ns=st.st_mtime_ns))
+            nbytes += st.st_size
+    save_run( dict(args, status='ready', outputs=outputs, bytes=nbytes, jobid=''))
+    evict_runs( args )
+    return outputs
+
+
+def record_batch_run( args ):
+    """ Records a submitted AWS Batch run as pending - it becomes a cache entry when the job succeeds (finalize_batch_runs).
+    Until then, its outputs field holds the listing of the output destination taken before the job was submitted.
+
+    snapshot: snapshot_s3_outputs of the output destination, taken before submitting the job
+    """
+    save_run( dict(args, status='pending', outputs=dict(snapshot=args['snapshot']), bytes=0))
+    return
+
+
+def finalize_batch_runs( args ):
+    """ Turns pending entries of succeeded Batch jobs into cache entries (their objects under out::s3://...).
+    Called from job status refreshes. Entries of failed jobs are dropped.
+
+    succeeded: list of job IDs that succeeded
+    failed: list of job IDs that failed
+    stopped: (optional) dict of job ID -> time the job stopped
+    """
+    if not os.path.exists(args['cachedb'] if 'cachedb' in args else RUN_CACHE_DB):
+        return
+    conn = open_cache( args )
+    ids = list(args.get('succeeded', [])) + list(args.get('failed', []))
+    pending = [dict(row) for row in conn.execute("SELECT * FROM runs WHERE status = 'pending' AND jobid IN ({})".format(
+               ','.join('?' * len(ids))), ids)] if ids != [] else []
+    conn.close()
+    for entry in pending:
+        if entry['jobid'] in args.get('succeeded', []) and entry['outdest'].startswith('s3://'):
+            try:
+                pending_outputs = json.loads(entry['outputs'])
+                outputs = s3_outputs_written( dict(outdest=entry['outdest'], started=entry['created'], ended=args.get('stopped', {}).get(entry['jobid'], None),
+                                                   snapshot=pending_outputs.get('snapshot', {}) if type(pending_outputs) == dict else {}))
+            except Exception:
+                outputs = []
+            if outputs != []:
+                save_run( dict(entry, program_args=json.loads(entry['program_args']), status='ready', outputs=outputs, bytes=0))
+                continue
+        conn = open_cache( args )
+        with conn:
+            conn.execute('DELETE FROM runs WHERE key = ?', (entry['key'],))
+        conn.close()
+    return
+
+
+def save_run( args ):
+    now = time.time()
+    conn = open_cache( args )
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (args['key'], args.get('module', ''), args.get('image', ''), json.dumps(args.get('program_args', [])), args['status'],
+                      args.get('jobid', ''), args.get('outdest', ''), json.dumps(args['outputs']), int(args['bytes']),
+                      float(args.get('created', now)), now))
+    conn.close()
+    return
+
+
+def evict_runs( args ):
+    """ Evicts least-recently-used local cache entries until local cached files fit in the size limit.
+
+    max_bytes: (optional) size limit - default BIOSHED_RUN_CACHE_MAX_GB
+    """
+    max_bytes = int(args['max_bytes']) if 'max_bytes' in args else RUN_CACHE_MAX_BYTES
+    conn = open_cache( args )
+    rows = [dict(row) for row in conn.execute("SELECT key, bytes FROM runs WHERE status = 'ready' AND bytes > 0 ORDER BY last_used ASC")]
+    total = sum(row['bytes'] for row in rows)
+    evicted = []
+    for row in rows:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(os.path.join(RUN_CACHE_DIR, row['key']), ignore_errors=True)
+        total -= row['bytes']
+        evicted.append(row['key'])
+    with conn:
+        conn.executemany('DELETE FROM runs WHERE key = ?', [(k,) for k in evicted])
+    conn.close()
+    return evicted
+
+
+def restore_local_outputs( args ):
+    """ Hard-links (or copies) cached output files into the output directory.
+    Fails if a cached file was modified after it was recorded.
+    """
+    cachedir = os.path.join(RUN_CACHE_DIR, args['key'])
+    for output in args['outputs']:
+        source = os.path.join(cachedir, output['path'])
+        st = os.stat(source)
+        if (st.st_size, st.st_mtime_ns) != (output['size'], output['mtime_ns']):
+            raise ValueError('cached file {} was modified'.format(output['path']))
+    for output in args['outputs']:
+        target = os.path.join(args['outdir'], output['path'])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            if os.path.samefile(target, os.path.join(cachedir, output['path'])):
+                continue
+            os.remove(target)
+        link_or_copy( os.path.join(cachedir, output['path']), target )
+    return True
+
+
+def restore_s3_outputs( args ):
+    """ Copies recorded S3 output objects to the new output destination (server-side copy).
+    Objects already at the destination with the same ETag are not copied. Fails if a recorded object changed.
+    """
+    client = bioshed_transfer.get_s3_client()
+    dest_bucket, dest_prefix = bioshed_transfer.split_s3_uri( args['outdest'] )
+    for output in args['outputs']:
+        if str(client.head_object(Bucket=output['bucket'], Key=output['key'])['ETag']).strip('"') != output['etag']:
+            raise ValueError('s3://{}/{} changed since it was recorded'.format(output['bucket'], output['key']))
+    transfers = []
+    for output in args['outputs']:
+        dest_key = dest_prefix.rstrip('/') + '/' + output['relkey'] if dest_prefix.strip('/') != '' else output['relkey']
+        if (dest_bucket, dest_key) != (output['bucket'], output['key']):
+            transfers.append(dict(src='s3://{}/{}'.format(output['bucket'], output['key']), dest='s3://{}/{}'.format(dest_bucket, dest_key)))
+    result = bioshed_transfer.transfer_files( dict(transfers=transfers, quiet=True))
+    if result['failed'] != []:
+        raise ValueError(result['failed'][0]['error'])
+    return True
+
+
+def snapshot_s3_outputs( args ):
+    """ Keys and ETags of the objects under an S3 output destination (taken before a run, to find what it wrote).
+
+    outdest: S3 output destination
+    ---
+    snapshot: dict of key -> ETag
+    """
+    bucket, prefix = bioshed_transfer.split_s3_uri( args['outdest'] )
+    prefix = prefix.rstrip('/') + '/' if prefix.strip('/') != '' else ''
+    return dict((o['key'], o['etag']) for o in list_s3_objects( dict(bucket=bucket, prefix=prefix)))
+
+
+def s3_outputs_written( args ):
+    """ Objects a run wrote under its S3 output destination - new or changed since the snapshot taken before the run,
+    and last modified while it ran (not objects other runs write to the same prefix before or after it).
+
+    outdest: S3 output destination
+    snapshot: snapshot_s3_outputs taken before the run
+    started: run start time
+    ended: (optional) run end time - default now
+    ---
+    outputs: list of dict(bucket, key, relkey, etag)
+    """
+    bucket, prefix = bioshed_transfer.split_s3_uri( args['outdest'] )
+    prefix = prefix.rstrip('/') + '/' if prefix.strip('/') != '' else ''
+    snapshot = args['snapshot']
+    started = float(args['started']) - 1
+    ended = float(args['ended']) + 1 if args.get('ended', None) != None else time.time() + 1
+    return [dict(bucket=bucket, key=o['key'], relkey=o['key'][len(prefix):], etag=o['etag'])
+            for o in list_s3_objects( dict(bucket=bucket, prefix=prefix))
+            if snapshot.get(o['key'], None) != o['etag'] and started <= o['modified'] <= ended]
+
+
+def list_s3_objects( args ):
+    client = bioshed_transfer.get_s3_client()
+    objects = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=args['bucket'], Prefix=args['prefix']):
+        for o in page.get('Contents', []):
+            objects.append(dict(key=o['Key'], etag=str(o['ETag']).strip('"'), size=o['Size'], modified=o['LastModified'].timestamp()))
+    return objects
+
+
+def link_or_copy( source, target ):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+    return target
+
+
+def cache_stats( args ):
+    """ Number of cache entries and bytes of cached local files.
+    """
+    conn = open_cache( args )
+    row = conn.execute("SELECT COUNT(*) AS runs, COALESCE(SUM(bytes), 0) AS bytes FROM runs WHERE status = 'ready'").fetchone()
+    conn.close()
+    return dict(runs=row['runs'], bytes=row['bytes'])
+
+
+def clear_cache( args ):
+    """ Removes all cached runs (cached input file hashes are kept).
+    """
+    shutil.rmtree(RUN_CACHE_DIR, ignore_errors=True)
+    if os.path.exists(RUN_CACHE_DB):
+        conn = open_cache( args )
+        with conn:
+            conn.execute('DELETE FROM runs')
+        conn.close()
+    return
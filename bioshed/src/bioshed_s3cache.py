@@ -0,0 +1,211 @@
+import os, sys, time, shutil, fcntl, sqlite3, hashlib, concurrent.futures
+##
+## Host-wide S3 object cache for local runs (bioshed run --local --s3-cache ..., or BIOSHED_S3_CACHE=1).
+##
+## Objects are stored once under ~/.bioshedinit/s3cache/objects/, keyed by bucket/key/ETag, so a changed object is
+## a new entry and an unchanged one is never downloaded twice. Before a run, its s3:// inputs are hard-linked into
+## a per-run staging directory that is bind-mounted read-only into the container, and the arguments are rewritten
+## to the mounted paths. Concurrent runs needing the same object wait on one download (file lock per object).
+## Objects are evicted least-recently-used first once the cache exceeds BIOSHED_S3_CACHE_MAX_GB.
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+S3_CACHE_DIR = os.path.join(INIT_PATH, 's3cache')
+S3_CACHE_DB = os.path.join(INIT_PATH, 's3cache.db')
+S3_CACHE_MAX_BYTES = int(float(os.environ.get('BIOSHED_S3_CACHE_MAX_GB', 200)) * 1024**3)
+STAGE_MOUNT = '/s3cache'        # where staged inputs appear inside the container
+FETCH_CONCURRENCY = 8
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_transfer
+
+def cache_enabled( args ):
+    """ Whether s3:// inputs of a local run are staged through the cache.
+
+    cache: True (--s3-cache) or None (not specified - use BIOSHED_S3_CACHE)
+    """
+    if args.get('cache', None) != None:
+        return args['cache']
+    return os.environ.get('BIOSHED_S3_CACHE', '') not in ['', '0']
+
+
+def open_cache( args ):
+    """ Opens (and creates if needed) the object cache index.
+    """
+    cachedb = args['cachedb'] if 'cachedb' in args else S3_CACHE_DB
+    conn = sqlite3.connect(cachedb, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute("""CREATE TABLE IF NOT EXISTS objects (
+                        id TEXT PRIMARY KEY,
+                        bucket TEXT,
+                        key TEXT,
+                        etag TEXT,
+                        bytes INTEGER,
+                        created REAL,
+                        last_used REAL)""")
+    conn.execute('CREATE INDEX IF NOT EXISTS objects_last_used ON objects (last_used)')
+    conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+    return conn
+
+
+def fetch_object( args ):
+    """ Returns the local cached path of an S3 object, downloading it if this bucket/key/ETag is not cached.
+    Only one process downloads a given object at a time - others wait for it and then use the cached copy.
+
+    bucket: S3 bucket
+    key: S3 key
+    etag: (optional) ETag if already known (e.g., from a listing) - saves a HeadObject call
+    size: (optional) object size if already known
+    ---
+    object: dict(path, bytes, hit)
+    """
+    client = bioshed_transfer.get_s3_client()
+    bucket, key = args['bucket'], args['key']
+    if args.get('etag', '') == '':
+        head = client.head_object(Bucket=bucket, Key=key)
+        etag, size = str(head['ETag']).strip('"'), int(head['ContentLength'])
+    else:
+        etag, size = args['etag'], int(args.get('size', 0))
+    objid = hashlib.sha256('{}/{}/{}'.format(bucket, key, etag).encode()).hexdigest()
+    objdir = os.path.join(S3_CACHE_DIR, 'objects', objid[:2], objid)
+    path = os.path.join(objdir, os.path.basename(key) or 'object')
+    os.makedirs(objdir, exist_ok=True)
+    with open(os.path.join(objdir, '.lock'), 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)     # coalesce concurrent downloads of the same object
+        try:
+            hit = os.path.exists(path)
+            if not hit:
+                evict_objects( dict(needed=size))     # make room before downloading
+                # pinned to the ETag - an object overwritten since the HeadObject/listing is not cached under the old ETag
+                bioshed_transfer.transfer_file( dict(src='s3://{}/{}'.format(bucket, key), dest=path, client=client, extra_args={'IfMatch': etag}))
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+    nbytes = os.path.getsize(path)
+    now = time.time()
+    conn = open_cache( args )
+    with conn:
+        conn.execute('INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET last_used = excluded.last_used',
+                     (objid, bucket, key, etag, nbytes, now, now))
+        add_stats( conn, dict(hits=int(hit), misses=int(not hit), bytes_served=nbytes, bytes_downloaded=0 if hit else nbytes))
+    conn.close()
+    return dict(path=path, bytes=nbytes, hit=hit)
+
+
+def stage_inputs( args ):
+    """ Stages every s3:// input of a run from the cache, for bind-mounting into the container.
+
+    program_args: program arguments (list) - out:: destinations are left alone
+    ---
+    staged: dict(program_args (rewritten to STAGE_MOUNT paths), stagedir, dockerargs (bind mount), hits, misses)
+    """
+    program_args = args['program_args']
+    uris = sorted(set(parg for parg in program_args if parg.startswith('s3://')))
+    stagedir = os.path.join(S3_CACHE_DIR, 'staging', '{}_{}'.format(os.getpid(), int(time.time()*1000)))
+    os.makedirs(stagedir, exist_ok=True)
+    objects = []     # (bucket, key, etag, size)
+    for uri in uris:
+        bucket, key = bioshed_transfer.split_s3_uri( uri )
+        if key.endswith('/') or key == '':
+            objects += [(bucket, o['Key'], str(o['ETag']).strip('"'), o['Size']) for o in list_prefix( bucket, key )]
+        else:
+            objects.append((bucket, key, '', 0))
+    objects = list(dict(((o[0], o[1]), o) for o in objects).values())     # an object can be named directly and via its prefix
+    print('Staging {} S3 object(s) from the local cache...'.format(len(objects)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(FETCH_CONCURRENCY, len(objects)))) as executor:
+        fetched = list(executor.map(lambda o: fetch_object( dict(bucket=o[0], key=o[1], etag=o[2], size=o[3])), objects))
+    for (bucket, key, etag, size), obj in zip(objects, fetched):
+        target = os.path.join(stagedir, bucket, key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(obj['path'], target)
+        except OSError:
+            os.symlink(obj['path'], target)   # cache on another filesystem from the staging dir
+    rewritten = [STAGE_MOUNT + '/' + parg[len('s3://'):] if parg.startswith('s3://') else parg for parg in program_args]
+    hits = len([o for o in fetched if o['hit']])
+    print('S3 cache: {} hit(s), {} miss(es).'.format(hits, len(fetched) - hits))
+    evict_objects({})
+    return dict(program_args=rewritten, stagedir=stagedir, dockerargs='-v {}:{}:ro '.format(stagedir, STAGE_MOUNT),
+                hits=hits, misses=len(fetched) - hits)
+
+
+def unstage_inputs( args ):
+    """ Removes a run's staging directory (the cached objects stay).
+    """
+    shutil.rmtree(args['stagedir'], ignore_errors=True)
+    return
+
+
+def evict_objects( args ):
+    """ Evicts least-recently-used objects until the cache fits in the size limit.
+    Objects that are being downloaded (locked) are skipped. Runs that have an object staged keep their hard link.
+
+    max_bytes: (optional) size limit - default BIOSHED_S3_CACHE_MAX_GB
+    needed: (optional) bytes about to be added
+    ---
+    evicted: number of objects evicted
+    """
+    max_bytes = int(args['max_bytes']) if 'max_bytes' in args else S3_CACHE_MAX_BYTES
+    conn = open_cache( args )
+    total = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM objects').fetchone()[0] + int(args.get('needed', 0))
+    if total <= max_bytes:
+        conn.close()
+        return 0
+    evicted = []
+    for row in conn.execute('SELECT id, bytes FROM objects ORDER BY last_used ASC').fetchall():
+        if total <= max_bytes:
+            break
+        objdir = os.path.join(S3_CACHE_DIR, 'objects', row['id'][:2], row['id'])
+        try:
+            with open(os.path.join(objdir, '.lock'), 'a') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(objdir, ignore_errors=True)
+        except BlockingIOError:
+            continue
+        total -= row['bytes']
+        evicted.append(row['id'])
+    with conn:
+        conn.executemany('DELETE FROM objects WHERE id = ?', [(objid,) for objid in evicted])
+        add_stats( conn, dict(evictions=len(evicted)))
+    conn.close()
+    return len(evicted)
+
+
+def cache_stats( args ):
+    """ Object cache size and hit/miss counters.
+    ---
+    stats: dict(objects, bytes, hits, misses, bytes_downloaded, bytes_served, evictions)
+    """
+    conn = open_cache( args )
+    row = conn.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM objects').fetchone()
+    stats = dict(objects=row[0], bytes=row[1], hits=0, misses=0, bytes_downloaded=0, bytes_served=0, evictions=0)
+    stats.update(dict((r['name'], r['value']) for r in conn.execute('SELECT name, value FROM stats')))
+    conn.close()
+    return stats
+
+
+def clear_cache( args ):
+    """ Removes all cached objects and resets stats.
+    """
+    shutil.rmtree(os.path.join(S3_CACHE_DIR, 'objects'), ignore_errors=True)
+    if os.path.exists(S3_CACHE_DB):
+        conn = open_cache( args )
+        with conn:
+            conn.execute('DELETE FROM objects')
+            conn.execute('DELETE FROM stats')
+        conn.close()
+    return
+
+
+def add_stats( conn, counters ):
+    conn.executemany('INSERT INTO stats VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                     list(counters.items()))
+    return
+
+
+def list_prefix( bucket, prefix ):
+    objects = []
+    for page in bioshed_transfer.get_s3_client().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        objects += [o for o in page.get('Contents', []) if not o['Key'].endswith('/')]
+    return objects
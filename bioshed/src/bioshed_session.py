@@ -0,0 +1,197 @@
+import os, sys, json, time, hmac, hashlib, subprocess
+##
+## Cached login session for the bioshed CLI.
+## A signed session record in the init directory replaces the per-command "searchusers" round-trip.
+## Stale records are re-verified by a detached process ("python bioshed_session.py <USER> <SESSIONFILE>"), so the
+## command itself neither waits on the API nor stays open at exit for it.
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+SESSION_FILE = os.path.join(INIT_PATH, 'session.json')
+SESSION_KEY_FILE = os.path.join(INIT_PATH, '.session_key')
+SESSION_TTL = int(os.environ.get('BIOSHED_SESSION_TTL', 12*60*60))                 # seconds a verified login is trusted
+SESSION_REFRESH_AFTER = int(os.environ.get('BIOSHED_SESSION_REFRESH', 6*60*60))    # re-verify in background after this age
+SESSION_OFFLINE_GRACE = int(os.environ.get('BIOSHED_SESSION_GRACE', 7*24*60*60))   # accept expired session while API unreachable
+SESSION_API_TIMEOUT = 5
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_config
+
+def session_valid( args ):
+    """ Checks once per invocation whether the configured user is logged in.
+    Uses the cached session record if unexpired, otherwise verifies against the serverless API.
+    If the API cannot be reached, an expired session is still accepted within an offline grace period.
+
+    user: bioshed username (login) from the config file
+    sessionfile: (optional) session record file
+    ---
+    boolean: True/False if user has a valid session
+    """
+    user = args['user'] if 'user' in args else ''
+    sessionfile = args['sessionfile'] if 'sessionfile' in args else SESSION_FILE
+    now = time.time()
+    if user in ['', None]:
+        return False
+
+    session = load_session( dict(sessionfile=sessionfile))
+    if session.get('user') == user and now < session.get('expires_at', 0):
+        if now - session.get('verified_at', 0) > SESSION_REFRESH_AFTER:
+            # still valid - refresh in background so this command doesn't wait on the API
+            refresh_in_background( dict(user=user, sessionfile=sessionfile))
+        return True
+
+    user_found = verify_user( dict(user=user))
+    if user_found is True:
+        write_session( dict(user=user, sessionfile=sessionfile))
+        return True
+    elif user_found is None and session.get('user') == user and now < session.get('expires_at', 0) + SESSION_OFFLINE_GRACE:
+        print('WARNING: Could not reach BioShed login service - using cached session for {}.'.format(user))
+        return True
+    elif user_found is False and session.get('user') == user:
+        clear_session( dict(sessionfile=sessionfile))
+    return False
+
+
+def verify_user( args ):
+    """ Verifies a user against the "searchusers" route within the Bioshed serverless core.
+    The API URL can be pointed at a local stand-in with the BIOSHED_SERVERLESS_API environment variable.
+
+    user: bioshed username
+    ---
+    user_found: True/False if user found, None if the API could not be reached
+    """
+    import requests     # only when the API is called - not for commands with a valid cached session
+    try:
+        response = requests.post(bioshed_config.BIOSHED_SERVERLESS_API+'/searchusers', json={"user": args['user']}, timeout=SESSION_API_TIMEOUT)
+        user_exists = json.loads(response.content)
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+    return True if "user_found" in user_exists and str(user_exists["user_found"])[0].upper() == "T" else False
+
+
+def refresh_in_background( args ):
+    """ Starts refresh_session in a detached process - at most one at a time per session record.
+
+    user: bioshed username
+    sessionfile: session record file
+    ---
+    started: True if a refresh process was started
+    """
+    markerfile = args['sessionfile'] + '.refresh'
+    try:
+        if time.time() - os.path.getmtime(markerfile) < 4 * SESSION_API_TIMEOUT:
+            return False     # another command is already refreshing
+    except OSError:
+        pass
+    try:
+        open(markerfile, 'w').close()
+        subprocess.Popen([sys.executable, os.path.realpath(__file__), args['user'], args['sessionfile']], stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=True, start_new_session=True)
+    except OSError:
+        return False
+    return True
+
+
+def refresh_session( args ):
+    """ Re-verifies a user and renews the session record. Network errors leave the current session untouched.
+
+    user: bioshed username
+    sessionfile: (optional) session record file
+    """
+    sessionfile = args['sessionfile'] if 'sessionfile' in args else SESSION_FILE
+    user_found = verify_user( dict(user=args['user']))
+    if user_found is True:
+        write_session( dict(user=args['user'], sessionfile=sessionfile))
+    elif user_found is False:
+        clear_session( dict(sessionfile=sessionfile))
+    try:
+        os.remove(sessionfile + '.refresh')
+    except OSError:
+        pass
+    return
+
+
+def load_session( args ):
+    """ Loads the session record, discarding it if the signature does not match.
+
+    sessionfile: (optional) session record file
+    ---
+    session: session record {"user", "verified_at", "expires_at", "sig"} or {}
+    """
+    sessionfile = args['sessionfile'] if 'sessionfile' in args else SESSION_FILE
+    try:
+        with open(sessionfile, 'r') as f:
+            session = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not hmac.compare_digest(str(session.get('sig', '')), sign_session( dict(session=session, keyfile=session_keyfile(sessionfile)))):
+        return {}
+    return session
+
+
+def write_session( args ):
+    """ Writes a freshly verified session record (atomically, readable by owner only).
+
+    user: bioshed username
+    sessionfile: (optional) session record file
+    ---
+    session: written session record
+    """
+    sessionfile = args['sessionfile'] if 'sessionfile' in args else SESSION_FILE
+    now = time.time()
+    session = {"user": args['user'], "verified_at": now, "expires_at": now + SESSION_TTL}
+    session['sig'] = sign_session( dict(session=session, keyfile=session_keyfile(sessionfile)))
+    tmpfile = '{}.{}.tmp'.format(sessionfile, os.getpid())
+    with open(os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fout:
+        json.dump(session, fout)
+    os.replace(tmpfile, sessionfile)
+    return session
+
+
+def clear_session( args ):
+    """ Removes the session record (e.g., user no longer exists).
+
+    sessionfile: (optional) session record file
+    """
+    sessionfile = args['sessionfile'] if 'sessionfile' in args else SESSION_FILE
+    if os.path.exists(sessionfile):
+        os.remove(sessionfile)
+    return
+
+
+def sign_session( args ):
+    """ HMAC-SHA256 signature of a session record, using a per-host key in the init directory.
+
+    session: session record (the "sig" field is ignored)
+    keyfile: session key file - created if it does not exist
+    ---
+    sig: hex signature
+    """
+    session = args['session']
+    keyfile = args['keyfile']
+    if not os.path.exists(keyfile):
+        # write then hard-link, so concurrent processes never see a partial key
+        tmpfile = '{}.{}.tmp'.format(keyfile, os.getpid())
+        with open(os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fout:
+            fout.write(os.urandom(32).hex())
+        try:
+            os.link(tmpfile, keyfile)
+        except FileExistsError:
+            pass
+        os.remove(tmpfile)
+    with open(keyfile, 'r') as f:
+        key = f.read().strip().encode()
+    payload = json.dumps({k: session[k] for k in session if k != 'sig'}, sort_keys=True).encode()
+    return hmac.new(key, payload, hashlib.sha256).hexdigest()
+
+
+def session_keyfile( sessionfile ):
+    """ Session key lives next to the session record.
+    """
+    return os.path.join(os.path.dirname(sessionfile), os.path.basename(SESSION_KEY_FILE))
+
+
+if __name__ == '__main__':
+    # python bioshed_session.py <USER> <SESSIONFILE> - re-verify a session (started by refresh_in_background)
+    refresh_session( dict(user=sys.argv[1], sessionfile=sys.argv[2]))
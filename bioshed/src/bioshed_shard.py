@@ -0,0 +1,349 @@
+import os, sys, gzip, shutil, tempfile, threading, concurrent.futures
+##
+## Scatter-gather runs of FASTQ modules in AWS Batch.
+## $ bioshed run --shard <N> <MODULE> <PROGRAM-ARGS> out::s3://...
+##
+## FASTQ inputs are split into N record-aligned shards while streaming through gzip. Paired inputs (R1/R2) are split
+## in lockstep - record i of every input lands in the same shard, and read names are checked at every shard start.
+## Shards are uploaded to <out>/shards_input/shard_NNNN/, N jobs run the module on one shard each (outputs in
+## <out>/shards/shard_NNNN/), and a merge job that depends on all of them writes the combined output to <out>/ -
+## samtools merge for aligners (bwa, STAR), a MultiQC report for fastqc.
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+SHARD_DIR = os.environ.get('BIOSHED_SHARD_DIR', os.path.join(INIT_PATH, 'shards'))     # local shard files until uploaded
+SHARD_BLOCK = 4 * 1024 * 1024        # decompressed bytes read per block
+SHARD_COMPRESSLEVEL = 1              # shards are temporary - favor speed over size
+SHARD_UPLOADS = 4                    # shard files uploaded in parallel while splitting
+MAX_SHARDS = 20                      # AWS Batch: a job depends on at most 20 jobs (the merge job depends on every shard)
+FASTQ_EXTENSIONS = ['.fastq.gz', '.fq.gz', '.fastq', '.fq']
+SHARD_MODULES = {'bwa': 'samtools', 'star': 'samtools', 'fastqc': 'multiqc'}     # module -> merge module
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_transfer
+
+def is_fastq( path ):
+    return any(str(path).lower().endswith(ext) for ext in FASTQ_EXTENSIONS) and (str(path).startswith('s3://') or os.path.isfile(path))
+
+
+def submit_shards( args ):
+    """ Splits the FASTQ inputs of a module run into shards and submits one Batch job per shard,
+    plus a merge job that runs after all of them.
+
+    module: module name (see SHARD_MODULES)
+    tag: (optional) image tag
+    program_args: program arguments (list), with FASTQ inputs and out::s3://...
+    shards: number of shards
+    ---
+    run: dict(jobs=[jobinfo of each shard], merge=jobinfo of the merge job)
+    """
+    import bioshed_batch
+    module = args['module']
+    program_args = list(args['program_args'])
+    nshards = int(args['shards'])
+    if module not in SHARD_MODULES:
+        raise ValueError('--shard is supported for {} - not {}.'.format(', '.join(sorted(SHARD_MODULES)), module))
+    if nshards < 2 or nshards > MAX_SHARDS:
+        raise ValueError('--shard must be between 2 and {}.'.format(MAX_SHARDS))
+    outdirs = [a[len('out::'):] for a in program_args if a.startswith('out::')]
+    if outdirs == [] or not outdirs[-1].startswith('s3://'):
+        raise ValueError('--shard needs an S3 output location - e.g., out::s3://mybucket/align/')
+    outdir = outdirs[-1].rstrip('/') + '/'
+    fastqs = []
+    for a in program_args:
+        if is_fastq( a ) and a not in fastqs:
+            fastqs.append(a)
+    if fastqs == []:
+        raise ValueError('No FASTQ inputs to shard in: {}'.format(' '.join(program_args)))
+    # fail on unsupported arguments before splitting
+    merge_args( dict(module=module, program_args=program_args, outdir=outdir, shards=nshards))
+
+    print('Splitting {} into {} shards...'.format(', '.join(fastqs), nshards))
+    split = split_fastqs( dict(paths=fastqs, shards=nshards, dest=outdir + 'shards_input/'))
+    print('Split {} records into {} shards.'.format(split['records'], len(split['shards'])))
+    jobs = []
+    for shard in split['shards']:
+        shard_args = []
+        for a in program_args:
+            if a in fastqs:
+                shard_args.append(shard['files'][fastqs.index(a)])
+            elif a.startswith('out::'):
+                shard_args.append('out::{}shards/{}/'.format(outdir, shard['name']))
+            else:
+                shard_args.append(a)
+        jobs.append(bioshed_batch.submit_job( dict(name=module, tag=args.get('tag', ''), program_args=shard_args)))
+    merge = bioshed_batch.submit_job( dict(name=SHARD_MODULES[module],
+                                           program_args=merge_args( dict(module=module, program_args=program_args, outdir=outdir,
+                                                                         shards=len(split['shards']))),
+                                           dependent_job_ids=[j['jobid'] for j in jobs]))
+    return dict(jobs=jobs, merge=merge)
+
+
+def shard_name( index ):
+    return 'shard_{:04d}'.format(index + 1)
+
+
+def shard_output( args ):
+    """ File each aligner shard job writes (merged under the same name).
+
+    module: bwa or star
+    program_args: program arguments (list)
+    ---
+    output: file name
+    """
+    pargs = args['program_args']
+    if args['module'] == 'bwa':
+        # bwa writes SAM to stdout (the program log in a module container) unless named with -o
+        if '-o' not in pargs or pargs.index('-o') == len(pargs) - 1:
+            raise ValueError('Name the bwa output to shard it - e.g., bioshed run --shard 8 bwa mem -o aligned.sam ...')
+        return os.path.basename(pargs[pargs.index('-o') + 1])
+    prefix = pargs[pargs.index('--outFileNamePrefix') + 1] if '--outFileNamePrefix' in pargs[:-1] else ''
+    samtype = []
+    if '--outSAMtype' in pargs:
+        for a in pargs[pargs.index('--outSAMtype') + 1:]:
+            if a.startswith('-') or a.startswith('out::'):
+                break
+            samtype.append(a)
+    if 'SortedByCoordinate' in samtype:
+        return os.path.basename(prefix) + 'Aligned.sortedByCoord.out.bam'
+    return os.path.basename(prefix) + ('Aligned.out.bam' if 'BAM' in samtype else 'Aligned.out.sam')
+
+
+def merge_args( args ):
+    """ Program arguments of the merge job.
+    Aligners: samtools merge of the shard outputs (-c/-p: shards share read groups and program records). The merge is
+    coordinate-sorted if the shard outputs are (e.g., STAR --outSAMtype BAM SortedByCoordinate).
+    fastqc: a MultiQC report over all shard reports.
+
+    module: module name
+    program_args: program arguments (list)
+    outdir: S3 output location (ending in /)
+    shards: number of shards
+    ---
+    program_args: merge module program arguments (list)
+    """
+    outdir = args['outdir']
+    if args['module'] == 'fastqc':
+        return ['multiqc', outdir + 'shards/', 'out::' + outdir]
+    output = shard_output( args )
+    return ['samtools', 'merge', '-f', '-c', '-p'] + (['-O', 'SAM'] if output.endswith('.sam') else []) + [output] \
+           + ['{}shards/{}/{}'.format(outdir, shard_name( i ), output) for i in range(int(args['shards']))] + ['out::' + outdir]
+
+
+def split_fastqs( args ):
+    """ Splits FASTQ inputs into record-aligned shards of about equal size, in one streaming pass.
+    The first input decides where shards end; the other inputs (e.g., R2) end their shards at the same record,
+    so paired inputs stay in lockstep. Fails if the inputs have different numbers of records or read names differ
+    at a shard start.
+
+    paths: FASTQ inputs (local or s3://, gzipped or plain)
+    shards: number of shards
+    dest: local directory or s3:// prefix for shard_NNNN/ folders
+    ---
+    split: dict(shards=[dict(name, files=[shard file of each input], records)], records)
+
+    >>> split = split_fastqs( dict(paths=['test/fastq/rnaseq_mouse_test_tiny1_R1.fastq.gz', 'test/fastq/rnaseq_mouse_test_tiny1_R2.fastq.gz'], shards=3, dest='shards/'))
+    >>> [s['records'] for s in split['shards']], split['records']
+    ([43309, 43114, 43446], 129869)
+    """
+    paths = args['paths']
+    dest = args['dest'].rstrip('/') + '/'
+    if dest.startswith('s3://'):
+        os.makedirs(SHARD_DIR, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix='split_', dir=SHARD_DIR) if dest.startswith('s3://') else dest
+    split = dict(nshards=int(args['shards']), lines=0, boundaries=[], done=False, cond=threading.Condition())
+    uploads = concurrent.futures.ThreadPoolExecutor(max_workers=SHARD_UPLOADS)
+    pending = []
+
+    def shard_file( index, shard, local ):
+        name, ext = os.path.basename(paths[index]), [e for e in FASTQ_EXTENSIONS if paths[index].lower().endswith(e)][0]
+        fname = '{}.{}{}'.format(name[:len(name) - len(ext)], shard_name( shard ).replace('_', ''), name[len(name) - len(ext):])
+        return os.path.join(workdir if local else dest, shard_name( shard ), fname)
+
+    def open_shard( index, shard ):
+        fname = shard_file( index, shard, True )
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        return gzip.open(fname, 'wb', compresslevel=SHARD_COMPRESSLEVEL) if fname.endswith('.gz') else open(fname, 'wb')
+
+    def close_shard( out, index, shard ):
+        out.close()
+        if dest.startswith('s3://'):
+            local = shard_file( index, shard, True )
+            pending.append(uploads.submit(upload_shard, local, shard_file( index, shard, False )))
+
+    split.update(open_shard=open_shard, close_shard=close_shard)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(paths)) as pool:
+            futures = [pool.submit(split_input, dict(path=path, index=i, split=split)) for i, path in enumerate(paths)]
+            results = [f.result() for f in futures]
+        for result in results[1:]:
+            if result['lines'] != results[0]['lines']:
+                raise ValueError('FASTQ inputs are not paired: {} has {} records, {} has {}.'.format(
+                                 paths[0], results[0]['lines'] // 4, paths[results.index(result)], result['lines'] // 4))
+            for shard, (name, mate) in enumerate(zip(results[0]['names'], result['names'])):
+                if read_id( name ) != read_id( mate ):
+                    raise ValueError('FASTQ inputs are out of step at {}: {} vs {}'.format(shard_name( shard ), name, mate))
+        for f in pending:
+            f.result()
+    finally:
+        uploads.shutdown(wait=True)
+        if dest.startswith('s3://'):
+            shutil.rmtree(workdir, ignore_errors=True)
+    ends = split['boundaries'] + [results[0]['lines']]
+    return dict(shards=[dict(name=shard_name( i ), files=[shard_file( index, i, False ) for index in range(len(paths))],
+                             records=(ends[i] - (ends[i-1] if i > 0 else 0)) // 4) for i in range(len(ends))],
+                records=results[0]['lines'] // 4)
+
+
+def split_input( args ):
+    """ Splits one FASTQ input into shards (see split_fastqs).
+    The first input ends a shard at the first record boundary after about 1/N of its estimated decompressed size, and
+    publishes the shard's end as a line count; the other inputs wait until the first input is past each block they
+    read, then end their shards at the published line counts.
+
+    path: FASTQ input
+    index: input number (0: the input that decides shard ends)
+    split: shared state - dict(nshards, lines, boundaries, done, cond, open_shard, close_shard)
+    ---
+    result: dict(lines, names=[first read name of each shard])
+    """
+    split, index = args['split'], args['index']
+    cond = split['cond']
+    raw = CountingReader( args['path'] )
+    stream = gzip.GzipFile(fileobj=raw, mode='rb') if args['path'].lower().endswith('.gz') else raw
+    shard, lines, decompressed, names = 0, 0, 0, []
+    out = split['open_shard']( index, shard )
+    try:
+        for block in read_blocks( stream ):
+            pos = 0
+            block_lines = lines
+            block_end = lines + block.count(b'\n')
+            if len(names) == shard:
+                names.append(block[:block.find(b'\n')].decode())
+            if index == 0:
+                # decompressed size of the input, estimated from the compression ratio so far
+                total = (decompressed + len(block)) * raw.size / max(raw.count, 1)
+                while shard < split['nshards'] - 1:
+                    target = int(total * (shard + 1) / split['nshards']) - decompressed
+                    if target >= len(block):
+                        break
+                    cut, cut_lines = record_boundary( block, max(target, pos + 1), block_lines )
+                    if cut == None or cut >= len(block):
+                        break
+                    out.write(block[pos:cut])
+                    pos = cut
+                    with cond:
+                        split['boundaries'].append(cut_lines)
+                    split['close_shard']( out, index, shard )
+                    shard += 1
+                    out = split['open_shard']( index, shard )
+                    names.append(block[cut:block.find(b'\n', cut)].decode())
+            else:
+                with cond:
+                    cond.wait_for(lambda: split['lines'] >= block_end or split['done'])
+                    boundaries = list(split['boundaries'])
+                while shard < len(boundaries) and boundaries[shard] <= block_end:
+                    cut = line_start( block, boundaries[shard] - block_lines )
+                    out.write(block[pos:cut])
+                    pos = cut
+                    split['close_shard']( out, index, shard )
+                    shard += 1
+                    out = split['open_shard']( index, shard )
+                    if cut < len(block):
+                        names.append(block[cut:block.find(b'\n', cut)].decode())
+            out.write(block[pos:])
+            lines = block_end
+            decompressed += len(block)
+            if index == 0:
+                with cond:
+                    split['lines'] = lines
+                    cond.notify_all()
+    finally:
+        if index == 0:
+            with cond:
+                split['done'] = True
+                cond.notify_all()
+        raw.close()
+    split['close_shard']( out, index, shard )
+    return dict(lines=lines, names=names)
+
+
+def read_blocks( stream ):
+    """ Decompressed blocks of a stream, each ending at a line end (a missing last newline is added).
+    """
+    carry = b''
+    while True:
+        data = stream.read(SHARD_BLOCK)
+        if data == b'':
+            break
+        data = carry + data
+        end = data.rfind(b'\n') + 1
+        carry = data[end:]
+        if end > 0:
+            yield data[:end]
+    if carry != b'':
+        yield carry + b'\n'
+
+
+def record_boundary( block, offset, lines ):
+    """ First FASTQ record start (every 4th line) at or after an offset in a block.
+
+    lines: lines before the block
+    ---
+    (position, lines before position), or (None, None) if the block ends first
+    """
+    n = lines + block.count(b'\n', 0, offset)
+    pos = offset
+    if offset > 0 and block[offset-1:offset] != b'\n':
+        pos = block.find(b'\n', offset) + 1
+        n += 1
+    while pos > 0 and n % 4 != 0:
+        nxt = block.find(b'\n', pos)
+        if nxt == -1:
+            return None, None
+        pos, n = nxt + 1, n + 1
+    return (pos, n) if pos > 0 else (None, None)
+
+
+def line_start( block, n ):
+    """ Position after the n-th line of a block.
+    """
+    pos = 0
+    for _ in range(n):
+        pos = block.find(b'\n', pos) + 1
+    return pos
+
+
+def read_id( name ):
+    """ Read name without comment or /1 /2 mate suffix.
+    """
+    rid = name.split()[0] if name.strip() != '' else ''
+    return rid[:-2] if rid[-2:] in ['/1', '/2'] else rid
+
+
+class CountingReader:
+    """ Reads a local file or S3 object, counting the (compressed) bytes read - how far splitting is into the input.
+    """
+    def __init__( self, path ):
+        self.count = 0
+        if path.startswith('s3://'):
+            bucket, key = bioshed_transfer.split_s3_uri( path )
+            response = bioshed_transfer.get_s3_client().get_object(Bucket=bucket, Key=key)
+            self.body, self.size = response['Body'], int(response['ContentLength'])
+        else:
+            self.body, self.size = open(path, 'rb'), os.path.getsize(path)
+
+    def read( self, size = -1 ):
+        data = self.body.read(size) if size not in [-1, None] else self.body.read()
+        self.count += len(data)
+        return data
+
+    def close( self ):
+        self.body.close()
+
+
+def upload_shard( local, dest ):
+    bioshed_transfer.transfer_file( dict(src=local, dest=dest))
+    os.remove(local)
+    return dest
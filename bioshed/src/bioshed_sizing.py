@@ -0,0 +1,181 @@
+import os, json
+##
+## Size-tiered AWS Batch compute environments and job queues (bioshed deploy core aws, bioshed run).
+##
+## A sizing profile declares tiers - e.g., small / medium / large / highmem - each with its instance types,
+## the jobs it takes (max_job_vcpus, max_job_mem, and optionally min_job_vcpus, min_job_mem_per_vcpu) and whether it
+## runs on Spot (with an On-Demand fallback environment behind it in the same queue). Deploy generates one compute environment and queue per tier, and each
+## job is routed to the tier that packs its specs.json vcpu/mem onto instances with the least wasted CPU and memory.
+##
+## Profile: BIOSHED_BATCH_SIZING, else ~/.bioshedinit/batch_sizing.json, else DEFAULT_SIZING_PROFILE.
+## The default tier keeps the original compute environment and queue (bioshed-managed_batch_job_queue_public).
+## reference_cache_gb sizes the host-level S3 object cache volume of Batch instances (see bioshed_refcache) - opt-in, default 0 (none).
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+SIZING_FILE = os.environ.get('BIOSHED_BATCH_SIZING', os.path.join(INIT_PATH, 'batch_sizing.json'))
+ECS_MEMORY_OVERHEAD = 0.06      # share of instance memory not available to jobs (ECS agent, OS)
+DEFAULT_JOB_VCPUS = 1           # AWS Batch job sizing when a module has no specs (see bioshed_batch.get_job_properties)
+DEFAULT_JOB_MEM = 1000
+
+## vCPUs and memory (MiB) of instance types used in sizing profiles
+INSTANCE_TYPES = {'c5.large': (2, 4096), 'c5.xlarge': (4, 8192), 'c5.2xlarge': (8, 16384), 'c5.4xlarge': (16, 32768),
+                  'c5.9xlarge': (36, 73728), 'c5.18xlarge': (72, 147456),
+                  'm5.large': (2, 8192), 'm5.xlarge': (4, 16384), 'm5.2xlarge': (8, 32768), 'm5.4xlarge': (16, 65536),
+                  'm5.8xlarge': (32, 131072), 'm5.12xlarge': (48, 196608), 'm5.16xlarge': (64, 262144), 'm5.24xlarge': (96, 393216),
+                  'r5.large': (2, 16384), 'r5.xlarge': (4, 32768), 'r5.2xlarge': (8, 65536), 'r5.4xlarge': (16, 131072),
+                  'r5.8xlarge': (32, 262144), 'r5.12xlarge': (48, 393216), 'r5.16xlarge': (64, 524288)}
+
+DEFAULT_SIZING_PROFILE = {
+    'spot': False,
+    'spot_bid_percentage': 100,
+    'reference_cache_gb': 0,
+    'tiers': [
+        {'name': 'small', 'instance_types': ['c5.large', 'c5.xlarge', 'm5.large'], 'max_vcpus': 64, 'max_job_vcpus': 2, 'max_job_mem': 3800},
+        {'name': 'medium', 'default': True, 'instance_types': ['m5.large', 'm5.xlarge', 'm5.2xlarge', 'm5.4xlarge'], 'max_vcpus': 256,
+         'max_job_vcpus': 16, 'max_job_mem': 61000},
+        {'name': 'large', 'instance_types': ['c5.9xlarge', 'm5.8xlarge', 'm5.12xlarge', 'm5.16xlarge'], 'max_vcpus': 256,
+         'min_job_vcpus': 9, 'max_job_vcpus': 64, 'max_job_mem': 245000},
+        {'name': 'highmem', 'instance_types': ['r5.xlarge', 'r5.2xlarge', 'r5.4xlarge', 'r5.8xlarge', 'r5.16xlarge'], 'max_vcpus': 256,
+         'min_job_mem_per_vcpu': 6000, 'max_job_vcpus': 64, 'max_job_mem': 490000}]}
+
+def load_profile( args ):
+    """ Sizing profile - from a file, or the default profile.
+
+    sizingfile: (optional) profile JSON - default BIOSHED_BATCH_SIZING or ~/.bioshedinit/batch_sizing.json if present
+    ---
+    profile: dict(spot, spot_bid_percentage, reference_cache_gb, tiers=[dict(name, instance_types, max_vcpus, min_vcpus, max_job_vcpus, max_job_mem,
+                                                         min_job_vcpus, min_job_mem_per_vcpu, spot, default, image_id)])
+    """
+    sizingfile = args['sizingfile'] if args.get('sizingfile', '') != '' else SIZING_FILE
+    profile = DEFAULT_SIZING_PROFILE
+    if os.path.exists(sizingfile):
+        with open(sizingfile, 'r') as f:
+            profile = json.load(f)
+    tiers = []
+    for tier in profile['tiers']:
+        unknown = [t for t in tier['instance_types'] if t not in INSTANCE_TYPES]
+        if unknown != []:
+            raise ValueError('Unknown instance type(s) in sizing tier {}: {} - add them to bioshed_sizing.INSTANCE_TYPES'.format(tier['name'], unknown))
+        tiers.append(dict(tier, spot=tier.get('spot', profile.get('spot', False)), default=tier.get('default', False),
+                          min_vcpus=tier.get('min_vcpus', 0), image_id=tier.get('image_id', ''),
+                          min_job_vcpus=tier.get('min_job_vcpus', 0), min_job_mem_per_vcpu=tier.get('min_job_mem_per_vcpu', 0)))
+    if not any(tier['default'] for tier in tiers):
+        tiers[0]['default'] = True
+    return dict(profile, tiers=tiers, reference_cache_gb=int(profile.get('reference_cache_gb', DEFAULT_SIZING_PROFILE['reference_cache_gb'])))
+
+
+def tier_resource_name( tier ):
+    """ Terraform/queue name suffix of a tier - the default tier keeps the original "public" compute environment and queue.
+    """
+    return 'public' if tier['default'] else tier['name']
+
+
+def queue_name( args ):
+    """ AWS Batch job queue name of a tier.
+
+    tier: sizing tier
+    name_prefix: (optional) resource name prefix - default bioshed-managed
+    """
+    return '{}_batch_job_queue_{}'.format(args.get('name_prefix', 'bioshed-managed'), tier_resource_name( args['tier'] ))
+
+
+def pack_job( args ):
+    """ How a job packs onto an instance type.
+
+    vcpus, mem: job size (vCPUs, MiB)
+    instance_type: EC2 instance type
+    ---
+    packing: dict(instance_type, jobs (per instance), cpu (utilization 0-1), mem (utilization 0-1), efficiency (mean of cpu and mem))
+    """
+    ivcpus, imem = INSTANCE_TYPES[args['instance_type']]
+    usable_mem = imem * (1 - ECS_MEMORY_OVERHEAD)
+    jobs = int(min(ivcpus // max(args['vcpus'], 1), usable_mem // max(args['mem'], 1)))
+    cpu = jobs * args['vcpus'] / ivcpus
+    mem = jobs * args['mem'] / imem
+    return dict(instance_type=args['instance_type'], jobs=jobs, cpu=cpu, mem=mem, efficiency=(cpu + mem) / 2)
+
+
+def tier_packing( args ):
+    """ Best packing of a job on a tier's instance types (Batch picks among them), or None if the tier cannot take the job.
+
+    vcpus, mem: job size
+    tier: sizing tier
+    """
+    tier = args['tier']
+    if args['vcpus'] > tier['max_job_vcpus'] or args['mem'] > tier['max_job_mem'] or args['vcpus'] < tier.get('min_job_vcpus', 0) \
+       or args['mem'] < tier.get('min_job_mem_per_vcpu', 0) * max(args['vcpus'], 1):
+        return None
+    packings = [p for p in [pack_job( dict(args, instance_type=t)) for t in tier['instance_types']] if p['jobs'] > 0]
+    return max(packings, key=lambda p: p['efficiency']) if packings != [] else None
+
+
+def route_tier( args ):
+    """ Tier for a job - the tier that takes the job with the best packing efficiency (earlier tiers win ties).
+    A job that no tier takes goes to the tier with the largest jobs.
+
+    vcpus, mem: job size
+    profile: sizing profile
+    ---
+    tier: dict(tier, packing)
+    """
+    best = None
+    for tier in args['profile']['tiers']:
+        packing = tier_packing( dict(vcpus=args['vcpus'], mem=args['mem'], tier=tier))
+        if packing != None and (best == None or packing['efficiency'] > best['packing']['efficiency'] + 1e-9):
+            best = dict(tier=tier, packing=packing)
+    if best == None:
+        largest = max(args['profile']['tiers'], key=lambda t: (t['max_job_vcpus'], t['max_job_mem']))
+        best = dict(tier=largest, packing=None)
+    return best
+
+
+def module_size( args ):
+    """ vCPUs and memory of a module's jobs, from specs.json.
+
+    module: module name
+    specs: specs.json contents
+    """
+    spec = args['specs'].get(args['module'], {})
+    return dict(vcpus=int(spec.get('vcpu', DEFAULT_JOB_VCPUS)), mem=int(spec.get('mem', DEFAULT_JOB_MEM)))
+
+
+def packing_report( args ):
+    """ Expected packing of every module in specs.json - routed to tiers, and in the default tier only (one queue).
+
+    profile: sizing profile
+    specs: specs.json contents
+    ---
+    report: dict(modules=[dict(module, vcpus, mem, tier, instance_type, jobs, cpu, mem_used, efficiency, single_queue)],
+                 efficiency, single_queue_efficiency)
+    """
+    profile = args['profile']
+    default = [tier for tier in profile['tiers'] if tier['default']][0]
+    modules = []
+    for module in sorted(args['specs'].keys()):
+        size = module_size( dict(module=module, specs=args['specs']))
+        routed = route_tier( dict(size, profile=profile))
+        single = tier_packing( dict(size, tier=dict(default, max_job_vcpus=float('inf'), max_job_mem=float('inf'), min_job_vcpus=0, min_job_mem_per_vcpu=0)))
+        packing = routed['packing'] or dict(instance_type='(too large for any tier)', jobs=0, cpu=0, mem=0, efficiency=0)
+        modules.append(dict(module=module, vcpus=size['vcpus'], mem=size['mem'], tier=routed['tier']['name'], instance_type=packing['instance_type'],
+                            jobs=packing['jobs'], cpu=packing['cpu'], mem_used=packing['mem'], efficiency=packing['efficiency'],
+                            single_queue=single['efficiency'] if single != None else 0))
+    count = max(len(modules), 1)
+    return dict(modules=modules, efficiency=sum(m['efficiency'] for m in modules) / count,
+                single_queue_efficiency=sum(m['single_queue'] for m in modules) / count)
+
+
+def print_packing_report( args ):
+    """ Prints the expected packing efficiency of the deployed tiers.
+    """
+    report = packing_report( args )
+    print('Batch tiers: {}'.format(', '.join('{} ({}{})'.format(t['name'], ', '.join(t['instance_types']), ', spot + on-demand' if t['spot'] else '')
+                                             for t in args['profile']['tiers'])))
+    print('MODULE\tVCPU\tMEM\tTIER\tINSTANCE\tJOBS/INSTANCE\tCPU\tMEMORY\tPACKING\t(ONE QUEUE)')
+    for m in report['modules']:
+        print('{}\t{}\t{}\t{}\t{}\t{}\t{:.0f}%\t{:.0f}%\t{:.0f}%\t({:.0f}%)'.format(m['module'], m['vcpus'], m['mem'], m['tier'], m['instance_type'], m['jobs'],
+              100 * m['cpu'], 100 * m['mem_used'], 100 * m['efficiency'], 100 * m['single_queue']))
+    print('Expected packing efficiency: {:.0f}% (one queue on {} instances: {:.0f}%)'.format(100 * report['efficiency'],
+          [t['name'] for t in args['profile']['tiers'] if t['default']][0], 100 * report['single_queue_efficiency']))
+    return report
@@ -0,0 +1,180 @@
+import os, sys, time, stat, shutil, platform, threading, concurrent.futures
+##
+## Streaming S3 inputs for local runs (bioshed run --local --stream-inputs ..., or BIOSHED_STREAM_INPUTS=1).
+##
+## Instead of downloading each s3:// input before the container starts, eligible inputs become named pipes (FIFOs)
+## in a per-run directory that is bind-mounted at /input/s3/ in the container. A feeder thread per pipe fills it
+## with concurrent ranged GETs written in order, so the tool starts on the first megabyte and input never lands
+## on local disk. Only inputs that are read strictly sequentially are streamed (FASTQ, SAM and plain text, for
+## modules that do not seek). Everything else - BAM/CRAM, references and their indexes, or any input of a module
+## marked "stream_inputs": false in specs.json - is fully downloaded into the same directory first.
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+STREAM_DIR = os.path.join(INIT_PATH, 'streams')
+STREAM_MOUNT = '/input/s3'      # where streamed inputs appear inside the container
+STREAM_FIRST_CHUNK = 1024 * 1024                                                      # small first read - start processing early
+STREAM_CHUNK = int(float(os.environ.get('BIOSHED_STREAM_CHUNK_MB', 8)) * 1024 * 1024)
+STREAM_READAHEAD = int(os.environ.get('BIOSHED_STREAM_READAHEAD', 8))                  # ranged GETs in flight per stream
+STREAMABLE_EXTENSIONS = ['.fastq', '.fq', '.fastq.gz', '.fq.gz', '.sam', '.txt', '.tsv', '.csv']
+SEEKING_MODULES = ['samtools', 'gatk', 'picard', 'igvtools', 'bedtools']              # read inputs by seeking - never stream
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_transfer
+
+def stream_enabled( args ):
+    """ Whether eligible s3:// inputs of a local run are streamed.
+
+    stream: True (--stream-inputs) or None (not specified - use BIOSHED_STREAM_INPUTS)
+    """
+    if args.get('stream', None) != None:
+        return args['stream']
+    return os.environ.get('BIOSHED_STREAM_INPUTS', '') not in ['', '0']
+
+
+def streamable( args ):
+    """ Whether an s3:// input can be streamed through a pipe, or needs a full (seekable) download.
+
+    module: module name
+    uri: s3:// input
+    ---
+    streamable: True / False
+    """
+    import bioshed_batch
+    if platform.system() != 'Linux':
+        return False        # Docker Desktop file sharing does not pass named pipes through to the container
+    stream_spec = bioshed_batch.load_specs().get(args['module'], {}).get('stream_inputs', None)
+    if stream_spec != None:
+        return bool(stream_spec) and any(args['uri'].lower().endswith(ext) for ext in STREAMABLE_EXTENSIONS)
+    return args['module'].lower() not in SEEKING_MODULES and any(args['uri'].lower().endswith(ext) for ext in STREAMABLE_EXTENSIONS)
+
+
+def stage_streams( args ):
+    """ Sets up the s3:// inputs of a run - a named pipe per streamable input (fed once the container opens it),
+    and a full download for the rest.
+
+    module: module name
+    program_args: program arguments (list) - out:: destinations are left alone
+    s3_cache: (optional) take fully downloaded inputs from the host-wide S3 object cache (bioshed_s3cache)
+    ---
+    staged: dict(program_args (rewritten to STREAM_MOUNT paths), stagedir, dockerargs (bind mount), streams, downloads)
+    """
+    program_args = args['program_args']
+    uris = sorted(set(parg for parg in program_args if parg.startswith('s3://') and not parg.endswith('/')))
+    stagedir = os.path.join(STREAM_DIR, '{}_{}'.format(os.getpid(), int(time.time()*1000)))
+    os.makedirs(stagedir, exist_ok=True)
+    streams = []
+    downloads = []
+    for uri in uris:
+        bucket, key = bioshed_transfer.split_s3_uri( uri )
+        target = os.path.join(stagedir, bucket, key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if streamable( dict(module=args['module'], uri=uri)):
+            os.mkfifo(target)
+            streams.append(start_stream( dict(src=uri, fifo=target)))
+        else:
+            downloads.append(dict(src=uri, dest=target))
+    if downloads != []:
+        print('Downloading {} input(s) that need seekable access...'.format(len(downloads)))
+        if args.get('s3_cache', False):
+            import bioshed_s3cache
+            for download in downloads:
+                bucket, key = bioshed_transfer.split_s3_uri( download['src'] )
+                cached = bioshed_s3cache.fetch_object( dict(bucket=bucket, key=key))['path']
+                try:
+                    os.link(cached, download['dest'])
+                except OSError:
+                    shutil.copyfile(cached, download['dest'])   # cache on another filesystem
+        else:
+            result = bioshed_transfer.transfer_files( dict(transfers=downloads, quiet=True))
+            if result['failed'] != []:
+                finish_streams( dict(streams=streams, stagedir=stagedir))
+                raise IOError('could not download {}: {}'.format(result['failed'][0]['src'], result['failed'][0]['error']))
+    print('Streaming {} input(s), downloaded {}.'.format(len(streams), len(downloads)))
+    rewritten = [STREAM_MOUNT + '/' + parg[len('s3://'):] if parg in uris else parg for parg in program_args]
+    return dict(program_args=rewritten, stagedir=stagedir, dockerargs='-v {}:{}:ro '.format(stagedir, STREAM_MOUNT),
+                streams=streams, downloads=len(downloads))
+
+
+def start_stream( args ):
+    """ Starts a feeder thread that writes an S3 object into a named pipe.
+
+    src: s3:// object
+    fifo: named pipe path
+    ---
+    stream: dict(src, fifo, thread, stop, status) - status has bytes, error, done
+    """
+    stream = dict(src=args['src'], fifo=args['fifo'], stop=threading.Event(), status=dict(bytes=0, error='', done=False))
+    stream['thread'] = threading.Thread(target=feed_stream, args=(stream,), daemon=True)
+    stream['thread'].start()
+    return stream
+
+
+def feed_stream( stream ):
+    """ Writes an object into its pipe in order, with up to STREAM_READAHEAD ranged GETs in flight.
+    Opening the pipe blocks until the container opens it for reading. On an error the pipe is closed early,
+    so the tool sees a truncated input and fails rather than waiting forever.
+    """
+    status = stream['status']
+    try:
+        with open(stream['fifo'], 'wb', buffering=0) as fifo:
+            client = bioshed_transfer.get_s3_client()
+            bucket, key = bioshed_transfer.split_s3_uri( stream['src'] )
+            head = client.head_object(Bucket=bucket, Key=key)
+            size, etag = int(head['ContentLength']), head['ETag']
+            ranges = []
+            start = 0
+            while start < size:
+                end = min(size, start + (STREAM_FIRST_CHUNK if start == 0 else STREAM_CHUNK))
+                ranges.append((start, end - 1))
+                start = end
+            def get_range( byte_range ):
+                # IfMatch: fail rather than splice two versions of an object that changes mid-stream
+                response = client.get_object(Bucket=bucket, Key=key, Range='bytes={}-{}'.format(*byte_range), IfMatch=etag)
+                return response['Body'].read()
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=STREAM_READAHEAD) as executor:
+                pending = [executor.submit(get_range, r) for r in ranges[:STREAM_READAHEAD]]
+                ranges = ranges[STREAM_READAHEAD:]
+                try:
+                    while pending != [] and not stream['stop'].is_set():
+                        chunk = pending.pop(0).result()
+                        if ranges != []:
+                            pending.append(executor.submit(get_range, ranges.pop(0)))
+                        fifo.write(chunk)
+                        status['bytes'] += len(chunk)
+                finally:
+                    for future in pending:
+                        future.cancel()
+    except BrokenPipeError:
+        # the tool closed its input early (e.g., only read the first reads, or --help) - not an error
+        pass
+    except Exception as e:
+        status['error'] = str(e)
+    status['done'] = True
+    return
+
+
+def finish_streams( args ):
+    """ Stops feeders whose pipes were never (fully) read, removes the run's directory and reports stream errors.
+
+    streams: streams from stage_streams
+    stagedir: staging directory
+    ---
+    errors: list of 'src: error' for streams that failed
+    """
+    for stream in args.get('streams', []):
+        stream['stop'].set()
+        if not stream['status']['done'] and os.path.exists(stream['fifo']) and stat.S_ISFIFO(os.stat(stream['fifo']).st_mode):
+            try:
+                # unblock a feeder still waiting to open the pipe - its next write then fails with a broken pipe
+                os.close(os.open(stream['fifo'], os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        stream['thread'].join(timeout=5)
+    shutil.rmtree(args['stagedir'], ignore_errors=True)
+    errors = ['{}: {}'.format(stream['src'], stream['status']['error']) for stream in args.get('streams', []) if stream['status']['error'] != '']
+    for error in errors:
+        print('ERROR: streaming input {}'.format(error))
+    return errors
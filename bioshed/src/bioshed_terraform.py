@@ -0,0 +1,252 @@
+import os, json, shutil, hashlib, platform, subprocess
+##
+## Terraform working directories (bioshed connect / deploy / teardown) with a host-wide provider cache.
+##
+## Provider plugins are downloaded once per host into a shared plugin cache (TF_SHARED_DIR/plugin-cache), and the
+## provider lock file written by the first init (exact provider versions and package hashes) is kept in
+## TF_SHARED_DIR/terraform.lock.hcl and copied into every new working directory, so all users and runners on a host
+## install the same verified provider builds. "bioshed cache terraform" fills a local provider mirror
+## (TF_SHARED_DIR/providers) - when it is present, init runs offline from the mirror.
+## A working directory that is already initialized with the same providers and lock file is not initialized again.
+## The host directory and its plugin cache are world-writable (1777) and its files world-readable, so the first user to
+## create them does not lock other users out. A user who cannot write the shared lock file or mirror still uses them
+## read-only, with a CLI config (and, if needed, plugin cache) of their own.
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+HOST_SHARED_DIR = '/var/cache/bioshed/terraform'
+PROVIDERS_FILE = 'hs_providers.tf'
+LOCK_FILE = '.terraform.lock.hcl'
+INIT_MARKER = os.path.join('.terraform', 'bioshed_init.json')
+
+def shared_dir():
+    """ Host-wide terraform directory - BIOSHED_TF_SHARED_DIR, else /var/cache/bioshed/terraform if it can be used,
+    else ~/.bioshedinit/terraform (this user only).
+    """
+    if os.environ.get('BIOSHED_TF_SHARED_DIR', '') != '':
+        return os.environ['BIOSHED_TF_SHARED_DIR']
+    if shared_writable_dir( HOST_SHARED_DIR ):
+        return HOST_SHARED_DIR
+    if os.access(os.path.join(HOST_SHARED_DIR, 'terraform.lock.hcl'), os.R_OK) or os.path.isdir(os.path.join(HOST_SHARED_DIR, 'providers')):
+        return HOST_SHARED_DIR      # read-only for this user - the pinned lock file and mirror are still used
+    return user_dir()
+
+
+def user_dir():
+    return os.path.join(INIT_PATH, 'terraform')
+
+
+def shared_writable_dir( path ):
+    """ Creates a directory shared by every user of the host (mode 1777, like /tmp) if it does not exist yet.
+    ---
+    writable: whether this user can write to it
+    """
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+            os.chmod(path, 0o1777)
+    except OSError:
+        pass
+    return os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK)
+
+
+def shared_paths():
+    """ Shared plugin cache, provider mirror, lock file and CLI config paths.
+    """
+    shared = shared_dir()
+    return dict(shared=shared, plugin_cache=os.path.join(shared, 'plugin-cache'), mirror=os.path.join(shared, 'providers'),
+                lockfile=os.path.join(shared, 'terraform.lock.hcl'), cliconfig=os.path.join(shared, 'terraformrc'))
+
+
+def mirror_present( paths ):
+    return os.path.isdir(os.path.join(paths['mirror'], 'registry.terraform.io'))
+
+
+def terraform_env( args ):
+    """ Environment for terraform commands - shared plugin cache, and the local provider mirror if present.
+    ---
+    env: environment dict
+    """
+    paths = shared_paths()
+    if paths['shared'] == user_dir():
+        os.makedirs(paths['plugin_cache'], exist_ok=True)
+    elif not shared_writable_dir( paths['plugin_cache'] ):
+        paths['plugin_cache'] = os.path.join(user_dir(), 'plugin-cache')
+        os.makedirs(paths['plugin_cache'], exist_ok=True)
+    cliconfig = 'plugin_cache_dir = "{}"\n'.format(paths['plugin_cache'])
+    if mirror_present( paths ):
+        cliconfig += ('provider_installation {\n'
+                      '  filesystem_mirror {\n'
+                      '    path    = "' + paths['mirror'] + '"\n'
+                      '    include = ["registry.terraform.io/*/*"]\n'
+                      '  }\n'
+                      '  direct {\n'
+                      '    exclude = ["registry.terraform.io/*/*"]\n'
+                      '  }\n'
+                      '}\n')
+    if read_text( paths['cliconfig'] ) != cliconfig:
+        try:
+            write_atomic( paths['cliconfig'], cliconfig, 0o666 )
+        except OSError:
+            # shared config written by another user (sticky directory) - use a config of this user's own
+            paths['cliconfig'] = os.path.join(user_dir(), 'terraformrc')
+            if read_text( paths['cliconfig'] ) != cliconfig:
+                write_atomic( paths['cliconfig'], cliconfig )
+    env = dict(os.environ)
+    env.update(dict(TF_CLI_CONFIG_FILE=paths['cliconfig'], TF_PLUGIN_CACHE_DIR=paths['plugin_cache'], TF_IN_AUTOMATION='1', CHECKPOINT_DISABLE='1'))
+    return env
+
+
+def run_terraform( args ):
+    """ Runs a terraform command in a working directory with the shared provider cache.
+
+    initpath: terraform working directory
+    command: list of terraform arguments - e.g., ['plan', '-out', 'hs_deploy_core.plan']
+    ---
+    returncode: terraform exit code
+    """
+    return subprocess.call(['terraform'] + args['command'], cwd=args['initpath'], env=terraform_env( args ))
+
+
+def terraform_init( args ):
+    """ terraform init of a working directory, from the local provider mirror when present, with providers pinned by
+    the shared lock file. Skipped if the directory is already initialized with the same providers and lock file.
+
+    initpath: terraform working directory
+    force: (optional) initialize even if already initialized
+    ---
+    returncode: 0 if initialized (or already was)
+    """
+    initpath = args['initpath']
+    paths = shared_paths()
+    lockfile = os.path.join(initpath, LOCK_FILE)
+    if not os.path.exists(lockfile) and os.path.exists(paths['lockfile']):
+        shutil.copyfile(paths['lockfile'], lockfile)
+    stamp = init_stamp( dict(initpath=initpath, mirror=mirror_present( paths )))
+    markerfile = os.path.join(initpath, INIT_MARKER)
+    if not args.get('force', False) and os.path.isdir(os.path.join(initpath, '.terraform', 'providers')) and os.path.exists(markerfile):
+        with open(markerfile, 'r') as f:
+            if json.load(f).get('stamp', '') == stamp:
+                print('Terraform working directory already initialized.')
+                return 0
+    command = ['init', '-input=false']
+    if os.path.exists(lockfile):
+        # providers must match the pinned versions and hashes
+        command.append('-lockfile=readonly')
+    if mirror_present( paths ):
+        print('Initializing terraform from the local provider mirror {} (offline).'.format(paths['mirror']))
+    returncode = run_terraform( dict(initpath=initpath, command=command))
+    if returncode != 0:
+        return returncode
+    if not os.path.exists(paths['lockfile']) and os.path.exists(lockfile):
+        # first init on this host pins the provider versions and hashes for every later init
+        publish_lockfile( lockfile, paths['lockfile'] )
+    write_atomic( markerfile, json.dumps(dict(stamp=init_stamp( dict(initpath=initpath, mirror=mirror_present( paths ))))) )
+    return 0
+
+
+def init_stamp( args ):
+    """ What an initialized working directory depends on: provider requirements, lock file, and provider source.
+    """
+    stamp = hashlib.sha256()
+    for fname in [PROVIDERS_FILE, LOCK_FILE]:
+        if os.path.exists(os.path.join(args['initpath'], fname)):
+            with open(os.path.join(args['initpath'], fname), 'rb') as f:
+                stamp.update(f.read())
+    stamp.update(b'mirror' if args['mirror'] else b'direct')
+    return stamp.hexdigest()
+
+
+def mirror_providers( args ):
+    """ Downloads the providers required by a working directory into the local provider mirror, and records their
+    hashes for the platforms in the shared lock file - later inits on this host (or on runners given a copy of the
+    mirror) run offline.
+
+    initpath: terraform working directory with the provider requirements (e.g., ~/.bioshedinit/)
+    platforms: (optional) list of platforms - default this platform, e.g., ['linux_amd64']
+    ---
+    returncode: 0 on success
+    """
+    initpath = args['initpath']
+    paths = shared_paths()
+    platforms = args['platforms'] if args.get('platforms', []) != [] else [current_platform()]
+    os.makedirs(paths['mirror'], exist_ok=True)
+    env = terraform_env( args )
+    returncode = subprocess.call(['terraform', 'providers', 'mirror'] + ['-platform={}'.format(p) for p in platforms] + [paths['mirror']], cwd=initpath, env=env)
+    if returncode != 0:
+        return returncode
+    returncode = subprocess.call(['terraform', 'providers', 'lock', '-fs-mirror={}'.format(paths['mirror'])] + ['-platform={}'.format(p) for p in platforms],
+                                 cwd=initpath, env=terraform_env( args ))
+    if returncode == 0 and os.path.exists(os.path.join(initpath, LOCK_FILE)):
+        publish_lockfile( os.path.join(initpath, LOCK_FILE), paths['lockfile'] )
+    return returncode
+
+
+def publish_lockfile( src, dest ):
+    """ Copies a lock file to the shared lock file (readable by every user). Not being allowed to replace another user's
+    shared lock file is not an error - the existing one stays pinned.
+    """
+    try:
+        write_atomic( dest, read_text( src ), 0o644 )
+    except OSError as e:
+        print('Could not update the shared terraform lock file {}: {}'.format(dest, str(e)))
+    return
+
+
+def current_platform():
+    machine = platform.machine().lower()
+    return '{}_{}'.format(platform.system().lower(), dict(x86_64='amd64', aarch64='arm64').get(machine, machine))
+
+
+def cache_stats( args ):
+    """ Shared provider cache size, and whether the offline mirror and lock file are present.
+    ---
+    stats: dict(shared, plugins_bytes, mirror_bytes, mirror, lockfile)
+    """
+    paths = shared_paths()
+    return dict(shared=paths['shared'], plugins_bytes=dir_size( paths['plugin_cache'] ), mirror_bytes=dir_size( paths['mirror'] ),
+                mirror=mirror_present( paths ), lockfile=os.path.exists(paths['lockfile']))
+
+
+def clear_cache( args ):
+    """ Removes the shared plugin cache and provider mirror (the pinned lock file is kept).
+    """
+    paths = shared_paths()
+    shutil.rmtree(paths['plugin_cache'], ignore_errors=True)
+    shutil.rmtree(paths['mirror'], ignore_errors=True)
+    return
+
+
+def dir_size( path ):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for fname in files:
+            try:
+                total += os.path.getsize(os.path.join(root, fname))
+            except OSError:
+                pass
+    return total
+
+
+def read_text( fname ):
+    try:
+        with open(fname, 'r') as f:
+            return f.read()
+    except OSError:
+        return ''
+
+
+def write_atomic( fname, text, mode = None ):
+    os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+    tmpfile = '{}.{}.tmp'.format(fname, os.getpid())
+    try:
+        with open(tmpfile, 'w') as f:
+            f.write(text)
+        if mode != None:
+            os.chmod(tmpfile, mode)     # not subject to the umask
+        os.replace(tmpfile, fname)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    return fname
@@ -0,0 +1,258 @@
+import os, sys, time, threading, functools, concurrent.futures
+##
+## In-process S3 transfer engine.
+## $ bioshed download s3 <S3_URI> [<LOCAL_DIR>] [--part-size <MB>] [--concurrency <N>]
+## $ bioshed upload s3 <LOCAL_PATH> <S3_URI> [--part-size <MB>] [--concurrency <N>]
+##
+## Many files move at once (bounded thread pool), and each large file is split into ranged GETs / multipart PUTs
+## that also run in parallel (boto3 managed transfers). Failed files are retried with backoff, and progress and
+## throughput are reported while transferring. BIOSHED_S3_ENDPOINT_URL points at another S3 endpoint
+## (e.g., a local S3 stand-in for testing).
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+S3_ENDPOINT_URL = os.environ.get('BIOSHED_S3_ENDPOINT_URL', '')
+TRANSFER_CONCURRENCY = int(os.environ.get('BIOSHED_TRANSFER_CONCURRENCY', 16))             # files in parallel
+TRANSFER_PART_CONCURRENCY = int(os.environ.get('BIOSHED_TRANSFER_PART_CONCURRENCY', 8))    # parts in parallel per file
+TRANSFER_PART_MB = int(os.environ.get('BIOSHED_TRANSFER_PART_MB', 64))
+TRANSFER_RETRIES = 3
+PROGRESS_SECONDS = 2
+
+sys.path.append(os.path.join(SCRIPT_DIR))
+import bioshed_config
+
+@functools.lru_cache(maxsize=None)
+def get_s3_client( max_connections = TRANSFER_CONCURRENCY * TRANSFER_PART_CONCURRENCY ):
+    """ One boto3 S3 client per process (thread-safe), with a connection pool large enough for all transfer threads.
+    """
+    import boto3
+    from botocore.config import Config
+    region = bioshed_config.get_config( dict(key='aws_region'))
+    kwargs = dict(config=Config(max_pool_connections=max(10, max_connections), retries={'max_attempts': 5, 'mode': 'adaptive'}))
+    if region != '':
+        kwargs['region_name'] = region
+    if S3_ENDPOINT_URL != '':
+        kwargs['endpoint_url'] = S3_ENDPOINT_URL
+    return boto3.client('s3', **kwargs)
+
+
+def transfer_config( args ):
+    """ boto3 TransferConfig for ranged/multipart transfers.
+
+    part_size: (optional) part size in MB
+    part_concurrency: (optional) parts in parallel per file
+    """
+    from boto3.s3.transfer import TransferConfig
+    part_bytes = int(float(args['part_size']) * 1024 * 1024) if args.get('part_size', '') != '' else TRANSFER_PART_MB * 1024 * 1024
+    return TransferConfig(multipart_threshold=part_bytes, multipart_chunksize=part_bytes,
+                          max_concurrency=int(args['part_concurrency']) if args.get('part_concurrency', '') != '' else TRANSFER_PART_CONCURRENCY,
+                          use_threads=True)
+
+
+def plan_download( args ):
+    """ Lists the files to download for an S3 object or prefix.
+
+    src: S3 URI (object, or prefix ending in /)
+    dest: local directory (or file path for a single object)
+    ---
+    transfers: list of dict(src, dest, size)
+    """
+    bucket, key = split_s3_uri( args['src'] )
+    dest = args['dest'] if args.get('dest', '') != '' else '.'
+    client = get_s3_client()
+    if key != '' and not key.endswith('/'):
+        try:
+            size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+            target = os.path.join(dest, os.path.basename(key)) if os.path.isdir(dest) or dest.endswith('/') else dest
+            return [dict(src=args['src'], dest=target, size=size)]
+        except Exception:
+            key = key + '/'     # not an object - treat as a prefix
+    transfers = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key):
+        for o in page.get('Contents', []):
+            if not o['Key'].endswith('/'):
+                transfers.append(dict(src='s3://{}/{}'.format(bucket, o['Key']), dest=os.path.join(dest, o['Key'][len(key):]), size=o['Size']))
+    return transfers
+
+
+def plan_upload( args ):
+    """ Lists the files to upload for a local file or directory.
+
+    src: local file or directory
+    dest: S3 URI (prefix for a directory, or a prefix ending in / for a file)
+    ---
+    transfers: list of dict(src, dest, size)
+    """
+    src = args['src']
+    dest = args['dest']
+    if os.path.isfile(src):
+        target = dest + os.path.basename(src) if dest.endswith('/') else dest
+        return [dict(src=src, dest=target, size=os.path.getsize(src))]
+    transfers = []
+    for root, dirs, files in os.walk(src):
+        for fname in sorted(files):
+            fpath = os.path.join(root, fname)
+            transfers.append(dict(src=fpath, dest=dest.rstrip('/') + '/' + os.path.relpath(fpath, src).replace(os.sep, '/'), size=os.path.getsize(fpath)))
+    return transfers
+
+
+def transfer_files( args ):
+    """ Runs transfers concurrently - S3 -> local (download), local -> S3 (upload) and S3 -> S3 (server-side copy).
+    Each file is retried up to TRANSFER_RETRIES times.
+
+    transfers: list of dict(src, dest, size)
+    concurrency: (optional) files in parallel
+    part_size: (optional) part size in MB
+    part_concurrency: (optional) parts in parallel per file
+    quiet: (optional) no progress output
+    ---
+    result: dict(files, failed=[dict(src, dest, error)], bytes, seconds, mbps)
+    """
+    transfers = args['transfers']
+    concurrency = int(args['concurrency']) if args.get('concurrency', '') != '' else TRANSFER_CONCURRENCY
+    config = transfer_config( args )
+    client = get_s3_client()
+    quiet = args.get('quiet', False)
+    total_bytes = sum(int(t.get('size', 0)) for t in transfers)
+    progress = dict(bytes=0, files=0)
+    lock = threading.Lock()
+    def add_bytes( nbytes ):
+        with lock:
+            progress['bytes'] += nbytes
+
+    def transfer_one( transfer ):
+        for attempt in range(TRANSFER_RETRIES + 1):
+            done_bytes = [0]
+            def callback( nbytes ):
+                with lock:
+                    done_bytes[0] += nbytes
+                    progress['bytes'] += nbytes
+            try:
+                transfer_file( dict(transfer, client=client, config=config, callback=callback))
+                with lock:
+                    progress['files'] += 1
+                return None
+            except Exception as e:
+                add_bytes( -done_bytes[0] )     # the retry transfers the whole file again
+                if attempt == TRANSFER_RETRIES:
+                    return dict(src=transfer['src'], dest=transfer['dest'], error=str(e))
+                time.sleep(min(2 ** attempt, 30))
+
+    start = time.time()
+    stop = threading.Event()
+    def report():
+        while not stop.wait(PROGRESS_SECONDS):
+            elapsed = time.time() - start
+            print('\t{}/{} files | {:.2f} / {:.2f} GB | {:.1f} MB/s'.format(progress['files'], len(transfers), progress['bytes'] / 1024**3,
+                                                                          total_bytes / 1024**3, progress['bytes'] / 1024**2 / elapsed), flush=True)
+    if not quiet:
+        print('Transferring {} file(s), {:.2f} GB ({} files in parallel, {} MB parts)...'.format(
+              len(transfers), total_bytes / 1024**3, concurrency, int(config.multipart_chunksize / 1024**2)))
+        threading.Thread(target=report, daemon=True).start()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(transfers) or 1))) as executor:
+        failed = [f for f in executor.map(transfer_one, transfers) if f != None]
+    stop.set()
+    seconds = max(time.time() - start, 1e-9)
+    result = dict(files=len(transfers) - len(failed), failed=failed, bytes=progress['bytes'], seconds=seconds,
+                  mbps=progress['bytes'] / 1024**2 / seconds)
+    if not quiet:
+        print('Transferred {} of {} file(s), {:.2f} GB in {:.1f}s ({:.1f} MB/s).'.format(result['files'], len(transfers),
+              result['bytes'] / 1024**3, seconds, result['mbps']))
+        for f in failed:
+            print('ERROR: {} -> {}: {}'.format(f['src'], f['dest'], f['error']))
+    return result
+
+
+def transfer_file( args ):
+    """ Transfers one file (download, upload or S3 -> S3 copy) with ranged/multipart parts in parallel.
+
+    src, dest: local path or S3 URI
+    client: (optional) S3 client
+    config: (optional) TransferConfig
+    callback: (optional) called with bytes transferred
+    extra_args: (optional) ExtraArgs for the transfer (e.g., ServerSideEncryption, or IfMatch to pin a download to an ETag)
+    """
+    src, dest = args['src'], args['dest']
+    client = args['client'] if 'client' in args else get_s3_client()
+    config = args['config'] if 'config' in args else transfer_config( args )
+    callback = args.get('callback', None)
+    extra_args = args.get('extra_args', None)
+    if src.startswith('s3://') and dest.startswith('s3://'):
+        src_bucket, src_key = split_s3_uri( src )
+        dest_bucket, dest_key = split_s3_uri( dest )
+        client.copy(dict(Bucket=src_bucket, Key=src_key), dest_bucket, dest_key, ExtraArgs=extra_args, Callback=callback, Config=config)
+    elif src.startswith('s3://'):
+        bucket, key = split_s3_uri( src )
+        if os.path.dirname(dest) != '':
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmpdest = '{}.{}.{}.part'.format(dest, os.getpid(), threading.get_ident())
+        try:
+            if extra_args and 'IfMatch' in extra_args and not download_arg_supported( 'IfMatch' ):
+                # this s3transfer cannot pin ranged downloads to an ETag - one conditional GET instead
+                download_object( dict(client=client, bucket=bucket, key=key, dest=tmpdest, extra_args=extra_args, callback=callback))
+            else:
+                client.download_file(bucket, key, tmpdest, ExtraArgs=extra_args, Callback=callback, Config=config)
+            os.replace(tmpdest, dest)
+        finally:
+            if os.path.exists(tmpdest):
+                os.remove(tmpdest)
+    else:
+        bucket, key = split_s3_uri( dest )
+        client.upload_file(src, bucket, key, ExtraArgs=extra_args, Callback=callback, Config=config)
+    return dest
+
+
+def download_arg_supported( name ):
+    from s3transfer.manager import TransferManager
+    return name in TransferManager.ALLOWED_DOWNLOAD_ARGS
+
+
+def download_object( args ):
+    """ Downloads an S3 object with a single GetObject (e.g., conditional on IfMatch - fails if the object changed).
+
+    client, bucket, key: S3 object
+    dest: local file
+    extra_args: (optional) GetObject arguments
+    callback: (optional) called with bytes transferred
+    """
+    response = args['client'].get_object(Bucket=args['bucket'], Key=args['key'], **(args.get('extra_args', None) or {}))
+    with open(args['dest'], 'wb') as f:
+        for chunk in iter(lambda: response['Body'].read(1024 * 1024), b''):
+            f.write(chunk)
+            if args.get('callback', None) != None:
+                args['callback'](len(chunk))
+    return args['dest']
+
+
+def download_s3( args ):
+    """ Downloads an S3 object or prefix.
+
+    src: S3 URI
+    dest: (optional) local directory - default current directory
+    concurrency, part_size: (optional) see transfer_files
+    """
+    transfers = plan_download( args )
+    if transfers == []:
+        print('Nothing found at {}.'.format(args['src']))
+        return dict(files=0, failed=[], bytes=0, seconds=0, mbps=0)
+    return transfer_files( dict(args, transfers=transfers))
+
+
+def upload_s3( args ):
+    """ Uploads a local file or directory.
+
+    src: local path
+    dest: S3 URI
+    concurrency, part_size: (optional) see transfer_files
+    """
+    transfers = plan_upload( args )
+    if transfers == []:
+        print('Nothing found at {}.'.format(args['src']))
+        return dict(files=0, failed=[], bytes=0, seconds=0, mbps=0)
+    return transfer_files( dict(args, transfers=transfers))
+
+
+def split_s3_uri( uri ):
+    """ s3://bucket/some/key -> ('bucket', 'some/key')
+    """
+    path = uri[len('s3://'):] if uri.startswith('s3://') else uri
+    return path.split('/', 1)[0], path.split('/', 1)[1] if '/' in path else ''
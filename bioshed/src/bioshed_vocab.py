@@ -0,0 +1,264 @@
+import os, sys, csv, glob, mmap, zlib, struct, bisect
+##
+## Compiled index of the ENCODE search vocabularies (bioshed_atlas/files/search_encode_<category>.txt).
+##
+## The vocabularies are compiled once - at build time by setup.py, or on first use if the packaged index is missing or
+## older than the vocabulary files - into search_encode_vocab.idx, which is memory-mapped on first lookup.
+## Terms are matched on a normalized key (lower case, letters and digits only), so "chipseq", "ChIP seq" and
+## "chip-seq" are the same term. A term matches an ID exactly, or the trailing words of IDs
+## ("chipseq" -> TF ChIP-seq, Histone ChIP-seq, ...), or failing that, the start of an ID ("h3k4" -> H3K4me3).
+##
+## Index layout: header | line offsets (sorted by key, for prefix search) | hash slots (crc32, open addressing) | lines
+## Each line is category \t key \t matches, and each match is kind (F = full ID, S = trailing words) \x1f ID \x1f count \x1f link.
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+HOME_PATH = os.path.expanduser('~')
+INIT_PATH = os.path.join(HOME_PATH, '.bioshedinit/')
+VOCAB_DIR = os.path.join(SCRIPT_DIR, 'bioshed_atlas', 'files')
+VOCAB_INDEX = os.path.join(SCRIPT_DIR, 'search_encode_vocab.idx')
+USER_VOCAB_INDEX = os.path.join(INIT_PATH, 'search_encode_vocab.idx')
+MAGIC = b'BSVOCAB1'
+HEADER = struct.Struct('<8sIII')     # magic, number of lines, number of hash slots, offset of lines
+MIN_SUFFIX_LENGTH = 3
+
+_index = {}
+
+def normalize_term( term ):
+    """ Normalized search term - e.g., "ChIP-seq" -> "chipseq"
+    """
+    return ''.join(c for c in str(term).lower() if c.isalnum())
+
+
+def compile_vocab( args ):
+    """ Compiles the search_encode_*.txt vocabularies into an index file.
+
+    vocabdir: (optional) directory with search_encode_<category>.txt files - default bioshed_atlas/files
+    indexfile: (optional) index file to write - default search_encode_vocab.idx next to this module
+    ---
+    indexfile: index file written
+    """
+    vocabdir = args['vocabdir'] if args.get('vocabdir', '') != '' else VOCAB_DIR
+    indexfile = args['indexfile'] if args.get('indexfile', '') != '' else VOCAB_INDEX
+    entries = {}    # (category, key) -> list of (kind, ID, count, link)
+    for vocabfile in sorted(glob.glob(os.path.join(vocabdir, 'search_encode_*.txt'))):
+        category = os.path.basename(vocabfile)[len('search_encode_'):-len('.txt')].lower()
+        entries.setdefault((category, ''), [])     # every category has a line, even if empty
+        with open(vocabfile, 'r', newline='') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                term_id = str(row.get('ID', '') or '').strip()
+                if term_id == '':
+                    continue
+                match = (term_id, str(row.get('number_of_datasets', '') or '0'), str(row.get('link', '') or ''))
+                entries.setdefault((category, normalize_term( term_id )), []).append(('F',) + match)
+                words = term_id.split()
+                for i in range(1, len(words)):
+                    suffix = normalize_term( ' '.join(words[i:]) )
+                    if len(suffix) >= MIN_SUFFIX_LENGTH:
+                        entries.setdefault((category, suffix), []).append(('S',) + match)
+    lines = []
+    for (category, key), matches in sorted(entries.items()):
+        matches = sorted(matches, key=lambda m: (m[0], -int(m[2]) if m[2].isdigit() else 0))    # full-ID matches first
+        lines.append('{}\t{}\t{}\n'.format(category, key, '\x1e'.join('\x1f'.join(m).replace('\n', ' ') for m in matches)).encode())
+    nslots = 1
+    while nslots < 2 * len(lines):
+        nslots *= 2
+    slots = [0] * nslots
+    for i, line in enumerate(lines):
+        slot = zlib.crc32(line[:line.index(b'\t', line.index(b'\t') + 1)]) & (nslots - 1)
+        while slots[slot] != 0:
+            slot = (slot + 1) & (nslots - 1)
+        slots[slot] = i + 1
+    lines_offset = HEADER.size + 4 * len(lines) + 4 * nslots
+    offsets = []
+    position = lines_offset
+    for line in lines:
+        offsets.append(position)
+        position += len(line)
+    os.makedirs(os.path.dirname(os.path.abspath(indexfile)), exist_ok=True)
+    tmpfile = '{}.{}.tmp'.format(indexfile, os.getpid())
+    with open(tmpfile, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(lines), nslots, lines_offset))
+        f.write(struct.pack('<{}I'.format(len(offsets)), *offsets))
+        f.write(struct.pack('<{}I'.format(nslots), *slots))
+        f.writelines(lines)
+    os.replace(tmpfile, indexfile)
+    return indexfile
+
+
+def index_file():
+    """ Index to use - the packaged index if it is up to date with the vocabulary files, otherwise a per-user index
+    (compiled now if needed).
+    """
+    vocabfiles = glob.glob(os.path.join(VOCAB_DIR, 'search_encode_*.txt'))
+    newest = max([os.path.getmtime(f) for f in vocabfiles]) if vocabfiles != [] else 0
+    for indexfile in [VOCAB_INDEX, USER_VOCAB_INDEX]:
+        if os.path.exists(indexfile) and os.path.getmtime(indexfile) >= newest:
+            return indexfile
+    if vocabfiles == []:
+        return ''
+    return compile_vocab( dict(indexfile=USER_VOCAB_INDEX))
+
+
+def load_index():
+    """ Memory-maps the index (once per process).
+    """
+    if 'map' not in _index:
+        indexfile = index_file()
+        if indexfile == '':
+            _index.update(dict(map=None, nlines=0))
+            return _index
+        with open(indexfile, 'rb') as f:
+            vmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, nlines, nslots, lines_offset = HEADER.unpack_from(vmap, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a bioshed vocabulary index'.format(indexfile))
+        _index.update(dict(map=vmap, nlines=nlines, nslots=nslots, lines_offset=lines_offset))
+    return _index
+
+
+def read_line( index, i ):
+    """ Line i of the index (in key order) -> (category, key, matches)
+    """
+    vmap = index['map']
+    start = struct.unpack_from('<I', vmap, HEADER.size + 4 * i)[0]
+    end = vmap.find(b'\n', start)
+    category, key, matches = vmap[start:end].decode().split('\t', 2)
+    return category, key, [dict(zip(['kind', 'ID', 'count', 'link'], m.split('\x1f'))) for m in matches.split('\x1e') if m != '']
+
+
+def lookup( args ):
+    """ Exact lookup of a normalized term - one hash probe sequence, O(term length).
+
+    category: search category (e.g., assay)
+    term: search term
+    ---
+    matches: list of dict(kind, ID, count, link) - full-ID matches first
+    """
+    line = find_line( dict(category=args['category'], key=normalize_term( args['term'] )))
+    return line[2] if line != None else []
+
+
+def find_line( args ):
+    """ Index line for a category and normalized key, or None.
+    """
+    index = load_index()
+    if index['map'] == None:
+        return None
+    wanted = '{}\t{}'.format(str(args['category']).lower(), args['key']).encode()
+    nslots = index['nslots']
+    slot = zlib.crc32(wanted) & (nslots - 1)
+    slots_offset = HEADER.size + 4 * index['nlines']
+    while True:
+        i = struct.unpack_from('<I', index['map'], slots_offset + 4 * slot)[0]
+        if i == 0:
+            return None
+        line = read_line( index, i - 1 )
+        if '{}\t{}'.format(line[0], line[1]).encode() == wanted:
+            return line
+        slot = (slot + 1) & (nslots - 1)
+
+
+def has_category( category ):
+    """ Whether a search category has a vocabulary (each category has a line with an empty key).
+    """
+    return find_line( dict(category=category, key='')) != None
+
+
+def lookup_prefix( args ):
+    """ IDs in a category whose normalized form starts with a term (binary search on the sorted keys).
+
+    category: search category
+    term: search term - '' lists the whole category
+    ---
+    matches: list of dict(kind, ID, count, link) - full-ID matches only, most datasets first
+    """
+    index = load_index()
+    if index['map'] == None:
+        return []
+    category = str(args['category']).lower()
+    prefix = normalize_term( args['term'] )
+    keys = KeyView( index )
+    matches = []
+    i = bisect.bisect_left(keys, (category, prefix))
+    while i < index['nlines']:
+        line_category, key, line_matches = read_line( index, i )
+        if line_category != category or not key.startswith(prefix):
+            break
+        matches += [m for m in line_matches if m['kind'] == 'F']
+        i += 1
+    return sorted(matches, key=lambda m: -int(m['count']) if m['count'].isdigit() else 0)
+
+
+class KeyView:
+    """ Sorted (category, key) sequence over the index lines, for bisect.
+    """
+    def __init__( self, index ):
+        self.index = index
+    def __len__( self ):
+        return self.index['nlines']
+    def __getitem__( self, i ):
+        return read_line( self.index, i )[0:2]
+
+
+def resolve_term( args ):
+    """ Resolves a search term in a category - an exact ID, else all IDs ending with the term, else the ID starting with
+    the term that has the most datasets.
+
+    category: search category
+    term: search term
+    ---
+    matches: list of dict(kind, ID, count, link) - [] if nothing matches
+    """
+    matches = lookup( args )
+    if matches != [] and matches[0]['kind'] == 'F':
+        return [m for m in matches if m['kind'] == 'F'][0:1]
+    if matches != []:
+        return matches
+    return lookup_prefix( args )[0:1]
+
+
+def convert_to_search_string( args ):
+    """ Given a category and search terms, outputs an updated url search string - same as
+    atlas_encode_utils.convert_to_search_string, resolved from the compiled index.
+
+    terms: breast cancer
+    category: general
+    ---
+    urlstring: search string
+
+    Example: 'breast cancer', 'general' => ?type=Experiment&searchTerm=breast+cancer
+    Example: 'chipseq', 'assay' => ?type=Experiment&assay_title=TF%20ChIP-seq&assay_title=Histone%20ChIP-seq&...
+    """
+    terms = str(args['terms'])
+    category = str(args['category']).lower()
+    search_string = ''
+    if category not in ['general', ''] and has_category( category ):
+        if terms == '':
+            # if category list is asked for:
+            print('You need to provide a search term for category --{}. Valid search terms are: {}\n'.format(
+                  category, [m['ID'] for m in lookup_prefix( dict(category=category, term='') )]))
+        else:
+            matches = [m for m in resolve_term( dict(category=category, term=terms)) if m['link'] != '']
+            if len(matches) > 0:
+                # several IDs (e.g., every "... ChIP-seq" assay): repeated parameters are ORed by ENCODE
+                search_string = matches[0]['link'] + ''.join('&' + m['link'].lstrip('?').replace('type=Experiment&', '') for m in matches[1:])
+    elif category not in ['general', ''] and terms == '':
+        # incorrect category used
+        print('ERROR: Invalid search category {}. Type "bioshed search encode" to see valid search categories, or just search without categories.'.format(category))
+        return ''
+    if search_string == '':
+        search_string = '?type=Experiment&searchTerm={}'.format(terms.lower().replace(' ','+'))
+    return search_string
+
+
+def install( args ):
+    """ Resolves atlas_encode_utils search terms from the compiled index instead of re-reading the vocabulary files per term.
+    """
+    import atlas_encode_utils
+    atlas_encode_utils.convert_to_search_string = convert_to_search_string
+    return
+
+
+if __name__ == '__main__':
+    # python bioshed_vocab.py [<VOCAB_DIR> [<INDEX_FILE>]] - compile the vocabulary index
+    print('Wrote {}'.format(compile_vocab( dict(vocabdir=sys.argv[1] if len(sys.argv) > 1 else '', indexfile=sys.argv[2] if len(sys.argv) > 2 else ''))))
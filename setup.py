@@ -1,4 +1,17 @@
+import os, sys
 from setuptools import setup
+from setuptools.command.build_py import build_py
+
+class build_py_vocab(build_py):
+    """ Compiles the ENCODE search vocabularies (bioshed_atlas/files) into bioshed/src/search_encode_vocab.idx before packaging.
+    """
+    def run(self):
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bioshed', 'src'))
+        import bioshed_vocab
+        if os.path.isdir(bioshed_vocab.VOCAB_DIR):
+            print('compiled {}'.format(bioshed_vocab.compile_vocab({})))
+        build_py.run(self)
+
 setup(
     name='bioshed',
     version='0.2.10',
@@ -14,9 +27,11 @@ setup(
     py_modules=["bioshed"],             # Name of the python package
     package_dir={'bioshed':'bioshed/src'},     # Directory of the source code of the package
     packages=['bioshed/src/', 'bioshed/src/bioshed_utils', 'bioshed/src/bioshed_atlas', 'bioshed/src/bioshed_atlas/bioshed_utils', 'bioshed/src/bioshed_atlas/files'],
-    package_data={'bioshed.src.bioshed_utils': ['bioshed_utils/*.json', 'bioshed_utils/*.yaml'], \
+    package_data={'bioshed.src': ['search_encode_vocab.idx'], \
+                  'bioshed.src.bioshed_utils': ['bioshed_utils/*.json', 'bioshed_utils/*.yaml'], \
                   'bioshed.src.bioshed_atlas.files': ['bioshed_atlas/files/*.txt'], \
                   'bioshed.src.bioshed_atlas.files.gdc': ['bioshed_atlas/files/gdc/*.txt', 'bioshed_atlas/files/gdc/*.gz']},
+    cmdclass={'build_py': build_py_vocab},
     entry_points={
         'console_scripts': [
             'bioshed=bioshed.src.bioshed:bioshed_cli_entrypoint'
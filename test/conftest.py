@@ -0,0 +1,73 @@
+import os, sys, json, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+##
+## Shared test setup: bioshed/src on sys.path, fixture paths, and local HTTP stand-ins for remote services
+## (serverless core, ENCODE, GDC, Batch) - routes are plain functions, so each test states the service behavior it needs.
+
+TEST_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+SRC_DIR = os.path.join(TEST_DIR, '..', 'bioshed', 'src')
+FASTQ_DIR = os.path.join(TEST_DIR, 'fastq')
+
+sys.path.insert(0, SRC_DIR)
+
+
+class StandIn:
+    """ Local HTTP server for a remote service.
+
+    routes: dict of (method, path) -> handler( request ) returning (status, headers, body) - body is bytes, or JSON-encoded otherwise.
+            path '*' matches any path. request is dict(method, path, query, headers, body, json).
+    """
+    def __init__( self, routes ):
+        self.routes = routes
+        self.requests = []     # every request received, in order
+        standin = self
+        class Handler(BaseHTTPRequestHandler):
+            def log_message( self, *args ):
+                pass
+            def handle_request( self, method ):
+                path, _, query = self.path.partition('?')
+                length = int(self.headers.get('Content-Length', 0) or 0)
+                body = self.rfile.read(length) if length > 0 else b''
+                request = dict(method=method, path=path, query=query, headers=dict(self.headers), body=body)
+                try:
+                    request['json'] = json.loads(body.decode()) if body != b'' else None
+                except ValueError:
+                    request['json'] = None
+                standin.requests.append(request)
+                handler = standin.routes.get((method, path), standin.routes.get((method, '*'), None))
+                status, headers, content = handler( request ) if handler != None else (404, {}, b'')
+                content = content if type(content) == bytes else json.dumps(content).encode()
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                if method != 'HEAD':
+                    self.wfile.write(content)
+            def do_GET( self ):
+                self.handle_request('GET')
+            def do_HEAD( self ):
+                self.handle_request('HEAD')
+            def do_POST( self ):
+                self.handle_request('POST')
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close( self ):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def standin():
+    """ Factory for local HTTP stand-ins - standin(routes) -> StandIn; all are shut down after the test.
+    """
+    servers = []
+    def start( routes ):
+        servers.append(StandIn( routes ))
+        return servers[-1]
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,95 @@
+import os, json
+import pytest
+boto3 = pytest.importorskip('boto3')
+import botocore.config
+import bioshed_batch
+import bioshed_jobs
+
+class BatchStandIn:
+    """ Local stand-in for the AWS Batch API (RegisterJobDefinition, SubmitJob, DescribeJobs).
+
+    submit_errors: dict of job name suffix (row) -> list of (status, error code) to answer before accepting the job
+    """
+    def __init__( self, standin, submit_errors = {} ):
+        self.submit_errors = dict((k, list(v)) for k, v in submit_errors.items())
+        self.jobs = {}
+        self.submit_calls = {}
+        self.server = standin({('POST', '/v1/registerjobdefinition'): self.register_job_definition,
+                               ('POST', '/v1/submitjob'): self.submit_job,
+                               ('POST', '/v1/describejobs'): self.describe_jobs})
+        self.client = boto3.client('batch', region_name='us-east-1', endpoint_url=self.server.url, aws_access_key_id='x',
+                                   aws_secret_access_key='x', config=botocore.config.Config(retries={'total_max_attempts': 1}))
+
+    def register_job_definition( self, request ):
+        name = request['json']['jobDefinitionName']
+        return 200, {}, {'jobDefinitionName': name, 'jobDefinitionArn': 'arn:aws:batch:us-east-1:0:job-definition/{}:1'.format(name), 'revision': 1}
+
+    def submit_job( self, request ):
+        name = request['json']['jobName']
+        row = name.split('_')[-1]
+        self.submit_calls[row] = self.submit_calls.get(row, 0) + 1
+        if self.submit_errors.get(row, []) != []:
+            status, code = self.submit_errors[row].pop(0)
+            return status, {'x-amzn-ErrorType': code}, {'__type': code, 'message': 'stand-in error'}
+        jobid = 'job-{}'.format(len(self.jobs))
+        self.jobs[jobid] = dict(jobId=jobid, jobName=name, status='RUNNABLE', command=request['json']['containerOverrides']['command'])
+        return 200, {}, {'jobName': name, 'jobId': jobid}
+
+    def describe_jobs( self, request ):
+        return 200, {}, {'jobs': [dict(job, jobQueue='q', createdAt=0, jobDefinition='d')
+                                  for jobid, job in self.jobs.items() if jobid in request['json']['jobs']]}
+
+
+@pytest.fixture
+def batch_env( tmp_path, monkeypatch ):
+    monkeypatch.setattr(bioshed_jobs, 'LEDGER_FILE', str(tmp_path / 'jobs.db'))
+    monkeypatch.setattr(bioshed_batch, 'SUBMIT_BACKOFF_SECONDS', 0.01)
+    samplesheet = tmp_path / 'samples.tsv'
+    samplesheet.write_text('sample\tfastq\n' + ''.join('s{}\ts3://b/s{}.fastq.gz\n'.format(i, i) for i in range(4)))
+    return dict(samplesheet=str(samplesheet), configfile=str(tmp_path / 'config.json'))
+
+
+def submit( batch, env ):
+    return bioshed_batch.submit_samplesheet( dict(name='fastqc', program_args=['fastqc', '{fastq}'], samplesheet=env['samplesheet'],
+                                                  client=batch.client, jobqueue='q', configfile=env['configfile'], rate=0))
+
+
+def test_samplesheet_submission_retries_throttling( standin, batch_env ):
+    batch = BatchStandIn( standin, submit_errors={'1': [(429, 'ThrottlingException'), (500, 'ServerException')]} )
+    manifest = submit( batch, batch_env )
+    assert [job['jobid'] != '' for job in manifest['jobs']] == [True] * 4
+    assert batch.submit_calls == {'0': 1, '1': 3, '2': 1, '3': 1}
+    assert sorted(job['command'][0] for job in batch.jobs.values()) == ['fastqc s3://b/s{}.fastq.gz'.format(i) for i in range(4)]
+    with open(os.path.splitext(batch_env['samplesheet'])[0] + '.manifest.json') as f:
+        assert len(json.load(f)['jobs']) == 4
+
+
+def test_samplesheet_submission_does_not_retry_client_errors( standin, batch_env ):
+    batch = BatchStandIn( standin, submit_errors={'2': [(400, 'ClientException')] * 5, '3': [(429, 'ThrottlingException')] * 5} )
+    manifest = submit( batch, batch_env )
+    jobs = dict((str(job['row']), job) for job in manifest['jobs'])
+    assert batch.submit_calls['2'] == 1 and jobs['2']['jobid'] == '' and 'ClientException' in jobs['2']['error']
+    assert batch.submit_calls['3'] == bioshed_batch.SUBMIT_ATTEMPTS and jobs['3']['jobid'] == ''
+
+
+def test_refresh_keeps_jobs_not_described_yet( standin, batch_env ):
+    batch = BatchStandIn( standin )
+    submit( batch, batch_env )
+    bioshed_jobs.record_jobs( dict(jobs=[dict(jobid='just-submitted', module='fastqc')]))
+    for i in range(bioshed_jobs.EXPIRE_AFTER_MISSES - 1):
+        result = bioshed_jobs.refresh_jobs( dict(client=batch.client))
+        assert result['active'] == 5
+    assert bioshed_jobs.job_summary({}) == {'RUNNABLE': 4, 'SUBMITTED': 1}
+    bioshed_jobs.refresh_jobs( dict(client=batch.client))
+    assert bioshed_jobs.job_summary({}) == {'RUNNABLE': 4, 'EXPIRED': 1}
+
+
+def test_wait_adds_jobs_missing_from_ledger( standin, batch_env ):
+    batch = BatchStandIn( standin )
+    batch.jobs['elsewhere'] = dict(jobId='elsewhere', jobName='job_fastqc_abc123', status='SUCCEEDED', command=['fastqc s3://b/x.fastq.gz'])
+    # submitted from another machine: described and added to the ledger, not reported as done without a check
+    assert bioshed_jobs.wait_jobs( dict(jobids=['elsewhere'], client=batch.client, min_interval=0)) == {'SUCCEEDED': 1}
+    assert [(job['jobid'], job['module'], job['status']) for job in bioshed_jobs.list_jobs({})] == [('elsewhere', 'fastqc', 'SUCCEEDED')]
+    # not known to Batch either (e.g., a typo)
+    assert bioshed_jobs.wait_jobs( dict(jobids=['elsewhere', 'typo'], client=batch.client, min_interval=0)) == {'SUCCEEDED': 1, 'UNKNOWN': 1}
+    assert [job['jobid'] for job in bioshed_jobs.list_jobs({})] == ['elsewhere']
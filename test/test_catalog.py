@@ -0,0 +1,50 @@
+import os, shutil
+import bioshed_catalog
+from conftest import FASTQ_DIR
+
+def data_tree( tmp_path ):
+    """ data/rnaseq/<test/fastq files>, data/wgs/tumor_S1_L001_R1_001.fastq plus a non-data file (notes.docx)
+    """
+    data = tmp_path / 'data'
+    (data / 'rnaseq').mkdir(parents=True)
+    (data / 'wgs').mkdir()
+    for name in os.listdir(FASTQ_DIR):
+        shutil.copy(os.path.join(FASTQ_DIR, name), str(data / 'rnaseq' / name))
+    (data / 'wgs' / 'tumor_S1_L001_R1_001.fastq').write_text('@r1\nACGT\n+\nIIII\n')
+    (data / 'wgs' / 'notes.docx').write_text('not data')
+    return data
+
+
+def test_index_and_search( tmp_path ):
+    data = data_tree( tmp_path )
+    catalogdb = str(tmp_path / 'catalog.db')
+    result = bioshed_catalog.index_location( dict(location=str(data), catalogdb=catalogdb))
+    assert (result['files'], result['new'], result['changed'], result['removed']) == (3, 3, 0, 0)
+    rows = bioshed_catalog.search_catalog( dict(terms='rna-seq R1', catalogdb=catalogdb))
+    assert [os.path.basename(r['path']) for r in rows] == ['rnaseq_mouse_test_tiny1_R1.fastq.gz']
+    assert (rows[0]['sample'], rows[0]['assay'], rows[0]['read'], rows[0]['filetype']) == ('rnaseq_mouse_test_tiny1', 'RNA-seq', 'R1', 'fastq.gz')
+    assert rows[0]['checksum'] == bioshed_catalog.file_md5( os.path.join(FASTQ_DIR, 'rnaseq_mouse_test_tiny1_R1.fastq.gz'))
+    assert [r['lane'] for r in bioshed_catalog.search_catalog( dict(terms='tumor', catalogdb=catalogdb))] == ['L001']
+    # only new, changed and removed files are looked at again
+    os.remove(str(data / 'wgs' / 'tumor_S1_L001_R1_001.fastq'))
+    (data / 'wgs' / 'normal_R2.fq').write_text('@r1\nACGT\n+\nIIII\n')
+    result = bioshed_catalog.index_location( dict(location=str(data), catalogdb=catalogdb))
+    assert (result['files'], result['new'], result['changed'], result['removed']) == (3, 1, 0, 1)
+    assert bioshed_catalog.search_catalog( dict(terms='tumor', catalogdb=catalogdb)) == []
+
+
+def test_nested_roots( tmp_path ):
+    data = data_tree( tmp_path )
+    catalogdb = str(tmp_path / 'catalog.db')
+    bioshed_catalog.index_location( dict(location=str(data), catalogdb=catalogdb))
+    result = bioshed_catalog.index_location( dict(location=str(data / 'rnaseq'), catalogdb=catalogdb))
+    assert (result['files'], result['new'], result['changed']) == (2, 0, 0)
+    roots = dict((r['root'], r['files']) for r in bioshed_catalog.list_roots( dict(catalogdb=catalogdb)))
+    assert roots == {str(data): 1, str(data / 'rnaseq'): 2}
+    # re-indexing the enclosing location takes its files back, without duplicates
+    result = bioshed_catalog.index_location( dict(location=str(data), catalogdb=catalogdb))
+    assert (result['files'], result['new'], result['removed']) == (3, 0, 0)
+    assert dict((r['root'], r['files']) for r in bioshed_catalog.list_roots( dict(catalogdb=catalogdb))) == {str(data): 3, str(data / 'rnaseq'): 0}
+    assert len(bioshed_catalog.search_catalog( dict(terms='rnaseq', catalogdb=catalogdb))) == 2
+    bioshed_catalog.remove_root( dict(root=str(data), catalogdb=catalogdb))
+    assert bioshed_catalog.search_catalog( dict(terms='', catalogdb=catalogdb)) == []
@@ -0,0 +1,83 @@
+import os, sys, types, time, multiprocessing
+import pytest
+pytest.importorskip('boto3')
+import bioshed
+import bioshed_daemon
+import bioshed_transfer
+import bioshed_config
+import bioshed_batch
+
+def forwarded_command( argv ):
+    """ Stand-in for bioshed.bioshed_cli_main in the server - reports what the forked child sees.
+    """
+    print('stdin {}'.format(os.fstat(0).st_ino))
+    print('cwd {}'.format(os.getcwd()))
+    print('env {}'.format(os.environ.get('BIOSHED_TEST_CLIENT', '')))
+    print('s3 {}'.format(bioshed_transfer.S3_ENDPOINT_URL))
+    print('api {}'.format(bioshed_config.BIOSHED_SERVERLESS_API))
+    print('batch {}'.format(bioshed_batch.BATCH_ENDPOINT_URL))
+    print('to stderr', file=sys.stderr)
+    if argv[2] == 'exit':
+        sys.exit(3)
+    return -1 if argv[2] == 'fail' else None
+
+
+@pytest.fixture
+def server( tmp_path, monkeypatch ):
+    """ bioshed serve in a forked process (without warming the subsystem modules), with the command stand-in.
+    """
+    socketfile = str(tmp_path / 'bioshed.sock')
+    monkeypatch.setattr(bioshed_daemon, 'warm_state', lambda args: None)
+    monkeypatch.setitem(sys.modules, 'bioshed', types.SimpleNamespace(bioshed_cli_main=forwarded_command, exit_status=bioshed.exit_status))
+    monkeypatch.delenv('BIOSHED_NO_DAEMON', raising=False)
+    for name in ['BIOSHED_S3_ENDPOINT_URL', 'BIOSHED_BATCH_ENDPOINT_URL']:
+        monkeypatch.delenv(name, raising=False)
+    process = multiprocessing.get_context('fork').Process(target=bioshed_daemon.bioshed_serve, args=(dict(socketfile=socketfile),), daemon=True)
+    process.start()
+    for _ in range(100):
+        if bioshed_daemon.server_running( dict(socketfile=socketfile)):
+            break
+        time.sleep(0.05)
+    yield socketfile
+    bioshed_daemon.stop_server( dict(socketfile=socketfile))
+    process.join(10)
+
+
+def forward( socketfile, command ):
+    return bioshed_daemon.forward_command( dict(argv=['bioshed', 'jobs', command], socketfile=socketfile))
+
+
+def test_round_trip( server, tmp_path, monkeypatch, capfd ):
+    capfd.readouterr()
+    workdir = tmp_path / 'work'
+    workdir.mkdir()
+    monkeypatch.chdir(workdir)
+    monkeypatch.setenv('BIOSHED_TEST_CLIENT', 'client-1')
+    assert forward( server, 'ok' ) == 0
+    out, err = capfd.readouterr()     # written by the server's child to this process's stdout/stderr
+    assert 'stdin {}\n'.format(os.fstat(0).st_ino) in out
+    assert 'cwd {}\n'.format(str(workdir)) in out and 'env client-1\n' in out and 's3 \n' in out
+    assert err == 'to stderr\n'
+    assert forward( server, 'fail' ) == 1     # -1 from a command handler
+    assert forward( server, 'exit' ) == 3
+    assert forward( server, 'other' ) == 0
+
+
+def test_client_settings( server, tmp_path, monkeypatch, capfd ):
+    capfd.readouterr()
+    monkeypatch.setenv('BIOSHED_S3_ENDPOINT_URL', 'http://127.0.0.1:9')
+    monkeypatch.setenv('BIOSHED_SERVERLESS_API', 'http://127.0.0.1:10')
+    monkeypatch.setenv('BIOSHED_BATCH_ENDPOINT_URL', 'http://127.0.0.1:11')
+    assert forward( server, 'ok' ) == 0
+    out, _ = capfd.readouterr()
+    assert 's3 http://127.0.0.1:9\n' in out and 'api http://127.0.0.1:10\n' in out and 'batch http://127.0.0.1:11\n' in out
+    for name in ['BIOSHED_S3_ENDPOINT_URL', 'BIOSHED_SERVERLESS_API', 'BIOSHED_BATCH_ENDPOINT_URL']:
+        monkeypatch.delenv(name)
+    assert forward( server, 'ok' ) == 0       # the server's own settings are unchanged
+    out, _ = capfd.readouterr()
+    assert 's3 \n' in out and 'api {}\n'.format(bioshed_config.BIOSHED_SERVERLESS_API) in out and 'batch \n' in out
+
+
+def test_no_server( tmp_path ):
+    assert forward( str(tmp_path / 'missing.sock'), 'ok' ) == None
+    assert bioshed_daemon.forward_command( dict(argv=['bioshed', 'init'], socketfile=str(tmp_path / 'missing.sock'))) == None
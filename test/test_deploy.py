@@ -0,0 +1,103 @@
+import os, json
+import pytest
+import bioshed_deploy_core
+import bioshed_terraform
+
+def model( cidr = '10.0.0.0/16', subnets = True, tags = 'bioshed' ):
+    variables = [dict(kind='variable', name='vpc_cidr_block', block=dict(type='${string}', default=cidr)),
+                 dict(kind='variable', name='name_prefix', block=dict(type='${string}', default='bioshed-managed'))]
+    resources = [dict(type='aws_vpc', name='vpc', block=dict(cidr_block='${var.vpc_cidr_block}', tags={'Name': tags})),
+                 dict(type='aws_internet_gateway', name='igw', block=dict(vpc_id='${aws_vpc.vpc.id}')),
+                 dict(type='aws_iam_role', name='batch_role', block=dict(name='${var.name_prefix}_batch'))]
+    if subnets:
+        resources.append(dict(type='aws_subnet', name='subnet', block=dict(vpc_id='${aws_vpc.vpc.id}', cidr_block='10.0.1.0/24')))
+    return {'variables.tf': variables, 'main.tf': resources}
+
+
+class FakeTerraform:
+    """ Records terraform commands; apply bumps the state serial like terraform does. "external" changes the state
+    outside bioshed deploy (e.g., a terraform apply run by hand).
+    """
+    def __init__( self, initpath, monkeypatch ):
+        self.initpath = initpath
+        self.commands = []
+        monkeypatch.setattr(bioshed_terraform, 'terraform_init', lambda args: 0)
+        monkeypatch.setattr(bioshed_terraform, 'run_terraform', self.run)
+
+    def run( self, args ):
+        self.commands.append(args['command'])
+        if args['command'][0] == 'apply':
+            self.external()
+        return 0
+
+    def external( self ):
+        serial = bioshed_deploy_core.tfstate_serial( dict(initpath=self.initpath)) or 0
+        with open(os.path.join(self.initpath, 'terraform.tfstate'), 'w') as f:
+            json.dump(dict(serial=serial + 1), f)
+
+    def plans( self ):
+        return [c[1:] for c in self.commands if c[0] == 'plan']
+
+
+@pytest.fixture
+def deploy( tmp_path, monkeypatch ):
+    terraform = FakeTerraform( str(tmp_path), monkeypatch )
+    def run( files, deployoption = '' ):
+        terraform.commands.clear()
+        return bioshed_deploy_core.deploy_resources( dict(initpath=str(tmp_path), files=files, deployoption=deployoption))
+    run.terraform = terraform
+    return run
+
+
+def test_first_deploy_plans_everything_then_unchanged_skips_terraform( deploy ):
+    assert deploy( model() ) == 'applied'
+    assert deploy.terraform.plans() == [['-out', 'hs_deploy_core.plan']]
+    assert deploy( model() ) == 'unchanged'
+    assert deploy.terraform.commands == []
+
+
+def test_changed_resource_targets_it_and_its_dependents( deploy ):
+    deploy( model() )
+    assert deploy( model( tags='renamed' )) == 'applied'
+    assert deploy.terraform.plans() == [['-out', 'hs_deploy_core.plan', '-target=aws_internet_gateway.igw', '-target=aws_subnet.subnet',
+                                         '-target=aws_vpc.vpc', '-refresh=false']]
+
+
+def test_changed_variable_targets_resources_using_it( deploy ):
+    deploy( model() )
+    assert deploy( model( cidr='10.1.0.0/16' )) == 'applied'
+    # var.vpc_cidr_block -> aws_vpc.vpc -> everything referencing the VPC; the IAM role is left alone
+    assert deploy.terraform.plans() == [['-out', 'hs_deploy_core.plan', '-target=aws_internet_gateway.igw', '-target=aws_subnet.subnet',
+                                         '-target=aws_vpc.vpc', '-refresh=false']]
+
+
+def test_state_changed_outside_deploy_refreshes( deploy ):
+    deploy( model() )
+    deploy.terraform.external()
+    deploy( model( tags='renamed' ))
+    assert '-refresh=false' not in deploy.terraform.plans()[0] and '-target=aws_vpc.vpc' in deploy.terraform.plans()[0]
+
+
+def test_removed_block_or_other_tf_change_plans_everything( deploy, tmp_path ):
+    deploy( model() )
+    assert deploy( model( subnets=False )) == 'applied'
+    assert deploy.terraform.plans() == [['-out', 'hs_deploy_core.plan']]
+    (tmp_path / 'provider.tf').write_text('provider "aws" {}\n')
+    assert deploy( model( subnets=False )) == 'applied'
+    assert deploy.terraform.plans() == [['-out', 'hs_deploy_core.plan']]
+    assert deploy( model( subnets=False ), deployoption='full' ) == 'applied'
+    assert deploy.terraform.plans() == [['-out', 'hs_deploy_core.plan']]
+
+
+def test_dryrun_plans_without_recording( deploy ):
+    deploy( model() )
+    assert deploy( model( tags='renamed' ), deployoption='dryrun' ) == 'planned'
+    assert [c[0] for c in deploy.terraform.commands] == ['plan']
+    assert deploy( model( tags='renamed' )) == 'applied'
+
+
+def test_dependent_resources():
+    texts = dict((bioshed_deploy_core.bioshed_core_utils.resource_address( block ), bioshed_deploy_core.bioshed_core_utils.render_resource_block( block ))
+                 for blocks in model().values() for block in blocks)
+    assert bioshed_deploy_core.dependent_resources( dict(changed=['var.name_prefix'], texts=texts)) == ['aws_iam_role.batch_role']
+    assert bioshed_deploy_core.dependent_resources( dict(changed=['aws_subnet.subnet'], texts=texts)) == ['aws_subnet.subnet']
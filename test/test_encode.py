@@ -0,0 +1,70 @@
+import pytest
+pd = pytest.importorskip('pandas')
+pytest.importorskip('requests')
+import bioshed_encode
+import bioshed_httpcache
+
+EXPERIMENTS = {'/experiments/ENCSR000AAA/': [('ENCFF001AAA', 'fastq', 100), ('ENCFF002AAA', 'bam', 500)],
+               '/experiments/ENCSR000BBB/': [('ENCFF001BBB', 'fastq', 200), ('ENCFF002BBB', 'bigWig', 50)],
+               '/experiments/ENCSR000CCC/': [('ENCFF001CCC', 'fastq', 300)]}
+
+class EncodeStandIn:
+    """ Fake ENCODE server - experiment pages list their files; experiments in "missing" are 404,
+    and each experiment in "flaky" answers 503 once.
+    """
+    def __init__( self, standin, monkeypatch, tmp_path ):
+        self.missing = set()
+        self.flaky = set()
+        self.server = standin({('GET', '*'): self.experiment})
+        monkeypatch.setattr(bioshed_encode, 'ENCODE_URL', self.server.url)
+        monkeypatch.setattr(bioshed_httpcache, 'HTTP_CACHE_DIR', str(tmp_path / 'httpcache'))
+        monkeypatch.setattr(bioshed_httpcache, 'HTTP_CACHE_DB', str(tmp_path / 'httpcache.db'))
+
+    def experiment( self, request ):
+        if request['path'] in self.missing or request['path'] not in EXPERIMENTS:
+            return 404, {}, {'status': 'error'}
+        if request['path'] in self.flaky:
+            self.flaky.discard(request['path'])
+            return 503, {}, b''
+        return 200, {'Content-Type': 'application/json'}, {'accession': request['path'].split('/')[2], 'files': [
+            dict(accession=acc, file_format=fmt, file_size=size, s3_uri='s3://encode-public/{}/{}.{}'.format(request['path'].split('/')[2], acc, fmt))
+            for acc, fmt, size in EXPERIMENTS[request['path']]] + [dict(accession='ENCFF999XXX', file_format='bed')]}     # no s3_uri: skipped
+
+    def gets( self ):
+        return sorted(r['path'] for r in self.server.requests)
+
+
+def search_results( tmp_path ):
+    df = pd.DataFrame([dict(experiment=e, assay='TF ChIP-seq' if 'CCC' not in e else 'total RNA-seq', celltype='K562', species='Homo sapiens',
+                            accession=[e.split('/')[2]], file=['/files/{}/'.format(f[0]) for f in files]) for e, files in EXPERIMENTS.items()])
+    return bioshed_encode.open_results( dict(resultsdb=bioshed_encode.save_results( dict(results=df, resultsdb=str(tmp_path / 'search_encode.db')))))
+
+
+def test_resolve_and_select( tmp_path, standin, monkeypatch ):
+    encode = EncodeStandIn( standin, monkeypatch, tmp_path )
+    encode.flaky.add('/experiments/ENCSR000BBB/')
+    conn = search_results( tmp_path )
+    experiments = bioshed_encode.select_experiments( dict(conn=conn, filters=dict(assay='chip-seq')))
+    assert experiments == ['/experiments/ENCSR000AAA/', '/experiments/ENCSR000BBB/']
+    assert bioshed_encode.resolve_experiments( dict(conn=conn, experiments=experiments, concurrency=4)) == []
+    assert encode.gets() == ['/experiments/ENCSR000AAA/', '/experiments/ENCSR000BBB/', '/experiments/ENCSR000BBB/']     # 503 retried
+    files = bioshed_encode.select_files( dict(conn=conn, experiments=experiments, filetypes=['fastq', 'bigwig']))
+    assert [(f['file'], f['file_size']) for f in files] == [('s3://encode-public/ENCSR000AAA/ENCFF001AAA.fastq', 100),
+        ('s3://encode-public/ENCSR000BBB/ENCFF001BBB.fastq', 200), ('s3://encode-public/ENCSR000BBB/ENCFF002BBB.bigWig', 50)]
+    assert files[0]['info'] == '/experiments/ENCSR000AAA/; TF ChIP-seq; K562; Homo sapiens'
+    conn.close()
+
+
+def test_resolution_resumes( tmp_path, standin, monkeypatch ):
+    encode = EncodeStandIn( standin, monkeypatch, tmp_path )
+    encode.missing.add('/experiments/ENCSR000CCC/')
+    conn = search_results( tmp_path )
+    experiments = bioshed_encode.select_experiments( dict(conn=conn, filters={}))
+    assert bioshed_encode.resolve_experiments( dict(conn=conn, experiments=experiments)) == ['/experiments/ENCSR000CCC/']
+    encode.missing.clear()
+    encode.server.requests.clear()
+    # only the experiment that failed is requested again
+    assert bioshed_encode.resolve_experiments( dict(conn=conn, experiments=experiments)) == []
+    assert encode.gets() == ['/experiments/ENCSR000CCC/']
+    assert len(bioshed_encode.select_files( dict(conn=conn, experiments=experiments))) == 5
+    conn.close()
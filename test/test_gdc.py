@@ -0,0 +1,87 @@
+import os, hashlib
+import pytest
+pytest.importorskip('requests')
+import bioshed_gdc
+from conftest import FASTQ_DIR
+
+FIXTURES = ['rnaseq_mouse_test_tiny1_R1.fastq.gz', 'rnaseq_mouse_test_tiny1_R2.fastq.gz']
+
+class GDCStandIn:
+    """ Local stand-in for the GDC data endpoint (GET /data/<id>, with Range support) serving the test/fastq files.
+
+    fail_ranges: set of (file id, range start) answered with 500
+    """
+    def __init__( self, standin, monkeypatch ):
+        self.files = {}
+        for i, name in enumerate(FIXTURES):
+            with open(os.path.join(FASTQ_DIR, name), 'rb') as f:
+                self.files['file-{}'.format(i)] = dict(filename=name, data=f.read())
+        self.fail_ranges = set()
+        self.server = standin({('GET', '*'): self.data})
+        monkeypatch.setattr(bioshed_gdc, 'GDC_URL', self.server.url)
+        monkeypatch.setattr(bioshed_gdc, 'GDC_RETRIES', 0)
+
+    def data( self, request ):
+        data = self.files[request['path'].split('/')[-1]]['data']
+        if 'Range' not in request['headers']:
+            return 200, {}, data
+        start, end = [int(x) for x in request['headers']['Range'].split('=')[1].split('-')]
+        if (request['path'].split('/')[-1], start) in self.fail_ranges:
+            return 500, {}, b''
+        return 206, {'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(data))}, data[start:end+1]
+
+    def manifest( self, path ):
+        with open(path, 'w') as f:
+            f.write('id\tfilename\tmd5\tsize\tstate\n')
+            for file_id, entry in sorted(self.files.items()):
+                f.write('{}\t{}\t{}\t{}\treleased\n'.format(file_id, entry['filename'], hashlib.md5(entry['data']).hexdigest(), len(entry['data'])))
+        return path
+
+    def ranged_gets( self, file_id ):
+        return [r for r in self.server.requests if r['path'].endswith(file_id) and 'Range' in r['headers']]
+
+
+def download( gdc, tmp_path ):
+    return bioshed_gdc.download_manifest( dict(manifest=gdc.manifest( str(tmp_path / 'manifest.txt')), outdir=str(tmp_path / 'gdc'), part_size=1))
+
+
+def test_ranged_download( tmp_path, standin, monkeypatch ):
+    gdc = GDCStandIn( standin, monkeypatch )
+    result = download( gdc, tmp_path )
+    assert result['downloaded'] == 2 and result['failed'] == []
+    for entry in gdc.files.values():
+        with open(str(tmp_path / 'gdc' / entry['filename']), 'rb') as f:
+            assert f.read() == entry['data']
+    assert len(gdc.ranged_gets('file-0')) == 4      # 4.1 MB in 1 MB parts
+    assert not os.path.exists(str(tmp_path / 'gdc' / (FIXTURES[0] + '.part')))
+
+
+def test_resume_fetches_only_missing_parts( tmp_path, standin, monkeypatch ):
+    gdc = GDCStandIn( standin, monkeypatch )
+    gdc.fail_ranges.add(('file-1', 2 * 1024**2))
+    result = download( gdc, tmp_path )
+    assert result['downloaded'] == 1 and [f['id'] for f in result['failed']] == ['file-1']
+    gdc.fail_ranges.clear()
+    gdc.server.requests.clear()
+    result = download( gdc, tmp_path )
+    assert result['skipped'] == 1 and result['downloaded'] == 1 and result['failed'] == []
+    assert [r['headers']['Range'] for r in gdc.ranged_gets('file-1')] == ['bytes={}-{}'.format(2 * 1024**2, 3 * 1024**2 - 1)]
+    assert gdc.ranged_gets('file-0') == []
+    with open(str(tmp_path / 'gdc' / FIXTURES[1]), 'rb') as f:
+        assert f.read() == gdc.files['file-1']['data']
+
+
+def test_corrupt_file_is_fetched_again( tmp_path, standin, monkeypatch ):
+    gdc = GDCStandIn( standin, monkeypatch )
+    download( gdc, tmp_path )
+    path = str(tmp_path / 'gdc' / FIXTURES[0])
+    with open(path, 'r+b') as f:
+        f.seek(1000)
+        f.write(b'corrupt')
+    os.utime(path, (1, 1))
+    gdc.server.requests.clear()
+    result = download( gdc, tmp_path )
+    assert result['skipped'] == 1 and result['downloaded'] == 1
+    assert gdc.ranged_gets('file-1') == []
+    with open(path, 'rb') as f:
+        assert f.read() == gdc.files['file-0']['data']
@@ -0,0 +1,126 @@
+import sys, types
+import pytest
+pytest.importorskip('requests')
+import bioshed_httpcache
+
+class SearchStandIn:
+    """ Local stand-in for a search API - GET /search answers with an ETag, GET /report with a Last-Modified date,
+    and both answer 304 when the client's validator still matches. Bodies are "<path> <version>".
+    """
+    def __init__( self, standin, monkeypatch, tmp_path ):
+        self.version = 1
+        self.server = standin({('GET', '/search'): self.search, ('GET', '/report'): self.report,
+                               ('GET', '/plain'): self.plain, ('POST', '/files'): self.files})
+        monkeypatch.setattr(bioshed_httpcache, 'HTTP_CACHE_DIR', str(tmp_path / 'httpcache'))
+        monkeypatch.setattr(bioshed_httpcache, 'HTTP_CACHE_DB', str(tmp_path / 'httpcache.db'))
+
+    def body( self, request ):
+        return '{} {}'.format(request['path'], self.version).encode()
+
+    def search( self, request ):
+        etag = '"v{}"'.format(self.version)
+        if request['headers'].get('If-None-Match', '') == etag:
+            return 304, {'ETag': etag}, b''
+        return 200, {'ETag': etag, 'Content-Type': 'text/plain'}, self.body( request )
+
+    def report( self, request ):
+        modified = 'Mon, 0{} Jan 2024 00:00:00 GMT'.format(self.version)
+        if request['headers'].get('If-Modified-Since', '') == modified:
+            return 304, {}, b''
+        return 200, {'Last-Modified': modified}, self.body( request )
+
+    def plain( self, request ):
+        return 200, {}, self.body( request )
+
+    def files( self, request ):
+        return 200, {'Content-Type': 'application/json'}, dict(query=request['json'], version=self.version)
+
+    def get( self, path, **kwargs ):
+        return bioshed_httpcache.cached_request( dict(kwargs, url=self.server.url + path))
+
+
+def test_key_normalization():
+    key = bioshed_httpcache.request_key
+    assert bioshed_httpcache.normalize_url('HTTPS://Example.ORG/search?type=Experiment&searchTerm=x#top') == \
+           'https://example.org/search?searchTerm=x&type=Experiment'
+    assert key( dict(url='https://example.org/search?type=Experiment&searchTerm=x')) == \
+           key( dict(url='https://EXAMPLE.org/search?searchTerm=x&type=Experiment'))
+    assert key( dict(url='https://example.org/search?searchTerm=x')) != key( dict(url='https://example.org/search?searchTerm=y'))
+    assert key( dict(url='https://example.org/files', method='POST', body={'size': 10, 'from': 0})) == \
+           key( dict(url='https://example.org/files', method='post', body={'from': 0, 'size': 10}))
+    assert key( dict(url='https://example.org/files', method='POST', body={'size': 10})) != \
+           key( dict(url='https://example.org/files', method='POST', body={'size': 20}))
+    assert key( dict(url='https://example.org/search')) != key( dict(url='https://example.org/search', accept='application/json'))
+
+
+def test_ttl_and_revalidation( tmp_path, standin, monkeypatch ):
+    api = SearchStandIn( standin, monkeypatch, tmp_path )
+    first = api.get('/search?b=2&a=1')
+    assert first.from_cache == '' and first.content == b'/search 1'
+    fresh = api.get('/search?a=1&b=2')         # same key - answered within the TTL without a request
+    assert fresh.from_cache == 'fresh' and fresh.content == b'/search 1' and fresh.headers['ETag'] == '"v1"'
+    assert len(api.server.requests) == 1
+
+    monkeypatch.setattr(bioshed_httpcache, 'HTTP_CACHE_TTL', 0)
+    revalidated = api.get('/search?a=1&b=2')   # expired - If-None-Match, 304 reuses the stored body
+    assert revalidated.from_cache == 'revalidated' and revalidated.content == b'/search 1'
+    assert api.server.requests[-1]['headers']['If-None-Match'] == '"v1"'
+    api.version = 2
+    changed = api.get('/search?a=1&b=2')       # validator no longer matches - new body is stored
+    assert changed.from_cache == '' and changed.content == b'/search 2'
+    assert api.get('/search?a=1&b=2').content == b'/search 2'
+
+    assert api.get('/report').from_cache == ''
+    report = api.get('/report')                # If-Modified-Since
+    assert report.from_cache == 'revalidated' and report.content == b'/report 2'
+    assert api.server.requests[-1]['headers']['If-Modified-Since'] == 'Mon, 02 Jan 2024 00:00:00 GMT'
+    assert api.get('/plain').from_cache == ''
+    assert api.get('/plain').from_cache == ''  # no validators - refetched once expired
+    assert 'If-None-Match' not in api.server.requests[-1]['headers']
+
+    monkeypatch.setattr(bioshed_httpcache, 'HTTP_CACHE_TTL', 3600)
+    assert api.get('/plain').from_cache == 'fresh'
+    assert api.get('/plain', refresh=True).from_cache == ''
+    assert api.get('/plain', ttl=0).from_cache == ''
+    stats = bioshed_httpcache.cache_stats({})
+    assert (stats['responses'], stats['fresh'], stats['revalidated']) == (3, 2, 3)
+
+
+def test_lru_size_limit( tmp_path, standin, monkeypatch ):
+    api = SearchStandIn( standin, monkeypatch, tmp_path )
+    monkeypatch.setattr(bioshed_httpcache, 'HTTP_CACHE_MAX_BYTES', 20)     # bodies are 9-10 bytes - room for two
+    api.get('/search')
+    api.get('/report')
+    assert api.get('/search').from_cache == 'fresh'     # /search is now the most recently used
+    api.get('/plain')                                   # evicts /report
+    assert bioshed_httpcache.cache_stats({})['responses'] == 2
+    assert api.get('/search').from_cache == 'fresh'
+    assert api.get('/plain').from_cache == 'fresh'
+    requests_before = len(api.server.requests)
+    assert api.get('/report').from_cache == ''
+    assert len(api.server.requests) == requests_before + 1 and 'If-Modified-Since' not in api.server.requests[-1]['headers']
+    bioshed_httpcache.clear_cache({})
+    assert bioshed_httpcache.cache_stats({})['responses'] == 0 and not (tmp_path / 'httpcache').exists()
+
+
+def test_install_routes_quick_utils( tmp_path, standin, monkeypatch, capsys ):
+    api = SearchStandIn( standin, monkeypatch, tmp_path )
+    quick_utils = types.ModuleType('quick_utils')
+    monkeypatch.setitem(sys.modules, 'quick_utils', quick_utils)
+    monkeypatch.setitem(bioshed_httpcache._options, 'installed', False)
+    monkeypatch.setitem(bioshed_httpcache._options, 'refresh', False)
+    bioshed_httpcache.install({})
+    assert quick_utils.get_request( dict(url=api.server.url + '/search')).content == b'/search 1'
+    assert quick_utils.post_request( dict(url=api.server.url + '/files', body={'size': 10})) == dict(query={'size': 10}, version=1)
+    api.version = 2
+    assert quick_utils.get_request( dict(url=api.server.url + '/search')).content == b'/search 1'
+    assert quick_utils.post_request( dict(url=api.server.url + '/files', body={'size': 10})) == dict(query={'size': 10}, version=1)
+    assert len(api.server.requests) == 2
+    bioshed_httpcache.print_report()
+    assert 'HTTP cache: 2 hit(s) (2 fresh, 0 revalidated), 2 miss(es)' in capsys.readouterr().out
+
+    bioshed_httpcache.install( dict(refresh=True))      # next command, --refresh - patched once, report restarted
+    assert quick_utils.post_request( dict(url=api.server.url + '/files', body={'size': 10})) == dict(query={'size': 10}, version=2)
+    assert quick_utils.get_request( dict(url=api.server.url + '/search')).content == b'/search 2'
+    bioshed_httpcache.print_report()
+    assert 'HTTP cache: 0 hit(s) (0 fresh, 0 revalidated), 2 miss(es)' in capsys.readouterr().out
@@ -0,0 +1,62 @@
+import os
+import bioshed_local
+
+FAKE_DOCKER = """#!/bin/sh
+# stand-in for docker: "docker run ... <image> <args>" exits with the status named by the last argument (exit:N)
+[ "$1" = "run" ] || exit 0
+for a in "$@"; do last="$a"; done
+sleep 0.3
+case "$last" in exit:*) exit "${last#exit:}";; esac
+exit 0
+"""
+
+def fake_docker( tmp_path, monkeypatch ):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    (bindir / 'docker').write_text(FAKE_DOCKER)
+    os.chmod(str(bindir / 'docker'), 0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bindir, os.environ.get('PATH', '')))
+
+
+def task( name, status = 0, depends_on = [], dockerargs = '' ):
+    return dict(name=name, module='fastqc', args=['fastqc', 'exit:{}'.format(status)], depends_on=depends_on, dockerargs=dockerargs)
+
+
+def test_tasks_packed_by_capacity( tmp_path, monkeypatch ):
+    fake_docker( tmp_path, monkeypatch )
+    tasks = [task('s{}'.format(i), dockerargs='-v /data/s{}:/output/:Z'.format(i)) for i in range(6)]
+    results = bioshed_local.run_local_tasks( dict(tasks=tasks, cpus=0.3, mem=100000, logdir=str(tmp_path / 'logs')))
+    assert all(r['status'] == 'SUCCEEDED' for r in results.values())
+    # 0.3 CPUs: each fastqc task is capped to the host and runs on its own
+    spans = sorted((r['start'], r['end']) for r in results.values())
+    assert all(spans[i][1] <= spans[i+1][0] + 0.01 for i in range(len(spans) - 1))
+    with open(results['s3']['log']) as f:
+        assert '-v /data/s3:/output/:Z' in f.readline()
+
+
+def concurrent_at_starts( results ):
+    """ Number of tasks running at each task's start.
+    """
+    spans = [(r['start'], r['end']) for r in results.values()]
+    return [len([1 for s, e in spans if s <= start + 0.01 and start < e - 0.01]) for start, end in spans]
+
+
+def test_tasks_that_fit_run_together( tmp_path, monkeypatch ):
+    fake_docker( tmp_path, monkeypatch )
+    # fastqc tasks need 1 CPU / 1000 MB: 3 fit on 3 CPUs, the other 3 wait for them
+    tasks = [task('s{}'.format(i)) for i in range(6)]
+    results = bioshed_local.run_local_tasks( dict(tasks=tasks, cpus=3, mem=100000, logdir=str(tmp_path / 'logs')))
+    assert all(r['status'] == 'SUCCEEDED' for r in results.values())
+    assert max(concurrent_at_starts( results )) == 3
+    # memory is packed too: 2500 MB fits two at a time
+    results = bioshed_local.run_local_tasks( dict(tasks=[task('m{}'.format(i)) for i in range(4)], cpus=8, mem=2500, logdir=str(tmp_path / 'logs')))
+    assert max(concurrent_at_starts( results )) == 2
+
+
+def test_failed_task_skips_downstream_tasks( tmp_path, monkeypatch ):
+    fake_docker( tmp_path, monkeypatch )
+    tasks = [task('merge', depends_on=['align']), task('align', depends_on=['qc']), task('qc', status=3), task('other')]
+    results = bioshed_local.run_local_tasks( dict(tasks=tasks, cpus=4, mem=100000, logdir=str(tmp_path / 'logs')))
+    assert results['qc']['status'] == 'FAILED' and results['qc']['returncode'] == 3
+    assert results['align']['status'] == 'SKIPPED' and results['merge']['status'] == 'SKIPPED'
+    assert results['other']['status'] == 'SUCCEEDED'
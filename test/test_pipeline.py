@@ -0,0 +1,36 @@
+import pytest
+import bioshed_pipeline
+import bioshed_local
+
+def steps( deps ):
+    return dict((step, dict(depends_on=d)) for step, d in deps.items())
+
+
+def test_topological_order():
+    order = bioshed_pipeline.topological_order( dict(steps=steps({'featurecounts': ['star'], 'star': [], 'fastqc': [], 'multiqc': ['fastqc', 'featurecounts']})))
+    assert order == ['fastqc', 'star', 'featurecounts', 'multiqc']
+
+
+def test_topological_order_rejects_cycles_and_unknown_steps():
+    with pytest.raises(ValueError, match='cycle'):
+        bioshed_pipeline.topological_order( dict(steps=steps({'a': ['c'], 'b': ['a'], 'c': ['b']})))
+    with pytest.raises(ValueError, match='unknown step'):
+        bioshed_pipeline.topological_order( dict(steps=steps({'a': ['missing']})))
+
+
+def test_load_pipeline( tmp_path ):
+    pipelinefile = tmp_path / 'rnaseq.yaml'
+    pipelinefile.write_text('steps:\n'
+                            '  star:\n    module: STAR\n    args: --genomeDir s3://b/ref/ out::s3://b/align/\n'
+                            '  counts:\n    module: featurecounts\n    args: [-a, s3://b/genes.gtf]\n    depends_on: star\n')
+    pipeline = bioshed_pipeline.load_pipeline( dict(pipelinefile=str(pipelinefile)))
+    assert pipeline['name'] == 'rnaseq'
+    assert pipeline['order'] == ['star', 'counts']
+    assert pipeline['steps']['star']['module'] == 'star'
+    assert pipeline['steps']['counts']['depends_on'] == ['star']
+    assert bioshed_pipeline.step_args( pipeline['steps']['counts'] ) == ['featurecounts', '-a', 's3://b/genes.gtf']
+
+
+def test_module_args():
+    assert bioshed_local.module_args( ['fastqc', 'a.fastq.gz'] ) == ['fastqc', '-o', '/output/', 'a.fastq.gz']
+    assert bioshed_local.module_args( ['star', '--genomeDir', 'ref/'] ) == ['star', '--genomeDir', 'ref/']
@@ -0,0 +1,111 @@
+import os, time, json, hashlib, multiprocessing
+import pytest
+import bioshed_refcache
+
+class FakeS3:
+    """ S3 client stand-in serving files of a local directory (bucket "refs") - downloads take "delay" seconds.
+    """
+    def __init__( self, root, delay = 0 ):
+        self.root = root
+        self.delay = delay
+
+    def head_object( self, Bucket, Key ):
+        with open(os.path.join(self.root, Key), 'rb') as f:
+            data = f.read()
+        return {'ETag': '"{}"'.format(hashlib.md5(data).hexdigest()), 'ContentLength': len(data)}
+
+    def download_file( self, bucket, key, dest ):
+        time.sleep(self.delay)
+        with open(os.path.join(self.root, key), 'rb') as f, open(dest, 'wb') as out:
+            out.write(f.read())
+
+
+@pytest.fixture
+def refs( tmp_path, monkeypatch ):
+    monkeypatch.setattr(bioshed_refcache, '_held_locks', [])
+    root = tmp_path / 'refs'
+    root.mkdir()
+    for name in ['genome.fa', 'genes.gtf', 'star.idx']:
+        (root / name).write_text(name * 10)
+    (tmp_path / 'cache' / 'objects').mkdir(parents=True)
+    yield dict(root=str(root), cachedir=str(tmp_path / 'cache'), log=str(tmp_path / 'log.jsonl'))
+    for lockfile in bioshed_refcache._held_locks:
+        lockfile.close()
+
+
+def job( refs, keys, delay, runtime ):
+    """ A Batch job on the host: stages keys from the cache, runs for "runtime" seconds, exits (releasing its pins).
+    """
+    client = FakeS3( refs['root'], delay )
+    for key in keys:
+        start = time.time()
+        obj = bioshed_refcache.fetch_object( dict(bucket='refs', key=key, cachedir=refs['cachedir'], client=client))
+        with open(refs['log'], 'a') as f:
+            f.write(json.dumps(dict(pid=os.getpid(), key=key, hit=obj['hit'], waited=time.time() - start, at=time.time())) + '\n')
+    time.sleep(runtime)
+    os._exit(0)
+
+
+def start_job( refs, keys, delay = 0, runtime = 0 ):
+    process = multiprocessing.get_context('fork').Process(target=job, args=(refs, keys, delay, runtime), daemon=True)
+    process.start()
+    return process
+
+
+def read_log( refs ):
+    with open(refs['log']) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_running_job_does_not_block_cache_hits( refs ):
+    a = start_job( refs, ['star.idx'], runtime=2.5 )
+    deadline = time.time() + 10
+    while not os.path.exists(refs['log']) and time.time() < deadline:
+        time.sleep(0.05)
+    b = start_job( refs, ['star.idx'] )
+    b.join(10)
+    assert b.exitcode == 0 and a.is_alive()      # B got its hit while A still runs
+    a.join(10)
+    log = read_log( refs )
+    assert [(entry['hit'], entry['waited'] < 1) for entry in log] == [(False, True), (True, True)]
+
+
+def test_jobs_staging_in_opposite_order_do_not_deadlock( refs ):
+    a = start_job( refs, ['genome.fa', 'genes.gtf'], delay=0.5, runtime=1 )
+    b = start_job( refs, ['genes.gtf', 'genome.fa'], delay=0.5, runtime=1 )
+    a.join(15)
+    b.join(15)
+    assert a.exitcode == 0 and b.exitcode == 0
+    log = read_log( refs )
+    # one download per object, the other job's lookup is a hit
+    assert sorted((entry['key'], entry['hit']) for entry in log) == [('genes.gtf', False), ('genes.gtf', True), ('genome.fa', False), ('genome.fa', True)]
+
+
+def test_eviction_skips_pinned_objects( refs, monkeypatch ):
+    done = start_job( refs, ['genome.fa', 'genes.gtf'] )     # exited: its objects are no longer in use
+    done.join(10)
+    pinned = bioshed_refcache.fetch_object( dict(bucket='refs', key='star.idx', cachedir=refs['cachedir'], client=FakeS3( refs['root'] )))
+    monkeypatch.setattr(bioshed_refcache, 'REF_CACHE_FULL', 0)
+    assert bioshed_refcache.evict_objects( dict(cachedir=refs['cachedir'])) == 2
+    assert os.path.exists(pinned['path'])
+    # evicted objects are downloaded again
+    obj = bioshed_refcache.fetch_object( dict(bucket='refs', key='genome.fa', cachedir=refs['cachedir'], client=FakeS3( refs['root'] )))
+    assert not obj['hit'] and open(obj['path']).read() == 'genome.fa' * 10
+
+
+def test_eviction_is_least_recently_used_first( refs, monkeypatch ):
+    done = start_job( refs, ['genome.fa', 'genes.gtf', 'star.idx'] )
+    done.join(10)
+    objdirs = {}
+    for prefix in os.listdir(os.path.join(refs['cachedir'], 'objects')):
+        for objid in os.listdir(os.path.join(refs['cachedir'], 'objects', prefix)):
+            objdir = os.path.join(refs['cachedir'], 'objects', prefix, objid)
+            name = [f for f in os.listdir(objdir) if not f.startswith('.')][0]
+            objdirs[name] = objdir
+    for last_used, name in enumerate(['genes.gtf', 'star.idx', 'genome.fa']):
+        os.utime(os.path.join(objdirs[name], '.lock'), (last_used + 1, last_used + 1))
+    # 900 of 1000 bytes allowed, 990 needed: evicting the least recently used object (90 bytes) is enough
+    usage = type('usage', (), dict(total=1000, used=950, free=50))
+    monkeypatch.setattr(bioshed_refcache.shutil, 'disk_usage', lambda path: usage)
+    assert bioshed_refcache.evict_objects( dict(cachedir=refs['cachedir'], needed=40)) == 1
+    assert sorted(name for name in objdirs if os.path.exists(objdirs[name])) == ['genome.fa', 'star.idx']
@@ -0,0 +1,24 @@
+import bioshed_runcache
+
+def test_input_paths_skip_output_locations( tmp_path, monkeypatch ):
+    monkeypatch.setattr(bioshed_runcache, 'RUN_CACHE_DB', str(tmp_path / 'runcache.db'))
+    fastq = tmp_path / 'a.fastq'
+    fastq.write_text('@r\nACGT\n+\nIIII\n')
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    program_args = ['fastqc', str(fastq), str(outdir), '-o', str(outdir), '--outdir={}'.format(outdir), 'out::s3://b/qc/']
+    assert bioshed_runcache.input_paths( dict(program_args=program_args, outdir=str(outdir))) == [str(fastq)]
+    # output files appearing between runs do not change the key
+    key = bioshed_runcache.run_key( dict(image='fastqc@sha256:0', program_args=program_args, outdir=str(outdir)))['key']
+    (outdir / 'a_fastqc.html').write_text('report')
+    assert bioshed_runcache.run_key( dict(image='fastqc@sha256:0', program_args=program_args, outdir=str(outdir)))['key'] == key
+
+
+def test_s3_outputs_written_skips_other_writers( monkeypatch ):
+    objects = [dict(key='qc/old.html', etag='1', modified=50.0),       # there before the run
+               dict(key='qc/a.html', etag='2', modified=105.0),        # written by the run
+               dict(key='qc/b.html', etag='3', modified=106.0),        # overwritten by the run
+               dict(key='qc/late.html', etag='4', modified=300.0)]     # written by a later run
+    monkeypatch.setattr(bioshed_runcache, 'list_s3_objects', lambda args: objects)
+    outputs = bioshed_runcache.s3_outputs_written( dict(outdest='s3://b/qc/', snapshot={'qc/old.html': '1', 'qc/b.html': '0'}, started=100, ended=200))
+    assert [(o['relkey'], o['etag']) for o in outputs] == [('a.html', '2'), ('b.html', '3')]
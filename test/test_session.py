@@ -0,0 +1,83 @@
+import os, sys, json, time, subprocess
+import bioshed_config
+import bioshed_session
+from conftest import SRC_DIR
+
+USERS = ['alice']
+
+def serverless_core( standin, monkeypatch, up = True ):
+    """ Stand-in for the serverless core's "searchusers" route (or an unreachable one).
+    """
+    def searchusers( request ):
+        return 200, {}, {'user_found': 'True' if request['json']['user'] in USERS else 'False'}
+    core = standin({('POST', '/searchusers'): searchusers})
+    url = core.url if up else 'http://127.0.0.1:9'
+    monkeypatch.setattr(bioshed_config, 'BIOSHED_SERVERLESS_API', url)
+    monkeypatch.setenv('BIOSHED_SERVERLESS_API', url)      # for the detached refresh process
+    return core
+
+
+def age_session( sessionfile, seconds ):
+    session = bioshed_session.load_session( dict(sessionfile=sessionfile))
+    session['verified_at'] -= seconds
+    session['expires_at'] -= seconds
+    session['sig'] = bioshed_session.sign_session( dict(session=session, keyfile=bioshed_session.session_keyfile(sessionfile)))
+    with open(sessionfile, 'w') as f:
+        json.dump(session, f)
+
+
+def test_session_cached_after_first_check( tmp_path, standin, monkeypatch ):
+    core = serverless_core( standin, monkeypatch )
+    sessionfile = str(tmp_path / 'session.json')
+    for i in range(5):
+        assert bioshed_session.session_valid( dict(user='alice', sessionfile=sessionfile))
+    assert len(core.requests) == 1
+    assert not bioshed_session.session_valid( dict(user='mallory', sessionfile=sessionfile))
+
+
+def test_tampered_session_is_rejected( tmp_path, standin, monkeypatch ):
+    core = serverless_core( standin, monkeypatch )
+    sessionfile = str(tmp_path / 'session.json')
+    bioshed_session.write_session( dict(user='alice', sessionfile=sessionfile))
+    with open(sessionfile) as f:
+        session = json.load(f)
+    session['user'] = 'mallory'
+    with open(sessionfile, 'w') as f:
+        json.dump(session, f)
+    assert not bioshed_session.session_valid( dict(user='mallory', sessionfile=sessionfile))
+    assert len(core.requests) == 1
+
+
+def test_stale_session_refreshes_in_background( tmp_path, standin, monkeypatch ):
+    core = serverless_core( standin, monkeypatch )
+    sessionfile = str(tmp_path / 'session.json')
+    bioshed_session.write_session( dict(user='alice', sessionfile=sessionfile))
+    age_session( sessionfile, bioshed_session.SESSION_REFRESH_AFTER + 60 )
+    verified_at = bioshed_session.load_session( dict(sessionfile=sessionfile))['verified_at']
+    assert bioshed_session.session_valid( dict(user='alice', sessionfile=sessionfile))
+    deadline = time.time() + 20
+    while bioshed_session.load_session( dict(sessionfile=sessionfile)).get('verified_at', 0) == verified_at and time.time() < deadline:
+        time.sleep(0.1)
+    assert bioshed_session.load_session( dict(sessionfile=sessionfile))['verified_at'] > verified_at
+    assert len(core.requests) == 1
+    assert not os.path.exists(sessionfile + '.refresh')
+
+
+def test_offline_grace( tmp_path, standin, monkeypatch ):
+    serverless_core( standin, monkeypatch, up=False )
+    sessionfile = str(tmp_path / 'session.json')
+    assert not bioshed_session.session_valid( dict(user='alice', sessionfile=sessionfile))
+    bioshed_session.write_session( dict(user='alice', sessionfile=sessionfile))
+    age_session( sessionfile, bioshed_session.SESSION_TTL + 60 )
+    assert bioshed_session.session_valid( dict(user='alice', sessionfile=sessionfile))
+    age_session( sessionfile, bioshed_session.SESSION_OFFLINE_GRACE )
+    assert not bioshed_session.session_valid( dict(user='alice', sessionfile=sessionfile))
+
+
+def test_cached_session_does_not_import_requests( tmp_path, standin, monkeypatch ):
+    serverless_core( standin, monkeypatch )
+    sessionfile = str(tmp_path / 'session.json')
+    bioshed_session.write_session( dict(user='alice', sessionfile=sessionfile))
+    code = ('import sys; sys.path.insert(0, {!r}); import bioshed_session; '
+            'print(bioshed_session.session_valid( dict(user="alice", sessionfile={!r})), "requests" in sys.modules)').format(SRC_DIR, sessionfile)
+    assert subprocess.check_output([sys.executable, '-c', code]).decode().split() == ['True', 'False']
@@ -0,0 +1,42 @@
+import os, gzip
+import pytest
+import bioshed_shard
+from conftest import FASTQ_DIR
+
+R1 = os.path.join(FASTQ_DIR, 'rnaseq_mouse_test_tiny1_R1.fastq.gz')
+R2 = os.path.join(FASTQ_DIR, 'rnaseq_mouse_test_tiny1_R2.fastq.gz')
+
+def read_fastq( path ):
+    with gzip.open(path, 'rb') as f:
+        return f.read()
+
+
+def test_split_round_trip( tmp_path ):
+    split = bioshed_shard.split_fastqs( dict(paths=[R1, R2], shards=3, dest=str(tmp_path)))
+    assert [s['name'] for s in split['shards']] == ['shard_0001', 'shard_0002', 'shard_0003']
+    assert [s['records'] for s in split['shards']] == [43309, 43114, 43446] and split['records'] == 129869
+    for index, path in enumerate([R1, R2]):
+        # concatenating the shards in order gives back the input, byte for byte
+        assert b''.join(read_fastq( s['files'][index] ) for s in split['shards']) == read_fastq( path )
+    for shard in split['shards']:
+        r1, r2 = [read_fastq( f ).split(b'\n') for f in shard['files']]
+        assert len(r1) == len(r2) == 4 * shard['records'] + 1
+        assert bioshed_shard.read_id( r1[0].decode() ) == bioshed_shard.read_id( r2[0].decode() )
+        assert bioshed_shard.read_id( r1[-5].decode() ) == bioshed_shard.read_id( r2[-5].decode() )
+
+
+def test_split_rejects_unpaired_inputs( tmp_path ):
+    truncated = str(tmp_path / 'truncated_R2.fastq')
+    with open(truncated, 'wb') as f:
+        f.write(b'\n'.join(read_fastq( R2 ).split(b'\n')[:-9]) + b'\n')
+    with pytest.raises(ValueError, match='not paired'):
+        bioshed_shard.split_fastqs( dict(paths=[R1, truncated], shards=2, dest=str(tmp_path / 'shards')))
+
+
+def test_merge_args():
+    outdir = 's3://b/run/'
+    assert bioshed_shard.merge_args( dict(module='fastqc', program_args=['fastqc', 'a.fq.gz'], outdir=outdir, shards=2)) == \
+        ['multiqc', 's3://b/run/shards/', 'out::s3://b/run/']
+    assert bioshed_shard.merge_args( dict(module='star', program_args=['--outSAMtype', 'BAM', 'SortedByCoordinate'], outdir=outdir, shards=2)) == \
+        ['samtools', 'merge', '-f', '-c', '-p', 'Aligned.sortedByCoord.out.bam', 's3://b/run/shards/shard_0001/Aligned.sortedByCoord.out.bam',
+         's3://b/run/shards/shard_0002/Aligned.sortedByCoord.out.bam', 'out::s3://b/run/']
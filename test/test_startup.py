@@ -0,0 +1,48 @@
+import os, re, sys, subprocess, importlib.util
+import pytest
+import bioshed_benchmark
+from conftest import SRC_DIR
+
+HEAVY_MODULES = ['boto3', 'botocore', 'requests', 'yaml', 'docker']
+SUBMODULE_DIRS = ['bioshed_utils', 'bioshed_atlas']
+
+def submodules_checked_out():
+    return all(os.path.isdir(os.path.join(SRC_DIR, d)) and os.listdir(os.path.join(SRC_DIR, d)) != [] for d in SUBMODULE_DIRS)
+
+
+def missing_submodule( error ):
+    """ Whether a command failed only because the bioshed_utils / bioshed_atlas submodules are not checked out.
+    """
+    missing = re.match(r"ModuleNotFoundError: No module named '([\w.]+)'", error)
+    return missing != None and not submodules_checked_out() and importlib.util.find_spec(missing.group(1)) == None
+
+
+def test_startup_within_budget():
+    results = bioshed_benchmark.startup_benchmark( dict(budget=bioshed_benchmark.STARTUP_BUDGET))
+    assert len(results) == len(bioshed_benchmark.BENCHMARK_COMMANDS)
+    measured = [r for r in results if not missing_submodule( r['error'] )]
+    assert [(r['command'], r['error']) for r in measured if r['error'] != ''] == []
+    assert [r['command'] for r in measured if r['over_budget']] == []
+    if len(measured) < len(results):
+        pytest.skip('submodules not checked out - not measured: {}'.format(', '.join(r['command'] for r in results if r not in measured)))
+
+
+def test_benchmark_home_pins_supported_os( tmp_path, monkeypatch ):
+    import bioshed_core_utils
+    bioshed_benchmark.setup_benchmark_home( dict(homedir=str(tmp_path)))
+    monkeypatch.setattr(bioshed_core_utils, '_DETECTED_OS', '')
+    assert bioshed_core_utils.detect_os_cached( dict(initpath=str(tmp_path / '.bioshedinit'))) == bioshed_benchmark.BENCHMARK_OS
+
+
+def test_benchmark_reports_failed_commands( tmp_path, monkeypatch ):
+    (tmp_path / 'bioshed.py').write_text('def bioshed_cli_main( argv ):\n    raise RuntimeError("dispatch failed: " + argv[1])\n')
+    monkeypatch.setattr(bioshed_benchmark, 'SCRIPT_DIR', str(tmp_path))
+    results = bioshed_benchmark.startup_benchmark( dict(commands=[['init', '--help']], budget=60))
+    assert results[0]['error'] == 'RuntimeError: dispatch failed: init' and results[0]['returncode'] == 1
+    assert results[0]['over_budget']
+
+
+def test_import_does_not_load_heavy_modules():
+    code = 'import sys; sys.path.insert(0, {!r}); import bioshed; print(" ".join(sorted(sys.modules)))'.format(SRC_DIR)
+    modules = subprocess.check_output([sys.executable, '-c', code]).decode().split()
+    assert [m for m in HEAVY_MODULES if m in modules] == []
@@ -0,0 +1,44 @@
+import os
+import bioshed_vocab
+
+ASSAYS = [('TF ChIP-seq', 120, '?type=Experiment&assay_title=TF%20ChIP-seq'),
+          ('Histone ChIP-seq', 300, '?type=Experiment&assay_title=Histone%20ChIP-seq'),
+          ('total RNA-seq', 80, '?type=Experiment&assay_title=total%20RNA-seq')]
+TARGETS = [('H3K4me3', 40, '?type=Experiment&target.label=H3K4me3'), ('H3K4me1', 10, '?type=Experiment&target.label=H3K4me1')]
+
+def vocab_index( tmp_path, monkeypatch ):
+    vocabdir = tmp_path / 'files'
+    vocabdir.mkdir()
+    for category, rows in [('assay', ASSAYS), ('target', TARGETS)]:
+        (vocabdir / 'search_encode_{}.txt'.format(category)).write_text(
+            'ID\tnumber_of_datasets\tlink\n' + ''.join('{}\t{}\t{}\n'.format(*row) for row in rows))
+    monkeypatch.setattr(bioshed_vocab, 'VOCAB_DIR', str(vocabdir))
+    monkeypatch.setattr(bioshed_vocab, 'VOCAB_INDEX', str(tmp_path / 'search_encode_vocab.idx'))
+    monkeypatch.setattr(bioshed_vocab, 'USER_VOCAB_INDEX', str(tmp_path / 'user' / 'search_encode_vocab.idx'))
+    monkeypatch.setattr(bioshed_vocab, '_index', {})
+    return bioshed_vocab.compile_vocab({})
+
+
+def test_compile_and_lookup( tmp_path, monkeypatch ):
+    assert vocab_index( tmp_path, monkeypatch ) == str(tmp_path / 'search_encode_vocab.idx')
+    assert [m['ID'] for m in bioshed_vocab.lookup( dict(category='assay', term='tf chip-SEQ'))] == ['TF ChIP-seq']
+    # trailing words match every assay ending with them, most datasets first
+    assert [m['ID'] for m in bioshed_vocab.resolve_term( dict(category='assay', term='chipseq'))] == ['Histone ChIP-seq', 'TF ChIP-seq']
+    # start of an ID: the one with the most datasets
+    assert [m['ID'] for m in bioshed_vocab.resolve_term( dict(category='target', term='h3k4'))] == ['H3K4me3']
+    assert bioshed_vocab.lookup( dict(category='assay', term='wgbs')) == []
+    assert bioshed_vocab.has_category('Target') and not bioshed_vocab.has_category('biosample')
+
+
+def test_search_string( tmp_path, monkeypatch ):
+    vocab_index( tmp_path, monkeypatch )
+    assert bioshed_vocab.convert_to_search_string( dict(terms='chipseq', category='assay')) == \
+        '?type=Experiment&assay_title=Histone%20ChIP-seq&assay_title=TF%20ChIP-seq'
+    assert bioshed_vocab.convert_to_search_string( dict(terms='breast cancer', category='general')) == '?type=Experiment&searchTerm=breast+cancer'
+
+
+def test_stale_packaged_index_is_recompiled_per_user( tmp_path, monkeypatch ):
+    indexfile = vocab_index( tmp_path, monkeypatch )
+    os.utime(indexfile, (0, 0))
+    assert bioshed_vocab.index_file() == str(tmp_path / 'user' / 'search_encode_vocab.idx')
+    assert [m['ID'] for m in bioshed_vocab.lookup( dict(category='target', term='H3K4me1'))] == ['H3K4me1']